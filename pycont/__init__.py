@@ -5,7 +5,16 @@ Custom library designed to control Tricontinent C-series syringe pumps.
 
 """
 from ._logger import __logger_root_name__
-from .controller import MultiPumpController, C3000Controller
 
 import logging
 logging.getLogger(__logger_root_name__).addHandler(logging.NullHandler())
+
+__all__ = ['MultiPumpController', 'C3000Controller']
+
+
+def __getattr__(name):
+    # The controllers are imported on first use, so that importing pycont (e.g. for a submodule) stays fast
+    if name in __all__:
+        from . import controller
+        return getattr(controller, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,175 @@
+"""
+.. module:: bus
+   :platform: Unix
+   :synopsis: A module used for sharing a serial bus between request classes of different priorities.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque
+from typing import Deque, Tuple
+
+from . import pump_protocol
+from .clock import Clock, SYSTEM_CLOCK
+from .dtprotocol import DTInstructionPacket
+
+#: Requests that must go first, e.g. terminate
+PRIORITY_EMERGENCY = 0
+#: Commands changing the state of the pumps, e.g. moves and valve switches
+PRIORITY_CONTROL = 1
+#: Queries reading the state of the pumps, e.g. status and position polls
+PRIORITY_TELEMETRY = 2
+
+#: Default fraction of the bus time telemetry may use, 1 means no limit
+DEFAULT_TELEMETRY_BUDGET = 1.0
+#: Sliding window over which the telemetry budget is measured (in seconds)
+TELEMETRY_BUDGET_WINDOW = 1.0
+
+
+def packet_priority(packet: DTInstructionPacket) -> int:
+    """
+    Infers the priority class of a packet from its first command.
+
+    Args:
+        packet: The packet to be sent.
+
+    Returns:
+        PRIORITY_EMERGENCY for terminate, PRIORITY_TELEMETRY for reports and PRIORITY_CONTROL otherwise.
+
+    """
+    if not packet.dtcommands:
+        return PRIORITY_CONTROL
+    command = packet.dtcommands[0].command.decode()
+    if command == pump_protocol.CMD_TERMINATE:
+        return PRIORITY_EMERGENCY
+    if command.startswith(pump_protocol.CMD_REPORT_PLUNGER_POSITION) or command == pump_protocol.CMD_REPORT_STATUS:
+        return PRIORITY_TELEMETRY
+    return PRIORITY_CONTROL
+
+
+class BusArbiter:
+    """
+    This class is a lock handing the bus to the most urgent waiting request.
+
+    A request is never granted while a request of a higher class is waiting. Telemetry is also limited to a
+    fraction of the bus time, measured over the last TELEMETRY_BUDGET_WINDOW seconds, so that aggressive polling
+    leaves room for commands. It can be used as a plain lock (acquire/release or with) at control priority.
+
+    Bus time, the budget window and timeouts are measured on the monotonic time of the clock, so that a wall clock
+    adjustment does not distort them and so that simulated buses are arbitrated in simulated time.
+
+    Args:
+        telemetry_budget: Fraction of the bus time telemetry may use, default set to DEFAULT_TELEMETRY_BUDGET (1.0).
+
+        clock: The clock of the pumps on the bus, default set to None (SYSTEM_CLOCK).
+
+    Raises:
+        ValueError: The budget is not in (0, 1].
+
+    """
+    def __init__(self, telemetry_budget: float = DEFAULT_TELEMETRY_BUDGET, clock: Clock = None):
+        if not 0 < telemetry_budget <= 1:
+            raise ValueError('Telemetry budget must be in (0, 1], got {}'.format(telemetry_budget))
+        self.telemetry_budget = telemetry_budget
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        self._condition = threading.Condition()
+        self._locked = False
+        self._holder_priority = PRIORITY_CONTROL
+        self._holder_since = 0.
+        self._waiting = [0, 0, 0]
+        self._telemetry_holds: Deque[Tuple[float, float]] = deque()
+
+    def telemetry_usage(self) -> float:
+        """
+        Gets the fraction of the bus time used by telemetry over the last TELEMETRY_BUDGET_WINDOW seconds.
+        """
+        with self._condition:
+            return self._telemetry_time(self.clock.monotonic()) / TELEMETRY_BUDGET_WINDOW
+
+    def _telemetry_time(self, now: float) -> float:
+        window_start = now - TELEMETRY_BUDGET_WINDOW
+        while self._telemetry_holds and self._telemetry_holds[0][1] < window_start:
+            self._telemetry_holds.popleft()
+        return sum(end - max(start, window_start) for start, end in self._telemetry_holds)
+
+    def _can_acquire(self, priority: int) -> Tuple[bool, float]:
+        """
+        Returns whether the bus can be granted now, and otherwise how long to wait before checking the budget again.
+        """
+        if self._locked or any(self._waiting[:priority]):
+            return False, None
+        if priority == PRIORITY_TELEMETRY and self.telemetry_budget < 1:
+            now = self.clock.monotonic()
+            excess = self._telemetry_time(now) - self.telemetry_budget * TELEMETRY_BUDGET_WINDOW
+            if excess > 0:
+                return False, excess
+        return True, 0.
+
+    def acquire(self, blocking: bool = True, timeout: float = -1, priority: int = PRIORITY_CONTROL) -> bool:
+        """
+        Acquires the bus.
+
+        Args:
+            blocking: Waits for the bus, default set to True.
+
+            timeout: Maximum time to wait (in seconds), -1 for no limit, default set to -1.
+
+            priority: PRIORITY_EMERGENCY, PRIORITY_CONTROL or PRIORITY_TELEMETRY, default set to PRIORITY_CONTROL.
+
+        Returns:
+            True: The bus is acquired.
+
+            False: The bus could not be acquired.
+
+        """
+        deadline = self.clock.monotonic() + timeout if blocking and timeout >= 0 else None
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    granted, retry_in = self._can_acquire(priority)
+                    if granted:
+                        break
+                    if not blocking:
+                        return False
+                    wait_time = retry_in
+                    if deadline is not None:
+                        remaining = deadline - self.clock.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait_time = remaining if wait_time is None else min(wait_time, remaining)
+                    self.clock.wait(self._condition, wait_time)
+            finally:
+                self._waiting[priority] -= 1
+            self._locked = True
+            self._holder_priority = priority
+            self._holder_since = self.clock.monotonic()
+            return True
+
+    def release(self) -> None:
+        """
+        Releases the bus, handing it to the most urgent waiting request.
+        """
+        with self._condition:
+            if self._holder_priority == PRIORITY_TELEMETRY:
+                self._telemetry_holds.append((self._holder_since, self.clock.monotonic()))
+            self._locked = False
+            self.clock.notify_all(self._condition)
+
+    def locked(self) -> bool:
+        """
+        Determines if the bus is currently held.
+        """
+        return self._locked
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
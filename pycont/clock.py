@@ -0,0 +1,317 @@
+"""
+.. module:: clock
+   :platform: Unix
+   :synopsis: A module used for giving the controllers the time, from the wall clock, an accelerated or a virtual one.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Deque, Iterable, List, Optional, Tuple
+
+
+class Clock:
+    """
+    This class gives the time of the wall clock, and waits in it. Controllers take a clock so that simulations can
+    replace it.
+    """
+    def time(self) -> float:
+        """
+        Gets the current time (in seconds).
+        """
+        return time.time()
+
+    def monotonic(self) -> float:
+        """
+        Gets a time that never goes backwards (in seconds), for measuring durations and timeouts.
+        """
+        return time.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        """
+        Waits for some time.
+
+        Args:
+            seconds: The time to wait (in seconds).
+
+        """
+        time.sleep(seconds)
+
+    def wait(self, condition: threading.Condition, timeout: float = None) -> bool:
+        """
+        Waits on a condition held by the caller until it is notified, see notify_all(), or until a timeout.
+
+        Args:
+            condition: The condition, acquired by the caller.
+
+            timeout: Maximum time to wait (in seconds), default set to None (no limit).
+
+        Returns:
+            True: The condition was notified.
+
+            False: The timeout expired first.
+
+        """
+        return condition.wait(timeout)
+
+    def notify_all(self, condition: threading.Condition) -> None:
+        """
+        Wakes up the threads waiting on a condition held by the caller, see wait().
+
+        Args:
+            condition: The condition, acquired by the caller.
+
+        """
+        condition.notify_all()
+
+
+#: The wall clock, used by default
+SYSTEM_CLOCK = Clock()
+
+
+def clock_of(pumps: Iterable) -> Clock:
+    """
+    Gets the clock pumps run on, for the helpers timing their work in the same time as the pumps.
+
+    Args:
+        pumps: The pumps, sharing one clock as those of a MultiPumpController.
+
+    Returns:
+        Clock: The clock of the first pump, SYSTEM_CLOCK if there is none.
+
+    """
+    for pump in pumps:
+        return getattr(pump, 'clock', SYSTEM_CLOCK)
+    return SYSTEM_CLOCK
+
+
+class ScaledClock(Clock):
+    """
+    This class gives a time running time_scale times faster than the wall clock, sleeps are shortened accordingly.
+
+    Args:
+        time_scale: Speed of the time relative to the wall clock, e.g. 10 makes a 10 seconds sleep last 1 second.
+
+    Raises:
+        ValueError: time_scale is not positive.
+
+    """
+    def __init__(self, time_scale: float = 1.):
+        if time_scale <= 0:
+            raise ValueError('Time scale must be positive, got {}'.format(time_scale))
+        self.time_scale = float(time_scale)
+        self._wall_start = time.time()
+        self._monotonic_start = time.monotonic()
+
+    def time(self) -> float:
+        return self._wall_start + (time.time() - self._wall_start) * self.time_scale
+
+    def monotonic(self) -> float:
+        return self._monotonic_start + (time.monotonic() - self._monotonic_start) * self.time_scale
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds / self.time_scale)
+
+    def wait(self, condition: threading.Condition, timeout: float = None) -> bool:
+        return condition.wait(timeout / self.time_scale if timeout is not None else None)
+
+
+class VirtualClock(Clock):
+    """
+    This class gives a time that only moves forward when it is asked to, sleeps return immediately.
+
+    A sleep moves the time to the end of the sleep, which is exact for a single thread of control. Threads sleeping
+    concurrently each move the time to their own wake-up, so they interleave approximately; SimulationClock
+    interleaves them exactly.
+
+    Args:
+        start: The initial time (in seconds), default set to 0.
+
+    """
+    def __init__(self, start: float = 0.):
+        self._now = float(start)
+        self._lock = threading.Lock()
+
+    def time(self) -> float:
+        return self._now
+
+    def monotonic(self) -> float:
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        with self._lock:
+            self._now += max(seconds, 0.)
+
+    def wait(self, condition: threading.Condition, timeout: float = None) -> bool:
+        """
+        Waits on a condition until it is notified, a timeout moves the time to its end and expires at once.
+        """
+        if timeout is None:
+            return condition.wait()
+        self.sleep(timeout)
+        return False
+
+    def advance_to(self, when: float) -> None:
+        """
+        Moves the time forward to a given time, never backwards.
+
+        Args:
+            when: The new time (in seconds).
+
+        """
+        with self._lock:
+            self._now = max(self._now, when)
+
+
+class ClockStopped(BaseException):
+    """
+    Exception raised in the threads waiting on a stopped SimulationClock. It is not an Exception, so that the code
+    the threads run does not handle it as a failure of its own.
+    """
+    pass
+
+
+class _Turn:
+    """
+    A thread waiting for its turn on a SimulationClock.
+    """
+    def __init__(self, lock: threading.Lock, condition: threading.Condition = None):
+        self.resumed = threading.Condition(lock)
+        self.condition = condition
+        self.ready = False
+        self.notified = False
+
+
+class SimulationClock(VirtualClock):
+    """
+    This class is a VirtualClock running concurrent threads as a discrete-event simulation.
+
+    The threads taking part take turns: one runs at a time, until it sleeps or waits on the clock, and then hands over
+    to the next thread ready to run, in the order they became ready. When none is ready, the time moves forward to the
+    earliest wake-up. Each thread thus sees the time of its own events, and runs with the same inputs give the same
+    result. Threads take part from add_participant() to leave(), and must only block on the clock (see wait()) or on
+    locks released before they do.
+
+    Args:
+        start: The initial time (in seconds), default set to 0.
+
+    """
+    def __init__(self, start: float = 0.):
+        super().__init__(start)
+        self._running: Optional[_Turn] = None
+        self._ready: Deque[_Turn] = deque()
+        self._wake_ups: List[Tuple[float, int, _Turn]] = []
+        self._waiting: List[_Turn] = []
+        self._sequence = itertools.count()
+        self._stopped = False
+
+    def add_participant(self) -> _Turn:
+        """
+        Adds a thread taking part, called before the thread starts so that the time waits for it.
+
+        Returns:
+            The turn of the thread, passed to enter() by the thread itself.
+
+        """
+        with self._lock:
+            turn = _Turn(self._lock)
+            self._make_ready(turn)
+            return turn
+
+    def enter(self, turn: _Turn) -> None:
+        """
+        Waits for the first turn of the calling thread, see add_participant().
+
+        Raises:
+            ClockStopped: The clock was stopped.
+
+        """
+        with self._lock:
+            self._check_stopped()
+            if self._running is None:
+                self._hand_over()
+            self._wait_for(turn)
+
+    def leave(self) -> None:
+        """
+        Removes the calling thread from the participants, handing over to the next one.
+        """
+        with self._lock:
+            self._hand_over()
+
+    def stop(self) -> None:
+        """
+        Ends the simulation, the threads waiting on the clock raise ClockStopped.
+        """
+        with self._lock:
+            self._stopped = True
+            for turn in list(self._ready) + [turn for _, _, turn in self._wake_ups] + self._waiting:
+                turn.resumed.notify_all()
+
+    def sleep(self, seconds: float) -> None:
+        with self._lock:
+            self._check_stopped()
+            turn = _Turn(self._lock)
+            heapq.heappush(self._wake_ups, (self._now + max(seconds, 0.), next(self._sequence), turn))
+            self._hand_over()
+            self._wait_for(turn)
+
+    def wait(self, condition: threading.Condition, timeout: float = None) -> bool:
+        with self._lock:
+            self._check_stopped()
+            turn = _Turn(self._lock, condition)
+            self._waiting.append(turn)
+            if timeout is not None:
+                heapq.heappush(self._wake_ups, (self._now + max(timeout, 0.), next(self._sequence), turn))
+            self._hand_over()
+        condition.release()
+        try:
+            with self._lock:
+                self._wait_for(turn)
+        finally:
+            condition.acquire()
+        return turn.notified
+
+    def notify_all(self, condition: threading.Condition) -> None:
+        with self._lock:
+            for turn in [turn for turn in self._waiting if turn.condition is condition]:
+                turn.notified = True
+                self._make_ready(turn)
+        condition.notify_all()
+
+    def _make_ready(self, turn: _Turn) -> None:
+        if turn.ready:
+            return
+        turn.ready = True
+        if turn.condition is not None:
+            self._waiting.remove(turn)
+        self._ready.append(turn)
+
+    def _hand_over(self) -> None:
+        self._running = None
+        if self._stopped:
+            return
+        while not self._ready and self._wake_ups:
+            when, _, turn = heapq.heappop(self._wake_ups)
+            if not turn.ready:  # Otherwise notified before its timeout
+                self._now = max(self._now, when)
+                self._make_ready(turn)
+        if self._ready:
+            self._running = self._ready.popleft()
+            self._running.resumed.notify()
+
+    def _wait_for(self, turn: _Turn) -> None:
+        while self._running is not turn:
+            self._check_stopped()
+            turn.resumed.wait()
+
+    def _check_stopped(self) -> None:
+        if self._stopped:
+            raise ClockStopped
@@ -9,17 +9,37 @@
 
 # -*- coding: utf-8 -*-
 
-import time
+import copy
 import json
 from pathlib import Path
-from typing import Dict, Union, Optional, List, Any, Tuple
+from typing import Dict, Union, Optional, List, Any, Set, Tuple, TYPE_CHECKING
 
-import serial
 import threading
 
 from ._logger import create_logger
 
 from . import pump_protocol
+from .clock import Clock, ScaledClock, VirtualClock, SYSTEM_CLOCK
+from .bus import BusArbiter, DEFAULT_TELEMETRY_BUDGET, packet_priority
+from .dispatch import DispenseQueue, DEFAULT_REFILL_THRESHOLD
+from .health import HealthMonitor, DEFAULT_CHECK_PERIOD, DEFAULT_TIMEOUT_THRESHOLD
+from .initialization import InitializationEngine
+from .liquid import LiquidClass, SpeedTuner, DEFAULT_TUNING_SAFETY_FACTOR
+from .migration import BaudrateMigration
+from .motion import MotionProfile, MOTION_PROFILE_FACTORY
+from .network import FluidicNetwork, Route
+from .recipe import Recipe, RecipeRunner, RecipeReport
+from .registry import PumpRegistry, Hub
+from .resilience import RetryPolicy, CircuitBreaker
+from .scheduler import PumpScheduler, POLICY_EDF
+from .state import StateSnapshotter, restore_snapshot, DEFAULT_SNAPSHOT_PERIOD
+from .virtual import VirtualPump
+
+if TYPE_CHECKING:
+    import serial
+
+    from .dryrun import DryRun
+    from .recording import TrafficRecorder
 
 #: Represents the Broadcast of the C3000
 from .dtprotocol import DTInstructionPacket
@@ -71,6 +91,13 @@ N_STEP_MICRO_STEP_MODE_2 = 24000
 MAX_TOP_VELOCITY_MICRO_STEP_MODE_0 = 6000
 #: The maximum top velocity for Microstep Mode 2
 MAX_TOP_VELOCITY_MICRO_STEP_MODE_2 = 48000
+#: The minimum top velocity the pumps accept in Microstep Mode 0
+MIN_TOP_VELOCITY_MICRO_STEP_MODE_0 = 5
+#: The minimum top velocity the pumps accept in Microstep Mode 2
+MIN_TOP_VELOCITY_MICRO_STEP_MODE_2 = 40
+
+#: Longest time a call waits for a lost port to be reconnected by a HealthMonitor (in seconds)
+RECONNECT_WAIT = 30
 
 #: default Input/Output (I/O) Baudrate
 DEFAULT_IO_BAUDRATE = 9600
@@ -83,6 +110,10 @@ WAIT_SLEEP_TIME = 0.1
 MAX_REPEAT_WRITE_AND_READ = 10
 #: Sets the maximum time to repeat a specific operation
 MAX_REPEAT_OPERATION = 10
+#: Sets the maximum time to repeat a presence check, kept low so that checking an absent pump is quick
+MAX_REPEAT_PING = 2
+#: Default period after which the plunger model is re-synced with a real read (in seconds), None to never expire
+DEFAULT_POSITION_RESYNC_PERIOD = None
 
 
 class PumpIO:
@@ -90,27 +121,46 @@ class PumpIO:
     This class deals with the pump I/O instructions.
 
     Args:
-        port: The device name (depending on operating system. e.g. /dev/ttyUSB0 on GNU/Linux or COM3 on Windows.)
+        port: The device name (depending on operating system. e.g. /dev/ttyUSB0 on GNU/Linux or COM3 on Windows.),
+            or a URL, e.g. tcp://labpc2:7250 for a bus bridged from another host, see transport.open_transport()
 
         baudrate: Baudrate of the communication, default set to DEFAULT_IO_BAUDRATE(9600)
 
         timeout: The timeout of communication, default set to DEFAULT_IO_TIMEOUT(1)
 
+        telemetry_budget: Fraction of the bus time status and position queries may use, default set to
+            DEFAULT_TELEMETRY_BUDGET (1.0, no limit)
+
+        clock: The clock of the pumps on the hub, timing the bus arbitration, default set to None (SYSTEM_CLOCK)
+
     """
-    def __init__(self, port: str, baudrate: int = DEFAULT_IO_BAUDRATE, timeout: float = DEFAULT_IO_TIMEOUT):
+    def __init__(self, port: str, baudrate: int = DEFAULT_IO_BAUDRATE, timeout: float = DEFAULT_IO_TIMEOUT,
+                 telemetry_budget: float = DEFAULT_TELEMETRY_BUDGET, clock: Clock = None):
         self.logger = create_logger(self.__class__.__name__)
 
-        self.lock = threading.Lock()
+        # Commands go ahead of queued queries, see bus.BusArbiter
+        self.lock = BusArbiter(telemetry_budget, clock)
 
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
-        self._serial = None  # type: Union[serial.serialposix.Serial, serial.serialwin32.Serial]
+        self._serial = None  # type: Optional[serial.Serial]
+        self._open_lock = threading.Lock()
+
+        # Connection health, watched by health.HealthMonitor. When supervised, calls wait for a lost port to be
+        # reconnected instead of failing.
+        self.supervised = False
+        self.connected = threading.Event()
+        self.connected.set()
+        self.consecutive_timeouts = 0
+        # Addresses that timed out since the last answer on the port, one pump being off does not make the port lost
+        self.timed_out_addresses: Set[str] = set()
+        self.last_error: Optional[Exception] = None
 
-        self.open(port, baudrate, timeout)
+        # The port is opened on first use, see connect(), so that a hub the script does not use is never opened
 
     @classmethod
-    def from_config(cls, io_config: Dict) -> 'PumpIO':
+    def from_config(cls, io_config: Dict, clock: Clock = None) -> 'PumpIO':
         """
         Sets details laid out in the configuration .json file
 
@@ -119,6 +169,8 @@ class PumpIO:
 
             io_config: Dictionary holding the configuration data.
 
+            clock: The clock of the pumps on the hub, default set to None (SYSTEM_CLOCK).
+
         Returns:
             PumpIO: New PumpIO object with the variables set from the configuration file.
 
@@ -135,7 +187,12 @@ class PumpIO:
         else:
             timeout = DEFAULT_IO_TIMEOUT
 
-        return cls(port, baudrate, timeout)
+        if 'telemetry_budget' in io_config:
+            telemetry_budget = io_config['telemetry_budget']
+        else:
+            telemetry_budget = DEFAULT_TELEMETRY_BUDGET
+
+        return cls(port, baudrate, timeout, telemetry_budget, clock)
 
     @classmethod
     def from_configfile(cls, io_configfile: Union[str, Path]) -> 'PumpIO':
@@ -179,28 +236,94 @@ class PumpIO:
         Opens a communication with the hardware.
 
         Args:
-            port: The port number on which the communication will take place.
+            port: The device name or URL on which the communication will take place, see transport.open_transport().
 
             baudrate: The baudrate of the communication, default set to DEFAULT_IO_BAUDRATE(9600).
 
             timeout: The timeout of the communication, default set to DEFAULT_IO_TIMEOUT(1).
 
         """
-        self._serial = serial.Serial(port, baudrate, timeout=timeout)
+        from .transport import open_transport
+
+        self._serial = open_transport(port, baudrate, timeout)
         self.logger.debug("Opening port '%s'", self.port,
                           extra={'port': self.port,
                                  'baudrate': self.baudrate,
                                  'timeout': self.timeout})
 
+    def connect(self) -> None:
+        """
+        Opens the communication if it is not open yet, calls to the pumps do it on first use.
+
+        Raises:
+            serial.SerialException: The port cannot be opened.
+
+        """
+        if self._serial is None:
+            with self._open_lock:
+                if self._serial is None:
+                    self.open(self.port, self.baudrate, self.timeout)
+
+    @property
+    def is_open(self) -> bool:
+        """
+        Whether the communication is open, see connect().
+        """
+        return self._serial is not None
+
+    def connection_lost(self, error: Exception) -> None:
+        """
+        Records an I/O error on the port, calls wait for the reconnection if the port is supervised.
+
+        Args:
+            error: The error raised by the serial port.
+
+        """
+        self.logger.debug("Connection lost on {}: {!r}".format(self.port, error))
+        self.last_error = error
+        if self.supervised:
+            self.connected.clear()
+
+    def mark_connected(self) -> None:
+        """
+        Records that the port works again, waiting calls carry on.
+        """
+        self.last_error = None
+        self.consecutive_timeouts = 0
+        self.timed_out_addresses.clear()
+        self.connected.set()
+
+    def reopen(self, baudrate: int = None, timeout: float = None) -> None:
+        """
+        Closes and opens the communication again, waiting for the bus to be free. Pumps using this PumpIO keep it.
+
+        Args:
+            baudrate: The new baudrate of the communication, default set to None (unchanged).
+
+            timeout: The new timeout of the communication, default set to None (unchanged).
+
+        """
+        with self.lock:
+            try:
+                self.close()
+            except OSError:  # serial.SerialException included, the device is already gone
+                self._serial = None
+            if baudrate is not None:
+                self.baudrate = baudrate
+            if timeout is not None:
+                self.timeout = timeout
+            self.open(self.port, self.baudrate, self.timeout)
+
     def close(self) -> None:
         """
         Closes the communication with the hardware.
         """
-        # This happens when serial.Serial fails in PumpIO.open(), so that PumpIO._serial is None.
+        # This happens when the port was never used, or when serial.Serial fails in PumpIO.open().
         if self._serial is None:
             return
 
-        self._serial.close()
+        serial_port, self._serial = self._serial, None
+        serial_port.close()
         self.logger.debug("Closing port '%s'", self.port,
                           extra={'port': self.port,
                                  'baudrate': self.baudrate,
@@ -242,31 +365,50 @@ class PumpIO:
             self.logger.debug("Readline timeout!")
             raise PumpIOTimeOutError
 
-    def write_and_readline(self, packet: DTInstructionPacket) -> bytes:
+    def write_and_readline(self, packet: DTInstructionPacket, priority: int = None) -> bytes:
         """
         Writes a packet along the serial communication and waits for a response.
 
         Args:
             packet (DTInstructionPacket): The packet to be written.
 
+            priority: Priority class on the bus, default set to None (inferred, see bus.packet_priority).
+
         .. note:: Unsure if this is the correct packet type (GAK).
 
         Returns:
             response: The received response.
 
         Raises:
-            PumpIOTimeOutError: If the response time is greater than the timeout threshold.
+            PumpIOTimeOutError: If the response time is greater than the timeout threshold, or the port is lost and
+                supervised (the caller retries once it is reconnected).
+
+            serial.SerialException: The port cannot be opened, or is lost, and is not supervised.
         """
-        self.lock.acquire()
-        self.flush_input()
-        self.write(packet)
+        if self.supervised and not self.connected.wait(RECONNECT_WAIT):
+            raise PumpIOTimeOutError
+        if priority is None:
+            priority = packet_priority(packet)
+        self.lock.acquire(priority=priority)
         try:
+            self.connect()
+            self.flush_input()
+            self.write(packet)
             response = self.readline()
+        except PumpIOTimeOutError:
+            self.consecutive_timeouts += 1
+            self.timed_out_addresses.add(packet.address.decode())
+            raise
+        except OSError as err:  # serial.SerialException included
+            self.connection_lost(err)
+            if not self.supervised:
+                raise
+            raise PumpIOTimeOutError from err
+        finally:
             self.lock.release()
-            return response
-        except PumpIOTimeOutError as err:
-            self.lock.release()
-            raise err
+        self.consecutive_timeouts = 0
+        self.timed_out_addresses.clear()
+        return response
 
 
 class VirtualPumpIO(PumpIO):
@@ -286,7 +428,7 @@ class VirtualPumpIO(PumpIO):
     def readline(self):
         raise PumpIOTimeOutError
 
-    def write_and_readline(self, packet):
+    def write_and_readline(self, packet, priority=None):
         raise PumpIOTimeOutError
 
 
@@ -304,6 +446,13 @@ class ControllerRepeatedError(Exception):
     pass
 
 
+class PumpUnavailableError(ControllerRepeatedError):
+    """
+    Exception for when a pump is not contacted because it stopped answering, see resilience.CircuitBreaker.
+    """
+    pass
+
+
 class PumpHWError(Exception):
     """
     Exception for when the pump encounters an hardware error.
@@ -356,16 +505,44 @@ class C3000Controller(object):
 
         initialize_valve_position: Sets the valve position, default set to VALVE_INPUT ('I')
 
+        position_resync_period: Time after which the plunger model is re-synced with a real read (in seconds),
+            default set to DEFAULT_POSITION_RESYNC_PERIOD (None, only after errors, terminate and initialisation)
+
+        motion_profiles: Named acceleration profiles, e.g. {"aliquot": {"start_velocity": 8000, "slope": 20,
+            "cutoff_velocity": 8000}}, see MotionProfile, default set to None
+
+        motion_profile: Name of the profile used by moves that do not select one, default set to None (the factory
+            profile, only sent to the pump after another profile was used)
+
+        liquid_classes: Tuned velocities per liquid, e.g. {"glycerol": {"speed_in": 3000, "speed_out": 9000}},
+            see LiquidClass and tune_liquid_class(), default set to None
+
+        liquid_class: Name of the liquid currently handled by the pump, its velocities replace the default top
+            velocity in pump() and deliver(), default set to None
+
+        retry_policy: How failed exchanges are retried, e.g. {"attempts": 4, "backoff": 0.05, "jitter": 0.5}, see
+            RetryPolicy, default set to None (MAX_REPEAT_WRITE_AND_READ immediate attempts)
+
+        circuit_breaker: When to stop contacting the pump after failed exchanges, e.g. {"failure_threshold": 3,
+            "cooldown": 5}, see CircuitBreaker, False to disable, default set to None (default values)
+
+        clock: The clock used to wait and to time the plunger model, default set to None (SYSTEM_CLOCK)
+
     Raises:
-        ValueError: Invalid microstep mode.
+        ValueError: Invalid microstep mode, or invalid motion profile.
 
     """
     def __init__(self, pump_io: PumpIO, name: str, address: str, total_volume: float,
                  micro_step_mode: int = MICRO_STEP_MODE_2, top_velocity: int = 6000,
-                 initialize_valve_position: str = VALVE_INPUT):
+                 initialize_valve_position: str = VALVE_INPUT,
+                 position_resync_period: Optional[float] = DEFAULT_POSITION_RESYNC_PERIOD,
+                 motion_profiles: Dict[str, Dict] = None, motion_profile: str = None,
+                 liquid_classes: Dict[str, Dict] = None, liquid_class: str = None,
+                 retry_policy: Dict = None, circuit_breaker: Union[Dict, bool] = None, clock: Clock = None):
         self.logger = create_logger(self.__class__.__name__)
 
         self._io = pump_io
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
 
         self.name = name
 
@@ -387,6 +564,46 @@ class C3000Controller(object):
 
         self.default_top_velocity = top_velocity
 
+        # Plunger model, the position the plunger reaches once the moves issued by this controller are done.
+        # It is None when unknown, e.g. after an error, and is then re-synced with a real read on next use.
+        self.position_resync_period = position_resync_period
+        self._plunger_steps: Optional[int] = None
+        self._plunger_synced_at = 0.
+        self._plunger_moving = False
+
+        # Values last read from the pump, by name ('initialized', 'top_velocity', 'valve_position' (raw) and
+        # 'eeprom_config'), saved by state.StateSnapshotter
+        self.last_known: Dict[str, Any] = {}
+
+        # Name of the profile last sent to the pump, None while the pump holds the settings it was found with
+        self._active_motion_profile: Optional[str] = None
+        self.motion_profiles = {MOTION_PROFILE_FACTORY: MotionProfile.factory(self.micro_step_mode)}
+        if motion_profiles is not None:
+            for profile_name, profile_config in motion_profiles.items():
+                self.add_motion_profile(profile_name, MotionProfile.from_config(profile_config))
+        if motion_profile is not None and motion_profile not in self.motion_profiles:
+            raise ValueError('Motion profile {} is not defined for pump {}'.format(motion_profile, self.name))
+        self.default_motion_profile = motion_profile
+
+        self.liquid_classes: Dict[str, LiquidClass] = {}
+        if liquid_classes is not None:
+            for liquid_name, liquid_config in liquid_classes.items():
+                self.liquid_classes[liquid_name] = LiquidClass.from_config(liquid_config)
+        if liquid_class is not None and liquid_class not in self.liquid_classes:
+            raise ValueError('Liquid class {} is not defined for pump {}'.format(liquid_class, self.name))
+        self.liquid_class = liquid_class
+
+        if retry_policy is not None:
+            self.retry_policy = RetryPolicy.from_config(retry_policy)
+        else:
+            self.retry_policy = RetryPolicy(MAX_REPEAT_WRITE_AND_READ)
+        if circuit_breaker is False:
+            self.circuit_breaker: Optional[CircuitBreaker] = None
+        else:
+            breaker_config = circuit_breaker if isinstance(circuit_breaker, dict) else {}  # None or True: defaults
+            self.circuit_breaker = CircuitBreaker.from_config(breaker_config, probe=self._probe, name=self.name,
+                                                              clock=self.clock)
+
     @classmethod
     def from_config(cls, pump_io: PumpIO, pump_name: str, pump_config: Dict) -> 'C3000Controller':
         """
@@ -413,15 +630,20 @@ class C3000Controller(object):
 
         return cls(pump_io, pump_name, **pump_config)
 
-    def write_and_read_from_pump(self, packet: DTInstructionPacket, max_repeat: int = MAX_REPEAT_WRITE_AND_READ)\
-            -> Tuple[str, str, str]:
+    def write_and_read_from_pump(self, packet: DTInstructionPacket, max_repeat: int = None,
+                                 priority: int = None) -> Tuple[str, str, str]:
         """
         Writes packets to and reads the response from the pump.
 
+        Failed attempts are retried following the retry policy of the pump, and the pump is not contacted at all
+        while its circuit breaker is open.
+
         Args:
             packet: The packet to be written.
 
-            max_repeat: The maximum time to repeat the read/write operation.
+            max_repeat: The maximum time to repeat the read/write operation, default set to None (retry_policy).
+
+            priority: Priority class on the bus, default set to None (inferred from the packet).
 
         Returns:
             decoded_response: The decoded response.
@@ -431,21 +653,82 @@ class C3000Controller(object):
 
             ControllerRepeatedError: Error in decoding.
 
+            PumpUnavailableError: The pump stopped answering and is not contacted until it answers a probe again.
+
         """
-        for i in range(max_repeat):
-            self.logger.debug("Write and read {}/{}".format(i + 1, max_repeat))
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+            raise PumpUnavailableError('Pump {} is not answering, circuit open'.format(self.name))
+        try:
+            decoded_response = self._exchange(packet, max_repeat, priority)
+        except ControllerRepeatedError:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_failure()
+            raise
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_success()
+        return decoded_response
+
+    def _exchange(self, packet: DTInstructionPacket, max_repeat: int = None,
+                  priority: int = None) -> Tuple[str, str, str]:
+        """
+        Sends a packet and decodes the reply, retrying following the retry policy. See write_and_read_from_pump().
+        """
+        attempts = max_repeat if max_repeat is not None else self.retry_policy.attempts
+        for i in range(attempts):
+            if i > 0:
+                self.clock.sleep(self.retry_policy.delay(i))  # The bus is free meanwhile
+            self.logger.debug("Write and read {}/{}".format(i + 1, attempts))
             try:
-                response = self._io.write_and_readline(packet)
+                response = self._io.write_and_readline(packet, priority=priority)
                 decoded_response = self._protocol.decode_packet(response)
                 if decoded_response is not None:
+                    if decoded_response[1] in pump_protocol.ERROR_STATUSES_IDLE + pump_protocol.ERROR_STATUSES_BUSY:
+                        self.invalidate_plunger_model()
                     return decoded_response
                 else:
                     self.logger.debug("Decode error for {!r}, trying again!".format(response))
             except PumpIOTimeOutError:
                 self.logger.debug("Timeout, trying again!")
         self.logger.debug("Too many failed communication!")
+        self.invalidate_plunger_model()
         raise ControllerRepeatedError('Repeated Error from pump {}'.format(self.name))
 
+    def _probe(self) -> bool:
+        """
+        Sends a single status request bypassing the circuit breaker, used by it to probe the pump.
+        """
+        try:
+            self._exchange(self._protocol.forge_report_status_packet(), max_repeat=1)
+            return True
+        except ControllerRepeatedError:
+            return False
+
+    def reset_circuit_breaker(self) -> None:
+        """
+        Closes the circuit breaker of the pump, e.g. after its port was reopened.
+        """
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.reset()
+
+    def ping(self, max_repeat: int = MAX_REPEAT_PING) -> bool:
+        """
+        Determines if the pump answers on the bus.
+
+        Args:
+            max_repeat: The maximum number of attempts, default set to MAX_REPEAT_PING (2).
+
+        Returns:
+            True: The pump answered a status request.
+
+            False: The pump did not answer.
+
+        """
+        try:
+            self.write_and_read_from_pump(self._protocol.forge_report_status_packet(), max_repeat=max_repeat)
+            return True
+        except ControllerRepeatedError:
+            return False
+
     def volume_to_step(self, volume_in_ml: float) -> int:
         """
         Determines the number of steps for a given volume.
@@ -488,6 +771,7 @@ class C3000Controller(object):
         report_status_packet = self._protocol.forge_report_status_packet()
         (_, status, _) = self.write_and_read_from_pump(report_status_packet)
         if status == pump_protocol.STATUS_IDLE_ERROR_FREE:
+            self._plunger_moving = False
             return True
         elif status == pump_protocol.STATUS_BUSY_ERROR_FREE:
             return False
@@ -518,7 +802,7 @@ class C3000Controller(object):
         Waits until the pump is not busy for WAIT_SLEEP_TIME, default set to 0.1
         """
         while self.is_busy():
-            time.sleep(WAIT_SLEEP_TIME)
+            self.clock.sleep(WAIT_SLEEP_TIME)
 
     def is_initialized(self) -> bool:
         """
@@ -532,7 +816,8 @@ class C3000Controller(object):
         """
         initialized_packet = self._protocol.forge_report_initialized_packet()
         (_, _, init_status) = self.write_and_read_from_pump(initialized_packet)
-        return bool(int(init_status))
+        self.last_known['initialized'] = bool(int(init_status))
+        return self.last_known['initialized']
 
     def smart_initialize(self, valve_position: str = None, secure: bool = True) -> None:
         """
@@ -588,7 +873,9 @@ class C3000Controller(object):
             wait: Whether or not to wait until the pump is idle, default set to True.
 
         """
-        self.write_and_read_from_pump(self._protocol.forge_initialize_valve_right_packet(operand_value))
+        packet = self._protocol.forge_initialize_valve_right_packet(operand_value)
+        (_, status, _) = self.write_and_read_from_pump(packet)
+        self.track_plunger_move(pump_protocol.CMD_MOVE_TO, 0, status)
         if wait:
             self.wait_until_idle()
 
@@ -602,7 +889,9 @@ class C3000Controller(object):
             wait: Whether or not to wait until the pump is idle, default set to True.
 
         """
-        self.write_and_read_from_pump(self._protocol.forge_initialize_valve_left_packet(operand_value))
+        packet = self._protocol.forge_initialize_valve_left_packet(operand_value)
+        (_, status, _) = self.write_and_read_from_pump(packet)
+        self.track_plunger_move(pump_protocol.CMD_MOVE_TO, 0, status)
         if wait:
             self.wait_until_idle()
 
@@ -623,7 +912,9 @@ class C3000Controller(object):
             else:
                 operand_value = 0
 
-        self.write_and_read_from_pump(self._protocol.forge_initialize_no_valve_packet(operand_value))
+        packet = self._protocol.forge_initialize_no_valve_packet(operand_value)
+        (_, status, _) = self.write_and_read_from_pump(packet)
+        self.track_plunger_move(pump_protocol.CMD_MOVE_TO, 0, status)
         if wait:
             self.wait_until_idle()
 
@@ -664,6 +955,34 @@ class C3000Controller(object):
 
         """
         self.write_and_read_from_pump(self._protocol.forge_microstep_mode_packet(micro_step_mode))
+        self.invalidate_plunger_model()  # The position is reported in the steps of the new mode
+        self._active_motion_profile = None  # Profile velocities are in the steps of the mode they were set in
+
+    @property
+    def max_top_velocity(self) -> int:
+        """
+        Gets the maximum top velocity allowed in the current microstep mode.
+
+        Returns:
+            max_top_velocity: The maximum top velocity (steps/second).
+
+        """
+        if self.micro_step_mode == MICRO_STEP_MODE_0:
+            return MAX_TOP_VELOCITY_MICRO_STEP_MODE_0
+        return MAX_TOP_VELOCITY_MICRO_STEP_MODE_2
+
+    @property
+    def min_top_velocity(self) -> int:
+        """
+        Gets the minimum top velocity the pump accepts in the current microstep mode.
+
+        Returns:
+            min_top_velocity: The minimum top velocity (steps/second).
+
+        """
+        if self.micro_step_mode == MICRO_STEP_MODE_0:
+            return MIN_TOP_VELOCITY_MICRO_STEP_MODE_0
+        return MIN_TOP_VELOCITY_MICRO_STEP_MODE_2
 
     def check_top_velocity_within_range(self, top_velocity: int) -> bool:
         """
@@ -679,12 +998,7 @@ class C3000Controller(object):
             ValueError: Top velocity is out of range.
 
         """
-        if self.micro_step_mode == MICRO_STEP_MODE_0:
-            max_range = MAX_TOP_VELOCITY_MICRO_STEP_MODE_0
-        elif self.micro_step_mode == MICRO_STEP_MODE_2:
-            max_range = MAX_TOP_VELOCITY_MICRO_STEP_MODE_2
-
-        if top_velocity in range(1, max_range + 1):
+        if top_velocity in range(1, self.max_top_velocity + 1):
             return True
         else:
             raise ValueError('Top velocity {} is not in range'.format(top_velocity))
@@ -721,6 +1035,69 @@ class C3000Controller(object):
         if self.get_top_velocity() != self.default_top_velocity:
             self.set_top_velocity(self.default_top_velocity, secure=secure)
 
+    def ensure_liquid_top_velocity(self, direction: str, secure: bool = True) -> None:
+        """
+        Ensures that the top velocity is the one tuned for the current liquid class, or the default top velocity.
+
+        Args:
+            direction: CMD_PUMP to aspirate, CMD_DELIVER to dispense.
+
+            secure: Ensures that everything is correct, default set to True.
+
+        """
+        speed = self.liquid_classes[self.liquid_class].speed(direction) if self.liquid_class is not None else None
+        if speed is not None:
+            self.set_top_velocity(speed, secure=secure)
+        else:
+            self.ensure_default_top_velocity(secure=secure)
+
+    def set_liquid_class(self, liquid_name: str, liquid_class: LiquidClass = None) -> None:
+        """
+        Sets the liquid currently handled by the pump.
+
+        Args:
+            liquid_name: The name of the liquid, None to go back to the default top velocity.
+
+            liquid_class: The velocities for this liquid, default set to None (the ones already known for it).
+
+        Raises:
+            ValueError: No velocities are known for this liquid.
+
+        """
+        if liquid_class is not None:
+            self.liquid_classes[liquid_name] = liquid_class
+        if liquid_name is not None and liquid_name not in self.liquid_classes:
+            raise ValueError('Liquid class {} is not defined for pump {}'.format(liquid_name, self.name))
+        self.liquid_class = liquid_name
+
+    def tune_liquid_class(self, liquid_name: str, from_valve: str, to_valve: str, test_volume: float = None,
+                          safety_factor: float = DEFAULT_TUNING_SAFETY_FACTOR) -> LiquidClass:
+        """
+        Searches the highest aspirate and dispense velocities free of plunger overload for a liquid, see SpeedTuner.
+
+        The pump must be initialised and primed with the liquid, liquid is moved from from_valve to to_valve. The
+        tuned velocities are kept under liquid_name and the pump is set to handle this liquid.
+
+        Args:
+            liquid_name: The name of the liquid.
+
+            from_valve: The valve position the liquid is aspirated from.
+
+            to_valve: The valve position the liquid is dispensed to.
+
+            test_volume: Volume of each test stroke (in mL), default set to None (half the syringe).
+
+            safety_factor: Fraction of the highest stall-free velocity kept, default set to
+                DEFAULT_TUNING_SAFETY_FACTOR (0.8).
+
+        Returns:
+            LiquidClass: The tuned velocities.
+
+        """
+        liquid_class = SpeedTuner(self, from_valve, to_valve, test_volume, safety_factor).run()
+        self.set_liquid_class(liquid_name, liquid_class)
+        return liquid_class
+
     def set_top_velocity(self, top_velocity: int, max_repeat: int = MAX_REPEAT_OPERATION, secure: bool = True) -> bool:
         """
         Sets the top velocity for the pump.
@@ -746,6 +1123,7 @@ class C3000Controller(object):
                 self.logger.debug("Top velocity not set, change attempt {}/{}".format(i + 1, max_repeat))
             self.check_top_velocity_within_range(top_velocity)
             self.write_and_read_from_pump(self._protocol.forge_top_velocity_packet(top_velocity))
+            self.last_known['top_velocity'] = top_velocity
             # if do not want to wait and check things went well, return now
             if secure is False:
                 return True
@@ -763,8 +1141,175 @@ class C3000Controller(object):
         """
         top_velocity_packet = self._protocol.forge_report_peak_velocity_packet()
         (_, _, top_velocity) = self.write_and_read_from_pump(top_velocity_packet)
+        self.last_known['top_velocity'] = int(top_velocity)
         return int(top_velocity)
 
+    def add_motion_profile(self, profile_name: str, motion_profile: MotionProfile) -> None:
+        """
+        Adds (or replaces) a named acceleration profile.
+
+        Args:
+            profile_name: The name of the profile, used to select it for a move.
+
+            motion_profile: The profile.
+
+        Raises:
+            ValueError: A value of the profile is out of range.
+
+        """
+        motion_profile.check_within_range(self.micro_step_mode)
+        self.motion_profiles[profile_name] = motion_profile
+        if profile_name == self._active_motion_profile:
+            self._active_motion_profile = None  # The pump holds the previous values
+
+    def get_motion_profile(self, profile_name: str = None) -> MotionProfile:
+        """
+        Gets a named acceleration profile.
+
+        Args:
+            profile_name: The name of the profile, default set to None (the default profile of the pump).
+
+        Returns:
+            MotionProfile: The profile.
+
+        Raises:
+            ValueError: Unknown profile.
+
+        """
+        if profile_name is None:
+            profile_name = self.default_motion_profile or MOTION_PROFILE_FACTORY
+        if profile_name not in self.motion_profiles:
+            raise ValueError('Motion profile {} is not defined for pump {}'.format(profile_name, self.name))
+        return self.motion_profiles[profile_name]
+
+    def set_start_velocity(self, start_velocity: int) -> None:
+        """
+        Sets the start velocity for the pump.
+
+        Args:
+            start_velocity: The start velocity (steps/second).
+
+        """
+        self.write_and_read_from_pump(self._protocol.forge_start_velocity_packet(start_velocity))
+        self._active_motion_profile = None
+
+    def get_start_velocity(self) -> int:
+        """
+        Gets the current start velocity.
+
+        Returns:
+            start_velocity: The current start velocity (steps/second).
+
+        """
+        (_, _, start_velocity) = self.write_and_read_from_pump(self._protocol.forge_report_start_velocity_packet())
+        return int(start_velocity)
+
+    def set_slope(self, slope: int) -> None:
+        """
+        Sets the slope code of the acceleration and deceleration ramps, the pump cannot report it back.
+
+        Args:
+            slope: The slope code, from 1 to 20.
+
+        """
+        self.write_and_read_from_pump(self._protocol.forge_slope_packet(slope))
+        self._active_motion_profile = None
+
+    def set_cutoff_velocity(self, cutoff_velocity: int) -> None:
+        """
+        Sets the cutoff velocity for the pump.
+
+        Args:
+            cutoff_velocity: The cutoff velocity (steps/second).
+
+        """
+        self.write_and_read_from_pump(self._protocol.forge_cutoff_velocity_packet(cutoff_velocity))
+        self._active_motion_profile = None
+
+    def get_cutoff_velocity(self) -> int:
+        """
+        Gets the current cutoff velocity.
+
+        Returns:
+            cutoff_velocity: The current cutoff velocity (steps/second).
+
+        """
+        (_, _, cutoff_velocity) = self.write_and_read_from_pump(self._protocol.forge_report_cutoff_velocity_packet())
+        return int(cutoff_velocity)
+
+    def set_motion_profile(self, profile_name: str, max_repeat: int = MAX_REPEAT_OPERATION,
+                           secure: bool = True) -> bool:
+        """
+        Sends a named acceleration profile to the pump, in one packet.
+
+        Args:
+            profile_name: The name of the profile.
+
+            max_repeat: Maximum number of times to repeat an operation, default set to MAX_REPEAT_OPERATION (10).
+
+            secure: Ensures that everything is correct, the start and cutoff velocities are read back.
+
+        Returns:
+            True: The profile has been set.
+
+        Raises:
+            ValueError: Unknown profile.
+
+            ControllerRepeatedError: Too many failed attempts at setting the profile.
+
+        """
+        motion_profile = self.get_motion_profile(profile_name)
+        packet = self._protocol.forge_motion_profile_packet(motion_profile.start_velocity, motion_profile.slope,
+                                                            motion_profile.cutoff_velocity)
+        for i in range(max_repeat):
+            self.write_and_read_from_pump(packet)
+            if secure is False or (self.get_start_velocity() == motion_profile.start_velocity and
+                                   self.get_cutoff_velocity() == motion_profile.cutoff_velocity):
+                self._active_motion_profile = profile_name
+                return True
+            self.logger.debug("Motion profile not set, change attempt {}/{}".format(i + 1, max_repeat))
+
+        self.logger.debug(f"[PUMP {self.name}] Too many failed attempts in set_motion_profile!")
+        raise ControllerRepeatedError(f'Repeated Error from pump {self.name}')
+
+    def ensure_motion_profile(self, profile_name: str = None, secure: bool = True) -> None:
+        """
+        Ensures that the pump uses a profile, it is only sent if another profile was set last.
+
+        Args:
+            profile_name: The name of the profile, default set to None (the default profile of the pump).
+
+            secure: Ensures that everything is correct, default set to True.
+
+        """
+        if profile_name is None:
+            profile_name = self.default_motion_profile
+            if profile_name is None:
+                if self._active_motion_profile in (None, MOTION_PROFILE_FACTORY):
+                    return  # Never changed by this controller, leave the pump settings alone
+                profile_name = MOTION_PROFILE_FACTORY
+        if profile_name != self._active_motion_profile:
+            self.set_motion_profile(profile_name, secure=secure)
+
+    def estimate_move_duration(self, volume_in_ml: float, speed: int = None, profile: str = None) -> float:
+        """
+        Estimates how long the plunger takes to move a volume, ramps included.
+
+        Args:
+            volume_in_ml: The volume moved.
+
+            speed: The top velocity of the move, default set to None (the default top velocity).
+
+            profile: The name of the acceleration profile, default set to None (the default profile of the pump).
+
+        Returns:
+            duration: Duration of the move (in seconds).
+
+        """
+        top_velocity = speed if speed is not None else self.default_top_velocity
+        return self.get_motion_profile(profile).move_duration(self.volume_to_step(volume_in_ml), top_velocity,
+                                                             self.micro_step_mode)
+
     def get_plunger_position(self) -> int:
         """
         Gets the current position of the plunger.
@@ -777,12 +1322,71 @@ class C3000Controller(object):
         (_, _, steps) = self.write_and_read_from_pump(plunger_position_packet)
         return int(steps)
 
+    def sync_plunger_position(self) -> int:
+        """
+        Reads the plunger position from the pump and re-syncs the plunger model with it.
+
+        Returns:
+            steps: The position of the plunger (in steps).
+
+        """
+        steps = self.get_plunger_position()
+        self._plunger_steps = steps
+        self._plunger_synced_at = self.clock.time()
+        return steps
+
+    def invalidate_plunger_model(self) -> None:
+        """
+        Forgets the modelled plunger position, the next use re-syncs it with a real read.
+        """
+        self._plunger_steps = None
+
+    def track_plunger_move(self, command: str, steps: int, status: str) -> None:
+        """
+        Updates the plunger model with a move issued to the pump.
+
+        Only moves the pump accepted are tracked: a busy pump drops the packet and an error status leaves the plunger
+        where the error stopped it, so the model is forgotten and re-synced on next use instead.
+
+        Args:
+            command: CMD_PUMP, CMD_DELIVER or CMD_MOVE_TO.
+
+            steps: The operand of the move (in steps).
+
+            status: The status the pump replied to the move.
+
+        """
+        if status != pump_protocol.STATUS_IDLE_ERROR_FREE:
+            self.invalidate_plunger_model()
+            return
+        self._plunger_moving = True
+        if command == pump_protocol.CMD_MOVE_TO:
+            self._plunger_steps = steps
+            self._plunger_synced_at = self.clock.time()
+        elif self._plunger_steps is not None:
+            if command == pump_protocol.CMD_PUMP:
+                self._plunger_steps += steps
+            elif command == pump_protocol.CMD_DELIVER:
+                self._plunger_steps -= steps
+
     @property
     def current_steps(self) -> int:
         """
-        See get_plunger_position()
+        Gets the plunger position once the issued moves are done (in steps), from the plunger model.
+
+        The model is re-synced with a real read when it is unknown, or when position_resync_period has expired and
+        the pump is not known to be moving.
+
+        Returns:
+            steps: The modelled position of the plunger (in steps).
+
         """
-        return self.get_plunger_position()
+        if self._plunger_steps is None:
+            return self.sync_plunger_position()
+        if self.position_resync_period is not None and not self._plunger_moving and \
+                self.clock.time() - self._plunger_synced_at > self.position_resync_period:
+            return self.sync_plunger_position()
+        return self._plunger_steps
 
     @property
     def remaining_steps(self) -> int:
@@ -808,13 +1412,13 @@ class C3000Controller(object):
     @property
     def current_volume(self) -> float:
         """
-        See get_volume()
+        Gets the volume in the syringe once the issued moves are done, from the plunger model (see current_steps).
 
         Returns:
-            self.get_volume()
+            self.step_to_volume(self.current_steps)
 
         """
-        return self.get_volume()
+        return self.step_to_volume(self.current_steps)
 
     @property
     def remaining_volume(self) -> float:
@@ -843,12 +1447,14 @@ class C3000Controller(object):
         return steps <= self.remaining_steps
 
     def pump(self, volume_in_ml: float, from_valve: str = None, speed_in: int = None, wait: bool = False,
-             secure: bool = True) -> bool:
+             secure: bool = True, profile: str = None) -> bool:
         """
         Sends the signal to initiate the pump sequence.
 
         .. warning:: Change of speed will last after the scope of this function but will be reset to default each time speed_in == None
 
+        .. note:: When the pump handles a liquid class (see set_liquid_class()) its speed_in replaces the default
+
         Args:
             volume_in_ml: Volume to pump (in mL).
 
@@ -860,6 +1466,8 @@ class C3000Controller(object):
 
             secure: Ensures everything is correct, default set to True.
 
+            profile: Name of the acceleration profile of the move, default set to None (the default profile).
+
         Returns:
             True: The supplied volume is pumpable.
 
@@ -871,14 +1479,16 @@ class C3000Controller(object):
             if speed_in is not None:
                 self.set_top_velocity(speed_in, secure=secure)
             else:
-                self.ensure_default_top_velocity(secure=secure)
+                self.ensure_liquid_top_velocity(pump_protocol.CMD_PUMP, secure=secure)
+            self.ensure_motion_profile(profile, secure=secure)
 
             if from_valve is not None:
                 self.set_valve_position(from_valve, secure=secure)
 
             steps_to_pump = self.volume_to_step(volume_in_ml)
             packet = self._protocol.forge_pump_packet(steps_to_pump)
-            self.write_and_read_from_pump(packet)
+            (_, status, _) = self.write_and_read_from_pump(packet)
+            self.track_plunger_move(pump_protocol.CMD_PUMP, steps_to_pump, status)
 
             if wait:
                 self.wait_until_idle()
@@ -904,12 +1514,14 @@ class C3000Controller(object):
         return steps <= self.current_steps
 
     def deliver(self, volume_in_ml: float, to_valve: str = None, speed_out: int = None, wait: bool = False,
-                secure: bool = True) -> bool:
+                secure: bool = True, profile: str = None) -> bool:
         """
         Delivers the volume payload.
 
         .. warning:: Change of speed will last after the scope of this function but will be reset to default each time speed_out == None
 
+        .. note:: When the pump handles a liquid class (see set_liquid_class()) its speed_out replaces the default
+
         Args:
             volume_in_ml: The supplied volume to deliver.
 
@@ -921,6 +1533,8 @@ class C3000Controller(object):
 
             secure: Ensures that everything is correct, default set to False.
 
+            profile: Name of the acceleration profile of the move, default set to None (the default profile).
+
         """
         if self.is_volume_deliverable(volume_in_ml):
 
@@ -930,14 +1544,16 @@ class C3000Controller(object):
             if speed_out is not None:
                 self.set_top_velocity(speed_out, secure=secure)
             else:
-                self.ensure_default_top_velocity(secure=secure)
+                self.ensure_liquid_top_velocity(pump_protocol.CMD_DELIVER, secure=secure)
+            self.ensure_motion_profile(profile, secure=secure)
 
             if to_valve is not None:
                 self.set_valve_position(to_valve, secure=secure)
 
             steps_to_deliver = self.volume_to_step(volume_in_ml)
             packet = self._protocol.forge_deliver_packet(steps_to_deliver)
-            self.write_and_read_from_pump(packet)
+            (_, status, _) = self.write_and_read_from_pump(packet)
+            self.track_plunger_move(pump_protocol.CMD_DELIVER, steps_to_deliver, status)
 
             if wait:
                 self.wait_until_idle()
@@ -947,7 +1563,7 @@ class C3000Controller(object):
             return False
 
     def transfer(self, volume_in_ml: float, from_valve: str, to_valve: str, speed_in: int = None,
-                 speed_out: int = None) -> None:
+                 speed_out: int = None, profile: str = None) -> None:
         """
         Transfers the desired volume in mL.
 
@@ -962,14 +1578,16 @@ class C3000Controller(object):
 
             speed_out: The speed of transfer from the valve, default set to None.
 
+            profile: Name of the acceleration profile of the moves, default set to None (the default profile).
+
         """
         volume_transferred = min(volume_in_ml, self.remaining_volume)
-        self.pump(volume_transferred, from_valve, speed_in=speed_in, wait=True)
-        self.deliver(volume_transferred, to_valve, speed_out=speed_out, wait=True)
+        self.pump(volume_transferred, from_valve, speed_in=speed_in, wait=True, profile=profile)
+        self.deliver(volume_transferred, to_valve, speed_out=speed_out, wait=True, profile=profile)
 
         remaining_volume_to_transfer = volume_in_ml - volume_transferred
         if remaining_volume_to_transfer > 0:
-            self.transfer(remaining_volume_to_transfer, from_valve, to_valve, speed_in, speed_out)
+            self.transfer(remaining_volume_to_transfer, from_valve, to_valve, speed_in, speed_out, profile)
 
     def is_volume_valid(self, volume_in_ml: float) -> bool:
         """
@@ -986,7 +1604,8 @@ class C3000Controller(object):
         """
         return 0 <= volume_in_ml <= self.total_volume
 
-    def go_to_volume(self, volume_in_ml: float, speed: int = None, wait: bool = False, secure: bool = True) -> bool:
+    def go_to_volume(self, volume_in_ml: float, speed: int = None, wait: bool = False, secure: bool = True,
+                     profile: str = None) -> bool:
         """
         Moves the pump to the desired volume.
 
@@ -1001,6 +1620,8 @@ class C3000Controller(object):
 
             secure: Ensures that everything is correct, default set to True.
 
+            profile: Name of the acceleration profile of the move, default set to None (the default profile).
+
         Returns:
             True: The supplied volume is valid.
 
@@ -1013,10 +1634,12 @@ class C3000Controller(object):
                 self.set_top_velocity(speed, secure=secure)
             else:
                 self.ensure_default_top_velocity(secure=secure)
+            self.ensure_motion_profile(profile, secure=secure)
 
             steps = self.volume_to_step(volume_in_ml)
             packet = self._protocol.forge_move_to_packet(steps)
-            self.write_and_read_from_pump(packet)
+            (_, status, _) = self.write_and_read_from_pump(packet)
+            self.track_plunger_move(pump_protocol.CMD_MOVE_TO, steps, status)
 
             if wait:
                 self.wait_until_idle()
@@ -1025,7 +1648,7 @@ class C3000Controller(object):
         else:
             return False
 
-    def go_to_max_volume(self, speed: int = None, wait: bool = False) -> None:
+    def go_to_max_volume(self, speed: int = None, wait: bool = False, profile: str = None) -> None:
         """
         Moves the pump to the maximum volume.
 
@@ -1034,15 +1657,36 @@ class C3000Controller(object):
 
             wait: Waits until the pump is idle, default set to False.
 
+            profile: Name of the acceleration profile of the move, default set to None (the default profile).
+
         Returns:
             True: The maximum volume is valid.
 
             False: The maximum volume is not valid.
 
         """
-        self.go_to_volume(self.total_volume, speed=speed, wait=wait)
+        self.go_to_volume(self.total_volume, speed=speed, wait=wait, profile=profile)
 
-    def get_raw_valve_position(self) -> str:
+    def run_move_sequence(self, moves: List[Tuple[str, int]], wait: bool = False) -> None:
+        """
+        Sends a chain of commands in one packet, the pump runs them back to back without waiting for the host.
+
+        .. warning:: Velocity changes in the sequence last after it ends, use ensure_default_top_velocity() to reset.
+
+        Args:
+            moves: List of (command, operand) pairs, e.g. [('V', 1200), ('D', 300)].
+
+            wait: Waits for the pump to be idle, default set to False.
+
+        """
+        (_, status, _) = self.write_and_read_from_pump(self._protocol.forge_move_sequence_packet(moves))
+        for command, operand_value in moves:
+            if command in (pump_protocol.CMD_PUMP, pump_protocol.CMD_DELIVER, pump_protocol.CMD_MOVE_TO):
+                self.track_plunger_move(command, int(operand_value), status)
+        if wait:
+            self.wait_until_idle()
+
+    def get_raw_valve_position(self) -> str:
         """
         Gets the raw value of the valve's position.
 
@@ -1052,6 +1696,7 @@ class C3000Controller(object):
         """
         valve_position_packet = self._protocol.forge_report_valve_position_packet()
         (_, _, raw_valve_position) = self.write_and_read_from_pump(valve_position_packet)
+        self.last_known['valve_position'] = raw_valve_position
         return raw_valve_position
 
     def get_valve_position(self, max_repeat: int = MAX_REPEAT_OPERATION) -> str:
@@ -1125,6 +1770,7 @@ class C3000Controller(object):
                 raise ValueError('Valve position {} unknown'.format(valve_position))
 
             self.write_and_read_from_pump(valve_position_packet)
+            self.last_known.pop('valve_position', None)  # Known once read back
 
             # if do not want to wait and check things went well, return now
             if secure is False:
@@ -1207,6 +1853,7 @@ class C3000Controller(object):
 
         """
         (_, _, eeprom_config) = self.write_and_read_from_pump(self._protocol.forge_report_eeprom_packet())
+        self.last_known['eeprom_config'] = eeprom_config
         return eeprom_config
 
     def get_current_valve_config(self) -> str:
@@ -1241,79 +1888,57 @@ class C3000Controller(object):
         Sends the command to terminate the current action.
         """
         self.write_and_read_from_pump(self._protocol.forge_terminate_packet())
+        self.invalidate_plunger_model()  # The plunger stopped somewhere along its move
 
+    def dry_run(self) -> 'DryRun':
+        """
+        Creates a dry run of this pump: a simulated twin on a VirtualClock, with the same config and starting from
+        what is known of the pump (plunger model and last read values), on which scripts can be run to predict their
+        duration and bus load, see DryRun. The pump itself is not touched.
 
-class VirtualC3000Controller(C3000Controller):
-
-    def write_and_read_from_pump(self, packet, max_repeat=MAX_REPEAT_WRITE_AND_READ):
-        raise NotImplementedError
-
-    def initialize(self, valve_position=None, max_repeat=MAX_REPEAT_OPERATION, secure=True):
-        raise NotImplementedError
-
-    def initialize_valve_right(self, operand_value=0, wait=True):
-        raise NotImplementedError
-
-    def initialize_valve_left(self, operand_value=0, wait=True):
-        raise NotImplementedError
-
-    def initialize_no_valve(self, operand_value=0, wait=True):
-        raise NotImplementedError
-
-    def initialize_valve_only(self, operand_string='0,0', wait=True):
-        raise NotImplementedError
-
-    def is_idle(self):
-        return True
-
-    def is_busy(self):
-        return False
-
-    def is_initialized(self):
-        return True
-
-    def init_all_pump_parameters(self, secure=True):
-        pass
-
-    def set_microstep_mode(self, micro_step_mode):
-        pass
-
-    def set_top_velocity(self, top_velocity, max_repeat=MAX_REPEAT_OPERATION, secure=True):
-        pass
-
-    def get_top_velocity(self):
-        return 10000
+        Returns:
+            DryRun: The dry run, use run(script) where script takes the twin pump as argument.
 
-    def get_plunger_position(self):
-        return 0
+        """
+        from .dryrun import DryRun
+        from .state import pump_snapshot
 
-    def pump(self, volume_in_ml, from_valve=None, speed_in=None, wait=False, secure=True):
-        pass
+        clock = VirtualClock()
+        twin = VirtualC3000Controller(VirtualPumpIO(self._io.port, self._io.baudrate, self._io.timeout, clock=clock),
+                                      self.name, self.address, self.total_volume, micro_step_mode=self.micro_step_mode,
+                                      top_velocity=self.default_top_velocity,
+                                      initialize_valve_position=self.initialize_valve_position,
+                                      circuit_breaker=False, clock=clock)
+        twin.motion_profiles = dict(self.motion_profiles)
+        twin.default_motion_profile = self.default_motion_profile
+        twin.liquid_classes = dict(self.liquid_classes)
+        twin.liquid_class = self.liquid_class
+        return DryRun(twin, states={self.name: pump_snapshot(self)})
 
-    def deliver(self, volume_in_ml, to_valve=None, speed_out=None, wait=False, secure=True):
-        pass
 
-    def go_to_volume(self, volume_in_ml, speed=None, wait=False, secure=True):
-        return True
+class VirtualC3000Controller(C3000Controller):
+    """
+    This class is a C3000Controller talking to a simulated pump instead of the hardware, see virtual.VirtualPump.
 
-    def go_to_max_volume(self, speed=None, wait=False):
-        return True
+    The controller logic is the one of C3000Controller, only the exchanges are answered by the simulated pump, so
+    that plunger and valve positions, busy times and errors follow the real device.
 
-    def get_valve_position(self, max_repeat=MAX_REPEAT_OPERATION):
-        if self.current_valve_position is not None:
-            return self.current_valve_position
-        else:
-            return VALVE_INPUT
+    Args:
+        time_scale: Speed of the simulated time relative to the wall clock, default set to 1 (real time), used when
+            no clock is given.
 
-    def set_valve_position(self, valve_position, max_repeat=MAX_REPEAT_OPERATION, secure=True):
-        self.current_valve_position = valve_position
-        return True
+        See C3000Controller for the other arguments, the clock is shared with the simulated pump.
 
-    def set_eeprom_config(self, operand_value):
-        pass
+    """
+    def __init__(self, pump_io: PumpIO, name: str, address: str, total_volume: float, time_scale: float = 1.,
+                 clock: Clock = None, **kwargs):
+        if clock is None:
+            clock = ScaledClock(time_scale) if time_scale != 1 else SYSTEM_CLOCK
+        super().__init__(pump_io, name, address, total_volume, clock=clock, **kwargs)
+        self.device = VirtualPump(address, clock)
 
-    def get_eeprom_config(self):
-        return None
+    def write_and_read_from_pump(self, packet, max_repeat=None, priority=None):
+        return self.device.execute(packet)
 
 
 class MultiPumpController(object):
@@ -1323,32 +1948,86 @@ class MultiPumpController(object):
     Args:
         setup_config: The configuration of the setup.
 
+        clock: The clock shared by the pumps, default set to None (SYSTEM_CLOCK).
+
     """
-    def __init__(self, setup_config: Dict):
+    #: Restores and snapshots the state of the pumps if the setup config has a state_snapshot, subclasses whose pumps
+    #: are not the hardware (simulated, replayed) leave the snapshot file of the setup alone
+    persists_state = True
+
+    def __init__(self, setup_config: Dict, clock: Clock = None):
         self.logger = create_logger(self.__class__.__name__)
-        self.pumps: Dict[str, C3000Controller] = {}
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.pumps = PumpRegistry()
         self._io: Union[PumpIO, List[PumpIO]] = []
 
-        # Sets groups and default configs if provided in the config dictionary
-        self.groups = setup_config['groups'] if 'groups' in setup_config else {}
+        # Kept to write back settings found while running, e.g. tuned liquid classes, see save_configfile()
+        self.setup_config = setup_config
+        self._pump_configs: Dict[str, Dict] = {}
+
+        # Sets default configs if provided in the config dictionary, groups are set once the pumps are added
         self.default_config = setup_config['default'] if 'default' in setup_config else {}
 
         if "hubs" in setup_config:  # This implements the "new" behaviour with multiple hubs
             for hub_config in setup_config["hubs"]:
                 # Each hub has its own I/O config. Create a PumpIO object per each hub and reuse it with -1 after append
-                self._io.append(PumpIO.from_config(hub_config['io']))
+                self._io.append(self._create_pump_io(hub_config['io']))
+                self.pumps.add_hub(self._io[-1])
                 for pump_name, pump_config in list(hub_config['pumps'].items()):
-                    full_pump_config = self.default_pump_config(pump_config)
-                    self.pumps[pump_name] = C3000Controller.from_config(self._io[-1], pump_name, full_pump_config)
+                    self._add_pump(self._io[-1], pump_name, pump_config)
         else:  # This implements the "old" behaviour with one hub per object instance / json file
-            self._io = PumpIO.from_config(setup_config['io'])
+            self._io = self._create_pump_io(setup_config['io'])
+            self.pumps.add_hub(self._io)
             for pump_name, pump_config in list(setup_config['pumps'].items()):
-                full_pump_config = self.default_pump_config(pump_config)
-                self.pumps[pump_name] = C3000Controller.from_config(self._io, pump_name, full_pump_config)
+                self._add_pump(self._io, pump_name, pump_config)
+        self.pumps.set_groups(setup_config['groups'] if 'groups' in setup_config else {})
 
         # Adds pumps as attributes
         self.set_pumps_as_attributes()
 
+        # Describes how vessels are connected to the pumps, if provided in the config dictionary
+        self.network = FluidicNetwork(self.pumps, setup_config['network'], self.clock) \
+            if 'network' in setup_config else None
+
+        # Starts from the state saved by a previous run, if provided in the config dictionary
+        self._restored_pumps: List[str] = []
+        self.state_snapshotter: Optional[StateSnapshotter] = None
+        if 'state_snapshot' in setup_config and self.persists_state:
+            snapshot_config = setup_config['state_snapshot']
+            self.restore_state(snapshot_config['path'])
+            self.state_snapshotter = self.start_state_snapshots(
+                snapshot_config['path'], snapshot_config.get('period', DEFAULT_SNAPSHOT_PERIOD))
+
+    @property
+    def groups(self) -> Dict[str, Tuple[str, ...]]:
+        """
+        The pump names of each group, held by the registry of the pumps.
+        """
+        return self.pumps.groups
+
+    @groups.setter
+    def groups(self, groups: Dict[str, List[str]]) -> None:
+        self.pumps.set_groups(groups)
+
+    def _create_pump_io(self, io_config: Dict) -> PumpIO:
+        """
+        Creates the PumpIO of a hub, subclasses replace it to talk to something else than a serial port.
+        """
+        return PumpIO.from_config(io_config, self.clock)
+
+    def _create_pump(self, pump_io: PumpIO, pump_name: str, full_pump_config: Dict) -> C3000Controller:
+        """
+        Creates a pump from its config merged with the defaults, subclasses replace it to create other pumps.
+        """
+        return C3000Controller.from_config(pump_io, pump_name, full_pump_config)
+
+    def _add_pump(self, pump_io: PumpIO, pump_name: str, pump_config: Dict) -> None:
+        self._pump_configs[pump_name] = pump_config
+        full_pump_config = self.default_pump_config(pump_config)
+        full_pump_config.setdefault('clock', self.clock)
+        tags = full_pump_config.pop('tags', ())
+        self.pumps.add(pump_name, self._create_pump(pump_io, pump_name, full_pump_config), tags)
+
     @classmethod
     def from_configfile(cls, setup_configfile: Union[str, Path]) -> 'MultiPumpController':
         """
@@ -1366,6 +2045,17 @@ class MultiPumpController(object):
         with open(setup_configfile) as f:
             return cls(json.load(f))
 
+    def save_configfile(self, setup_configfile: Union[str, Path]) -> None:
+        """
+        Writes the setup configuration, including the settings found while running, to a file.
+
+        Args:
+            setup_configfile: The configuration file.
+
+        """
+        with open(setup_configfile, 'w') as f:
+            json.dump(self.setup_config, f, indent=2)
+
     def default_pump_config(self, pump_specific_config: Dict) -> Dict:
         """
         Creates a default pump configuration.
@@ -1409,13 +2099,7 @@ class MultiPumpController(object):
             pumps: A list of the pump objects.
 
         """
-        pumps = []
-        for pump_name in pump_names:
-            try:
-                pumps.append(self.pumps[pump_name])
-            except KeyError:
-                pass
-        return pumps
+        return [self.pumps[pump_name] for pump_name in pump_names if pump_name in self.pumps]
 
     def get_pumps_in_group(self, group_name: str) -> Optional[List[C3000Controller]]:
         """
@@ -1428,22 +2112,45 @@ class MultiPumpController(object):
             pumps: A list of the pump objects in the group. None for non-existing groups.
 
         """
-        pumps = []
         try:
-            pump_list = self.groups[group_name]
+            return self.pumps.group_pumps(group_name)
         except KeyError:
             return None
 
-        for pump_name in pump_list:
-            pumps.append(self.pumps[pump_name])
-        return pumps
+    def get_pumps_on_hub(self, hub: Hub) -> List[C3000Controller]:
+        """
+        Obtains a list of all pumps on a hub.
+
+        Args:
+            hub: The hub, by index in the setup config, port or PumpIO.
+
+        Returns:
+            pumps: A list of the pump objects on the hub.
+
+        Raises:
+            KeyError: Unknown hub.
+
+        """
+        return [self.pumps[pump_name] for pump_name in self.pumps.on_hub(hub)]
+
+    def select(self, hub: Union[Hub, List[Hub]] = None, group: Union[str, List[str]] = None,
+               tag: Union[str, List[str]] = None, names: List[str] = None) -> List[str]:
+        """
+        Selects pumps by hub, group and tag, e.g. select(hub=2, group='oils'), see PumpRegistry.select(). The
+        selection can be given to any method taking pump names.
+
+        Returns:
+            pump_names: The selected pumps.
+
+        """
+        return self.pumps.select(hub, group, tag, names)
 
-    def get_all_pumps(self) -> Dict[str, C3000Controller]:
+    def get_all_pumps(self) -> PumpRegistry:
         """
-        Obtains a list of all pumps.
+        Obtains all pumps.
 
         Returns:
-            pumps: A list of the all the pump objects in the Controller.
+            pumps: The pump objects in the Controller by name, see PumpRegistry.
 
         """
 
@@ -1488,7 +2195,7 @@ class MultiPumpController(object):
             returns (Dict): Dictionary of the functions.
 
         """
-        return self.apply_command_to_pumps(list(self.pumps.keys()), command, *args, **kwargs)
+        return self.apply_command_to_pumps(list(self.pumps), command, *args, **kwargs)
 
     def apply_command_to_group(self, group_name: str, command: str, *args, **kwargs) -> Dict[str, Any]:
         """
@@ -1507,7 +2214,7 @@ class MultiPumpController(object):
             returns Dictionary of the functions.
 
         """
-        return self.apply_command_to_pumps(self.groups[group_name], command, *args, **kwargs)
+        return self.apply_command_to_pumps(self.pumps.in_group(group_name), command, *args, **kwargs)
 
     def are_pumps_initialized(self) -> bool:
         """
@@ -1526,29 +2233,103 @@ class MultiPumpController(object):
 
     def smart_initialize(self, secure: bool = True) -> None:
         """
-        Initialises the pumps, setting all parameters.
+        Initialises the pumps, setting all parameters, see start_initialization().
 
         Args:
             secure: Ensures everything is correct, default set to True.
 
+        Raises:
+            ControllerRepeatedError: A pump could not be initialised, the others are initialised all the same.
+
         """
-        for pump in list(self.pumps.values()):
-            if not pump.is_initialized():
-                pump.initialize_valve_only(wait=False)
-        self.wait_until_all_pumps_idle()
+        self.start_initialization(secure).wait()
 
-        for pump in list(self.pumps.values()):
-            if not pump.is_initialized():
-                pump.set_valve_position(pump.initialize_valve_position, secure=secure)
-        self.wait_until_all_pumps_idle()
+    def connect(self, pump_names: List[str] = None) -> Dict[str, Exception]:
+        """
+        Opens the hubs of pumps in parallel. Hubs are otherwise opened on first use, one after the other as the script
+        reaches them, and hubs the script does not use are never opened.
 
-        for pump in list(self.pumps.values()):
-            if not pump.is_initialized():
-                pump.initialize_no_valve(wait=False)
-        self.wait_until_all_pumps_idle()
+        Args:
+            pump_names: The pumps whose hubs to open, default set to None (all the pumps).
+
+        Returns:
+            errors: The error of each hub that could not be opened, by port, empty when all of them are open.
+
+        """
+        hubs = self.pumps.partition_by_hub(self.pumps if pump_names is None else pump_names)
+        pump_ios = [self.pumps.hubs[hub] for hub in hubs if not self.pumps.hubs[hub].is_open]
+
+        errors: Dict[str, Exception] = {}
 
-        self.apply_command_to_all_pumps('init_all_pump_parameters', secure=secure)
-        self.wait_until_all_pumps_idle()
+        def connect_hub(pump_io: PumpIO) -> None:
+            try:
+                pump_io.connect()
+            except OSError as err:  # serial.SerialException included
+                self.logger.warning("Cannot open hub {}: {!r}".format(pump_io.port, err))
+                errors[pump_io.port] = err
+
+        threads = [threading.Thread(target=connect_hub, args=(pump_io,), name='connect-{}'.format(pump_io.port))
+                   for pump_io in pump_ios]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def start_initialization(self, secure: bool = True, force: bool = False) -> InitializationEngine:
+        """
+        Starts initialising the pumps and setting their parameters, hubs in parallel and each pump at its own pace,
+        see InitializationEngine. Work can start on a pump as soon as it is ready. Hubs not open yet are opened by
+        their own thread, so they also open in parallel.
+
+        Args:
+            secure: Ensures everything is correct, default set to True.
+
+            force: Initialises the pumps even if they report being initialised, default set to False.
+
+        Returns:
+            InitializationEngine: The started engine, ready(pump_name) waits for a pump and wait() for all of them.
+
+        """
+        ready = [] if force else [pump_name for pump_name in self._restored_pumps
+                                  if self.pumps[pump_name].last_known.get('top_velocity') ==
+                                  self.pumps[pump_name].default_top_velocity]
+        self._restored_pumps = []  # Checked as usual from now on
+        return InitializationEngine(self.pumps, secure, force, ready).start()
+
+    def restore_state(self, path: Union[str, Path]) -> List[str]:
+        """
+        Starts the pumps from a snapshot saved by a previous run, see state.restore_pump(). Each pump is checked with
+        one status and one position read, and restored pumps with their parameters set are not initialised again by
+        the next smart_initialize().
+
+        Args:
+            path: The snapshot file, see start_state_snapshots().
+
+        Returns:
+            pump_names: The pumps restored.
+
+        """
+        self.connect()
+        self._restored_pumps = restore_snapshot(self.pumps, path)
+        return list(self._restored_pumps)
+
+    def start_state_snapshots(self, path: Union[str, Path],
+                              period: float = DEFAULT_SNAPSHOT_PERIOD) -> StateSnapshotter:
+        """
+        Starts saving the state of the pumps to a file periodically, for restore_state() after a restart. Setting
+        "state_snapshot": {"path": ..., "period": ...} in the setup config does both when the controller is created.
+
+        Args:
+            path: The snapshot file.
+
+            period: Time between two flushes (in seconds), default set to DEFAULT_SNAPSHOT_PERIOD (10).
+
+        Returns:
+            StateSnapshotter: The started snapshotter, use stop() to stop it after a last flush.
+
+        """
+        return StateSnapshotter(self.pumps, path, period).start()
 
     def wait_until_all_pumps_idle(self) -> None:
         """
@@ -1596,7 +2377,7 @@ class MultiPumpController(object):
         return not self.are_pumps_idle()
 
     def pump(self, pump_names: List[str], volume_in_ml: float, from_valve: str = None, speed_in: float = None,
-             wait: bool = False, secure: bool = True) -> None:
+             wait: bool = False, secure: bool = True, profile: str = None) -> None:
         """
         Pumps the desired volume.
 
@@ -1613,22 +2394,24 @@ class MultiPumpController(object):
 
             secure: Ensures everything is correct, default set to False.
 
+            profile: Name of the acceleration profile of the moves, default set to None (the default profiles).
+
         """
         if speed_in is not None:
             self.apply_command_to_pumps(pump_names, 'set_top_velocity', speed_in, secure=secure)
         else:
-            self.apply_command_to_pumps(pump_names, 'ensure_default_top_velocity', secure=secure)
+            self.apply_command_to_pumps(pump_names, 'ensure_liquid_top_velocity', pump_protocol.CMD_PUMP, secure=secure)
 
         if from_valve is not None:
             self.apply_command_to_pumps(pump_names, 'set_valve_position', from_valve, secure=secure)
 
-        self.apply_command_to_pumps(pump_names, 'pump', volume_in_ml, speed_in=speed_in, wait=False)
+        self.apply_command_to_pumps(pump_names, 'pump', volume_in_ml, speed_in=speed_in, wait=False, profile=profile)
 
         if wait:
             self.apply_command_to_pumps(pump_names, 'wait_until_idle')
 
     def deliver(self, pump_names: List[str], volume_in_ml: float, to_valve: str = None, speed_out: int = None,
-                wait: bool = False, secure: bool = True) -> None:
+                wait: bool = False, secure: bool = True, profile: str = None) -> None:
         """
         Delivers the desired volume.
 
@@ -1645,22 +2428,26 @@ class MultiPumpController(object):
 
             secure: Ensures everything is correct, default set to True.
 
+            profile: Name of the acceleration profile of the moves, default set to None (the default profiles).
+
         """
         if speed_out is not None:
             self.apply_command_to_pumps(pump_names, 'set_top_velocity', speed_out, secure=secure)
         else:
-            self.apply_command_to_pumps(pump_names, 'ensure_default_top_velocity', secure=secure)
+            self.apply_command_to_pumps(pump_names, 'ensure_liquid_top_velocity', pump_protocol.CMD_DELIVER,
+                                        secure=secure)
 
         if to_valve is not None:
             self.apply_command_to_pumps(pump_names, 'set_valve_position', to_valve, secure=secure)
 
-        self.apply_command_to_pumps(pump_names, 'deliver', volume_in_ml, speed_out=speed_out, wait=False)
+        self.apply_command_to_pumps(pump_names, 'deliver', volume_in_ml, speed_out=speed_out, wait=False,
+                                    profile=profile)
 
         if wait:
             self.apply_command_to_pumps(pump_names, 'wait_until_idle')
 
     def transfer(self, pump_names: List[str], volume_in_ml: float, from_valve: str, to_valve: str,
-                 speed_in: int = None, speed_out: int = None, secure: bool = True) -> None:
+                 speed_in: int = None, speed_out: int = None, secure: bool = True, profile: str = None) -> None:
         """
         Transfers the desired volume between pumps.
 
@@ -1679,18 +2466,23 @@ class MultiPumpController(object):
 
             secure: Ensures that everything is correct, default set to False.
 
+            profile: Name of the acceleration profile of the moves, default set to None (the default profiles).
+
         """
         volume_transferred = float('inf')  # Temporary value for the first cycle only, see below
         for pump in self.get_pumps(pump_names):
             candidate_volume = min(volume_in_ml, pump.remaining_volume)  # Smallest target and remaining is candidate
             volume_transferred = min(candidate_volume, volume_transferred)  # Transferred is global minimum
 
-        self.pump(pump_names, volume_transferred, from_valve, speed_in=speed_in, wait=True, secure=secure)
-        self.deliver(pump_names, volume_transferred, to_valve, speed_out=speed_out, wait=True, secure=secure)
+        self.pump(pump_names, volume_transferred, from_valve, speed_in=speed_in, wait=True, secure=secure,
+                  profile=profile)
+        self.deliver(pump_names, volume_transferred, to_valve, speed_out=speed_out, wait=True, secure=secure,
+                     profile=profile)
 
         remaining_volume_to_transfer = volume_in_ml - volume_transferred
         if remaining_volume_to_transfer > 0:
-            self.transfer(pump_names, remaining_volume_to_transfer, from_valve, to_valve, speed_in, speed_out)
+            self.transfer(pump_names, remaining_volume_to_transfer, from_valve, to_valve, speed_in, speed_out,
+                          profile=profile)
 
     def parallel_transfer(self, pumps_and_volumes_dict: Dict, from_valve: str, to_valve: str,
                           speed_in: int = None, speed_out: int = None, secure: bool = True, wait: bool = False) -> bool:
@@ -1751,31 +2543,384 @@ class MultiPumpController(object):
             self.apply_command_to_pumps(list(pumps_and_volumes_dict.keys()), "wait_until_idle")
         return True
 
+    def start_health_monitor(self, check_period: float = DEFAULT_CHECK_PERIOD,
+                             timeout_threshold: int = DEFAULT_TIMEOUT_THRESHOLD,
+                             reinitialize: bool = False) -> HealthMonitor:
+        """
+        Starts watching the ports of all pumps and reconnecting them when they are lost, see HealthMonitor.
+
+        Args:
+            check_period: Time between two checks (in seconds), default set to DEFAULT_CHECK_PERIOD (1).
+
+            timeout_threshold: Timeouts in a row reopening a port, default set to DEFAULT_TIMEOUT_THRESHOLD (5).
+
+            reinitialize: Re-initialises the pumps found not initialised after reconnecting, default set to False.
+
+        Returns:
+            HealthMonitor: The started monitor, use stop() to stop it.
+
+        """
+        return HealthMonitor(self.pumps, check_period, timeout_threshold, reinitialize).start()
+
+    def record_traffic(self, path: Union[str, Path]) -> 'TrafficRecorder':
+        """
+        Starts recording the frames exchanged with all the hubs to a traffic log, see recording.TrafficRecorder.
+
+        The log can be read with recording.read_traffic() and replayed with recording.ReplayMultiPumpController.
+
+        Args:
+            path: The file to write the log to.
+
+        Returns:
+            TrafficRecorder: The recorder, close() stops recording, it can also be used as a context manager.
+
+        """
+        from .recording import TrafficRecorder
+
+        recorder = TrafficRecorder(path)
+        for pump_io in self._io if isinstance(self._io, list) else [self._io]:
+            recorder.attach(pump_io)
+        return recorder
+
+    def dry_run(self) -> 'DryRun':
+        """
+        Creates a dry run of this setup: a VirtualMultiPumpController built from the same setup config on a
+        VirtualClock, its pumps starting from what is known of the real ones (plunger model and last read values), on
+        which scripts can be run to predict their duration, the busy time of each pump and the occupancy of each bus,
+        see DryRun. No hardware is touched.
+
+        Returns:
+            DryRun: The dry run, use run(script) where script takes the simulated controller as argument.
+
+        """
+        from .dryrun import DryRun
+        from .state import pump_snapshot
+
+        setup_config = copy.deepcopy(self.setup_config)
+        setup_config.pop('state_snapshot', None)  # The snapshot file holds the state of the hardware
+        states = {pump_name: pump_snapshot(pump) for pump_name, pump in self.pumps.items()}
+        return DryRun(VirtualMultiPumpController(setup_config, clock=VirtualClock()), states=states)
+
+    def migrate_baudrate(self, port: str, new_baudrate: int) -> BaudrateMigration:
+        """
+        Starts moving all the pumps of a hub to another baudrate, see BaudrateMigration.
+
+        The pumps are checked and their EEPROM backed up, then the returned instructions tell how to set the baudrate
+        jumpers. Call verify() on the returned migration once done, the hub config gets the new baudrate if every
+        pump answers, use save_configfile() to keep it.
+
+        Args:
+            port: The port of the hub, as in its io config.
+
+            new_baudrate: The baudrate to move to, 9600 or 38400.
+
+        Returns:
+            BaudrateMigration: The prepared migration, print its instructions() for the hardware steps.
+
+        Raises:
+            ValueError: Unknown port, unsupported baudrate, or a pump of the hub does not answer.
+
+        """
+        hubs = self.setup_config['hubs'] if 'hubs' in self.setup_config else [self.setup_config]
+        pump_ios = self._io if isinstance(self._io, list) else [self._io]
+        for hub_config, pump_io in zip(hubs, pump_ios):
+            if pump_io.port == port:
+                hub_pumps = [self.pumps[pump_name] for pump_name in self.pumps.on_hub(pump_io)]
+                migration = BaudrateMigration(pump_io, hub_pumps, new_baudrate, hub_config['io'])
+                migration.prepare()
+                return migration
+        raise ValueError('No hub on port {}'.format(port))
+
+    def tune_liquid_class(self, pump_name: str, liquid_name: str, from_valve: str, to_valve: str,
+                          test_volume: float = None,
+                          safety_factor: float = DEFAULT_TUNING_SAFETY_FACTOR) -> LiquidClass:
+        """
+        Tunes a liquid class on a pump (see C3000Controller.tune_liquid_class()) and stores it in the setup config.
+
+        The pump config gets the tuned velocities under liquid_classes and liquid_name as its liquid_class, use
+        save_configfile() to keep them for the next runs.
+
+        Args:
+            pump_name: The name of the pump.
+
+            liquid_name: The name of the liquid.
+
+            from_valve: The valve position the liquid is aspirated from.
+
+            to_valve: The valve position the liquid is dispensed to.
+
+            test_volume: Volume of each test stroke (in mL), default set to None (half the syringe).
+
+            safety_factor: Fraction of the highest stall-free velocity kept, default set to
+                DEFAULT_TUNING_SAFETY_FACTOR (0.8).
+
+        Returns:
+            LiquidClass: The tuned velocities.
+
+        """
+        liquid_class = self.pumps[pump_name].tune_liquid_class(liquid_name, from_valve, to_valve, test_volume,
+                                                               safety_factor)
+        pump_config = self._pump_configs[pump_name]
+        pump_config.setdefault('liquid_classes', {})[liquid_name] = liquid_class.to_config()
+        pump_config['liquid_class'] = liquid_name
+        return liquid_class
+
+    def split_volume(self, pump_names: List[str], volume_in_ml: float, speed_in: int = None,
+                     speed_out: int = None) -> Dict[str, float]:
+        """
+        Shares a volume between pumps in proportion to their transfer rate, so that they all finish together.
+
+        The transfer rate of a pump depends on its syringe size and on its speed: a pump needs
+        steps_per_ml / speed_in + steps_per_ml / speed_out seconds to transfer one mL.
+
+        Args:
+            pump_names: The name of the pumps.
+
+            volume_in_ml: The total volume to share.
+
+            speed_in: The speed at which to pump, default set to None (default top velocity of each pump).
+
+            speed_out: The speed at which to deliver, default set to None (default top velocity of each pump).
+
+        Returns:
+            volumes: Dictionary of the volume given to each pump.
+
+        """
+        rates = {}
+        for pump_name in pump_names:
+            pump = self.pumps[pump_name]
+            velocity_in = speed_in if speed_in is not None else pump.default_top_velocity
+            velocity_out = speed_out if speed_out is not None else pump.default_top_velocity
+            rates[pump_name] = 1 / (pump.steps_per_ml / velocity_in + pump.steps_per_ml / velocity_out)
+
+        total_rate = sum(rates.values())
+        return {pump_name: volume_in_ml * rate / total_rate for pump_name, rate in rates.items()}
+
+    def split_transfer(self, group_name: str, volume_in_ml: float, from_valve: str, to_valve: str,
+                       speed_in: int = None, speed_out: int = None) -> Dict[str, float]:
+        """
+        Transfers one large volume with all the pumps of a group working concurrently.
+
+        The volume is shared with split_volume() and each pump runs its own transfer() in a separate thread, so no
+        pump waits for the others between strokes. This function is blocking.
+
+        Args:
+            group_name: Name of the group.
+
+            volume_in_ml: The total volume to transfer.
+
+            from_valve: The valve to transfer from.
+
+            to_valve: The valve to transfer to.
+
+            speed_in: The speed at which to pump, default set to None.
+
+            speed_out: The speed at which to deliver, default set to None.
+
+        Returns:
+            volumes: Dictionary of the volume transferred by each pump.
+
+        """
+        volumes = self.split_volume(self.pumps.in_group(group_name), volume_in_ml, speed_in=speed_in,
+                                    speed_out=speed_out)
+
+        errors = []
+
+        def transfer_share(pump: C3000Controller, pump_volume: float) -> None:
+            try:
+                pump.transfer(pump_volume, from_valve, to_valve, speed_in=speed_in, speed_out=speed_out)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=transfer_share, args=(self.pumps[pump_name], pump_volume))
+                   for pump_name, pump_volume in volumes.items() if pump_volume > 0]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return volumes
+
+    def dispense_queue(self, group_name: str, from_valve: str, to_valve: str,
+                       refill_threshold: float = DEFAULT_REFILL_THRESHOLD, speed_in: int = None) -> DispenseQueue:
+        """
+        Creates and starts a dispense queue on a group of interchangeable pumps, see dispatch.DispenseQueue.
+
+        Args:
+            group_name: Name of the group, all its pumps must hold the same reagent.
+
+            from_valve: The valve to refill from.
+
+            to_valve: The default valve to dispense to.
+
+            refill_threshold: Fraction of the syringe volume under which a pump refills, default set to 0.2.
+
+            speed_in: The speed of refills, default set to None.
+
+        Returns:
+            DispenseQueue: The started queue, submit jobs with submit() and stop it with close().
+
+        """
+        queue = DispenseQueue(self.get_pumps_in_group(group_name), from_valve, to_valve,
+                              refill_threshold=refill_threshold, speed_in=speed_in, clock=self.clock)
+        return queue.start()
+
+    def job_scheduler(self, policy: str = POLICY_EDF, pump_names: List[str] = None) -> PumpScheduler:
+        """
+        Creates and starts a priority/deadline scheduler on the pumps, see scheduler.PumpScheduler.
+
+        Args:
+            policy: 'edf' (earliest deadline first), 'priority' or 'fifo', default set to 'edf'.
+
+            pump_names: The pumps handed to the scheduler, default set to None (all pumps).
+
+        Returns:
+            PumpScheduler: The started scheduler, submit jobs with submit() and stop it with close().
+
+        """
+        if pump_names is None:
+            pump_names = list(self.pumps.keys())
+        scheduler = PumpScheduler({pump_name: self.pumps[pump_name] for pump_name in pump_names}, policy=policy,
+                                  clock=self.clock)
+        return scheduler.start()
+
+    def route_transfer(self, source: str, destination: str, volume_in_ml: float, speed_in: int = None,
+                       speed_out: int = None) -> Route:
+        """
+        Transfers a volume between two vessels of the network through the fastest route, see network.FluidicNetwork.
+
+        Args:
+            source: The vessel to take liquid from.
+
+            destination: The vessel to bring liquid to.
+
+            volume_in_ml: The volume to transfer.
+
+            speed_in: The speed at which to pump, default set to None.
+
+            speed_out: The speed at which to deliver, default set to None.
+
+        Returns:
+            Route: The route that was run.
+
+        Raises:
+            ValueError: No network in the setup config, or the vessels are not connected.
+
+        """
+        if self.network is None:
+            raise ValueError('No network defined in the setup config')
+        return self.network.transfer(source, destination, volume_in_ml, speed_in=speed_in, speed_out=speed_out)
+
+    def run_recipe(self, recipe: Union[Recipe, Dict, str, Path]) -> RecipeReport:
+        """
+        Runs a recipe with as many steps in parallel as dependencies and pumps allow, see recipe.RecipeRunner.
+
+        Args:
+            recipe: A Recipe, a recipe dictionary or the path of a recipe file.
+
+        Returns:
+            RecipeReport: The timeline of the run, with its critical path.
+
+        """
+        if isinstance(recipe, dict):
+            recipe = Recipe.from_config(recipe, self.groups)
+        elif not isinstance(recipe, Recipe):
+            recipe = Recipe.from_configfile(recipe, self.groups)
+        return RecipeRunner(self, recipe).run()
+
+    def run_gradient(self, pump_names: List[str], times: List[float], flow_rates: List[List[float]],
+                     valve: str = None, direction: str = pump_protocol.CMD_DELIVER, segment_duration: float = 1.0,
+                     secure: bool = True) -> bool:
+        """
+        Runs flow-rate curves on the pumps, see gradient.GradientExecutor (requires numpy).
+
+        Args:
+            pump_names: The name of the pumps.
+
+            times: Times of the curve points (in seconds), shared by all curves.
+
+            flow_rates: One flow-rate curve (in mL/s) per pump, sampled at times.
+
+            valve: Valve position set before starting, default set to None.
+
+            direction: 'D' to dispense the curves, 'P' to aspirate them, default set to 'D'.
+
+            segment_duration: Duration of each segment (in seconds), default set to 1.0.
+
+            secure: Ensures that everything is correct, default set to True.
+
+        Returns:
+            True: The gradient ran.
+
+            False: The gradient is not feasible without refilling, nothing was moved.
+
+        """
+        from .gradient import GradientExecutor
+
+        executor = GradientExecutor([self.pumps[pump_name] for pump_name in pump_names], times, flow_rates,
+                                    segment_duration=segment_duration)
+        return executor.run(valve=valve, direction=direction, secure=secure)
+
+    def run_binary_gradient(self, pump_name_a: str, pump_name_b: str, times: List[float],
+                            total_flow_rates: List[float], fractions_b: List[float], valve: str = None,
+                            segment_duration: float = 1.0, secure: bool = True) -> bool:
+        """
+        Delivers a two-pump mixture with a programmed total flow rate and composition (requires numpy).
+
+        Args:
+            pump_name_a: The name of the first pump.
+
+            pump_name_b: The name of the second pump.
+
+            times: Times of the curve points (in seconds).
+
+            total_flow_rates: Total flow rate at each time point (in mL/s).
+
+            fractions_b: Fraction of the flow given by pump_name_b at each time point (from 0 to 1).
+
+            valve: Valve position set before starting, default set to None.
+
+            segment_duration: Duration of each segment (in seconds), default set to 1.0.
+
+            secure: Ensures that everything is correct, default set to True.
+
+        Returns:
+            True: The gradient ran.
+
+            False: The gradient is not feasible without refilling, nothing was moved.
+
+        """
+        from .gradient import binary_gradient_curves
+
+        flow_rates_a, flow_rates_b = binary_gradient_curves(total_flow_rates, fractions_b)
+        return self.run_gradient([pump_name_a, pump_name_b], times, [flow_rates_a, flow_rates_b], valve=valve,
+                                 segment_duration=segment_duration, secure=secure)
+
 
 class VirtualMultiPumpController(MultiPumpController):
-    def __init__(self, setup_config):
-        self.logger = create_logger(self.__class__.__name__)
-        self.pumps = {}
-        self._io = []
+    """
+    This class is a MultiPumpController whose pumps are simulated, see VirtualC3000Controller.
 
-        # Sets groups and default configs if provided in the config dictionary
-        self.groups = setup_config['groups'] if 'groups' in setup_config else {}
-        self.default_config = setup_config['default'] if 'default' in setup_config else {}
+    Args:
+        setup_config: The configuration of the setup.
 
-        if "hubs" in setup_config:  # This implements the "new" behaviour with multiple hubs
-            for hub_config in setup_config["hubs"]:
-                # Each hub has its own I/O config. Create a PumpIO object per each hub and reuse it with -1 after append
-                self._io.append(VirtualPumpIO.from_config(hub_config['io']))
-                for pump_name, pump_config in list(hub_config['pumps'].items()):
-                    full_pump_config = self.default_pump_config(pump_config)
-                    self.pumps[pump_name] = VirtualC3000Controller.from_config(self._io[-1], pump_name, full_pump_config)
-        else:  # This implements the "old" behaviour with one hub per object instance / json file
-            self._io = VirtualPumpIO.from_config(setup_config['io'])
-            for pump_name, pump_config in list(setup_config['pumps'].items()):
-                full_pump_config = self.default_pump_config(pump_config)
-                self.pumps[pump_name] = VirtualC3000Controller.from_config(self._io, pump_name, full_pump_config)
+        time_scale: Speed of the simulated time relative to the wall clock, e.g. 10 runs moves and waits ten times
+            faster, default set to 1 (real time).
 
-        self.set_pumps_as_attributes()
+        clock: The clock shared by the pumps, e.g. a VirtualClock, default set to None (a clock at time_scale).
 
-    def smart_initialize(self, secure=True):
-        pass
+    """
+    persists_state = False
+
+    def __init__(self, setup_config, time_scale=1., clock=None):
+        if clock is None:
+            clock = ScaledClock(time_scale) if time_scale != 1 else SYSTEM_CLOCK
+        super().__init__(setup_config, clock)
+
+    def _create_pump_io(self, io_config):
+        return VirtualPumpIO.from_config(io_config, self.clock)
+
+    def _create_pump(self, pump_io, pump_name, full_pump_config):
+        return VirtualC3000Controller.from_config(pump_io, pump_name, full_pump_config)
@@ -0,0 +1,370 @@
+"""
+.. module:: discovery
+   :platform: Unix
+   :synopsis: A module used for finding the pumps on serial buses and generating the setup config of a rig.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import statistics
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Union, TYPE_CHECKING
+
+from ._logger import create_logger
+
+from . import pump_protocol
+from .migration import SUPPORTED_BAUDRATES
+
+if TYPE_CHECKING:
+    from .controller import PumpIO
+
+#: Time a pump is given to answer a probe (in seconds), a status reply takes about 10 ms at 9600 baud
+PROBE_TIMEOUT = 0.05
+#: Status exchanges timed to measure the round trip time of each pump found
+RTT_SAMPLES = 5
+#: Attempts at reading the configuration of a pump found
+CONFIG_ATTEMPTS = 2
+
+
+def candidate_ports() -> List[str]:
+    """
+    Lists the serial ports of this host, see serial.tools.list_ports.
+
+    Returns:
+        ports: The device names, e.g. ['/dev/ttyUSB0', '/dev/ttyUSB1'].
+
+    """
+    from serial.tools import list_ports
+
+    return sorted(port_info.device for port_info in list_ports.comports())
+
+
+class DiscoveredPump:
+    """
+    This class holds what was found of a pump answering on a bus.
+
+    Args:
+        port: The port of the bus.
+
+        baudrate: The baudrate the pump answers at.
+
+        switch: The position of the address switch of the pump, see C3000SwitchToAddress.
+
+        address: The address of the pump on the bus.
+
+    """
+    def __init__(self, port: str, baudrate: int, switch: str, address: str):
+        self.port = port
+        self.baudrate = baudrate
+        self.switch = switch
+        self.address = address
+
+        #: Median round trip time of a status exchange (in seconds)
+        self.rtt: Optional[float] = None
+        #: More than one pump answers on this address, their replies overlap
+        self.duplicate = False
+        self.initialized: Optional[bool] = None
+        self.eeprom_config: Optional[str] = None
+        #: Valve inferred from the EEPROM, see C3000Controller.get_current_valve_config()
+        self.valve_config: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return 'DiscoveredPump({!r}, switch {!r})'.format(self.port, self.switch)
+
+
+class HubScan:
+    """
+    This class holds the outcome of scanning one port.
+
+    Args:
+        port: The port scanned.
+
+    """
+    def __init__(self, port: str):
+        self.port = port
+
+        #: Baudrate the pumps answer at, None if no pump answered
+        self.baudrate: Optional[int] = None
+        self.pumps: List[DiscoveredPump] = []
+        #: Error that stopped the scan, e.g. the port cannot be opened
+        self.error: Optional[Exception] = None
+        #: Time taken by the scan (in seconds)
+        self.duration = 0.
+
+
+class DiscoveryReport:
+    """
+    This class holds the outcome of a scan of all the candidate ports, see BusScanner.
+
+    Args:
+        hubs: The scan of each port.
+
+        duration: Time taken by the whole scan (in seconds).
+
+    """
+    def __init__(self, hubs: List[HubScan], duration: float):
+        self.hubs = hubs
+        self.duration = duration
+
+    @property
+    def pumps(self) -> List[DiscoveredPump]:
+        """
+        The pumps found, hub by hub.
+        """
+        return [pump for hub in self.hubs for pump in hub.pumps]
+
+    @property
+    def duplicates(self) -> List[DiscoveredPump]:
+        """
+        The addresses answered by more than one pump, their switches must be changed.
+        """
+        return [pump for pump in self.pumps if pump.duplicate]
+
+    def setup_config(self, volume: float = 5, micro_step_mode: int = 2, top_velocity: int = 6000,
+                     timeout: float = 1) -> Dict:
+        """
+        Generates the setup config of the pumps found, in the multi-hub format of MultiPumpController.
+
+        Pumps are named pump_<hub>_<switch>, to rename and group as needed. Duplicate addresses are left out, they
+        cannot be told apart until their switches are changed.
+
+        Args:
+            volume: The syringe volume of all pumps (in ml), it cannot be read from the pumps, default set to 5.
+
+            micro_step_mode: The microstep mode of all pumps, default set to 2.
+
+            top_velocity: The default top velocity of all pumps, default set to 6000.
+
+            timeout: The timeout of the communication on each hub (in seconds), default set to 1.
+
+        Returns:
+            setup_config: The config, see MultiPumpController.
+
+        """
+        hubs = []
+        for hub in self.hubs:
+            pumps = {'pump_{}_{}'.format(len(hubs), pump.switch): {'switch': pump.switch}
+                     for pump in hub.pumps if not pump.duplicate}
+            if pumps:
+                hubs.append({'io': {'port': hub.port, 'baudrate': hub.baudrate, 'timeout': timeout}, 'pumps': pumps})
+        return {
+            'default': {'volume': volume, 'micro_step_mode': micro_step_mode, 'top_velocity': top_velocity},
+            'groups': {},
+            'hubs': hubs,
+        }
+
+    def save_configfile(self, setup_configfile: Union[str, Path], **kwargs) -> None:
+        """
+        Writes the setup config of the pumps found to a file, see setup_config() for the arguments.
+        """
+        with open(setup_configfile, 'w') as f:
+            json.dump(self.setup_config(**kwargs), f, indent=2)
+
+    def summary(self) -> str:
+        """
+        Gives a table of the pumps found, hub by hub.
+        """
+        lines = ['Scanned {} port(s) in {:.2f} s, found {} pump(s)'.format(len(self.hubs), self.duration,
+                                                                         len(self.pumps))]
+        for hub in self.hubs:
+            if hub.error is not None:
+                lines.append('{}: {!r}'.format(hub.port, hub.error))
+                continue
+            if not hub.pumps:
+                lines.append('{}: no pump'.format(hub.port))
+                continue
+            lines.append('{} at {} baud ({:.2f} s):'.format(hub.port, hub.baudrate, hub.duration))
+            for pump in hub.pumps:
+                rtt = '{:.1f} ms'.format(pump.rtt * 1e3) if pump.rtt is not None else '-'
+                lines.append('  switch {} (address {!r}): {}, {}, rtt {}{}'.format(
+                    pump.switch, pump.address, pump.valve_config or 'valve unknown',
+                    'initialised' if pump.initialized else 'not initialised', rtt,
+                    ', DUPLICATE ADDRESS' if pump.duplicate else ''))
+        return '\n'.join(lines)
+
+
+class BusScanner:
+    """
+    This class finds the pumps on serial buses: every address of C3000SwitchToAddress is probed on each port, at each
+    baudrate until pumps answer, with short timeouts. Ports are scanned in parallel, one thread each.
+
+    For each pump found, the round trip time of a status exchange is measured, the EEPROM is read to infer the valve,
+    and the address is checked for a second pump answering along with the first.
+
+    Args:
+        ports: The ports to scan, default set to None (all the serial ports of the host, see candidate_ports()).
+
+        baudrates: The baudrates to try, in order, default set to SUPPORTED_BAUDRATES.
+
+        timeout: Time a pump is given to answer a probe (in seconds), default set to PROBE_TIMEOUT (0.05).
+
+        rtt_samples: Status exchanges timed per pump, default set to RTT_SAMPLES (5).
+
+    """
+    def __init__(self, ports: Iterable[str] = None, baudrates: Sequence[int] = SUPPORTED_BAUDRATES,
+                 timeout: float = PROBE_TIMEOUT, rtt_samples: int = RTT_SAMPLES):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.ports = list(ports) if ports is not None else candidate_ports()
+        self.baudrates = baudrates
+        self.timeout = timeout
+        self.rtt_samples = rtt_samples
+
+    def scan(self) -> DiscoveryReport:
+        """
+        Scans all the ports in parallel.
+
+        Returns:
+            DiscoveryReport: The pumps found on each port.
+
+        """
+        start = time.perf_counter()
+        hubs = [HubScan(port) for port in self.ports]
+        threads = [threading.Thread(target=self.scan_port, args=(hub,), name='scan-{}'.format(hub.port), daemon=True)
+                   for hub in hubs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report = DiscoveryReport(hubs, time.perf_counter() - start)
+        for pump in report.duplicates:
+            self.logger.warning("More than one pump answers on {} switch {}".format(pump.port, pump.switch))
+        return report
+
+    def scan_port(self, hub: HubScan) -> HubScan:
+        """
+        Scans one port, trying each baudrate until pumps answer.
+
+        Args:
+            hub: The scan to fill.
+
+        Returns:
+            HubScan: The same scan, filled.
+
+        """
+        from .controller import PumpIO
+
+        start = time.perf_counter()
+        try:
+            for baudrate in self.baudrates:
+                pump_io = PumpIO(hub.port, baudrate, self.timeout)
+                try:
+                    pumps = self._scan_bus(pump_io)
+                finally:
+                    pump_io.close()
+                if pumps:
+                    hub.baudrate = baudrate
+                    hub.pumps = pumps
+                    break
+        except OSError as err:  # serial.SerialException included
+            self.logger.warning("Cannot scan {}: {!r}".format(hub.port, err))
+            hub.error = err
+        hub.duration = time.perf_counter() - start
+        self.logger.info("{}: {} pump(s) found in {:.2f} s".format(hub.port, len(hub.pumps), hub.duration))
+        return hub
+
+    def _scan_bus(self, pump_io: 'PumpIO') -> List[DiscoveredPump]:
+        from .controller import C3000SwitchToAddress, C3000Broadcast
+
+        pumps = []
+        for switch, address in C3000SwitchToAddress.items():
+            if address == C3000Broadcast:
+                continue
+            pump = DiscoveredPump(pump_io.port, pump_io.baudrate, switch, address)
+            if self._probe(pump_io, pump):
+                self._read_config(pump_io, pump)
+                pumps.append(pump)
+        return pumps
+
+    def _probe(self, pump_io: 'PumpIO', pump: DiscoveredPump) -> bool:
+        """
+        Sends status requests to an address, timing the replies and watching for overlapping ones.
+        """
+        from .controller import PumpIOTimeOutError
+
+        protocol = pump_protocol.C3000Protocol(pump.address)
+        packet = protocol.forge_report_status_packet()
+        rtts = []
+        garbled = 0
+        for i in range(self.rtt_samples):
+            start = time.perf_counter()
+            try:
+                response = pump_io.write_and_readline(packet)
+            except PumpIOTimeOutError:
+                if i == 0:
+                    return False  # Nobody on this address, one timeout is all it costs
+                continue
+            rtt = time.perf_counter() - start
+            decoded_response = protocol.decode_packet(response)
+            if decoded_response is None or decoded_response[0] != '0':
+                garbled += 1
+                continue
+            rtts.append(rtt)
+            if len(rtts) == 1:
+                try:
+                    pump_io.readline()  # A second pump on the address answers right after the first
+                    pump.duplicate = True
+                except PumpIOTimeOutError:
+                    pass
+        if not rtts:
+            return False  # Only noise, e.g. pumps set to another baudrate
+        if garbled:
+            pump.duplicate = True  # Replies mangled on the wire, e.g. two pumps talking at once
+        pump.rtt = statistics.median(rtts)
+        return True
+
+    def _read_config(self, pump_io: 'PumpIO', pump: DiscoveredPump) -> None:
+        from .controller import C3000Controller, ControllerRepeatedError
+
+        # The volume is not read from the pump, the config reads below do not depend on it
+        controller = C3000Controller(pump_io, 'switch_{}'.format(pump.switch), pump.address, 5,
+                                     retry_policy={'attempts': CONFIG_ATTEMPTS}, circuit_breaker=False)
+        try:
+            pump.initialized = controller.is_initialized()
+            pump.valve_config = controller.get_current_valve_config()
+            pump.eeprom_config = controller.last_known.get('eeprom_config')
+        except (ControllerRepeatedError, ValueError, IndexError) as err:  # Garbled or unexpected EEPROM reply
+            self.logger.debug("Cannot read the configuration of {} switch {}: {!r}".format(pump.port, pump.switch,
+                                                                                         err))
+
+
+def discover(ports: Iterable[str] = None, **kwargs) -> DiscoveryReport:
+    """
+    Finds the pumps on serial buses, see BusScanner for the arguments.
+
+    Returns:
+        DiscoveryReport: The pumps found, report.setup_config() gives a config to start a MultiPumpController with.
+
+    """
+    return BusScanner(ports, **kwargs).scan()
+
+
+def main(argv: Sequence[str] = None) -> None:
+    """
+    Scans buses and writes the setup config: python -m pycont.discovery /dev/ttyUSB0 /dev/ttyUSB1 -o setup.json
+    """
+    parser = argparse.ArgumentParser(description='Finds the pumps on serial buses and generates the setup config.')
+    parser.add_argument('ports', nargs='*', help='The ports to scan, all the serial ports of the host by default')
+    parser.add_argument('-o', '--output', help='The setup config file to write')
+    parser.add_argument('--volume', type=float, default=5, help='The syringe volume of the pumps (in ml)')
+    parser.add_argument('--timeout', type=float, default=PROBE_TIMEOUT, help='Time a pump is given to answer (in s)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    report = discover(args.ports or None, timeout=args.timeout)
+    print(report.summary())
+    if args.output:
+        report.save_configfile(args.output, volume=args.volume)
+        print('Setup config written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""
+.. module:: dispatch
+   :platform: Unix
+   :synopsis: A module used for dispatching dispense jobs to interchangeable pumps.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, TYPE_CHECKING
+
+from ._logger import create_logger
+from .clock import Clock, SYSTEM_CLOCK, clock_of
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller
+
+#: Default fraction of the syringe volume under which a pump refills in the background
+DEFAULT_REFILL_THRESHOLD = 0.2
+
+
+class DispenseJob:
+    """
+    This class represents one dispense submitted to a DispenseQueue.
+
+    Args:
+        volume_in_ml: The volume to dispense.
+
+        to_valve: The valve to dispense to, None to use the queue default.
+
+        speed_out: The speed of delivery, default set to None.
+
+        clock: The clock of the pumps, timing the job, default set to None (SYSTEM_CLOCK).
+
+    """
+    def __init__(self, volume_in_ml: float, to_valve: str = None, speed_out: int = None, clock: Clock = None):
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.volume_in_ml = volume_in_ml
+        self.to_valve = to_valve
+        self.speed_out = speed_out
+
+        #: Name of the pump that ran the job, None until taken
+        self.pump_name: Optional[str] = None
+        #: Exception raised while running the job, if any
+        self.error: Optional[Exception] = None
+        self.submitted_at = self.clock.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        """
+        Determines if the job has finished (successfully or not).
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits until the job has finished.
+
+        Args:
+            timeout: Maximum time to wait (in seconds), default set to None (no limit).
+
+        Returns:
+            True: The job has finished.
+
+            False: The timeout expired first.
+
+        """
+        return self._done.wait(timeout)
+
+
+class DispenseQueue:
+    """
+    This class dispatches dispense jobs to a group of pumps holding the same reagent.
+
+    Each pump of the group has a worker thread. Whenever a pump is idle and holds enough volume it takes the next
+    job of the shared queue, so that no job waits behind a specific pump. A pump running low refills in the
+    background while the others keep dispensing. A pump that fails leaves the queue, and once no pump is left the
+    queued jobs fail.
+
+    Args:
+        pumps: The interchangeable pumps.
+
+        from_valve: The valve to refill from.
+
+        to_valve: The default valve to dispense to.
+
+        refill_threshold: Fraction of the syringe volume under which a pump refills, default set to
+            DEFAULT_REFILL_THRESHOLD (0.2).
+
+        speed_in: The speed of refills, default set to None.
+
+        clock: The clock timing the jobs, default set to None (the clock of the pumps).
+
+    """
+    def __init__(self, pumps: List['C3000Controller'], from_valve: str, to_valve: str,
+                 refill_threshold: float = DEFAULT_REFILL_THRESHOLD, speed_in: int = None, clock: Clock = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.pumps = pumps
+        self.clock = clock if clock is not None else clock_of(pumps)
+        self.from_valve = from_valve
+        self.to_valve = to_valve
+        self.refill_threshold = refill_threshold
+        self.speed_in = speed_in
+
+        self._jobs: Deque[DispenseJob] = deque()
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._workers: List[threading.Thread] = []
+        self._live_workers = 0
+
+        self.started_at: Optional[float] = None
+        self._stats = {pump.name: {'jobs': 0, 'volume': 0.0, 'dispensing': 0.0, 'refilling': 0.0}
+                       for pump in self.pumps}
+
+    def start(self) -> 'DispenseQueue':
+        """
+        Starts one worker thread per pump.
+
+        Returns:
+            self, so that the queue can be created and started in one line.
+
+        """
+        self.started_at = self.clock.time()
+        self._live_workers = len(self.pumps)
+        for pump in self.pumps:
+            worker = threading.Thread(target=self._work, args=(pump,), name='dispense-{}'.format(pump.name),
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def submit(self, volume_in_ml: float, to_valve: str = None, speed_out: int = None) -> DispenseJob:
+        """
+        Adds a dispense job to the queue.
+
+        Args:
+            volume_in_ml: The volume to dispense.
+
+            to_valve: The valve to dispense to, default set to None (queue default).
+
+            speed_out: The speed of delivery, default set to None.
+
+        Returns:
+            job: The submitted job, use job.wait() to block until it has run.
+
+        Raises:
+            ValueError: The queue is closed, or no pump is left in it.
+
+        """
+        job = DispenseJob(volume_in_ml, to_valve, speed_out, self.clock)
+        with self._condition:
+            if self._closed:
+                raise ValueError('Cannot submit to a closed DispenseQueue')
+            if self._workers and self._live_workers == 0:
+                raise ValueError('No pump left in the DispenseQueue')
+            self._jobs.append(job)
+            self._pending += 1
+            self._condition.notify_all()
+        return job
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Waits until every submitted job has run, or failed because no pump is left.
+
+        Args:
+            timeout: Maximum time to wait (in seconds), default set to None (no limit).
+
+        Returns:
+            True: All jobs have run.
+
+            False: The timeout expired first.
+
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Stops accepting jobs, the workers exit once the queue is empty.
+
+        Args:
+            wait: Waits for the queued jobs and the workers to finish, default set to True.
+
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def utilisation(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Reports the work done by each pump since start().
+
+        Returns:
+            report: For each pump name, the number of jobs, the volume dispensed, the time spent dispensing and
+            refilling (in seconds), and the busy fraction of the elapsed time.
+
+        """
+        elapsed = self.clock.time() - self.started_at if self.started_at is not None else 0.
+        report = {}
+        for pump_name, stats in self._stats.items():
+            busy = stats['dispensing'] + stats['refilling']
+            report[pump_name] = dict(stats, utilisation=busy / elapsed if elapsed > 0 else 0.)
+        return report
+
+    def _next_job(self, pump: 'C3000Controller') -> Optional[DispenseJob]:
+        """
+        Blocks until the pump can take the next job, returns None when the pump should refill or the queue is over.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._jobs or self._closed)
+                if not self._jobs:
+                    return None
+                job = self._jobs[0]
+            # Reading the volume may resync the plunger over the bus, which must not hold up the other workers.
+            # A full pump takes any job, larger jobs are dispensed over several strokes.
+            can_take = pump.volume_to_step(pump.remaining_volume) <= 0 or pump.is_volume_deliverable(job.volume_in_ml)
+            with self._condition:
+                if not self._jobs or self._jobs[0] is not job:
+                    continue  # Taken by another pump meanwhile, look at the next one
+                return self._jobs.popleft() if can_take else None
+
+    def _refill(self, pump: 'C3000Controller') -> None:
+        start = self.clock.time()
+        pump.pump(pump.remaining_volume, from_valve=self.from_valve, speed_in=self.speed_in, wait=True)
+        self._stats[pump.name]['refilling'] += self.clock.time() - start
+
+    def _run(self, pump: 'C3000Controller', job: DispenseJob) -> None:
+        stats = self._stats[pump.name]
+        refilling_before = stats['refilling']
+
+        job.pump_name = pump.name
+        job.started_at = self.clock.time()
+        to_valve = job.to_valve if job.to_valve is not None else self.to_valve
+        try:
+            volume_left = job.volume_in_ml
+            while volume_left > 0:
+                if pump.current_volume <= 0:
+                    self._refill(pump)
+                stroke_volume = min(volume_left, pump.current_volume)
+                pump.deliver(stroke_volume, to_valve=to_valve, speed_out=job.speed_out, wait=True)
+                volume_left -= stroke_volume
+        except Exception as err:
+            self.logger.warning("[PUMP {}] Dispense job failed: {}".format(pump.name, err))
+            job.error = err
+        job.finished_at = self.clock.time()
+
+        stats['jobs'] += 1
+        stats['volume'] += job.volume_in_ml
+        stats['dispensing'] += job.finished_at - job.started_at - (stats['refilling'] - refilling_before)
+
+        job._done.set()
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify_all()
+
+    def _work(self, pump: 'C3000Controller') -> None:
+        try:
+            self._serve(pump)
+        finally:
+            with self._condition:
+                self._live_workers -= 1
+                if self._live_workers == 0 and self._jobs:
+                    self._fail_queued_jobs()
+
+    def _fail_queued_jobs(self) -> None:
+        """
+        Fails the queued jobs once every pump has left the queue, called holding the condition.
+        """
+        self.logger.warning("No pump left, failing {} queued jobs".format(len(self._jobs)))
+        while self._jobs:
+            job = self._jobs.popleft()
+            job.error = RuntimeError('No pump left in the DispenseQueue')
+            job.finished_at = self.clock.time()
+            job._done.set()
+            self._pending -= 1
+        self._condition.notify_all()
+
+    def _serve(self, pump: 'C3000Controller') -> None:
+        while True:
+            job = self._next_job(pump)
+            if job is None:
+                with self._condition:
+                    if self._closed and not self._jobs:
+                        return
+            try:
+                if job is not None:
+                    self._run(pump, job)
+                    if pump.current_volume >= self.refill_threshold * pump.total_volume:
+                        continue
+                # Either running low or the next job needs more than this pump holds: refill while the others dispense
+                self._refill(pump)
+            except Exception as err:
+                self.logger.warning("[PUMP {}] Pump failed, leaving the queue: {}".format(pump.name, err))
+                return
@@ -0,0 +1,278 @@
+"""
+.. module:: dryrun
+   :platform: Unix
+   :synopsis: A module used for predicting the duration and bus load of a script on simulated pumps.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import functools
+import threading
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING, Union
+
+from ._logger import create_logger
+
+from .clock import VirtualClock
+from .simulation import BITS_PER_BYTE, REPLY_OVERHEAD_BYTES, DEFAULT_TURNAROUND
+from .virtual import VALVE_COMMANDS
+
+if TYPE_CHECKING:
+    from .controller import VirtualC3000Controller, VirtualMultiPumpController
+
+#: Pump operations recorded as steps
+RECORDED_PUMP_OPERATIONS = ('smart_initialize', 'initialize', 'set_valve_position', 'pump', 'deliver', 'transfer',
+                            'go_to_volume', 'go_to_max_volume', 'run_move_sequence', 'wait_until_idle', 'terminate')
+#: MultiPumpController operations recorded as steps
+RECORDED_CONTROLLER_OPERATIONS = ('smart_initialize', 'pump', 'deliver', 'transfer', 'parallel_transfer',
+                                  'split_volume', 'split_transfer', 'route_transfer', 'run_recipe', 'run_gradient',
+                                  'run_binary_gradient', 'wait_until_all_pumps_idle', 'wait_until_group_idle',
+                                  'terminate_all_pumps')
+
+#: Target of the steps issued to the MultiPumpController
+CONTROLLER_TARGET = 'controller'
+
+
+class DryRunStep:
+    """
+    This class records one operation issued by a script.
+
+    Args:
+        target: Name of the pump, or CONTROLLER_TARGET.
+
+        operation: Name of the method called.
+
+        arguments: The arguments of the call, formatted.
+
+        started_at: Simulated time of the call (in seconds from the start of the dry run).
+
+        depth: Nesting level, 0 for operations called by the script itself.
+
+    """
+    def __init__(self, target: str, operation: str, arguments: str, started_at: float, depth: int):
+        self.target = target
+        self.operation = operation
+        self.arguments = arguments
+        self.started_at = started_at
+        self.depth = depth
+
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+
+    @property
+    def feasible(self) -> bool:
+        """
+        Determines if the operation ran, i.e. it neither returned False nor raised.
+        """
+        return self.result is not False and self.error is None
+
+    @property
+    def duration(self) -> float:
+        return self.finished_at - self.started_at if self.finished_at is not None else 0.
+
+    def __str__(self):
+        outcome = '' if self.feasible else ' -> {}'.format(repr(self.error) if self.error is not None else 'False')
+        return "{:9.2f}s {:8.2f}s {}{} {}({}){}".format(self.started_at, self.duration, '  ' * self.depth, self.target,
+                                                       self.operation, self.arguments, outcome)
+
+
+class DryRunReport:
+    """
+    This class holds the predicted timeline of a script.
+    """
+    def __init__(self, steps: List[DryRunStep], makespan: float, pump_busy_time: Dict[str, float],
+                 bus_occupancy: Dict[str, float], exchanges: Dict[str, int], aborted: Exception = None):
+        self.steps = steps
+        #: Predicted duration of the script, until the last move ends (in seconds)
+        self.makespan = makespan
+        #: Time each pump is moving, by pump name (in seconds)
+        self.pump_busy_time = pump_busy_time
+        #: Time each bus carries exchanges, by port (in seconds)
+        self.bus_occupancy = bus_occupancy
+        #: Number of exchanges on each bus, by port
+        self.exchanges = exchanges
+        #: Exception that stopped the script, None if it ran to the end
+        self.aborted = aborted
+
+    @property
+    def infeasible_steps(self) -> List[DryRunStep]:
+        return [step for step in self.steps if not step.feasible]
+
+    def fits(self, available_time: float) -> bool:
+        """
+        Determines if the script runs to the end, without infeasible step, within some time.
+
+        Args:
+            available_time: The time available (in seconds), e.g. what is left of a shift.
+
+        """
+        return self.aborted is None and not self.infeasible_steps and self.makespan <= available_time
+
+    def timeline(self, max_depth: int = None) -> str:
+        """
+        Formats the steps, one per line: start time, duration, target and operation.
+
+        Args:
+            max_depth: Deepest nesting level shown, default set to None (all).
+
+        """
+        return '\n'.join(str(step) for step in self.steps if max_depth is None or step.depth <= max_depth)
+
+    def summary(self) -> str:
+        """
+        Formats the makespan, busy times, bus occupancy and infeasible steps.
+        """
+        lines = ['Makespan {:.1f}s{}'.format(self.makespan, ', aborted by {!r}'.format(self.aborted)
+                                             if self.aborted is not None else '')]
+        for pump_name, busy_time in sorted(self.pump_busy_time.items()):
+            lines.append('  pump {}: busy {:.1f}s ({:.0%})'.format(
+                pump_name, busy_time, busy_time / self.makespan if self.makespan > 0 else 0.))
+        for port, occupancy in sorted(self.bus_occupancy.items()):
+            lines.append('  bus {}: {} exchanges, occupied {:.1f}s ({:.0%})'.format(
+                port, self.exchanges[port], occupancy, occupancy / self.makespan if self.makespan > 0 else 0.))
+        for step in self.infeasible_steps:
+            lines.append('  infeasible: {}'.format(str(step).strip()))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return "DryRunReport(makespan={:.1f}s, {} steps, {} infeasible)".format(
+            self.makespan, len(self.steps), len(self.infeasible_steps))
+
+
+class DryRun:
+    """
+    This class runs a script against simulated pumps in virtual time and records what it does.
+
+    The controller given is a virtual twin of the setup (see MultiPumpController.dry_run() and
+    C3000Controller.dry_run()): its pumps start from the state known of the real pumps, the clock is a VirtualClock so
+    that waits take no time, and each exchange takes the time of its bytes on the bus at the baudrate of its hub.
+    The operations issued are recorded with their simulated start and end, an operation returning False (e.g. pump()
+    of a volume that does not fit) or raising is infeasible. No hardware is touched.
+
+    Each simulated pump starts initialised with its config applied, with the plunger, valve position and top
+    velocity of its state when they are known, and otherwise with the plunger at 0 and the valve at its initialisation
+    position. A pump known not to be initialised starts from power-up.
+
+    Args:
+        controller: The VirtualMultiPumpController or VirtualC3000Controller to run the script on.
+
+        turnaround: Time a pump takes to start replying (in seconds), default set to DEFAULT_TURNAROUND.
+
+        states: The state known of each real pump, by pump name (see state.pump_snapshot()), default set to None
+            (nothing known).
+
+    """
+    def __init__(self, controller: Union['VirtualMultiPumpController', 'VirtualC3000Controller'],
+                 turnaround: float = DEFAULT_TURNAROUND, states: Dict[str, Dict[str, Any]] = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.controller = controller
+        self.turnaround = turnaround
+        self.pumps = controller.pumps if hasattr(controller, 'pumps') else {controller.name: controller}
+        self.clock = next(iter(self.pumps.values())).clock
+        if not isinstance(self.clock, VirtualClock):
+            raise ValueError('A dry run needs pumps on a VirtualClock')
+        self.started_at = self.clock.time()
+
+        self.steps: List[DryRunStep] = []
+        self.bus_occupancy: Dict[str, float] = {}
+        self.exchanges: Dict[str, int] = {}
+        self.aborted: Optional[Exception] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        for pump_name, pump in self.pumps.items():
+            self._seed(pump, states.get(pump_name, {}) if states is not None else {})
+            self.bus_occupancy.setdefault(pump._io.port, 0.)
+            self.exchanges.setdefault(pump._io.port, 0)
+            pump.write_and_read_from_pump = self._timed_exchange(pump, pump.write_and_read_from_pump)
+            for operation in RECORDED_PUMP_OPERATIONS:
+                setattr(pump, operation, self._recorded(pump_name, operation, getattr(pump, operation)))
+        if controller is not next(iter(self.pumps.values())):
+            for operation in RECORDED_CONTROLLER_OPERATIONS:
+                setattr(controller, operation, self._recorded(CONTROLLER_TARGET, operation,
+                                                              getattr(controller, operation)))
+
+    @staticmethod
+    def _seed(pump: 'VirtualC3000Controller', state: Dict[str, Any]) -> None:
+        """
+        Puts a simulated pump in the known state of the real one, see DryRun.
+        """
+        if state.get('initialized') is False:
+            return
+        valve_position = state.get('valve_position')
+        if valve_position is None:
+            valve_position = VALVE_COMMANDS.get(pump.initialize_valve_position, pump.initialize_valve_position)
+        top_velocity = state.get('top_velocity')
+        plunger_steps = state.get('plunger_steps')
+        pump.device.set_initialized_state(pump.micro_step_mode,
+                                          top_velocity if top_velocity is not None else pump.default_top_velocity,
+                                          valve_position, plunger_steps if plunger_steps is not None else 0)
+
+    def run(self, script: Callable[..., Any], *args, **kwargs) -> DryRunReport:
+        """
+        Runs a script and reports its predicted timeline.
+
+        Args:
+            script: Called with the controller as first argument, followed by args and kwargs.
+
+        Returns:
+            DryRunReport: The predicted timeline, also when the script raised.
+
+        """
+        try:
+            script(self.controller, *args, **kwargs)
+        except Exception as err:
+            self.logger.info("Dry run aborted by {!r}".format(err))
+            self.aborted = err
+        return self.report()
+
+    def report(self) -> DryRunReport:
+        """
+        Reports the timeline recorded so far.
+        """
+        # Moves started without waiting still run after the script returned
+        remaining = max(max(pump.device.busy_until - pump.device.now() for pump in self.pumps.values()), 0.)
+        return DryRunReport(list(self.steps), self.clock.time() - self.started_at + remaining,
+                            {pump_name: pump.device.busy_time for pump_name, pump in self.pumps.items()},
+                            dict(self.bus_occupancy), dict(self.exchanges), self.aborted)
+
+    def _timed_exchange(self, pump, exchange: Callable) -> Callable:
+        port = pump._io.port
+        baudrate = pump._io.baudrate
+
+        @functools.wraps(exchange)
+        def timed_exchange(packet, max_repeat=None, priority=None):
+            reply = exchange(packet, max_repeat, priority)
+            n_bytes = len(packet.to_string()) + REPLY_OVERHEAD_BYTES + len(reply[2])
+            duration = n_bytes * BITS_PER_BYTE / baudrate + self.turnaround
+            self.clock.sleep(duration)
+            with self._lock:
+                self.bus_occupancy[port] += duration
+                self.exchanges[port] += 1
+            return reply
+        return timed_exchange
+
+    def _recorded(self, target: str, operation: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def recorded(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            arguments = ', '.join([repr(arg) for arg in args] +
+                                  ['{}={!r}'.format(key, value) for key, value in kwargs.items()])
+            step = DryRunStep(target, operation, arguments, self.clock.time() - self.started_at, depth)
+            with self._lock:
+                self.steps.append(step)
+            self._local.depth = depth + 1
+            try:
+                step.result = method(*args, **kwargs)
+                return step.result
+            except Exception as err:
+                step.error = err
+                raise
+            finally:
+                self._local.depth = depth
+                step.finished_at = self.clock.time() - self.started_at
+        return recorded
@@ -7,6 +7,7 @@ from ._logger import create_logger
 
 DTStart = '/'
 DTStop = '\r'
+DTEnd = '\x03'
 
 
 class DTCommand(object):
@@ -88,14 +89,17 @@ class DTStatus(object):
             self.response = None  # type: ignore
 
     def decode(self) -> Optional[Tuple[str, str, str]]:
-        if self.response is not None:
-            info = self.response.rstrip().rstrip('\x03').lstrip(DTStart)
-            address = info[0]
-            # try:
-            status = info[1]
-            data = info[2:]
-            # except IndexError:
-            #     return None
-            return address, status, data
-        else:
+        if self.response is None:
+            return None
+        # A complete reply is /<address><status><data>ETX, a frame cut short would give truncated data
+        if not self.response.startswith(DTStart) or DTEnd not in self.response:
+            self.logger.debug('Incomplete frame {!r}'.format(self.response))
+            return None
+        info = self.response.rstrip().rstrip(DTEnd).lstrip(DTStart)
+        if len(info) < 2:
+            self.logger.debug('Incomplete frame {!r}'.format(self.response))
             return None
+        address = info[0]
+        status = info[1]
+        data = info[2:]
+        return address, status, data
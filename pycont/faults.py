@@ -0,0 +1,373 @@
+"""
+.. module:: faults
+   :platform: Unix
+   :synopsis: A module used for injecting communication faults between a PumpIO and its pumps and measuring their cost.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import math
+import random
+import time
+from typing import Callable, Dict, List, Optional, Sequence, TYPE_CHECKING
+
+from ._logger import create_logger
+
+from . import pump_protocol
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller, PumpIO
+
+#: Latency distributions known to FaultMix.from_config(), by name
+LATENCY_CONSTANT = 'constant'
+LATENCY_UNIFORM = 'uniform'
+LATENCY_EXPONENTIAL = 'exponential'
+LATENCY_LOGNORMAL = 'lognormal'
+
+#: Percentiles reported by FaultReport.summary()
+REPORTED_PERCENTILES = (50, 95, 99)
+
+
+def constant_latency(delay: float) -> Callable[[random.Random], float]:
+    """
+    Creates a latency distribution always giving the same delay (in seconds).
+    """
+    return lambda rng: delay
+
+
+def uniform_latency(low: float, high: float) -> Callable[[random.Random], float]:
+    """
+    Creates a latency distribution uniform between low and high (in seconds).
+    """
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential_latency(mean: float) -> Callable[[random.Random], float]:
+    """
+    Creates an exponential latency distribution of the given mean (in seconds).
+    """
+    return lambda rng: rng.expovariate(1. / mean) if mean > 0 else 0.
+
+
+def lognormal_latency(median: float, sigma: float) -> Callable[[random.Random], float]:
+    """
+    Creates a log-normal latency distribution of the given median (in seconds), sigma sets the length of the tail.
+    """
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+LATENCY_DISTRIBUTIONS = {
+    LATENCY_CONSTANT: constant_latency,
+    LATENCY_UNIFORM: uniform_latency,
+    LATENCY_EXPONENTIAL: exponential_latency,
+    LATENCY_LOGNORMAL: lognormal_latency,
+}
+
+
+class FaultMix:
+    """
+    This class describes the faults injected in the replies of the pumps.
+
+    Each reply is delayed by a latency drawn from the latency distribution, then at most one fault is injected, drawn
+    with the given rates: the reply is dropped (the pump executed the command but the reply is lost), truncated
+    (only its beginning arrives, after the timeout), corrupted (a bit of one byte is flipped) or its status is
+    replaced by a hardware error status.
+
+    Args:
+        latency: Latency distribution, see constant_latency() and the like, default set to None (no added latency).
+
+        drop_rate: Fraction of the replies dropped, default set to 0.
+
+        truncation_rate: Fraction of the replies truncated, default set to 0.
+
+        corruption_rate: Fraction of the replies corrupted, default set to 0.
+
+        error_status_rate: Fraction of the replies given a hardware error status, default set to 0.
+
+        error_statuses: Error statuses drawn from, default set to None (pump_protocol.ERROR_STATUSES_IDLE).
+
+        seed: Seed of the random draws, to replay the same faults, default set to None.
+
+    Raises:
+        ValueError: The rates add up to more than 1.
+
+    """
+    def __init__(self, latency: Callable[[random.Random], float] = None, drop_rate: float = 0.,
+                 truncation_rate: float = 0., corruption_rate: float = 0., error_status_rate: float = 0.,
+                 error_statuses: Sequence[str] = None, seed: int = None):
+        if drop_rate + truncation_rate + corruption_rate + error_status_rate > 1:
+            raise ValueError('Fault rates add up to more than 1')
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.truncation_rate = truncation_rate
+        self.corruption_rate = corruption_rate
+        self.error_status_rate = error_status_rate
+        self.error_statuses = error_statuses if error_statuses is not None else pump_protocol.ERROR_STATUSES_IDLE
+        self.seed = seed
+
+    @classmethod
+    def from_config(cls, fault_config: Dict) -> 'FaultMix':
+        """
+        Creates a fault mix from its configuration dictionary.
+
+        Args:
+            cls: The initialising class.
+
+            fault_config: Dictionary holding any of the FaultMix arguments, the latency being a dictionary holding the
+                name of the distribution and its arguments, e.g. {"distribution": "lognormal", "median": 0.01,
+                "sigma": 1}.
+
+        Returns:
+            FaultMix: New FaultMix object.
+
+        Raises:
+            ValueError: Unknown latency distribution.
+
+        """
+        fault_config = dict(fault_config)
+        latency_config = fault_config.pop('latency', None)
+        if latency_config is not None:
+            latency_config = dict(latency_config)
+            distribution = latency_config.pop('distribution')
+            if distribution not in LATENCY_DISTRIBUTIONS:
+                raise ValueError('Unknown latency distribution {}, use one of {}'.format(
+                    distribution, list(LATENCY_DISTRIBUTIONS)))
+            fault_config['latency'] = LATENCY_DISTRIBUTIONS[distribution](**latency_config)
+        return cls(**fault_config)
+
+
+class FaultInjectingSerial:
+    """
+    This class wraps the serial port of a PumpIO and injects the faults of a FaultMix in the replies.
+
+    Commands are written to the pumps unchanged, only the replies are altered. Dropped and truncated replies take the
+    timeout of the port to arrive, as they would on the bus.
+
+    Args:
+        serial_port: The serial port to wrap.
+
+        fault_mix: The faults to inject.
+
+    """
+    def __init__(self, serial_port, fault_mix: FaultMix):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.serial_port = serial_port
+        self.fault_mix = fault_mix
+        self.rng = random.Random(fault_mix.seed)
+
+        #: Number of replies read and of each injected fault
+        self.counts = {'replies': 0, 'dropped': 0, 'truncated': 0, 'corrupted': 0, 'error_status': 0}
+
+    def __getattr__(self, name):
+        return getattr(self.serial_port, name)
+
+    def write(self, data: bytes) -> int:
+        return self.serial_port.write(data)
+
+    def readline(self) -> bytes:
+        reply = self.serial_port.readline()
+        self.counts['replies'] += 1
+        mix = self.fault_mix
+        if mix.latency is not None:
+            time.sleep(max(mix.latency(self.rng), 0.))
+        if not reply:
+            return reply
+
+        draw = self.rng.random()
+        if draw < mix.drop_rate:
+            self.counts['dropped'] += 1
+            self._wait_timeout()
+            return b''
+        draw -= mix.drop_rate
+        if draw < mix.truncation_rate:
+            self.counts['truncated'] += 1
+            self._wait_timeout()
+            return reply[:self.rng.randrange(len(reply))]
+        draw -= mix.truncation_rate
+        if draw < mix.corruption_rate:
+            self.counts['corrupted'] += 1
+            position = self.rng.randrange(len(reply))
+            corrupted = bytearray(reply)
+            corrupted[position] ^= 1 << self.rng.randrange(8)
+            return bytes(corrupted)
+        draw -= mix.corruption_rate
+        if draw < mix.error_status_rate and len(reply) > 2:
+            self.counts['error_status'] += 1
+            # The status follows the start character and the address
+            return reply[:2] + self.rng.choice(mix.error_statuses).encode() + reply[3:]
+        return reply
+
+    def _wait_timeout(self) -> None:
+        timeout = getattr(self.serial_port, 'timeout', None)
+        if timeout:
+            time.sleep(timeout)
+
+
+def inject_faults(pump_io: 'PumpIO', fault_mix: FaultMix) -> FaultInjectingSerial:
+    """
+    Starts injecting faults in the replies read by a PumpIO, until remove_faults() or the port is reopened. The port
+    is opened first if it is not open yet.
+
+    Args:
+        pump_io: The PumpIO of the hub.
+
+        fault_mix: The faults to inject.
+
+    Returns:
+        FaultInjectingSerial: The wrapper now used by the PumpIO, holding the counts of injected faults.
+
+    """
+    pump_io.connect()
+    with pump_io.lock:
+        pump_io._serial = FaultInjectingSerial(_unwrap(pump_io._serial), fault_mix)
+        return pump_io._serial
+
+
+def remove_faults(pump_io: 'PumpIO') -> None:
+    """
+    Stops injecting faults in the replies read by a PumpIO.
+
+    Args:
+        pump_io: The PumpIO of the hub.
+
+    """
+    with pump_io.lock:
+        pump_io._serial = _unwrap(pump_io._serial)
+
+
+def _unwrap(serial_port):
+    while isinstance(serial_port, FaultInjectingSerial):
+        serial_port = serial_port.serial_port
+    return serial_port
+
+
+class FaultReport:
+    """
+    This class holds the outcome of a series of exchanges under a fault mix.
+
+    Args:
+        name: Name of the fault mix.
+
+    """
+    def __init__(self, name: str):
+        self.name = name
+
+        #: Duration of each call to write_and_read_from_pump(), failed calls included (in seconds)
+        self.latencies: List[float] = []
+        #: Number of calls that went through, that returned a hardware error status and that failed
+        self.succeeded = 0
+        self.error_statuses = 0
+        self.failed = 0
+        #: Number of replies read from the bus, retries included, and of each injected fault
+        self.fault_counts: Dict[str, int] = {}
+        self.duration = 0.
+
+    @property
+    def requests(self) -> int:
+        return self.succeeded + self.error_statuses + self.failed
+
+    @property
+    def retries(self) -> int:
+        """
+        Number of exchanges made on top of one per request.
+        """
+        return max(self.fault_counts.get('replies', 0) - self.requests, 0)
+
+    @property
+    def throughput(self) -> float:
+        """
+        Effective throughput, the calls that went through per second.
+        """
+        return self.succeeded / self.duration if self.duration > 0 else 0.
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Gets a percentile of the latencies (in seconds), None if there are none.
+
+        Args:
+            percent: The percentile, from 0 to 100.
+
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        rank = max(int(math.ceil(percent / 100. * len(latencies))) - 1, 0)
+        return latencies[rank]
+
+    def summary(self) -> str:
+        """
+        Formats the report on one line.
+        """
+        percentiles = ', '.join('p{} {:.1f}ms'.format(percent, self.percentile(percent) * 1000)
+                                for percent in REPORTED_PERCENTILES) if self.latencies else 'no calls'
+        return "{}: {:.1f} calls/s, {}, max {:.1f}ms, {} retries, {} errors, {} failed out of {}".format(
+            self.name, self.throughput, percentiles, max(self.latencies, default=0) * 1000, self.retries,
+            self.error_statuses, self.failed, self.requests)
+
+    def __repr__(self):
+        return "FaultReport({})".format(self.summary())
+
+
+def benchmark_faults(pumps: Sequence['C3000Controller'], fault_mixes: Dict[str, FaultMix],
+                     requests: int = 100) -> Dict[str, FaultReport]:
+    """
+    Measures the cost of each fault mix on status requests sent to a set of pumps in turn.
+
+    Faults are injected in the PumpIO of every pump and removed after each mix. The circuit breakers are reset
+    before each mix so that mixes are measured independently, but they stay active during it.
+
+    Args:
+        pumps: The pumps to send the requests to.
+
+        fault_mixes: The fault mixes to measure, by name, e.g. {'clean': FaultMix(), 'noisy': FaultMix(...)}.
+
+        requests: Number of requests under each mix, default set to 100.
+
+    Returns:
+        reports: The report of each mix, by name.
+
+    """
+    from .controller import ControllerRepeatedError
+
+    logger = create_logger('benchmark_faults')
+    pump_ios: List['PumpIO'] = []
+    for pump in pumps:
+        if all(pump._io is not pump_io for pump_io in pump_ios):
+            pump_ios.append(pump._io)
+
+    reports = {}
+    for name, fault_mix in fault_mixes.items():
+        report = FaultReport(name)
+        wrappers = [inject_faults(pump_io, fault_mix) for pump_io in pump_ios]
+        for pump in pumps:
+            pump.reset_circuit_breaker()
+        try:
+            start_time = time.time()
+            for i in range(requests):
+                pump = pumps[i % len(pumps)]
+                request_time = time.time()
+                try:
+                    (_, status, _) = pump.write_and_read_from_pump(pump._protocol.forge_report_status_packet())
+                    if status in pump_protocol.ERROR_STATUSES_IDLE + pump_protocol.ERROR_STATUSES_BUSY:
+                        report.error_statuses += 1
+                    else:
+                        report.succeeded += 1
+                except ControllerRepeatedError:
+                    report.failed += 1
+                report.latencies.append(time.time() - request_time)
+            report.duration = time.time() - start_time
+        finally:
+            for pump_io in pump_ios:
+                remove_faults(pump_io)
+        for wrapper in wrappers:
+            for fault, count in wrapper.counts.items():
+                report.fault_counts[fault] = report.fault_counts.get(fault, 0) + count
+        logger.info(report.summary())
+        reports[name] = report
+    for pump in pumps:
+        pump.reset_circuit_breaker()
+    return reports
@@ -0,0 +1,369 @@
+"""
+.. module:: gradient
+   :platform: Unix
+   :synopsis: A module used for running flow-rate ramps and binary gradients on the pumps.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from ._logger import create_logger
+
+from . import pump_protocol
+from .clock import clock_of
+from .controller import C3000Controller
+
+#: Default duration of a gradient segment (in seconds)
+DEFAULT_SEGMENT_DURATION = 1.0
+#: Maximum number of segments chained in one packet, bounds the time between two drift corrections. Packets are also
+#: kept within pump_protocol.MAX_PACKET_LENGTH, so batches of long segments hold fewer of them
+MAX_SEGMENTS_PER_PACKET = 12
+#: Shortest segment (in seconds), the pumps cannot time shorter pauses
+MIN_SEGMENT_DURATION = pump_protocol.DELAY_RANGE[0] / 1000.
+
+
+def cumulative_volume(times: Sequence[float], flow_rates: Sequence[float], at: Sequence[float]) -> np.ndarray:
+    """
+    Integrates a piecewise-linear flow-rate curve.
+
+    Args:
+        times: Times of the curve points (in seconds), increasing.
+
+        flow_rates: Flow rates at each time point (in mL/s).
+
+        at: Times at which the cumulative volume is computed (in seconds).
+
+    Returns:
+        volumes: Volume delivered since times[0] at each time in at (in mL).
+
+    """
+    times = np.asarray(times, dtype=float)
+    flow_rates = np.asarray(flow_rates, dtype=float)
+    at = np.clip(np.asarray(at, dtype=float), times[0], times[-1])
+
+    durations = np.diff(times)
+    slopes = np.diff(flow_rates) / durations
+    volumes_at_knots = np.concatenate(([0.], np.cumsum(durations * (flow_rates[:-1] + flow_rates[1:]) / 2)))
+
+    index = np.clip(np.searchsorted(times, at, side='right') - 1, 0, len(durations) - 1)
+    dt = at - times[index]
+    return volumes_at_knots[index] + flow_rates[index] * dt + slopes[index] * dt ** 2 / 2
+
+
+def segment_edges(times: Sequence[float], segment_duration: float = DEFAULT_SEGMENT_DURATION) -> np.ndarray:
+    """
+    Splits the time span of a curve into segments of (at most) segment_duration.
+
+    Args:
+        times: Times of the curve points (in seconds), increasing.
+
+        segment_duration: Duration of each segment (in seconds), default set to DEFAULT_SEGMENT_DURATION (1.0).
+
+    Returns:
+        edges: Start and end times of the segments, the curve points are always kept as edges.
+
+    """
+    times = np.asarray(times, dtype=float)
+    regular = np.arange(times[0], times[-1], segment_duration)
+    # Float steps can put a regular edge a hair away from a curve point, making a segment too short to time
+    index = np.clip(np.searchsorted(times, regular), 1, len(times) - 1)
+    distance = np.minimum(np.abs(regular - times[index - 1]), np.abs(times[index] - regular))
+    return np.unique(np.concatenate((regular[distance >= MIN_SEGMENT_DURATION], times)))
+
+
+def split_pause(pause_in_ms: int) -> List[int]:
+    """
+    Splits a pause into delay operands the pumps accept, see pump_protocol.DELAY_RANGE.
+
+    Args:
+        pause_in_ms: The pause (in milliseconds).
+
+    Returns:
+        pauses: Pauses of equal length adding up to pause_in_ms, none if it is shorter than the shortest delay.
+
+    """
+    shortest, longest = pump_protocol.DELAY_RANGE
+    if pause_in_ms < shortest:
+        return []
+    count = -(-pause_in_ms // longest)  # Ceiling division
+    pause, extra = divmod(pause_in_ms, count)
+    return [pause + 1] * extra + [pause] * (count - extra)
+
+
+def binary_gradient_curves(total_flow_rates: Sequence[float], fractions_b: Sequence[float])\
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits a total flow-rate curve into two complementary curves for a two-pump mixture.
+
+    Args:
+        total_flow_rates: Total flow rate at each time point (in mL/s).
+
+        fractions_b: Fraction of the flow given by the second pump at each time point (from 0 to 1).
+
+    Returns:
+        (flow_rates_a, flow_rates_b): The flow-rate curves of the first and second pump.
+
+    Raises:
+        ValueError: A fraction is not in [0, 1].
+
+    """
+    total_flow_rates = np.asarray(total_flow_rates, dtype=float)
+    fractions_b = np.asarray(fractions_b, dtype=float)
+    if np.any(fractions_b < 0) or np.any(fractions_b > 1):
+        raise ValueError('Gradient fractions must be in [0, 1]')
+    flow_rates_b = total_flow_rates * fractions_b
+    return total_flow_rates - flow_rates_b, flow_rates_b
+
+
+class GradientExecutor:
+    """
+    Runs flow-rate curves on one or more pumps sharing a common time axis.
+
+    Each curve is split into segments and sent as chained velocity changes and moves, so that the pump runs a
+    whole batch of segments without waiting for the host. A batch holds up to max_segments_per_packet segments, and
+    fewer when their commands would not fit in one packet (see pump_protocol.MAX_PACKET_LENGTH). Between batches the
+    plunger positions are read back and the next batch is computed from the actual position and the actual elapsed
+    time, correcting any drift.
+
+    .. note:: The pumps take no command while busy, so a batch can only be sent once the previous one has ended. The
+        flow stops for the exchanges between two batches (a status poll, a position read and the next packet, tens
+        of milliseconds per pump at 9600 baud), and the volume missed meanwhile is caught up by the next batch.
+
+    Args:
+        pumps: The pumps to run the curves on.
+
+        times: Times of the curve points (in seconds), increasing.
+
+        flow_rates: One flow-rate curve (in mL/s) per pump, sampled at times.
+
+        segment_duration: Duration of each segment (in seconds), default set to DEFAULT_SEGMENT_DURATION (1.0).
+
+        max_segments_per_packet: Number of segments sent to a pump at once, default set to MAX_SEGMENTS_PER_PACKET.
+
+    Raises:
+        ValueError: The curves are not consistent with the pumps or times, or a segment is too long for its commands
+            to fit in one packet.
+
+    """
+    def __init__(self, pumps: List[C3000Controller], times: Sequence[float], flow_rates: Sequence[Sequence[float]],
+                 segment_duration: float = DEFAULT_SEGMENT_DURATION,
+                 max_segments_per_packet: int = MAX_SEGMENTS_PER_PACKET):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.pumps = pumps
+        self.times = np.asarray(times, dtype=float)
+        self.flow_rates = [np.asarray(flow_rate, dtype=float) for flow_rate in flow_rates]
+
+        if len(self.flow_rates) != len(self.pumps):
+            raise ValueError('Got {} flow-rate curves for {} pumps'.format(len(self.flow_rates), len(self.pumps)))
+        if len(self.times) < 2 or np.any(np.diff(self.times) <= 0):
+            raise ValueError('Gradient times must be increasing and contain at least two points')
+        for flow_rate in self.flow_rates:
+            if flow_rate.shape != self.times.shape:
+                raise ValueError('Each flow-rate curve must have one value per time point')
+            if np.any(flow_rate < 0):
+                raise ValueError('Flow rates must be positive, use the direction argument to aspirate')
+
+        self.edges = segment_edges(self.times, segment_duration)
+        self.max_segments_per_packet = max_segments_per_packet
+
+        # The longest segment must fit in a packet on its own, even moving a full stroke and pausing throughout
+        longest_pauses = split_pause(int(round(1000 * np.max(np.diff(self.edges)))))
+        for pump in self.pumps:
+            moves = [(pump_protocol.CMD_TOPVELOCITY, pump.max_top_velocity),
+                     (pump_protocol.CMD_DELIVER, pump.number_of_steps)]
+            moves.extend((pump_protocol.CMD_DELAY, pause) for pause in longest_pauses)
+            if self.packet_length(pump, moves) > pump_protocol.MAX_PACKET_LENGTH:
+                raise ValueError('Gradient segments of {}s do not fit in a packet, use shorter segments'.format(
+                    segment_duration))
+
+        #: (elapsed time, pump name, expected steps, actual steps) recorded at each read back
+        self.position_log: List[Tuple[float, str, int, int]] = []
+
+    def target_steps(self, pump: C3000Controller, flow_rate: np.ndarray) -> np.ndarray:
+        """
+        Computes the cumulative number of steps the pump must have moved at each segment edge.
+
+        Args:
+            pump: The pump running the curve.
+
+            flow_rate: The flow-rate curve of the pump (in mL/s).
+
+        Returns:
+            steps: Cumulative steps at each segment edge.
+
+        """
+        volumes = cumulative_volume(self.times, flow_rate, self.edges)
+        return np.rint(volumes * pump.steps_per_ml).astype(int)
+
+    def forge_moves(self, pump: C3000Controller, move_command: str, targets: np.ndarray, first_segment: int,
+                    moved_steps: int, elapsed: float) -> List[List[Tuple[str, int]]]:
+        """
+        Computes the chained commands of the next segments for one pump, up to max_segments_per_packet of them.
+
+        Args:
+            pump: The pump running the curve.
+
+            move_command: CMD_DELIVER or CMD_PUMP.
+
+            targets: Cumulative steps at each segment edge.
+
+            first_segment: Index of the first segment of the batch.
+
+            moved_steps: Steps actually moved since the start of the gradient.
+
+            elapsed: Time actually elapsed since the start of the gradient (in seconds).
+
+        Returns:
+            moves: The list of (command, operand) pairs of each segment, chained by run_move_sequence().
+
+        """
+        moves: List[List[Tuple[str, int]]] = []
+        last_segment = min(first_segment + self.max_segments_per_packet, len(self.edges) - 1)
+        for segment in range(first_segment, last_segment):
+            start = max(self.edges[segment], elapsed) if segment == first_segment else self.edges[segment]
+            duration = self.edges[segment + 1] - start
+            steps = max(int(targets[segment + 1]) - moved_steps, 0)
+            moved_steps += steps
+
+            if duration <= 0:
+                # Running late, catch up as fast as possible
+                velocity = pump.max_top_velocity
+            else:
+                velocity = int(round(steps / duration))
+            if velocity < pump.min_top_velocity:
+                # Too slow for the pump, move at the minimum velocity and pause for the rest of the segment
+                velocity = pump.min_top_velocity
+            velocity = min(velocity, pump.max_top_velocity)
+            pause_in_ms = int(round(1000 * (duration - steps / velocity)))
+
+            segment_moves = []
+            if steps > 0:
+                segment_moves.append((pump_protocol.CMD_TOPVELOCITY, velocity))
+                segment_moves.append((move_command, steps))
+            segment_moves.extend((pump_protocol.CMD_DELAY, pause) for pause in split_pause(pause_in_ms))
+            moves.append(segment_moves)
+        return moves
+
+    @staticmethod
+    def packet_length(pump: C3000Controller, moves: List[Tuple[str, int]]) -> int:
+        """
+        Gets the length of the packet chaining moves (in characters), see pump_protocol.MAX_PACKET_LENGTH.
+        """
+        return len(pump._protocol.forge_move_sequence_packet(moves).to_string())
+
+    def packet_segments(self, pump: C3000Controller, moves: List[List[Tuple[str, int]]]) -> int:
+        """
+        Counts the segments, from the first, whose chained commands fit in one packet.
+
+        Args:
+            pump: The pump running the curve.
+
+            moves: The commands of each segment, from forge_moves().
+
+        Returns:
+            count: The number of segments that can be sent at once.
+
+        """
+        chained: List[Tuple[str, int]] = []
+        for count, segment_moves in enumerate(moves):
+            chained.extend(segment_moves)
+            if self.packet_length(pump, chained) > pump_protocol.MAX_PACKET_LENGTH:
+                return count
+        return len(moves)
+
+    def is_feasible(self, direction: str = pump_protocol.CMD_DELIVER) -> bool:
+        """
+        Determines if every pump holds (or can take) the volume of its curve.
+
+        Args:
+            direction: CMD_DELIVER to dispense the curve, CMD_PUMP to aspirate it, default set to CMD_DELIVER.
+
+        Returns:
+            True: The gradient can run without refilling.
+
+            False: At least one pump cannot move the volume of its curve.
+
+        """
+        for pump, flow_rate in zip(self.pumps, self.flow_rates):
+            total_volume = float(cumulative_volume(self.times, flow_rate, [self.times[-1]])[0])
+            if direction == pump_protocol.CMD_DELIVER and not pump.is_volume_deliverable(total_volume):
+                return False
+            if direction == pump_protocol.CMD_PUMP and not pump.is_volume_pumpable(total_volume):
+                return False
+        return True
+
+    def run(self, valve: str = None, direction: str = pump_protocol.CMD_DELIVER, secure: bool = True) -> bool:
+        """
+        Runs the curves, blocking until the end of the gradient.
+
+        Args:
+            valve: Valve position set on every pump before starting, default set to None.
+
+            direction: CMD_DELIVER to dispense the curve, CMD_PUMP to aspirate it, default set to CMD_DELIVER.
+
+            secure: Ensures that everything is correct, default set to True.
+
+        Returns:
+            True: The gradient ran.
+
+            False: The gradient is not feasible, nothing was moved.
+
+        Raises:
+            ValueError: Unknown direction.
+
+        """
+        if direction not in (pump_protocol.CMD_DELIVER, pump_protocol.CMD_PUMP):
+            raise ValueError('Gradient direction must be {} or {}'.format(pump_protocol.CMD_DELIVER,
+                                                                          pump_protocol.CMD_PUMP))
+        if not self.is_feasible(direction):
+            return False
+
+        for pump in self.pumps:
+            pump.wait_until_idle()
+            if valve is not None:
+                pump.set_valve_position(valve, secure=secure)
+
+        targets = [self.target_steps(pump, flow_rate) for pump, flow_rate in zip(self.pumps, self.flow_rates)]
+        start_steps = [pump.sync_plunger_position() for pump in self.pumps]
+        sign = 1 if direction == pump_protocol.CMD_PUMP else -1
+
+        clock = clock_of(self.pumps)  # Elapsed time is measured in the time of the pumps, simulated ones included
+        start_time = clock.time()
+        first_segment = 0
+        while first_segment < len(self.edges) - 1:
+            elapsed = clock.time() - start_time
+            # Skip segments that are already over, their volume is caught up by the next one
+            while first_segment < len(self.edges) - 2 and self.edges[first_segment + 1] <= elapsed:
+                first_segment += 1
+
+            pump_moves = []
+            for pump, pump_targets, start_step in zip(self.pumps, targets, start_steps):
+                moved_steps = sign * (pump.sync_plunger_position() - start_step)
+                expected_steps = int(pump_targets[first_segment])
+                self.position_log.append((elapsed, pump.name, expected_steps, moved_steps))
+                if moved_steps != expected_steps:
+                    self.logger.debug("[PUMP {}] Gradient drift of {} steps at {:.2f}s".format(
+                        pump.name, moved_steps - expected_steps, elapsed))
+                pump_moves.append(self.forge_moves(pump, direction, pump_targets, first_segment, moved_steps, elapsed))
+
+            # The pumps run the same segments, as many as fit in the packet of each pump
+            batch_size = min(self.packet_segments(pump, moves) for pump, moves in zip(self.pumps, pump_moves))
+            for pump, moves in zip(self.pumps, pump_moves):
+                batch = [move for segment_moves in moves[:batch_size] for move in segment_moves]
+                if batch:
+                    pump.run_move_sequence(batch)
+
+            first_segment += batch_size
+            for pump in self.pumps:
+                pump.wait_until_idle()
+
+        for pump in self.pumps:
+            pump.ensure_default_top_velocity(secure=secure)
+        return True
@@ -0,0 +1,206 @@
+"""
+.. module:: health
+   :platform: Unix
+   :synopsis: A module used for detecting lost serial ports and reconnecting them in the background.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from ._logger import create_logger
+from .clock import clock_of
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller, PumpIO
+
+#: Default time between two checks of the ports (in seconds)
+DEFAULT_CHECK_PERIOD = 1.0
+#: Default number of timeouts in a row on a port, with no answer from any pump, after which the port is reopened
+DEFAULT_TIMEOUT_THRESHOLD = 5
+#: Number of pumps of a port that must have timed out, with no answer in between, for the port to be lost
+LOST_ADDRESSES = 2
+
+
+class HealthMonitor:
+    """
+    This class watches the ports of a set of pumps and reconnects them when they are lost.
+
+    A port is considered lost when reading or writing it raises an I/O error, when its device path disappears
+    (e.g. a USB adapter reset), or after timeout_threshold timeouts in a row coming from several of its pumps (one
+    pump not answering, e.g. switched off, does not make its port lost). Ports not opened yet are left alone. A lost
+    port is reopened with the same settings, one attempt per check, until that succeeds, so that a port staying lost
+    does not hold up the others. Meanwhile, calls to the pumps on that port wait for the reconnection instead of
+    failing, and carry on once it is done, so that queued work resumes. After reconnecting, the state of each pump
+    (initialised, valve, plunger position) is checked again.
+
+    Args:
+        pumps: The pumps to watch, by name, their ports are found from them.
+
+        check_period: Time between two checks (in seconds), default set to DEFAULT_CHECK_PERIOD (1).
+
+        timeout_threshold: Timeouts in a row reopening the port, default set to DEFAULT_TIMEOUT_THRESHOLD (5).
+
+        reinitialize: Re-initialises the pumps found not initialised after reconnecting (e.g. after a power loss),
+            default set to False. Initialising moves the plunger to zero, pushing the syringe content out.
+
+    """
+    def __init__(self, pumps: Dict[str, 'C3000Controller'], check_period: float = DEFAULT_CHECK_PERIOD,
+                 timeout_threshold: int = DEFAULT_TIMEOUT_THRESHOLD, reinitialize: bool = False):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.pumps = pumps
+        self.check_period = check_period
+        self.timeout_threshold = timeout_threshold
+        self.reinitialize = reinitialize
+        self.clock = clock_of(pumps.values())
+
+        self.pump_ios: List['PumpIO'] = list({id(pump._io): pump._io for pump in pumps.values()}.values())
+        self._hub_pumps: Dict[int, List['C3000Controller']] = {}  # id() of the PumpIO -> its pumps
+        for pump in pumps.values():
+            self._hub_pumps.setdefault(id(pump._io), []).append(pump)
+        self._lost: Dict[int, Tuple[float, str]] = {}  # id() of the PumpIO -> time lost and reason, until reconnected
+
+        #: (port, time lost, time reconnected, reason) of each reconnection
+        self.reconnections: List[Tuple[str, float, float, str]] = []
+        #: State of each pump after the last reconnection of its port, by pump name
+        self.pump_states: Dict[str, Dict[str, Any]] = {}
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'HealthMonitor':
+        """
+        Starts watching the ports in a background thread.
+
+        Returns:
+            self, so that the monitor can be created and started in one line.
+
+        """
+        for pump_io in self.pump_ios:
+            pump_io.supervised = True
+        self._thread = threading.Thread(target=self._run, name='health-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops watching, calls to the pumps fail again as soon as their port is lost.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for pump_io in self.pump_ios:
+            pump_io.supervised = False
+            pump_io.connected.set()
+
+    def loss_reason(self, pump_io: 'PumpIO') -> Optional[str]:
+        """
+        Determines if a port is lost.
+
+        Args:
+            pump_io: The port to check.
+
+        Returns:
+            reason: Why the port is considered lost, None if it is not.
+
+        """
+        if not pump_io.is_open and pump_io.last_error is None:
+            return None  # Not used yet, see PumpIO.connect()
+        if pump_io.last_error is not None:
+            return 'I/O error: {!r}'.format(pump_io.last_error)
+        if pump_io.port.startswith('/dev/') and not os.path.exists(pump_io.port):
+            return 'device {} disappeared'.format(pump_io.port)
+        lost_addresses = min(LOST_ADDRESSES, len(self._hub_pumps.get(id(pump_io), ())))
+        if pump_io.consecutive_timeouts >= self.timeout_threshold and \
+                len(pump_io.timed_out_addresses) >= lost_addresses:
+            return '{} timeouts in a row from addresses {}'.format(
+                pump_io.consecutive_timeouts, ', '.join(sorted(pump_io.timed_out_addresses)))
+        return None
+
+    def reconnect(self, pump_io: 'PumpIO', reason: str = 'requested') -> bool:
+        """
+        Makes one attempt at reopening a port with the same settings, then checks the pumps on it.
+
+        The port is marked lost from the first attempt: calls to its pumps wait until it is reconnected, and the
+        monitor tries again at each check.
+
+        Args:
+            pump_io: The port to reconnect.
+
+            reason: Why the port is reconnected, for the logs, default set to 'requested'.
+
+        Returns:
+            True: The port is reconnected.
+
+            False: The port could not be reopened yet.
+
+        """
+        if id(pump_io) not in self._lost:
+            self.logger.warning("Port {} lost ({}), reconnecting".format(pump_io.port, reason))
+            self._lost[id(pump_io)] = (self.clock.time(), reason)
+            pump_io.connected.clear()  # Calls to the pumps wait from now on
+        lost_at, reason = self._lost[id(pump_io)]
+        try:
+            pump_io.reopen()
+        except OSError as err:  # serial.SerialException included
+            self.logger.debug("Reopening {} failed: {!r}".format(pump_io.port, err))
+            return False
+        del self._lost[id(pump_io)]
+
+        hub_pumps = self._hub_pumps.get(id(pump_io), [])
+        for pump in hub_pumps:
+            pump.reset_circuit_breaker()
+            pump.invalidate_plunger_model()
+        pump_io.mark_connected()
+
+        reconnected_at = self.clock.time()
+        self.reconnections.append((pump_io.port, lost_at, reconnected_at, reason))
+        self.logger.info("Port {} reconnected in {:.2f}s".format(pump_io.port, reconnected_at - lost_at))
+        for pump in hub_pumps:
+            self.check_pump(pump)
+        return True
+
+    def check_pump(self, pump: 'C3000Controller') -> Dict[str, Any]:
+        """
+        Checks the state of a pump after a reconnection, see pump_states.
+
+        Args:
+            pump: The pump to check.
+
+        Returns:
+            state: The initialised flag, valve position and plunger position (in steps) of the pump, or the error
+                raised while reading them.
+
+        """
+        from .controller import ControllerRepeatedError
+
+        state: Dict[str, Any] = {'checked_at': self.clock.time()}
+        try:
+            state['initialized'] = pump.is_initialized()
+            if not state['initialized'] and self.reinitialize:
+                self.logger.warning("[PUMP {}] Not initialised after reconnection, initialising".format(pump.name))
+                pump.smart_initialize()
+                state['initialized'] = True
+            elif not state['initialized']:
+                self.logger.warning("[PUMP {}] Not initialised after reconnection".format(pump.name))
+            if state['initialized']:
+                state['valve_position'] = pump.get_valve_position()
+                state['plunger_position'] = pump.sync_plunger_position()
+        except ControllerRepeatedError as err:
+            self.logger.warning("[PUMP {}] No answer after reconnection: {!r}".format(pump.name, err))
+            state['error'] = err
+        self.pump_states[pump.name] = state
+        return state
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.check_period):
+            for pump_io in self.pump_ios:
+                reason = self._lost[id(pump_io)][1] if id(pump_io) in self._lost else self.loss_reason(pump_io)
+                if reason is not None:
+                    self.reconnect(pump_io, reason)
@@ -0,0 +1,181 @@
+"""
+.. module:: initialization
+   :platform: Unix
+   :synopsis: A module used for initialising many pumps at once, hubs in parallel and each pump at its own pace.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future, as_completed
+from typing import Dict, Generator, Iterable, Iterator, List, TYPE_CHECKING
+
+from ._logger import create_logger
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller
+
+#: Time between two status polls of a moving pump (in seconds)
+POLL_PERIOD = 0.1
+#: Attempts at initialising a pump, and at each secure setting, before giving up
+MAX_ATTEMPTS = 10
+
+
+class InitializationEngine:
+    """
+    This class initialises pumps and sets their parameters, every pump going through its own sequence.
+
+    Each hub is served by its own thread, so hubs initialise in parallel. On a hub, the pumps are interleaved: while a
+    pump moves, the others send their commands, and a moving pump is polled every POLL_PERIOD until it is idle.
+    There is no barrier between pumps, each pump is ready as soon as its own sequence ends:
+
+        1. One read of its initialisation state.
+        2. If not initialised: valve initialisation, valve set to its initialize_valve_position, plunger
+           initialisation, then a check that the pump reports being initialised.
+        3. Microstep mode and default top velocity.
+
+    Args:
+        pumps: The pumps to initialise, by name.
+
+        secure: Checks the valve position and top velocity after setting them, default set to True.
+
+        force: Initialises the pumps even if they report being initialised, default set to False.
+
+        ready: Pumps known to be ready, e.g. restored from a snapshot (see state.restore_pump()), left untouched.
+
+    """
+    def __init__(self, pumps: Dict[str, 'C3000Controller'], secure: bool = True, force: bool = False,
+                 ready: Iterable[str] = ()):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.pumps = pumps
+        self.secure = secure
+        self.force = force
+
+        #: Future of each pump, done with the pump when it is ready, or with the error that stopped it
+        self.futures: Dict[str, Future] = {pump_name: Future() for pump_name in pumps}
+        self.ready_pumps = set(ready)
+        for pump_name in self.ready_pumps:
+            self.futures[pump_name].set_result(pumps[pump_name])
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> 'InitializationEngine':
+        """
+        Starts initialising, one thread per hub.
+        """
+        hubs: Dict[int, List[str]] = {}  # Pumps by id() of their PumpIO
+        for pump_name, pump in self.pumps.items():
+            if pump_name not in self.ready_pumps:
+                hubs.setdefault(id(pump._io), []).append(pump_name)
+        for hub in hubs.values():
+            thread = threading.Thread(target=self._serve_hub, args=(hub,), daemon=True,
+                                      name='initialize-{}'.format(self.pumps[hub[0]]._io.port))
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def ready(self, pump_name: str, timeout: float = None) -> 'C3000Controller':
+        """
+        Waits for a pump to be ready.
+
+        Args:
+            pump_name: The pump.
+
+            timeout: Time to wait for at most (in seconds), default set to None (no limit).
+
+        Returns:
+            C3000Controller: The pump, initialised with its parameters set.
+
+        Raises:
+            ControllerRepeatedError: The pump could not be initialised, or any error raised while initialising it.
+
+            concurrent.futures.TimeoutError: The pump is not ready within the timeout.
+
+        """
+        return self.futures[pump_name].result(timeout)
+
+    def as_ready(self, timeout: float = None) -> Iterator[str]:
+        """
+        Gives the names of the pumps as they become ready, or fail (see ready()).
+        """
+        names = {future: pump_name for pump_name, future in self.futures.items()}
+        for future in as_completed(names, timeout):
+            yield names[future]
+
+    def wait(self, timeout: float = None) -> None:
+        """
+        Waits for all the pumps to be ready.
+
+        Raises:
+            The error of the first pump that failed, see ready().
+
+        """
+        for pump_name in self.futures:
+            self.ready(pump_name, timeout)
+
+    def _serve_hub(self, pump_names: List[str]) -> None:
+        clock = self.pumps[pump_names[0]].clock
+        order = itertools.count()
+        # (due time, order, pump name, sequence): the pump whose next step is due first goes on the bus
+        queue = [(clock.time(), next(order), pump_name, self._sequence(self.pumps[pump_name]))
+                 for pump_name in pump_names]
+        heapq.heapify(queue)
+        while queue:
+            due_at, _, pump_name, sequence = heapq.heappop(queue)
+            now = clock.time()
+            if due_at > now:
+                clock.sleep(due_at - now)
+            try:
+                delay = next(sequence)
+            except StopIteration:
+                self.logger.debug("Pump {} ready".format(pump_name))
+                self.futures[pump_name].set_result(self.pumps[pump_name])
+            except Exception as err:
+                self.logger.warning("Pump {} failed to initialise: {!r}".format(pump_name, err))
+                self.futures[pump_name].set_exception(err)
+            else:
+                heapq.heappush(queue, (clock.time() + delay, next(order), pump_name, sequence))
+
+    def _sequence(self, pump: 'C3000Controller') -> Generator[float, None, None]:
+        """
+        Runs the steps of one pump, yielding the time to wait before the next step (in seconds).
+        """
+        from .controller import ControllerRepeatedError
+
+        if self.force or not pump.is_initialized():
+            for _ in range(MAX_ATTEMPTS):
+                pump.initialize_valve_only(wait=False)
+                yield from self._until_idle(pump)
+                yield from self._set_valve(pump, pump.initialize_valve_position)
+                pump.initialize_no_valve(wait=False)
+                yield from self._until_idle(pump)
+                if pump.is_initialized():
+                    break
+                yield 0.
+            else:
+                raise ControllerRepeatedError('Repeated Error from pump {}'.format(pump.name))
+
+        pump.set_microstep_mode(pump.micro_step_mode)
+        yield 0.
+        pump.set_top_velocity(pump.default_top_velocity, secure=self.secure)
+
+    def _set_valve(self, pump: 'C3000Controller', valve_position: str) -> Generator[float, None, None]:
+        from .controller import ControllerRepeatedError
+
+        for _ in range(MAX_ATTEMPTS):
+            pump.set_valve_position(valve_position, secure=False)
+            yield from self._until_idle(pump)
+            if not self.secure or pump.get_valve_position() == valve_position:
+                return
+        raise ControllerRepeatedError('Repeated Error from pump {}'.format(pump.name))
+
+    @staticmethod
+    def _until_idle(pump: 'C3000Controller') -> Generator[float, None, None]:
+        yield POLL_PERIOD  # Lets the other pumps of the hub go while this one moves
+        while pump.is_busy():
+            yield POLL_PERIOD
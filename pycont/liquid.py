@@ -0,0 +1,225 @@
+"""
+.. module:: liquid
+   :platform: Unix
+   :synopsis: A module used for finding and holding the fastest stall-free speeds of a pump for a liquid.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from ._logger import create_logger
+
+from . import pump_protocol
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller
+
+#: Fraction of the highest stall-free velocity kept as the tuned velocity, leaves a margin for batch variations
+DEFAULT_TUNING_SAFETY_FACTOR = 0.8
+#: The search stops when the stall-free and stalling velocities are closer than this fraction
+DEFAULT_TUNING_RESOLUTION = 0.05
+#: Maximum number of test strokes per direction
+MAX_TUNING_TRIALS = 12
+#: Velocity below which the search gives up (steps/second)
+MIN_TUNING_VELOCITY = 50
+
+#: Error code of a plunger overload, as reported by PumpHWError
+OVERLOAD_ERROR_CODE = pump_protocol.STATUS_IDLE_PLUNGER_OVERLOAD
+
+
+class LiquidClass:
+    """
+    This class holds the fastest safe velocities of a pump for a liquid.
+
+    Args:
+        speed_in: Top velocity used to aspirate the liquid (steps/second), default set to None (default top velocity).
+
+        speed_out: Top velocity used to dispense the liquid (steps/second), default set to None (default top
+            velocity).
+
+    """
+    def __init__(self, speed_in: int = None, speed_out: int = None):
+        self.speed_in = speed_in
+        self.speed_out = speed_out
+
+    @classmethod
+    def from_config(cls, liquid_config: Dict) -> 'LiquidClass':
+        """
+        Creates a liquid class from its configuration dictionary.
+
+        Args:
+            cls: The initialising class.
+
+            liquid_config: Dictionary holding speed_in and speed_out, both optional.
+
+        Returns:
+            LiquidClass: New LiquidClass object.
+
+        """
+        return cls(liquid_config.get('speed_in'), liquid_config.get('speed_out'))
+
+    def to_config(self) -> Dict:
+        """
+        Creates the configuration dictionary of the liquid class, see from_config().
+        """
+        liquid_config = {}
+        if self.speed_in is not None:
+            liquid_config['speed_in'] = self.speed_in
+        if self.speed_out is not None:
+            liquid_config['speed_out'] = self.speed_out
+        return liquid_config
+
+    def speed(self, direction: str) -> Optional[int]:
+        """
+        Gets the velocity of a direction.
+
+        Args:
+            direction: CMD_PUMP or CMD_DELIVER.
+
+        Returns:
+            The velocity (steps/second), None if not set.
+
+        """
+        return self.speed_in if direction == pump_protocol.CMD_PUMP else self.speed_out
+
+    def __repr__(self):
+        return "LiquidClass(speed_in={}, speed_out={})".format(self.speed_in, self.speed_out)
+
+
+class SpeedTuner:
+    """
+    This class searches the highest velocities at which a pump moves a liquid without a plunger overload.
+
+    Each trial is a stroke of test_volume at the tested velocity, aspirating from from_valve or dispensing to to_valve.
+    The search first tries the maximum top velocity, then bisects between the highest stall-free velocity and the
+    lowest stalling one. After an overload the plunger is re-initialised, which pushes what is left in the syringe out
+    of the valve position used by the failed stroke.
+
+    Args:
+        pump: The pump to tune, it must be initialised and primed with the liquid.
+
+        from_valve: The valve position the liquid is aspirated from.
+
+        to_valve: The valve position the liquid is dispensed to.
+
+        test_volume: Volume of each test stroke (in mL), default set to None (half the syringe).
+
+        safety_factor: Fraction of the highest stall-free velocity kept, default set to DEFAULT_TUNING_SAFETY_FACTOR.
+
+        resolution: Relative precision of the search, default set to DEFAULT_TUNING_RESOLUTION.
+
+        max_trials: Maximum number of test strokes per direction, default set to MAX_TUNING_TRIALS.
+
+    """
+    def __init__(self, pump: 'C3000Controller', from_valve: str, to_valve: str, test_volume: float = None,
+                 safety_factor: float = DEFAULT_TUNING_SAFETY_FACTOR, resolution: float = DEFAULT_TUNING_RESOLUTION,
+                 max_trials: int = MAX_TUNING_TRIALS):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.pump = pump
+        self.from_valve = from_valve
+        self.to_valve = to_valve
+        self.test_volume = test_volume if test_volume is not None else pump.total_volume / 2
+        self.safety_factor = safety_factor
+        self.resolution = resolution
+        self.max_trials = max_trials
+
+        #: (direction, velocity, stall-free) of every test stroke
+        self.trials: List[Tuple[str, int, bool]] = []
+        self._speed_in: Optional[int] = None
+
+    def trial(self, direction: str, velocity: int) -> bool:
+        """
+        Runs one test stroke.
+
+        Args:
+            direction: CMD_PUMP to test aspiration, CMD_DELIVER to test dispensing.
+
+            velocity: The tested top velocity (steps/second).
+
+        Returns:
+            True: The stroke ran without overload.
+
+            False: The plunger overloaded, the pump has been re-initialised.
+
+        Raises:
+            PumpHWError: The pump reported an error other than a plunger overload.
+
+        """
+        from .controller import PumpHWError
+
+        pump = self.pump
+        try:
+            # Start from an empty syringe, or from a syringe holding the test volume to dispense it
+            pump.set_valve_position(self.to_valve)
+            pump.go_to_volume(0, speed=pump.default_top_velocity, wait=True)
+            if direction == pump_protocol.CMD_PUMP:
+                pump.pump(self.test_volume, self.from_valve, speed_in=velocity, wait=True)
+            else:
+                pump.pump(self.test_volume, self.from_valve, speed_in=self._speed_in, wait=True)
+                pump.deliver(self.test_volume, self.to_valve, speed_out=velocity, wait=True)
+            stall_free = True
+        except PumpHWError as err:
+            if err.error_code != OVERLOAD_ERROR_CODE:
+                raise
+            self.logger.info("[PUMP {}] Plunger overload at {} steps/s, re-initialising".format(pump.name, velocity))
+            # Homes the plunger through the current valve position, which clears the overload
+            pump.initialize_no_valve()
+            stall_free = False
+        self.trials.append((direction, velocity, stall_free))
+        return stall_free
+
+    def search(self, direction: str) -> int:
+        """
+        Searches the highest stall-free velocity of a direction.
+
+        Args:
+            direction: CMD_PUMP or CMD_DELIVER.
+
+        Returns:
+            velocity: The tuned velocity, with the safety factor applied if the pump overloaded (steps/second).
+
+        Raises:
+            ValueError: The pump overloads even at MIN_TUNING_VELOCITY.
+
+        """
+        max_velocity = self.pump.max_top_velocity
+        if self.trial(direction, max_velocity):
+            return max_velocity
+
+        stalling = max_velocity
+        stall_free = min(self.pump.default_top_velocity, max_velocity // 2)
+        while not self.trial(direction, stall_free):
+            stalling = stall_free
+            stall_free //= 2
+            if stall_free < MIN_TUNING_VELOCITY:
+                raise ValueError('Pump {} overloads at {} steps/s, cannot tune'.format(self.pump.name, stalling))
+
+        for _ in range(self.max_trials - len([trial for trial in self.trials if trial[0] == direction])):
+            if stalling - stall_free <= self.resolution * stall_free:
+                break
+            velocity = (stall_free + stalling) // 2
+            if self.trial(direction, velocity):
+                stall_free = velocity
+            else:
+                stalling = velocity
+        return max(int(stall_free * self.safety_factor), MIN_TUNING_VELOCITY)
+
+    def run(self) -> LiquidClass:
+        """
+        Tunes aspiration, then dispensing with the syringe filled at the tuned aspiration velocity.
+
+        Returns:
+            LiquidClass: The tuned velocities.
+
+        """
+        self._speed_in = self.search(pump_protocol.CMD_PUMP)
+        speed_out = self.search(pump_protocol.CMD_DELIVER)
+        self.pump.go_to_volume(0, speed=self.pump.default_top_velocity, wait=True)
+        self.logger.info("[PUMP {}] Tuned speed_in {} and speed_out {} steps/s in {} strokes".format(
+            self.pump.name, self._speed_in, speed_out, len(self.trials)))
+        return LiquidClass(self._speed_in, speed_out)
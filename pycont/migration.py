@@ -0,0 +1,201 @@
+"""
+.. module:: migration
+   :platform: Unix
+   :synopsis: A module used for moving all the pumps of a hub to another baudrate and verifying them.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+from ._logger import create_logger
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller, PumpIO
+
+#: Baudrates the C3000 serial interface can run at
+SUPPORTED_BAUDRATES = (9600, 38400)
+
+#: A pump answers at the new baudrate
+PUMP_MIGRATED = 'migrated'
+#: A pump only answers at the old baudrate, its jumper was not moved
+PUMP_NOT_MIGRATED = 'not migrated'
+#: A pump answers at the new baudrate but its EEPROM differs from the backup, another pump may be on its address
+PUMP_EEPROM_MISMATCH = 'eeprom mismatch'
+#: A pump answers at neither baudrate
+PUMP_SILENT = 'silent'
+
+
+class BaudrateMigration:
+    """
+    This class moves all the pumps of a hub to another baudrate.
+
+    The C3000 baudrate (9600 or 38400) is selected by a jumper on each pump, it cannot be set through the EEPROM.
+    The migration is therefore done in two steps around the jumper change:
+
+    - prepare() checks that every pump answers at the current baudrate and keeps a backup of its EEPROM, so that
+      each address can later be checked to hold the same pump.
+    - once the jumpers are moved and the pumps power cycled, verify() reopens the PumpIO at the new baudrate and
+      checks every address. Pumps that do not answer are probed at the old baudrate to tell a missed jumper from a
+      silent pump. If all pumps answer the hub config gets the new baudrate, otherwise rollback() goes back to the old
+      one.
+
+    Args:
+        pump_io: The PumpIO of the hub.
+
+        pumps: The pumps on the hub.
+
+        new_baudrate: The baudrate to move to.
+
+        io_config: The io section of the hub in the setup config, updated on success, default set to None.
+
+    Raises:
+        ValueError: Unsupported baudrate.
+
+    """
+    def __init__(self, pump_io: 'PumpIO', pumps: List['C3000Controller'], new_baudrate: int,
+                 io_config: Dict = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        if new_baudrate not in SUPPORTED_BAUDRATES:
+            raise ValueError('Baudrate {} is not supported, use one of {}'.format(new_baudrate, SUPPORTED_BAUDRATES))
+        self.pump_io = pump_io
+        self.pumps = pumps
+        self.old_baudrate = pump_io.baudrate
+        self.new_baudrate = new_baudrate
+        self.io_config = io_config
+
+        #: EEPROM of each pump read by prepare(), by pump name
+        self.eeprom_backup: Dict[str, str] = {}
+        #: Outcome of verify() for each pump, by pump name, one of PUMP_MIGRATED, PUMP_NOT_MIGRATED,
+        #: PUMP_EEPROM_MISMATCH or PUMP_SILENT
+        self.report: Dict[str, str] = {}
+
+    def prepare(self) -> str:
+        """
+        Checks every pump at the current baudrate and backs up their EEPROM.
+
+        Returns:
+            instructions: What to do on the hardware before calling verify().
+
+        Raises:
+            ValueError: A pump does not answer, migrating would leave it out.
+
+        """
+        self._reset_circuit_breakers()
+        silent = [pump.name for pump in self.pumps if not pump.ping()]
+        if silent:
+            raise ValueError('Pumps {} do not answer at {} baud on {}, fix them before migrating'.format(
+                silent, self.old_baudrate, self.pump_io.port))
+        for pump in self.pumps:
+            self.eeprom_backup[pump.name] = pump.get_eeprom_config()
+        instructions = self.instructions()
+        self.logger.info(instructions)
+        return instructions
+
+    def instructions(self) -> str:
+        """
+        Formats the hardware steps of the migration.
+        """
+        lines = ['Migrating {} from {} to {} baud:'.format(self.pump_io.port, self.old_baudrate, self.new_baudrate),
+                 '1. Power off the pumps on this hub: {}'.format(', '.join(pump.name for pump in self.pumps)),
+                 '2. On each of them, set the baudrate jumper to {}'.format(self.new_baudrate),
+                 '3. Power the pumps on and call verify()']
+        return '\n'.join(lines)
+
+    def rollback_instructions(self) -> str:
+        """
+        Formats the hardware steps to go back to the old baudrate.
+        """
+        migrated = [name for name, outcome in self.report.items() if outcome != PUMP_NOT_MIGRATED]
+        lines = ['Rolling back {} to {} baud:'.format(self.pump_io.port, self.old_baudrate),
+                 '1. Power off the pumps on this hub',
+                 '2. Set the baudrate jumper back to {} on: {}'.format(self.old_baudrate, ', '.join(migrated)),
+                 '3. Power the pumps on and call rollback()']
+        return '\n'.join(lines)
+
+    def _reset_circuit_breakers(self) -> None:
+        """
+        Forgets the failures seen at another baudrate, so that every pump is actually contacted.
+        """
+        for pump in self.pumps:
+            pump.reset_circuit_breaker()
+
+    def _probe(self, pump: 'C3000Controller') -> Optional[str]:
+        """
+        Returns the EEPROM of the pump if it answers at the current baudrate of the PumpIO, None otherwise.
+        """
+        if not pump.ping():
+            return None
+        return pump.get_eeprom_config()
+
+    def verify(self) -> bool:
+        """
+        Reopens the PumpIO at the new baudrate and checks every pump.
+
+        Returns:
+            True: All pumps answer at the new baudrate with their backed up EEPROM, the hub config is updated.
+
+            False: At least one pump failed, see report and rollback_instructions(). The PumpIO stays at the new
+                baudrate.
+
+        Raises:
+            ValueError: prepare() was not called.
+
+        """
+        if not self.eeprom_backup:
+            raise ValueError('Call prepare() before verify()')
+
+        self.pump_io.reopen(baudrate=self.new_baudrate)
+        self._reset_circuit_breakers()
+        failed = []
+        for pump in self.pumps:
+            eeprom = self._probe(pump)
+            if eeprom is None:
+                failed.append(pump)
+            elif eeprom != self.eeprom_backup[pump.name]:
+                self.report[pump.name] = PUMP_EEPROM_MISMATCH
+            else:
+                self.report[pump.name] = PUMP_MIGRATED
+
+        if failed:
+            # Tells a jumper left at the old baudrate from a pump that does not answer at all
+            self.pump_io.reopen(baudrate=self.old_baudrate)
+            self._reset_circuit_breakers()
+            for pump in failed:
+                self.report[pump.name] = PUMP_NOT_MIGRATED if pump.ping() else PUMP_SILENT
+            self.pump_io.reopen(baudrate=self.new_baudrate)
+            self._reset_circuit_breakers()
+
+        if all(outcome == PUMP_MIGRATED for outcome in self.report.values()):
+            if self.io_config is not None:
+                self.io_config['baudrate'] = self.new_baudrate
+            self.logger.info("{} migrated to {} baud".format(self.pump_io.port, self.new_baudrate))
+            return True
+
+        self.logger.warning("Migration of {} failed: {}\n{}".format(self.pump_io.port, self.report,
+                                                                      self.rollback_instructions()))
+        return False
+
+    def rollback(self) -> bool:
+        """
+        Reopens the PumpIO at the old baudrate and checks every pump, once the jumpers are set back.
+
+        Returns:
+            True: All pumps answer at the old baudrate, the hub config is restored.
+
+            False: At least one pump does not answer.
+
+        """
+        self.pump_io.reopen(baudrate=self.old_baudrate)
+        self._reset_circuit_breakers()
+        silent = [pump.name for pump in self.pumps if not pump.ping()]
+        if self.io_config is not None:
+            self.io_config['baudrate'] = self.old_baudrate
+        if silent:
+            self.logger.warning("Pumps {} do not answer at {} baud after rollback".format(silent, self.old_baudrate))
+            return False
+        return True
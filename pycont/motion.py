@@ -0,0 +1,181 @@
+"""
+.. module:: motion
+   :platform: Unix
+   :synopsis: A module used for describing the acceleration profiles of the plunger moves.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import math
+from typing import Dict
+
+#: Name of the profile the pumps power up with
+MOTION_PROFILE_FACTORY = 'factory'
+
+#: Factory start velocity in Microstep Mode 0 (steps/second)
+FACTORY_START_VELOCITY = 900
+#: Factory slope code
+FACTORY_SLOPE = 14
+#: Factory cutoff velocity in Microstep Mode 0 (steps/second)
+FACTORY_CUTOFF_VELOCITY = 900
+
+#: Range of the start velocity in Microstep Mode 0 (steps/second)
+START_VELOCITY_RANGE = (50, 1000)
+#: Range of the slope code
+SLOPE_RANGE = (1, 20)
+#: Range of the cutoff velocity in Microstep Mode 0 (steps/second)
+CUTOFF_VELOCITY_RANGE = (50, 2700)
+
+#: Acceleration given by one slope code in Microstep Mode 0 (steps/second^2)
+ACCELERATION_PER_SLOPE_CODE = 2500
+#: Velocities and accelerations are scaled by this factor in Microstep Mode 2
+MICRO_STEP_MODE_2_SCALE = 8
+
+
+def micro_step_scale(micro_step_mode: int) -> int:
+    """
+    Gets the factor applied to velocities and accelerations in a microstep mode.
+
+    Args:
+        micro_step_mode: The microstep mode of the pump.
+
+    Returns:
+        1 in Microstep Mode 0 and 1, MICRO_STEP_MODE_2_SCALE in Microstep Mode 2.
+
+    """
+    return MICRO_STEP_MODE_2_SCALE if micro_step_mode == 2 else 1
+
+
+class MotionProfile:
+    """
+    This class represents the acceleration profile of the plunger moves.
+
+    The plunger starts at the start velocity, accelerates at a constant rate given by the slope code up to the top
+    velocity, decelerates at the same rate down to the cutoff velocity and stops. Short moves spend most of their
+    time ramping, a high start velocity, slope and cutoff shorten them. Velocities are in the steps of the
+    microstep mode the profile is used in.
+
+    Args:
+        start_velocity: Velocity at which the plunger starts (steps/second).
+
+        slope: Slope code of the acceleration and deceleration ramps, from 1 to 20.
+
+        cutoff_velocity: Velocity at which the plunger stops (steps/second).
+
+    """
+    def __init__(self, start_velocity: int, slope: int, cutoff_velocity: int):
+        self.start_velocity = int(start_velocity)
+        self.slope = int(slope)
+        self.cutoff_velocity = int(cutoff_velocity)
+
+    @classmethod
+    def from_config(cls, profile_config: Dict) -> 'MotionProfile':
+        """
+        Creates a profile from its configuration dictionary.
+
+        Args:
+            cls: The initialising class.
+
+            profile_config: Dictionary holding start_velocity, slope and cutoff_velocity.
+
+        Returns:
+            MotionProfile: New MotionProfile object.
+
+        """
+        return cls(profile_config['start_velocity'], profile_config['slope'], profile_config['cutoff_velocity'])
+
+    @classmethod
+    def factory(cls, micro_step_mode: int) -> 'MotionProfile':
+        """
+        Creates the profile the pumps power up with.
+
+        Args:
+            cls: The initialising class.
+
+            micro_step_mode: The microstep mode of the pump.
+
+        Returns:
+            MotionProfile: New MotionProfile object.
+
+        """
+        scale = micro_step_scale(micro_step_mode)
+        return cls(FACTORY_START_VELOCITY * scale, FACTORY_SLOPE, FACTORY_CUTOFF_VELOCITY * scale)
+
+    def check_within_range(self, micro_step_mode: int) -> bool:
+        """
+        Checks that the profile values are accepted by the pump.
+
+        Args:
+            micro_step_mode: The microstep mode of the pump.
+
+        Returns:
+            True: The profile is within range.
+
+        Raises:
+            ValueError: A value of the profile is out of range.
+
+        """
+        scale = micro_step_scale(micro_step_mode)
+        if not START_VELOCITY_RANGE[0] * scale <= self.start_velocity <= START_VELOCITY_RANGE[1] * scale:
+            raise ValueError('Start velocity {} is not in range'.format(self.start_velocity))
+        if not SLOPE_RANGE[0] <= self.slope <= SLOPE_RANGE[1]:
+            raise ValueError('Slope code {} is not in range'.format(self.slope))
+        if not CUTOFF_VELOCITY_RANGE[0] * scale <= self.cutoff_velocity <= CUTOFF_VELOCITY_RANGE[1] * scale:
+            raise ValueError('Cutoff velocity {} is not in range'.format(self.cutoff_velocity))
+        return True
+
+    def acceleration(self, micro_step_mode: int) -> float:
+        """
+        Gets the acceleration of the ramps (steps/second^2).
+
+        Args:
+            micro_step_mode: The microstep mode of the pump.
+
+        """
+        return self.slope * ACCELERATION_PER_SLOPE_CODE * micro_step_scale(micro_step_mode)
+
+    def move_duration(self, steps: int, top_velocity: int, micro_step_mode: int) -> float:
+        """
+        Estimates the duration of a plunger move.
+
+        Args:
+            steps: Length of the move (in steps).
+
+            top_velocity: Top velocity of the move (steps/second).
+
+            micro_step_mode: The microstep mode of the pump.
+
+        Returns:
+            duration: Duration of the move (in seconds).
+
+        """
+        steps = abs(steps)
+        if steps == 0:
+            return 0.
+        acceleration = self.acceleration(micro_step_mode)
+        start_velocity = min(self.start_velocity, top_velocity)
+        cutoff_velocity = min(self.cutoff_velocity, top_velocity)
+
+        ramp_up_steps = (top_velocity ** 2 - start_velocity ** 2) / (2 * acceleration)
+        ramp_down_steps = (top_velocity ** 2 - cutoff_velocity ** 2) / (2 * acceleration)
+        if ramp_up_steps + ramp_down_steps <= steps:
+            cruise_time = (steps - ramp_up_steps - ramp_down_steps) / top_velocity
+            return (top_velocity - start_velocity) / acceleration + cruise_time + \
+                (top_velocity - cutoff_velocity) / acceleration
+
+        # The move is too short to reach the top velocity, the ramps meet at a lower peak velocity
+        peak_velocity = math.sqrt(acceleration * steps + (start_velocity ** 2 + cutoff_velocity ** 2) / 2)
+        if peak_velocity <= max(start_velocity, cutoff_velocity):
+            return steps / max(start_velocity, cutoff_velocity)
+        return (peak_velocity - start_velocity) / acceleration + (peak_velocity - cutoff_velocity) / acceleration
+
+    def __eq__(self, other):
+        return isinstance(other, MotionProfile) and (self.start_velocity, self.slope, self.cutoff_velocity) == \
+            (other.start_velocity, other.slope, other.cutoff_velocity)
+
+    def __repr__(self):
+        return "MotionProfile(start_velocity={}, slope={}, cutoff_velocity={})".format(
+            self.start_velocity, self.slope, self.cutoff_velocity)
@@ -0,0 +1,402 @@
+"""
+.. module:: network
+   :platform: Unix
+   :synopsis: A module used for describing the fluidic network of a setup and planning transfers through it.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+from ._logger import create_logger
+
+from . import pump_protocol
+from .clock import Clock, clock_of
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller
+
+#: Valve ports that can be connected in the network
+NETWORK_PORTS = ('I', 'O', 'B', 'E', '1', '2', '3', '4', '5', '6')
+#: Estimated time for the valve switches of one stroke (in seconds)
+VALVE_SWITCH_TIME = 0.5
+#: Maximum number of hops explored by the planner
+MAX_HOPS = 4
+
+
+class Hop:
+    """
+    This class represents one pump moving liquid from the vessel on one of its ports to the vessel on another port.
+
+    Args:
+        pump: The pump doing the hop.
+
+        from_port: The valve port to aspirate from.
+
+        to_port: The valve port to dispense to.
+
+        source: The vessel connected to from_port.
+
+        destination: The vessel connected to to_port.
+
+    """
+    def __init__(self, pump: 'C3000Controller', from_port: str, to_port: str, source: str, destination: str):
+        self.pump = pump
+        self.from_port = from_port
+        self.to_port = to_port
+        self.source = source
+        self.destination = destination
+
+    def velocity(self, direction: str, speed: Optional[int] = None) -> int:
+        """
+        Gets the top velocity of the moves of the hop in one direction, as C3000Controller.pump() and deliver() set
+        it: the given speed, else the one of the liquid class of the pump, else its default top velocity.
+
+        Args:
+            direction: CMD_PUMP to aspirate, CMD_DELIVER to dispense.
+
+            speed: The speed given for the moves, default set to None.
+
+        """
+        if speed is not None:
+            return speed
+        if self.pump.liquid_class is not None:
+            liquid_speed = self.pump.liquid_classes[self.pump.liquid_class].speed(direction)
+            if liquid_speed is not None:
+                return liquid_speed
+        return self.pump.default_top_velocity
+
+    def move_time(self, volume_in_ml: float, speed_in: int = None, speed_out: int = None) -> float:
+        """
+        Estimates the time to aspirate and dispense volume_in_ml, valve switches excluded, in seconds.
+        """
+        steps = self.pump.volume_to_step(volume_in_ml)
+        return (steps / self.velocity(pump_protocol.CMD_PUMP, speed_in) +
+                steps / self.velocity(pump_protocol.CMD_DELIVER, speed_out))
+
+    def stroke_time(self, volume_in_ml: float, speed_in: int = None, speed_out: int = None) -> float:
+        """
+        Estimates the time of one stroke (aspirate and dispense) of volume_in_ml, in seconds.
+        """
+        return self.move_time(volume_in_ml, speed_in, speed_out) + VALVE_SWITCH_TIME
+
+    def transfer_time(self, volume_in_ml: float, speed_in: int = None, speed_out: int = None) -> float:
+        """
+        Estimates the time to move volume_in_ml with as many full strokes as needed, in seconds.
+        """
+        strokes = max(math.ceil(volume_in_ml / self.pump.total_volume), 1)
+        return self.move_time(volume_in_ml, speed_in, speed_out) + strokes * VALVE_SWITCH_TIME
+
+    def __repr__(self):
+        return "{} --[{} {}>{}]--> {}".format(self.source, self.pump.name, self.from_port, self.to_port,
+                                            self.destination)
+
+
+class Route:
+    """
+    This class represents a sequence of hops and its estimated timeline for a given volume.
+
+    Args:
+        hops: The hops, the destination of each hop is the source of the next one.
+
+        volume_in_ml: The volume to move.
+
+        start_times: Estimated start of each hop, relative to now (in seconds).
+
+        end_times: Estimated end of each hop, relative to now (in seconds).
+
+    """
+    def __init__(self, hops: List[Hop], volume_in_ml: float, start_times: List[float], end_times: List[float]):
+        self.hops = hops
+        self.volume_in_ml = volume_in_ml
+        self.start_times = start_times
+        self.end_times = end_times
+
+    @property
+    def duration(self) -> float:
+        """
+        Estimated time until the whole volume has reached the destination (in seconds).
+        """
+        return self.end_times[-1]
+
+    def __repr__(self):
+        return "Route({:.1f}s: {})".format(self.duration, ', '.join(repr(hop) for hop in self.hops))
+
+
+class FluidicNetwork:
+    """
+    This class describes which vessel is connected to which valve port of which pump.
+
+    The network section of the setup config maps each pump name to its connected ports, and lists the buffer
+    vessels that liquid may go through on its way from one pump to the next, e.g.
+    {"connections": {"left": {"1": "water_bottle", "3": "buffer"}, "right": {"1": "buffer", "2": "reactor"}},
+    "buffers": ["buffer"]}. Any name used in a connection is a vessel.
+
+    A running route holds its pumps until it is done, so that routes sharing a pump, e.g. run from two threads, run
+    one after the other instead of driving the same syringe at once. The estimated occupancy of the pumps is only used
+    to rank routes.
+
+    Args:
+        pumps: Dictionary of the pumps of the setup, by name.
+
+        network_config: Dictionary with the connected ports of each pump, and optionally the buffer vessels.
+
+        clock: The clock timing the routes, default set to None (the clock of the pumps).
+
+    Raises:
+        ValueError: Unknown pump, port or buffer in network_config.
+
+    """
+    def __init__(self, pumps: Dict[str, 'C3000Controller'], network_config: Dict[str, Any], clock: Clock = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.pumps = pumps
+        self.clock = clock if clock is not None else clock_of(pumps.values())
+        self.connections: Dict[str, Dict[str, str]] = {}
+        for pump_name, ports in network_config['connections'].items():
+            if pump_name not in pumps:
+                raise ValueError('Pump {} of the network is not in the setup'.format(pump_name))
+            for port in ports:
+                if port not in NETWORK_PORTS:
+                    raise ValueError('Port {} of pump {} is not a valve port'.format(port, pump_name))
+            self.connections[pump_name] = dict(ports)
+
+        self.vessels = sorted({vessel for ports in self.connections.values() for vessel in ports.values()})
+        self.buffers = set(network_config['buffers']) if 'buffers' in network_config else set()
+        for buffer in self.buffers:
+            if buffer not in self.vessels:
+                raise ValueError('Buffer {} is not connected to any pump'.format(buffer))
+
+        # Hops leaving each vessel
+        self._hops: Dict[str, List[Hop]] = {vessel: [] for vessel in self.vessels}
+        for pump_name, ports in self.connections.items():
+            for from_port, source in ports.items():
+                for to_port, destination in ports.items():
+                    if source != destination:
+                        self._hops[source].append(Hop(pumps[pump_name], from_port, to_port, source, destination))
+
+        #: Estimated time (clock.time()) until which each pump is busy with a running routed transfer
+        self.busy_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # Held by the route running on each pump, always taken in the order of the pump names to avoid deadlocks
+        self._pump_locks: Dict[str, threading.Lock] = {pump_name: threading.Lock() for pump_name in self.connections}
+
+    def occupancy(self, pump_name: str) -> float:
+        """
+        Gets the time until the pump is free, from the routed transfers currently running (in seconds).
+        """
+        with self._lock:
+            return max(self.busy_until.get(pump_name, 0.) - self.clock.time(), 0.)
+
+    def estimate(self, hops: List[Hop], volume_in_ml: float, speed_in: int = None, speed_out: int = None) -> Route:
+        """
+        Estimates the timeline of a sequence of hops, each hop starting as soon as the previous one has delivered
+        its first stroke and its pump is free.
+
+        Args:
+            hops: The hops.
+
+            volume_in_ml: The volume to move.
+
+            speed_in: The speed at which the route pumps, default set to None (see Hop.velocity()).
+
+            speed_out: The speed at which the route delivers, default set to None (see Hop.velocity()).
+
+        Returns:
+            Route: The hops with their estimated timeline.
+
+        """
+        start_times: List[float] = []
+        end_times: List[float] = []
+        for i, hop in enumerate(hops):
+            stroke_volume = min(volume_in_ml, hop.pump.total_volume)
+            start = self.occupancy(hop.pump.name)
+            end = start + hop.transfer_time(volume_in_ml, speed_in, speed_out)
+            if i > 0:
+                previous_stroke = min(volume_in_ml, hops[i - 1].pump.total_volume)
+                start = max(start, start_times[-1] + hops[i - 1].stroke_time(previous_stroke, speed_in, speed_out))
+                end = max(start + hop.transfer_time(volume_in_ml, speed_in, speed_out),
+                          end_times[-1] + hop.stroke_time(stroke_volume, speed_in, speed_out))
+            start_times.append(start)
+            end_times.append(end)
+        return Route(hops, volume_in_ml, start_times, end_times)
+
+    def routes(self, source: str, destination: str, max_hops: int = MAX_HOPS) -> List[List[Hop]]:
+        """
+        Lists every route from source to destination, going only through buffers and using each pump at most once.
+
+        Args:
+            source: The vessel to take liquid from.
+
+            destination: The vessel to bring liquid to.
+
+            max_hops: Maximum number of hops of a route, default set to MAX_HOPS (4).
+
+        Returns:
+            routes: List of hop sequences.
+
+        Raises:
+            ValueError: Unknown vessel.
+
+        """
+        for vessel in (source, destination):
+            if vessel not in self._hops:
+                raise ValueError('Vessel {} is not in the network'.format(vessel))
+
+        found: List[List[Hop]] = []
+
+        def explore(vessel: str, hops: List[Hop]) -> None:
+            if vessel == destination:
+                found.append(list(hops))
+                return
+            if len(hops) == max_hops or (hops and vessel not in self.buffers):
+                return
+            used_pumps = {hop.pump.name for hop in hops}
+            visited = {source} | {hop.destination for hop in hops}
+            for hop in self._hops[vessel]:
+                if hop.pump.name not in used_pumps and hop.destination not in visited:
+                    hops.append(hop)
+                    explore(hop.destination, hops)
+                    hops.pop()
+
+        explore(source, [])
+        return found
+
+    def plan_transfer(self, source: str, destination: str, volume_in_ml: float, speed_in: int = None,
+                      speed_out: int = None) -> Optional[Route]:
+        """
+        Finds the fastest route for a transfer given syringe volumes, speeds and current pump occupancy.
+
+        Args:
+            source: The vessel to take liquid from.
+
+            destination: The vessel to bring liquid to.
+
+            volume_in_ml: The volume to move.
+
+            speed_in: The speed at which the route will pump, default set to None (see Hop.velocity()).
+
+            speed_out: The speed at which the route will deliver, default set to None (see Hop.velocity()).
+
+        Returns:
+            Route: The fastest route, None if the vessels are not connected.
+
+        """
+        candidates = [self.estimate(hops, volume_in_ml, speed_in, speed_out)
+                      for hops in self.routes(source, destination)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda route: route.duration)
+
+    def run(self, route: Route, speed_in: int = None, speed_out: int = None) -> None:
+        """
+        Runs a route, all hops in parallel: each hop aspirates from an intermediate vessel only what the previous
+        hop has already delivered to it. Waits for the routes running on its pumps to end first. This function is
+        blocking.
+
+        Args:
+            route: The route to run, from plan_transfer().
+
+            speed_in: The speed at which to pump, default set to None.
+
+            speed_out: The speed at which to deliver, default set to None.
+
+        """
+        pump_locks = [self._pump_locks[pump_name] for pump_name in sorted({hop.pump.name for hop in route.hops})]
+        for pump_lock in pump_locks:
+            pump_lock.acquire()
+        try:
+            self._run_hops(route, speed_in, speed_out)
+        finally:
+            for pump_lock in reversed(pump_locks):
+                pump_lock.release()
+
+    def _run_hops(self, route: Route, speed_in: Optional[int], speed_out: Optional[int]) -> None:
+        now = self.clock.time()
+        with self._lock:
+            for hop, end_time in zip(route.hops, route.end_times):
+                self.busy_until[hop.pump.name] = max(self.busy_until.get(hop.pump.name, 0.), now + end_time)
+
+        # Volume delivered into each intermediate vessel and not yet taken by the next hop
+        available = [0.] * len(route.hops)
+        condition = threading.Condition()
+        errors: List[Exception] = []
+
+        def run_hop(i: int, hop: Hop) -> None:
+            volume_left = route.volume_in_ml
+            try:
+                while volume_left > 0:
+                    stroke_volume = min(volume_left, hop.pump.remaining_volume)
+                    if stroke_volume <= 0:
+                        raise ValueError('Pump {} is full, cannot run {}'.format(hop.pump.name, hop))
+                    if i > 0:
+                        with condition:
+                            condition.wait_for(lambda: available[i - 1] > 0 or errors)
+                            if errors:
+                                return
+                            stroke_volume = min(stroke_volume, available[i - 1])
+                            available[i - 1] -= stroke_volume
+                    # pump() and deliver() return False when the volume is not feasible
+                    if hop.pump.pump(stroke_volume, from_valve=hop.from_port, speed_in=speed_in,
+                                     wait=True) is False:
+                        raise ValueError('pump of {} ml on pump {} is not feasible'.format(stroke_volume,
+                                                                                            hop.pump.name))
+                    if hop.pump.deliver(stroke_volume, to_valve=hop.to_port, speed_out=speed_out,
+                                        wait=True) is False:
+                        raise ValueError('deliver of {} ml on pump {} is not feasible'.format(stroke_volume,
+                                                                                               hop.pump.name))
+                    volume_left -= stroke_volume
+                    with condition:
+                        available[i] += stroke_volume
+                        condition.notify_all()
+            except Exception as err:
+                with condition:
+                    errors.append(err)
+                    condition.notify_all()
+            finally:
+                with self._lock:
+                    self.busy_until[hop.pump.name] = self.clock.time()
+
+        threads = [threading.Thread(target=run_hop, args=(i, hop)) for i, hop in enumerate(route.hops)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def transfer(self, source: str, destination: str, volume_in_ml: float, speed_in: int = None,
+                 speed_out: int = None) -> Route:
+        """
+        Plans and runs the fastest route for a transfer. This function is blocking.
+
+        Args:
+            source: The vessel to take liquid from.
+
+            destination: The vessel to bring liquid to.
+
+            volume_in_ml: The volume to move.
+
+            speed_in: The speed at which to pump, default set to None.
+
+            speed_out: The speed at which to deliver, default set to None.
+
+        Returns:
+            Route: The route that was run.
+
+        Raises:
+            ValueError: The vessels are not connected.
+
+        """
+        route = self.plan_transfer(source, destination, volume_in_ml, speed_in, speed_out)
+        if route is None:
+            raise ValueError('No route from {} to {} in the network'.format(source, destination))
+        self.logger.debug("Transfer of {} mL via {}".format(volume_in_ml, route))
+        self.run(route, speed_in=speed_in, speed_out=speed_out)
+        return route
@@ -33,11 +33,23 @@ CMD_PUMP = 'P'
 CMD_DELIVER = 'D'
 #: Command to achieve top velocity
 CMD_TOPVELOCITY = 'V'
+#: Command to set the start velocity
+CMD_START_VELOCITY = 'v'
+#: Command to set the slope code of the acceleration and deceleration ramps
+CMD_SLOPE = 'L'
+#: Command to set the cutoff velocity
+CMD_CUTOFF_VELOCITY = 'c'
 #: Command to access the EEPROM configuration
 CMD_EEPROM_CONFIG = 'U'      # Requires power restart to take effect
 CMD_EEPROM_LOWLEVEL_CONFIG = 'u'      # Requires power restart to take effect
 #: Command to terminate current operation
 CMD_TERMINATE = 'T'
+#: Command to pause the command sequence for a number of milliseconds
+CMD_DELAY = 'M'
+#: Shortest and longest pause of one delay command (in milliseconds)
+DELAY_RANGE = (5, 30000)
+#: Longest packet the pumps take, start and end characters included, longer ones overflow their command buffer
+MAX_PACKET_LENGTH = 255
 
 #: Command for the valve init_all_pump_parameters
 #: .. note:: Depending on EEPROM settings (U4 or U11) 4-way distribution valves either use IOBE or I<n>O<n>
@@ -302,6 +314,81 @@ class C3000Protocol:
         dtcommand = dtprotocol.DTCommand(CMD_TOPVELOCITY, str(int(operand_value)))
         return self.forge_packet(dtcommand)
 
+    def forge_start_velocity_packet(self, operand_value: int) -> dtprotocol.DTInstructionPacket:
+        """
+        Creates a packet for the start velocity of the device.
+
+        Args:
+            operand_value: The value of the supplied operand.
+
+        Returns:
+            DTInstructionPacket: The packet created for the start velocity of the device.
+
+        """
+        dtcommand = dtprotocol.DTCommand(CMD_START_VELOCITY, str(int(operand_value)))
+        return self.forge_packet(dtcommand)
+
+    def forge_slope_packet(self, operand_value: int) -> dtprotocol.DTInstructionPacket:
+        """
+        Creates a packet for the slope code of the device.
+
+        Args:
+            operand_value: The value of the supplied operand.
+
+        Returns:
+            DTInstructionPacket: The packet created for the slope code of the device.
+
+        """
+        dtcommand = dtprotocol.DTCommand(CMD_SLOPE, str(int(operand_value)))
+        return self.forge_packet(dtcommand)
+
+    def forge_cutoff_velocity_packet(self, operand_value: int) -> dtprotocol.DTInstructionPacket:
+        """
+        Creates a packet for the cutoff velocity of the device.
+
+        Args:
+            operand_value: The value of the supplied operand.
+
+        Returns:
+            DTInstructionPacket: The packet created for the cutoff velocity of the device.
+
+        """
+        dtcommand = dtprotocol.DTCommand(CMD_CUTOFF_VELOCITY, str(int(operand_value)))
+        return self.forge_packet(dtcommand)
+
+    def forge_motion_profile_packet(self, start_velocity: int, slope: int, cutoff_velocity: int)\
+            -> dtprotocol.DTInstructionPacket:
+        """
+        Creates a single packet setting the slope code, start velocity and cutoff velocity of the device.
+
+        Args:
+            start_velocity: The start velocity (steps/second).
+
+            slope: The slope code.
+
+            cutoff_velocity: The cutoff velocity (steps/second).
+
+        Returns:
+            DTInstructionPacket: The packet created for the acceleration profile of the device.
+
+        """
+        return self.forge_move_sequence_packet([(CMD_SLOPE, slope), (CMD_START_VELOCITY, start_velocity),
+                                                (CMD_CUTOFF_VELOCITY, cutoff_velocity)])
+
+    def forge_move_sequence_packet(self, moves: List[Tuple[str, int]]) -> dtprotocol.DTInstructionPacket:
+        """
+        Creates a single packet chaining several commands, executed one after the other by the device.
+
+        Args:
+            moves: List of (command, operand) pairs, e.g. [(CMD_TOPVELOCITY, 1200), (CMD_DELIVER, 300)].
+
+        Returns:
+            DTInstructionPacket: The packet created for the chained commands.
+
+        """
+        dtcommands = [dtprotocol.DTCommand(command, str(int(operand_value))) for command, operand_value in moves]
+        return self.forge_packet(dtcommands)
+
     def forge_eeprom_config_packet(self, operand_value: int) -> dtprotocol.DTInstructionPacket:
         """
         Creates a packet for accessing the EEPROM configuration of the device.
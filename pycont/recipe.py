@@ -0,0 +1,364 @@
+"""
+.. module:: recipe
+   :platform: Unix
+   :synopsis: A module used for running recipes, graphs of pump steps, with as much parallelism as possible.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Union, TYPE_CHECKING
+
+from ._logger import create_logger
+
+if TYPE_CHECKING:
+    from .controller import MultiPumpController
+
+
+class RecipeStep:
+    """
+    This class represents one step of a recipe: a C3000Controller command applied to one or more pumps.
+
+    Args:
+        name: The name of the step.
+
+        command: The C3000Controller method to call, e.g. 'pump', 'deliver' or 'transfer'.
+
+        pumps: The names of the pumps the command is applied to, they are used exclusively by the step.
+
+        args: Keyword arguments of the command, default set to None.
+
+        after: Names of the steps that must be finished before this one starts, default set to None.
+
+        exclusive_hub: Holds the hubs of its pumps, no other step runs on them meanwhile (e.g. a dose whose timing
+            must not be stretched by the traffic of the other pumps), default set to False.
+
+    """
+    def __init__(self, name: str, command: str, pumps: List[str], args: Dict[str, Any] = None,
+                 after: List[str] = None, exclusive_hub: bool = False):
+        self.name = name
+        self.command = command
+        self.pumps = pumps
+        self.args = args if args is not None else {}
+        self.after = after if after is not None else []
+        self.exclusive_hub = exclusive_hub
+
+    def __repr__(self):
+        return "RecipeStep({}: {} on {})".format(self.name, self.command, self.pumps)
+
+
+class Recipe:
+    """
+    This class represents a recipe: steps and the dependencies between them.
+
+    A recipe file looks like {"steps": {"fill": {"command": "pump", "pumps": ["water"], "args": {"volume_in_ml": 1,
+    "from_valve": "I"}}, "empty": {"command": "deliver", "group": "chemicals", "args": {"volume_in_ml": 1},
+    "after": ["fill"]}}}. A step takes either a list of "pumps" or a "group" of the setup config, and may hold the
+    hubs of its pumps with "exclusive_hub": true.
+
+    Args:
+        steps: The steps of the recipe.
+
+    Raises:
+        ValueError: A step depends on an unknown step, or the dependencies have a cycle.
+
+    """
+    def __init__(self, steps: List[RecipeStep]):
+        self.steps = {step.name: step for step in steps}
+
+        for step in steps:
+            for dependency in step.after:
+                if dependency not in self.steps:
+                    raise ValueError('Step {} depends on unknown step {}'.format(step.name, dependency))
+        self.order = self.topological_order()
+
+    @classmethod
+    def from_config(cls, recipe_config: Dict, groups: Dict[str, List[str]] = None) -> 'Recipe':
+        """
+        Creates a recipe from its configuration dictionary.
+
+        Args:
+            cls: The initialising class.
+
+            recipe_config: Dictionary holding the recipe.
+
+            groups: The pump groups of the setup, used to resolve steps given by "group", default set to None.
+
+        Returns:
+            Recipe: New Recipe object.
+
+        """
+        groups = groups if groups is not None else {}
+        steps = []
+        for step_name, step_config in recipe_config['steps'].items():
+            if 'group' in step_config:
+                pumps = groups[step_config['group']]
+            else:
+                pumps = step_config['pumps']
+            steps.append(RecipeStep(step_name, step_config['command'], list(pumps), step_config.get('args'),
+                                    step_config.get('after'), step_config.get('exclusive_hub', False)))
+        return cls(steps)
+
+    @classmethod
+    def from_configfile(cls, recipe_configfile: Union[str, Path], groups: Dict[str, List[str]] = None) -> 'Recipe':
+        """
+        Opens a recipe file and parses the data to be used in the from_config method.
+
+        Args:
+            cls: The initialising class.
+
+            recipe_configfile: File which contains the recipe.
+
+            groups: The pump groups of the setup, used to resolve steps given by "group", default set to None.
+
+        Returns:
+            Recipe: New Recipe object.
+
+        """
+        with open(recipe_configfile) as f:
+            return cls.from_config(json.load(f), groups)
+
+    def topological_order(self) -> List[str]:
+        """
+        Orders the steps so that each step comes after its dependencies.
+
+        Returns:
+            order: The step names.
+
+        Raises:
+            ValueError: The dependencies have a cycle.
+
+        """
+        order: List[str] = []
+        remaining = {name: set(step.after) for name, step in self.steps.items()}
+        while remaining:
+            ready = [name for name, dependencies in remaining.items() if not dependencies]
+            if not ready:
+                raise ValueError('Recipe steps {} have circular dependencies'.format(sorted(remaining)))
+            for name in ready:
+                del remaining[name]
+                order.append(name)
+            for dependencies in remaining.values():
+                dependencies.difference_update(ready)
+        return order
+
+
+class RecipeReport:
+    """
+    This class holds the timeline of a recipe run.
+
+    Args:
+        recipe: The recipe that was run.
+
+        start_times: Start of each step, relative to the start of the run (in seconds).
+
+        end_times: End of each step, relative to the start of the run (in seconds).
+
+        errors: Exception raised by each failed step.
+
+        hubs: Hubs of the pumps of each step, default set to None (the hubs are not known).
+
+    """
+    def __init__(self, recipe: Recipe, start_times: Dict[str, float], end_times: Dict[str, float],
+                 errors: Dict[str, Exception], hubs: Dict[str, Set[int]] = None):
+        self.recipe = recipe
+        self.start_times = start_times
+        self.end_times = end_times
+        self.errors = errors
+        self.hubs = hubs if hubs is not None else {}
+
+    @property
+    def makespan(self) -> float:
+        """
+        Wall time of the run (in seconds).
+        """
+        return max(self.end_times.values()) if self.end_times else 0.
+
+    @property
+    def timeline(self) -> List[Dict[str, Any]]:
+        """
+        The steps that ran, by start time, with their pumps, start, end and duration (in seconds).
+        """
+        timeline = []
+        for name in sorted(self.start_times, key=lambda step_name: self.start_times[step_name]):
+            timeline.append({'step': name,
+                             'pumps': self.recipe.steps[name].pumps,
+                             'start': self.start_times[name],
+                             'end': self.end_times.get(name),
+                             'duration': self.end_times[name] - self.start_times[name]
+                             if name in self.end_times else None})
+        return timeline
+
+    @property
+    def critical_path(self) -> List[str]:
+        """
+        The chain of steps that determined the makespan, from the first to the last.
+
+        Going back from the last step to finish, the predecessor of a step is whichever finished last among its
+        dependencies and the previous steps that used one of its pumps, or one of its hubs when either step held it.
+        """
+        if not self.end_times:
+            return []
+        path = [max(self.end_times, key=lambda step_name: self.end_times[step_name])]
+        while True:
+            step = self.recipe.steps[path[-1]]
+            start = self.start_times[step.name]
+            # Steps taking no time (e.g. failing at once) would otherwise precede themselves
+            candidates = [name for name in self.end_times
+                          if self.end_times[name] <= start and name not in path and
+                          (name in step.after or self._conflict(self.recipe.steps[name], step))]
+            if not candidates:
+                return list(reversed(path))
+            path.append(max(candidates, key=lambda step_name: self.end_times[step_name]))
+
+    def _conflict(self, step: RecipeStep, other: RecipeStep) -> bool:
+        if set(step.pumps) & set(other.pumps):
+            return True
+        return (step.exclusive_hub or other.exclusive_hub) and \
+            bool(self.hubs.get(step.name, set()) & self.hubs.get(other.name, set()))
+
+    def summary(self) -> str:
+        """
+        Formats the timeline and critical path as text.
+        """
+        lines = ['Makespan {:.2f}s'.format(self.makespan)]
+        for entry in self.timeline:
+            end = '{:8.2f}'.format(entry['end']) if entry['end'] is not None else '       -'
+            lines.append('{:8.2f} {} {}  {}'.format(entry['start'], end, entry['step'], ','.join(entry['pumps'])))
+        lines.append('Critical path: {}'.format(' -> '.join(self.critical_path)))
+        for name, error in self.errors.items():
+            lines.append('Step {} failed: {!r}'.format(name, error))
+        return '\n'.join(lines)
+
+
+class RecipeRunner:
+    """
+    This class runs a recipe on a MultiPumpController.
+
+    Every step whose dependencies are finished and whose pumps are all free is started at once in its own thread,
+    a step never shares a pump with another running step. A step holding its hubs (see RecipeStep) waits for the
+    steps running on them to finish, and once it is ready no new step starts on them before it. Within a step, the
+    command runs on all its pumps in parallel and the step ends when all of them are idle. A command returning False
+    fails the step.
+
+    Args:
+        controller: The controller holding the pumps.
+
+        recipe: The recipe to run.
+
+    Raises:
+        ValueError: A step uses a pump unknown to the controller.
+
+    """
+    def __init__(self, controller: 'MultiPumpController', recipe: Recipe):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.controller = controller
+        self.recipe = recipe
+        for step in recipe.steps.values():
+            for pump_name in step.pumps:
+                if pump_name not in controller.pumps:
+                    raise ValueError('Step {} uses unknown pump {}'.format(step.name, pump_name))
+
+    def run_step(self, step: RecipeStep) -> None:
+        """
+        Runs the command of a step on all its pumps in parallel, blocking until they are idle.
+
+        Args:
+            step: The step to run.
+
+        """
+        errors: List[Exception] = []
+
+        def run_on_pump(pump_name: str) -> None:
+            pump = self.controller.pumps[pump_name]
+            try:
+                # pump(), deliver() and go_to_volume() return False when the volume is not feasible
+                if getattr(pump, step.command)(**step.args) is False:
+                    raise ValueError('{} on pump {} is not feasible'.format(step.command, pump_name))
+                pump.wait_until_idle()
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=run_on_pump, args=(pump_name,)) for pump_name in step.pumps]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def run(self) -> RecipeReport:
+        """
+        Runs the recipe, blocking until every step has run or a step has failed.
+
+        Once a step fails no new step is started, the running ones are left to finish.
+
+        Returns:
+            RecipeReport: The timeline of the run.
+
+        """
+        start_times: Dict[str, float] = {}
+        end_times: Dict[str, float] = {}
+        errors: Dict[str, Exception] = {}
+        busy_pumps: set = set()
+        hubs = {name: {self.controller.pumps.hub_of(pump_name) for pump_name in step.pumps}
+                for name, step in self.recipe.steps.items()}
+        # Number of running steps on each hub, and the hubs held by a running step
+        hub_users: Dict[int, int] = {}
+        held_hubs: set = set()
+        condition = threading.Condition()
+        clock = self.controller.clock  # The time of the pumps, simulated ones included
+        start = clock.time()
+
+        def execute(step: RecipeStep) -> None:
+            error: Optional[Exception] = None
+            try:
+                self.run_step(step)
+            except Exception as err:
+                self.logger.warning("Step {} failed: {!r}".format(step.name, err))
+                error = err
+            with condition:
+                end_times[step.name] = clock.time() - start
+                if error is not None:
+                    errors[step.name] = error
+                busy_pumps.difference_update(step.pumps)
+                for hub in hubs[step.name]:
+                    hub_users[hub] -= 1
+                if step.exclusive_hub:
+                    held_hubs.difference_update(hubs[step.name])
+                condition.notify_all()
+
+        with condition:
+            while len(end_times) < len(self.recipe.steps) and not errors:
+                reserved_hubs = set(held_hubs)  # Kept free for the ready steps waiting to hold them
+                for name in self.recipe.order:
+                    step = self.recipe.steps[name]
+                    if name in start_times or not all(dependency in end_times for dependency in step.after):
+                        continue
+                    if reserved_hubs & hubs[name]:
+                        continue
+                    if step.exclusive_hub and any(hub_users.get(hub, 0) for hub in hubs[name]):
+                        reserved_hubs.update(hubs[name])
+                        continue
+                    if busy_pumps & set(step.pumps):
+                        continue
+                    busy_pumps.update(step.pumps)
+                    for hub in hubs[name]:
+                        hub_users[hub] = hub_users.get(hub, 0) + 1
+                    if step.exclusive_hub:
+                        held_hubs.update(hubs[name])
+                        reserved_hubs.update(hubs[name])
+                    start_times[name] = clock.time() - start
+                    self.logger.debug("Starting step {} at {:.2f}s".format(name, start_times[name]))
+                    threading.Thread(target=execute, args=(step,), name='recipe-{}'.format(name)).start()
+                condition.wait()
+            condition.wait_for(lambda: len(end_times) == len(start_times))
+
+        return RecipeReport(self.recipe, start_times, end_times, errors, hubs)
@@ -0,0 +1,431 @@
+"""
+.. module:: recording
+   :platform: Unix
+   :synopsis: A module used for recording the serial traffic of the hubs and replaying it to the controllers.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+from ._logger import create_logger
+
+from .clock import Clock, SYSTEM_CLOCK, VirtualClock
+from .controller import PumpIO, MultiPumpController, DEFAULT_IO_BAUDRATE, DEFAULT_IO_TIMEOUT
+from .bus import DEFAULT_TELEMETRY_BUDGET
+from .faults import FaultInjectingSerial
+
+#: Start of a traffic log, followed by the format version
+LOG_MAGIC = b'PYCONTREC'
+LOG_VERSION = 1
+#: Header of each record: kind, monotonic timestamp (ns), hub id, address, length of the data
+RECORD_HEADER = struct.Struct('<cQHcH')
+_VERSION = struct.Struct('<H')
+
+#: Record kinds: a hub entry (its data is the port name), a frame written to a hub and a frame read from it
+KIND_HUB = b'H'
+DIRECTION_WRITE = b'W'
+DIRECTION_READ = b'R'
+
+#: Address recorded when the frame does not name a pump
+UNKNOWN_ADDRESS = b'?'
+
+
+class TrafficFrame:
+    """
+    This class holds one frame of a traffic log.
+
+    Args:
+        direction: DIRECTION_WRITE for a frame sent to the pumps, DIRECTION_READ for a reply.
+
+        timestamp_ns: Monotonic time of the frame (in nanoseconds).
+
+        hub: The port of the hub.
+
+        address: The address of the pump, replies take the address of the command they answer.
+
+        data: The bytes of the frame, empty for a read that timed out.
+
+    """
+    def __init__(self, direction: bytes, timestamp_ns: int, hub: str, address: str, data: bytes):
+        self.direction = direction
+        self.timestamp_ns = timestamp_ns
+        self.hub = hub
+        self.address = address
+        self.data = data
+
+    def __repr__(self):
+        return "TrafficFrame({} {} {} {}: {!r})".format(self.timestamp_ns, self.hub, self.address,
+                                                         self.direction.decode(), self.data)
+
+
+class TrafficRecorder:
+    """
+    This class writes the frames of one or more hubs to a traffic log.
+
+    The log starts with LOG_MAGIC and LOG_VERSION, then holds one record per frame: a RECORD_HEADER followed by the
+    data. Hubs are named once, by a KIND_HUB record, and referred to by id afterwards. Records are appended as they
+    come, so that a log cut short by a crash can still be read up to its last complete record.
+
+    Args:
+        path: The file to write the log to, replaced if it exists.
+
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(LOG_MAGIC + _VERSION.pack(LOG_VERSION))
+        self._lock = threading.Lock()
+        self._hub_ids: Dict[str, int] = {}
+        self._pump_ios: List[PumpIO] = []
+
+        #: Number of frames recorded
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, direction: bytes, hub: str, address: bytes, data: bytes) -> None:
+        """
+        Appends a frame to the log.
+
+        Args:
+            direction: DIRECTION_WRITE or DIRECTION_READ.
+
+            hub: The port of the hub.
+
+            address: The address of the pump (one byte).
+
+            data: The bytes of the frame.
+
+        """
+        timestamp_ns = time.monotonic_ns()
+        with self._lock:
+            if self._file.closed:
+                return
+            if hub not in self._hub_ids:
+                self._hub_ids[hub] = len(self._hub_ids)
+                name = hub.encode()
+                self._file.write(RECORD_HEADER.pack(KIND_HUB, 0, self._hub_ids[hub], UNKNOWN_ADDRESS, len(name)) + name)
+            self._file.write(RECORD_HEADER.pack(direction, timestamp_ns, self._hub_ids[hub], address, len(data)) + data)
+            self.frames += 1
+
+    def attach(self, pump_io: PumpIO) -> 'RecordingSerial':
+        """
+        Starts recording the frames of a PumpIO, until close() or the port is reopened. The port is opened first if it
+        is not open yet.
+
+        The frames are recorded as the controller sees them: faults injected after attaching (see faults.inject_faults)
+        are not recorded, inject them first to replay them.
+
+        Args:
+            pump_io: The PumpIO of the hub.
+
+        Returns:
+            RecordingSerial: The wrapper now used by the PumpIO.
+
+        """
+        pump_io.connect()
+        with pump_io.lock:
+            pump_io._serial = RecordingSerial(_without_recording(pump_io._serial), self, pump_io.port)
+            self._pump_ios.append(pump_io)
+            return pump_io._serial
+
+    def close(self) -> None:
+        """
+        Stops recording the attached PumpIOs and closes the log.
+        """
+        for pump_io in self._pump_ios:
+            with pump_io.lock:
+                pump_io._serial = _without_recording(pump_io._serial)
+        self._pump_ios = []
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                self.logger.info("Recorded {} frames to {}".format(self.frames, self.path))
+
+
+class RecordingSerial:
+    """
+    This class wraps the serial port of a PumpIO and records the frames written and read through it.
+
+    Args:
+        serial_port: The serial port to wrap.
+
+        recorder: The recorder writing the log.
+
+        hub: The port of the hub, as recorded.
+
+    """
+    def __init__(self, serial_port, recorder: TrafficRecorder, hub: str):
+        self.serial_port = serial_port
+        self.recorder = recorder
+        self.hub = hub
+        self._address = UNKNOWN_ADDRESS
+
+    def __getattr__(self, name):
+        return getattr(self.serial_port, name)
+
+    def write(self, data: bytes) -> int:
+        # Commands start with '/' then the address, replies carry the address of the master instead
+        self._address = data[1:2] if data[:1] == b'/' and len(data) > 1 else UNKNOWN_ADDRESS
+        written = self.serial_port.write(data)
+        self.recorder.record(DIRECTION_WRITE, self.hub, self._address, data)
+        return written
+
+    def readline(self) -> bytes:
+        reply = self.serial_port.readline()
+        self.recorder.record(DIRECTION_READ, self.hub, self._address, reply)
+        return reply
+
+
+def _without_recording(serial_port):
+    """
+    Removes the RecordingSerial layers from a chain of wrapped serial ports.
+    """
+    while isinstance(serial_port, RecordingSerial):
+        serial_port = serial_port.serial_port
+    if isinstance(serial_port, FaultInjectingSerial):
+        serial_port.serial_port = _without_recording(serial_port.serial_port)
+    return serial_port
+
+
+def read_traffic(path: Union[str, Path]) -> Iterator[TrafficFrame]:
+    """
+    Reads the frames of a traffic log one at a time, without loading the log in memory.
+
+    A record cut short at the end of the log, e.g. by a crash while recording, ends the reading.
+
+    Args:
+        path: The traffic log.
+
+    Returns:
+        frames: The frames, in the order they were recorded.
+
+    Raises:
+        ValueError: The file is not a traffic log, or of an unknown version.
+
+    """
+    hubs: Dict[int, str] = {}
+    with open(path, 'rb') as f:
+        head = f.read(len(LOG_MAGIC) + _VERSION.size)
+        if head[:len(LOG_MAGIC)] != LOG_MAGIC or len(head) < len(LOG_MAGIC) + _VERSION.size:
+            raise ValueError('{} is not a traffic log'.format(path))
+        (version,) = _VERSION.unpack(head[len(LOG_MAGIC):])
+        if version != LOG_VERSION:
+            raise ValueError('Unknown traffic log version {} in {}'.format(version, path))
+
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                create_logger('read_traffic').warning("{} ends with a truncated record".format(path))
+                return
+            kind, timestamp_ns, hub_id, address, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                create_logger('read_traffic').warning("{} ends with a truncated record".format(path))
+                return
+            if kind == KIND_HUB:
+                hubs[hub_id] = data.decode()
+            else:
+                yield TrafficFrame(kind, timestamp_ns, hubs.get(hub_id, str(hub_id)),
+                                   address.decode(errors='replace'), data)
+
+
+class ReplayMismatchError(Exception):
+    """
+    Exception raised when the controllers write a frame that differs from the recorded one.
+    """
+    pass
+
+
+class ReplaySerial:
+    """
+    This class stands in for the serial port of a hub and answers with the replies of a traffic log.
+
+    Each frame written is checked against the next frame recorded for the same pump, and the recorded reply is read
+    back, after the recorded reply time when replaying in real time. Recorded timeouts are read as timeouts. Frames
+    are matched pump by pump: the exchanges of one pump follow from its replies, but how the pumps of a hub
+    interleave depends on timing (see initialization.InitializationEngine), so it may differ from the recording.
+
+    Args:
+        hub: The port of the hub.
+
+        frames: The recorded frames of the hub.
+
+        realtime: Replays with the recorded reply times, otherwise as fast as possible, default set to False.
+
+        strict: Raises ReplayMismatchError when a frame written differs from the recorded one, otherwise the
+            mismatch is only counted, default set to True.
+
+        clock: The clock the reply times are waited in, default set to None (the wall clock).
+
+    """
+    def __init__(self, hub: str, frames: List[TrafficFrame], realtime: bool = False, strict: bool = True,
+                 clock: Clock = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.hub = hub
+        self.realtime = realtime
+        self.strict = strict
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.timeout = None
+        self.is_open = True
+
+        # Recorded frames of each pump, by address, with the position of the next one
+        self._frames: Dict[str, List[TrafficFrame]] = {}
+        for frame in frames:
+            self._frames.setdefault(frame.address, []).append(frame)
+        self._positions = {address: 0 for address in self._frames}
+        self._address = UNKNOWN_ADDRESS.decode()
+        self._written: Optional[TrafficFrame] = None
+        #: Frames written that differ from the recording, as (recorded frame or None, written data)
+        self.mismatches: List[tuple] = []
+
+    @property
+    def finished(self) -> bool:
+        return all(self._positions[address] >= len(frames) for address, frames in self._frames.items())
+
+    def _next_frame(self) -> Optional[TrafficFrame]:
+        frames = self._frames.get(self._address, [])
+        position = self._positions.get(self._address, 0)
+        return frames[position] if position < len(frames) else None
+
+    def reset_input_buffer(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.is_open = False
+
+    def write(self, data: bytes) -> int:
+        self._address = data[1:2].decode(errors='replace') if data[:1] == b'/' and len(data) > 1 \
+            else UNKNOWN_ADDRESS.decode()
+        frame = self._next_frame()
+        if frame is not None and frame.direction == DIRECTION_WRITE:
+            self._positions[self._address] += 1
+        if frame is None or frame.direction != DIRECTION_WRITE or frame.data != data:
+            self.mismatches.append((frame, data))
+            if self.strict:
+                raise ReplayMismatchError('{}: wrote {!r}, recorded {!r}'.format(
+                    self.hub, data, frame.data if frame is not None else 'end of session'))
+            self.logger.debug("{}: wrote {!r}, recorded {!r}".format(self.hub, data, frame))
+        self._written = frame
+        return len(data)
+
+    def readline(self) -> bytes:
+        frame = self._next_frame()
+        if frame is None or frame.direction != DIRECTION_READ:
+            return b''  # Nothing recorded, read as a timeout
+        self._positions[self._address] += 1
+        if self.realtime and self._written is not None:
+            self.clock.sleep(max(frame.timestamp_ns - self._written.timestamp_ns, 0) / 1e9)
+        return frame.data
+
+
+class ReplaySession:
+    """
+    This class holds a recorded session, split by hub, for replaying it to the controllers.
+
+    Args:
+        path: The traffic log.
+
+        realtime: Replays with the recorded reply times, otherwise as fast as possible, default set to False.
+
+        strict: Raises ReplayMismatchError on the first frame written that differs from the recording, default set
+            to True.
+
+    """
+    def __init__(self, path: Union[str, Path], realtime: bool = False, strict: bool = True):
+        self.path = path
+        self.realtime = realtime
+        self.strict = strict
+
+        frames: Dict[str, List[TrafficFrame]] = {}
+        for frame in read_traffic(path):
+            frames.setdefault(frame.hub, []).append(frame)
+        self.serials = {hub: ReplaySerial(hub, hub_frames, realtime, strict) for hub, hub_frames in frames.items()}
+
+    def serial_for(self, hub: str) -> ReplaySerial:
+        """
+        Gets the stand-in serial port of a hub, one with no frames if the hub was not recorded.
+        """
+        if hub not in self.serials:
+            self.serials[hub] = ReplaySerial(hub, [], self.realtime, self.strict)
+        return self.serials[hub]
+
+    @property
+    def mismatches(self) -> int:
+        return sum(len(replay_serial.mismatches) for replay_serial in self.serials.values())
+
+    @property
+    def finished(self) -> bool:
+        """
+        Determines if every recorded frame was replayed.
+        """
+        return all(replay_serial.finished for replay_serial in self.serials.values())
+
+
+class ReplayPumpIO(PumpIO):
+    """
+    This class is a PumpIO whose hub is replayed from a ReplaySession instead of opened.
+
+    Args:
+        session: The recorded session.
+
+        See PumpIO for the other arguments.
+
+    """
+    def __init__(self, session: ReplaySession, port: str, baudrate: int = DEFAULT_IO_BAUDRATE,
+                 timeout: float = DEFAULT_IO_TIMEOUT, telemetry_budget: float = DEFAULT_TELEMETRY_BUDGET,
+                 clock: Clock = None):
+        self.session = session
+        super().__init__(port, baudrate, timeout, telemetry_budget, clock)
+
+    def open(self, port, baudrate=DEFAULT_IO_BAUDRATE, timeout=DEFAULT_IO_TIMEOUT):
+        self._serial = self.session.serial_for(port)
+
+
+class ReplayMultiPumpController(MultiPumpController):
+    """
+    This class is a MultiPumpController whose hubs are replayed from a traffic log, to run the script that was
+    recorded again, offline.
+
+    Replayed as fast as possible, the pumps take their time from a VirtualClock so that their waits take no time.
+    Check session.mismatches and session.finished afterwards: a script replaying cleanly writes every recorded
+    frame, in order.
+
+    Args:
+        setup_config: The configuration of the setup, as recorded.
+
+        path: The traffic log.
+
+        realtime: Replays with the recorded reply times, otherwise as fast as possible, default set to False.
+
+        strict: Raises ReplayMismatchError on the first frame written that differs from the recording, default set
+            to True.
+
+    """
+    persists_state = False
+
+    def __init__(self, setup_config: Dict, path: Union[str, Path], realtime: bool = False, strict: bool = True):
+        self.session = ReplaySession(path, realtime, strict)
+        super().__init__(setup_config, None if realtime else VirtualClock())
+
+    def _create_pump_io(self, io_config: Dict) -> PumpIO:
+        return ReplayPumpIO(self.session, io_config['port'], io_config.get('baudrate', DEFAULT_IO_BAUDRATE),
+                            io_config.get('timeout', DEFAULT_IO_TIMEOUT),
+                            io_config.get('telemetry_budget', DEFAULT_TELEMETRY_BUDGET), self.clock)
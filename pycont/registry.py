@@ -0,0 +1,307 @@
+"""
+.. module:: registry
+   :platform: Unix
+   :synopsis: A module used for holding the pumps of a setup, indexed by hub, address, group and tag.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+from collections.abc import Mapping
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller, PumpIO
+
+#: A hub, given by its index in the setup config, its port or its PumpIO
+Hub = Union[int, str, 'PumpIO']
+
+
+class PumpRegistry(Mapping):
+    """
+    This class holds the pumps of a setup by name, and behaves as a read-only dict of them.
+
+    The pumps are also indexed by hub, by address on their hub, by group and by tag, so that lookups and selections
+    do not go through all the pumps. Hubs are numbered in the order they are added, which is their order in the setup
+    config. Selections keep the order in which the pumps were added, and are cached.
+
+    """
+    def __init__(self):
+        self._pumps: Dict[str, 'C3000Controller'] = {}
+
+        #: The PumpIO of each hub, by hub index
+        self.hubs: List['PumpIO'] = []
+        self._hub_indexes: Dict[int, int] = {}  # id() of the PumpIO -> hub index
+        self._hub_of: Dict[str, int] = {}
+        self._by_hub: Dict[int, List[str]] = {}
+        self._by_address: Dict[Tuple[int, str], str] = {}
+        self._groups: Dict[str, Tuple[str, ...]] = {}
+        self._group_pumps: Dict[str, Tuple['C3000Controller', ...]] = {}
+        self._tags: Dict[str, List[str]] = {}
+        self._tags_of: Dict[str, FrozenSet[str]] = {}
+        self._rank: Dict[str, int] = {}  # Order in which the pumps were added
+        self._selections: Dict[Tuple, Tuple[str, ...]] = {}
+
+    def __getitem__(self, pump_name: str) -> 'C3000Controller':
+        return self._pumps[pump_name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._pumps)
+
+    def __len__(self) -> int:
+        return len(self._pumps)
+
+    def __contains__(self, pump_name) -> bool:
+        return pump_name in self._pumps
+
+    def __repr__(self) -> str:
+        return 'PumpRegistry({} pumps on {} hubs)'.format(len(self._pumps), len(self.hubs))
+
+    def keys(self):
+        return self._pumps.keys()
+
+    def values(self):
+        return self._pumps.values()
+
+    def items(self):
+        return self._pumps.items()
+
+    def add_hub(self, pump_io: 'PumpIO') -> int:
+        """
+        Adds a hub, hubs are also added with their first pump.
+
+        Args:
+            pump_io: The PumpIO of the hub.
+
+        Returns:
+            hub: The index of the hub.
+
+        """
+        hub = self._hub_indexes.get(id(pump_io))
+        if hub is None:
+            hub = len(self.hubs)
+            self.hubs.append(pump_io)
+            self._hub_indexes[id(pump_io)] = hub
+            self._by_hub[hub] = []
+        return hub
+
+    def add(self, pump_name: str, pump: 'C3000Controller', tags: Iterable[str] = ()) -> None:
+        """
+        Adds a pump.
+
+        Args:
+            pump_name: The name of the pump.
+
+            pump: The pump.
+
+            tags: Free-form labels to select the pump by, e.g. ["heated", "bay-2"], default set to ().
+
+        Raises:
+            ValueError: The name is taken, or another pump has the same address on the same hub.
+
+        """
+        if pump_name in self._pumps:
+            raise ValueError('Pump {} is already registered'.format(pump_name))
+        hub = self.add_hub(pump._io)
+        if (hub, pump.address) in self._by_address:
+            raise ValueError('Pumps {} and {} have the same address {!r} on hub {}'.format(
+                self._by_address[(hub, pump.address)], pump_name, pump.address, pump._io.port))
+
+        self._pumps[pump_name] = pump
+        self._rank[pump_name] = len(self._rank)
+        self._hub_of[pump_name] = hub
+        self._by_hub[hub].append(pump_name)
+        self._by_address[(hub, pump.address)] = pump_name
+        self._tags_of[pump_name] = frozenset(tags)
+        for tag in self._tags_of[pump_name]:
+            self._tags.setdefault(tag, []).append(pump_name)
+        self._selections.clear()
+
+    def set_groups(self, groups: Dict[str, List[str]]) -> None:
+        """
+        Sets the groups of pumps, replacing the previous ones.
+
+        Args:
+            groups: The pump names of each group, as in the setup config.
+
+        Raises:
+            ValueError: A group lists an unknown pump.
+
+        """
+        for group_name, pump_names in groups.items():
+            for pump_name in pump_names:
+                if pump_name not in self._pumps:
+                    raise ValueError('Group {} lists unknown pump {}'.format(group_name, pump_name))
+        self._groups = {group_name: tuple(pump_names) for group_name, pump_names in groups.items()}
+        self._group_pumps = {group_name: tuple(self._pumps[pump_name] for pump_name in pump_names)
+                             for group_name, pump_names in self._groups.items()}
+        self._selections.clear()
+
+    @property
+    def groups(self) -> Dict[str, Tuple[str, ...]]:
+        """
+        The pump names of each group.
+        """
+        return dict(self._groups)
+
+    def hub_index(self, hub: Hub) -> int:
+        """
+        Finds a hub.
+
+        Args:
+            hub: The hub, by index, port or PumpIO.
+
+        Returns:
+            hub: The index of the hub.
+
+        Raises:
+            KeyError: Unknown hub.
+
+        """
+        if isinstance(hub, int):
+            if 0 <= hub < len(self.hubs):
+                return hub
+        elif isinstance(hub, str):
+            for index, pump_io in enumerate(self.hubs):
+                if pump_io.port == hub:
+                    return index
+        elif id(hub) in self._hub_indexes:
+            return self._hub_indexes[id(hub)]
+        raise KeyError('No hub {!r}'.format(hub))
+
+    def hub_of(self, pump_name: str) -> int:
+        """
+        Gives the index of the hub of a pump.
+        """
+        return self._hub_of[pump_name]
+
+    def on_hub(self, hub: Hub) -> List[str]:
+        """
+        Gives the pumps of a hub.
+
+        Args:
+            hub: The hub, by index, port or PumpIO.
+
+        Returns:
+            pump_names: The pumps on the hub.
+
+        """
+        return list(self._by_hub[self.hub_index(hub)])
+
+    def at_address(self, hub: Hub, address: str) -> Optional[str]:
+        """
+        Gives the pump at an address.
+
+        Args:
+            hub: The hub, by index, port or PumpIO.
+
+            address: The address on the hub, see C3000SwitchToAddress.
+
+        Returns:
+            pump_name: The pump at this address, None if there is none.
+
+        """
+        return self._by_address.get((self.hub_index(hub), address))
+
+    def in_group(self, group_name: str) -> List[str]:
+        """
+        Gives the pumps of a group.
+
+        Raises:
+            KeyError: Unknown group.
+
+        """
+        return list(self._groups[group_name])
+
+    def group_pumps(self, group_name: str) -> List['C3000Controller']:
+        """
+        Gives the pump objects of a group.
+
+        Raises:
+            KeyError: Unknown group.
+
+        """
+        return list(self._group_pumps[group_name])
+
+    def with_tag(self, tag: str) -> List[str]:
+        """
+        Gives the pumps with a tag, none for an unknown tag.
+        """
+        return list(self._tags.get(tag, ()))
+
+    def tags_of(self, pump_name: str) -> FrozenSet[str]:
+        """
+        Gives the tags of a pump.
+        """
+        return self._tags_of[pump_name]
+
+    def select(self, hub: Union[Hub, List[Hub]] = None, group: Union[str, List[str]] = None,
+               tag: Union[str, List[str]] = None, names: List[str] = None) -> List[str]:
+        """
+        Selects pumps, e.g. select(hub=2, group='oils') for the pumps of group oils on the third hub.
+
+        Each criterion takes one value or a list of values, a pump matching any of them. A pump is selected if it
+        matches every criterion given. Selections are cached until pumps or groups change.
+
+        Args:
+            hub: The hubs, by index, port or PumpIO, default set to None (any hub).
+
+            group: The groups, default set to None (any group, or none).
+
+            tag: The tags, default set to None (any tags, or none).
+
+            names: The pumps to select from, default set to None (all pumps).
+
+        Returns:
+            pump_names: The selected pumps, in the order they were added.
+
+        Raises:
+            KeyError: Unknown hub, group or pump name.
+
+        """
+        hubs = tuple(self.hub_index(h) for h in _as_list(hub)) if hub is not None else None
+        groups = tuple(_as_list(group)) if group is not None else None
+        tags = tuple(_as_list(tag)) if tag is not None else None
+        names_key = tuple(names) if names is not None else None
+        key = (hubs, groups, tags, names_key)
+        if key not in self._selections:
+            matches = []  # The pumps matching each criterion given
+            if hubs is not None:
+                matches.append({pump_name for h in hubs for pump_name in self._by_hub[h]})
+            if groups is not None:
+                matches.append({pump_name for g in groups for pump_name in self._groups[g]})
+            if tags is not None:
+                matches.append({pump_name for t in tags for pump_name in self._tags.get(t, ())})
+            if names is not None:
+                for pump_name in names:
+                    if pump_name not in self._pumps:
+                        raise KeyError('No pump {!r}'.format(pump_name))
+                matches.append(set(names))
+            if matches:
+                selection = tuple(sorted(set.intersection(*matches), key=self._rank.__getitem__))
+            else:
+                selection = tuple(self._pumps)
+            self._selections[key] = selection
+        return list(self._selections[key])
+
+    def partition_by_hub(self, pump_names: Iterable[str]) -> Dict[int, List[str]]:
+        """
+        Splits pumps by hub, e.g. to run one thread per hub.
+
+        Args:
+            pump_names: The pumps.
+
+        Returns:
+            pump_names: The pumps of each hub, by hub index, only for hubs with pumps in pump_names.
+
+        """
+        partition: Dict[int, List[str]] = {}
+        for pump_name in pump_names:
+            partition.setdefault(self._hub_of[pump_name], []).append(pump_name)
+        return partition
+
+
+def _as_list(value) -> List:
+    return value if isinstance(value, (list, tuple, set, frozenset)) else [value]
@@ -0,0 +1,231 @@
+"""
+.. module:: resilience
+   :platform: Unix
+   :synopsis: A module used for retrying failed exchanges and isolating pumps that stopped answering.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+from typing import Callable, Dict
+
+from ._logger import create_logger
+from .clock import Clock, SYSTEM_CLOCK
+
+#: Default number of attempts of an exchange with a pump
+DEFAULT_RETRY_ATTEMPTS = 10
+#: Default number of consecutive failed exchanges opening the circuit
+DEFAULT_FAILURE_THRESHOLD = 3
+#: Default time a pump fast-fails before it is probed again (in seconds)
+DEFAULT_COOLDOWN = 5.0
+
+#: Requests go through
+CIRCUIT_CLOSED = 'closed'
+#: Requests fail immediately
+CIRCUIT_OPEN = 'open'
+#: The pump is being probed, requests still fail immediately
+CIRCUIT_HALF_OPEN = 'half-open'
+
+
+class RetryPolicy:
+    """
+    This class describes how an exchange with a pump is retried.
+
+    The delay before the n-th retry is backoff * backoff_factor ** (n - 1), capped at max_backoff, and randomly
+    shortened by up to jitter (a fraction of the delay) so that pumps retrying together spread out. The bus is free
+    during the delays.
+
+    Args:
+        attempts: Number of attempts, default set to DEFAULT_RETRY_ATTEMPTS (10).
+
+        backoff: Delay before the first retry (in seconds), default set to 0 (retry immediately).
+
+        backoff_factor: Growth of the delay at each retry, default set to 2.
+
+        max_backoff: Longest delay (in seconds), default set to 1.
+
+        jitter: Fraction of the delay randomly removed, from 0 to 1, default set to 0.
+
+    """
+    def __init__(self, attempts: int = DEFAULT_RETRY_ATTEMPTS, backoff: float = 0., backoff_factor: float = 2.,
+                 max_backoff: float = 1., jitter: float = 0.):
+        if attempts < 1:
+            raise ValueError('A retry policy needs at least one attempt')
+        if not 0 <= jitter <= 1:
+            raise ValueError('Jitter must be in [0, 1], got {}'.format(jitter))
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    @classmethod
+    def from_config(cls, retry_config: Dict) -> 'RetryPolicy':
+        """
+        Creates a retry policy from its configuration dictionary.
+
+        Args:
+            cls: The initialising class.
+
+            retry_config: Dictionary holding any of attempts, backoff, backoff_factor, max_backoff and jitter.
+
+        Returns:
+            RetryPolicy: New RetryPolicy object.
+
+        """
+        return cls(**retry_config)
+
+    def delay(self, retry: int) -> float:
+        """
+        Gets the delay before a retry.
+
+        Args:
+            retry: The number of the retry, 1 for the second attempt.
+
+        Returns:
+            delay: The time to wait (in seconds).
+
+        """
+        if self.backoff <= 0:
+            return 0.
+        delay = min(self.backoff * self.backoff_factor ** (retry - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+    def __repr__(self):
+        return "RetryPolicy(attempts={}, backoff={}, backoff_factor={}, max_backoff={}, jitter={})".format(
+            self.attempts, self.backoff, self.backoff_factor, self.max_backoff, self.jitter)
+
+
+class CircuitBreaker:
+    """
+    This class stops talking to a pump that stopped answering, so that it does not hold the bus of its hub.
+
+    After failure_threshold consecutive failed exchanges the circuit opens and requests fail immediately. After
+    cooldown seconds the pump is probed in the background (half-open): if it answers the circuit closes, otherwise it
+    stays open for another cooldown. Without a probe, the first request after the cooldown is let through instead.
+    Failures of exchanges already under way when the circuit opened do not extend the cooldown.
+
+    Args:
+        failure_threshold: Consecutive failures opening the circuit, default set to DEFAULT_FAILURE_THRESHOLD (3).
+
+        cooldown: Time the circuit stays open before probing (in seconds), default set to DEFAULT_COOLDOWN (5).
+
+        probe: Returns whether the pump answers, called in the background, default set to None.
+
+        name: Name used in the logs, default set to ''.
+
+        clock: The clock timing the cooldown, default set to None (SYSTEM_CLOCK).
+
+    """
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, cooldown: float = DEFAULT_COOLDOWN,
+                 probe: Callable[[], bool] = None, name: str = '', clock: Clock = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.probe = probe
+        self.name = name
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0.
+        self._lock = threading.Lock()
+        # Counts the openings of the circuit, a probe only runs if the circuit is still in the opening it was
+        # scheduled for, so that reset() cancels it
+        self._opening = 0
+
+    @classmethod
+    def from_config(cls, breaker_config: Dict, probe: Callable[[], bool] = None, name: str = '',
+                    clock: Clock = None) -> 'CircuitBreaker':
+        """
+        Creates a circuit breaker from its configuration dictionary.
+
+        Args:
+            cls: The initialising class.
+
+            breaker_config: Dictionary holding any of failure_threshold and cooldown.
+
+            probe: See CircuitBreaker, default set to None.
+
+            name: See CircuitBreaker, default set to ''.
+
+            clock: See CircuitBreaker, default set to None (SYSTEM_CLOCK).
+
+        Returns:
+            CircuitBreaker: New CircuitBreaker object.
+
+        """
+        return cls(probe=probe, name=name, clock=clock, **breaker_config)
+
+    def allow_request(self) -> bool:
+        """
+        Determines if a request may be sent to the pump.
+        """
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and self.probe is None and \
+                    self.clock.time() - self.opened_at >= self.cooldown:
+                self.state = CIRCUIT_HALF_OPEN  # This request is the probe
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """
+        Records an exchange that went through, closing the circuit.
+        """
+        with self._lock:
+            if self.state != CIRCUIT_CLOSED:
+                self.logger.info("[PUMP {}] Answering again, circuit closed".format(self.name))
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        """
+        Records a failed exchange, opening the circuit once failure_threshold is reached.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or \
+                    (self.state == CIRCUIT_CLOSED and self.failures >= self.failure_threshold):
+                self._open()
+
+    def _open(self) -> None:
+        if self.state == CIRCUIT_CLOSED:
+            self.logger.warning("[PUMP {}] {} failed exchanges, circuit open for {}s".format(
+                self.name, self.failures, self.cooldown))
+        self.state = CIRCUIT_OPEN
+        self.opened_at = self.clock.time()
+        self._opening += 1
+        if self.probe is not None:
+            threading.Thread(target=self._probe_after_cooldown, args=(self._opening,), daemon=True).start()
+
+    def _probe_after_cooldown(self, opening: int) -> None:
+        self.clock.sleep(self.cooldown)
+        with self._lock:
+            if self.state != CIRCUIT_OPEN or self._opening != opening:
+                return
+            self.state = CIRCUIT_HALF_OPEN
+        try:
+            answered = self.probe()
+        except Exception as err:
+            self.logger.debug("[PUMP {}] Probe failed: {!r}".format(self.name, err))
+            answered = False
+        if answered:
+            self.record_success()
+        else:
+            self.record_failure()
+
+    def reset(self) -> None:
+        """
+        Closes the circuit and stops probing, e.g. once the pump is known to be back.
+        """
+        with self._lock:
+            self._opening += 1
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
@@ -0,0 +1,348 @@
+"""
+.. module:: scheduler
+   :platform: Unix
+   :synopsis: A module used for scheduling pump operations by priority or deadline on a shared fleet.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import itertools
+import threading
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from ._logger import create_logger
+from .clock import Clock, SYSTEM_CLOCK, clock_of
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller
+
+#: Earliest deadline first, then highest priority
+POLICY_EDF = 'edf'
+#: Highest priority first, then earliest deadline
+POLICY_PRIORITY = 'priority'
+#: Submission order, ignoring priorities and deadlines
+POLICY_FIFO = 'fifo'
+
+POLICIES = (POLICY_EDF, POLICY_PRIORITY, POLICY_FIFO)
+
+
+def urgency_key(policy: str, deadline_at: Optional[float], priority: int, order: int) -> Tuple:
+    """
+    Gets the sort key of a job under a policy, the most urgent job has the smallest key.
+
+    Args:
+        policy: POLICY_EDF, POLICY_PRIORITY or POLICY_FIFO.
+
+        deadline_at: Absolute deadline of the job, None for no deadline.
+
+        priority: Priority of the job, higher runs first.
+
+        order: Submission rank of the job, breaks ties.
+
+    """
+    deadline = deadline_at if deadline_at is not None else float('inf')
+    if policy == POLICY_EDF:
+        return deadline, -priority, order
+    if policy == POLICY_PRIORITY:
+        return -priority, deadline, order
+    return (order,)
+
+
+class ScheduledJob:
+    """
+    This class represents one operation submitted to a PumpScheduler.
+
+    A 'transfer' is run one stroke (aspirate and dispense) at a time, other commands run in one go. Between two
+    strokes the pump goes back to the scheduler, so that a more urgent job can run first.
+
+    Args:
+        pump_names: The pumps that can run the job, the first free one takes it.
+
+        command: The C3000Controller method to call, e.g. 'deliver' or 'transfer'.
+
+        args: Keyword arguments of the command, default set to None.
+
+        priority: Higher priorities run first, default set to 0.
+
+        deadline: Time allowed for the job from its submission (in seconds), default set to None (no deadline).
+
+        clock: The clock of the pumps, timing the job and its deadline, default set to None (SYSTEM_CLOCK).
+
+    """
+    def __init__(self, pump_names: List[str], command: str, args: Dict[str, Any] = None, priority: int = 0,
+                 deadline: float = None, clock: Clock = None):
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.pump_names = pump_names
+        self.command = command
+        self.args = dict(args) if args is not None else {}
+        self.priority = priority
+
+        self.submitted_at = self.clock.time()
+        #: Absolute time (clock.time()) by which the job should be finished, None for no deadline
+        self.deadline_at = self.submitted_at + deadline if deadline is not None else None
+
+        #: Name of the pump running the job, None until started
+        self.pump_name: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        #: Number of times the job was set aside for a more urgent one
+        self.preemptions = 0
+        #: Exception raised while running the job, if any
+        self.error: Optional[Exception] = None
+        self.result: Any = None
+
+        #: Submission rank, breaks ties between equally urgent jobs
+        self.order = 0
+
+        self._volume_left = self.args.get('volume_in_ml', 0.)
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        """
+        Determines if the job has finished (successfully or not).
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits until the job has finished.
+
+        Args:
+            timeout: Maximum time to wait (in seconds), default set to None (no limit).
+
+        Returns:
+            True: The job has finished.
+
+            False: The timeout expired first.
+
+        """
+        return self._done.wait(timeout)
+
+    @property
+    def missed_deadline(self) -> bool:
+        """
+        Determines if the job finished (or is still running) past its deadline.
+        """
+        if self.deadline_at is None:
+            return False
+        end = self.finished_at if self.finished_at is not None else self.clock.time()
+        return end > self.deadline_at
+
+    def run_slice(self, pump: 'C3000Controller') -> bool:
+        """
+        Runs the next stroke of the job on a pump, blocking until the pump is idle.
+
+        Args:
+            pump: The pump running the job.
+
+        Returns:
+            True: The job is finished.
+
+            False: The job has strokes left.
+
+        Raises:
+            ValueError: The pump cannot run the stroke, e.g. it is full or holds less than the volume to deliver.
+
+        """
+        if self.command == 'transfer':
+            stroke_volume = min(self._volume_left, pump.remaining_volume)
+            if stroke_volume <= 0:
+                raise ValueError('Pump {} is full, cannot transfer'.format(pump.name))
+            # pump() and deliver() return False when the volume is not feasible
+            if pump.pump(stroke_volume, self.args.get('from_valve'), speed_in=self.args.get('speed_in'),
+                         wait=True) is False:
+                raise ValueError('pump of {} ml on pump {} is not feasible'.format(stroke_volume, pump.name))
+            if pump.deliver(stroke_volume, self.args.get('to_valve'), speed_out=self.args.get('speed_out'),
+                            wait=True) is False:
+                raise ValueError('deliver of {} ml on pump {} is not feasible'.format(stroke_volume, pump.name))
+            self._volume_left -= stroke_volume
+            return self._volume_left <= 0
+
+        self.result = getattr(pump, self.command)(**self.args)
+        if self.result is False:
+            raise ValueError('{} on pump {} is not feasible'.format(self.command, pump.name))
+        pump.wait_until_idle()
+        return True
+
+    def __repr__(self):
+        return "ScheduledJob({} on {}, priority {})".format(self.command, self.pump_names, self.priority)
+
+
+class PumpScheduler:
+    """
+    This class runs operations on a fleet of pumps, most urgent first.
+
+    Each pump has a worker thread. When a pump is free (or between two strokes of a transfer) it takes the most
+    urgent job it can run, ordered by POLICY_EDF (earliest deadline, then priority), POLICY_PRIORITY (priority,
+    then earliest deadline) or POLICY_FIFO (submission order). A job set aside between two strokes stays on the same
+    pump. Workers wait for jobs on the clock (see Clock.wait()), so that a SimulationClock runs them in simulated time.
+
+    Args:
+        pumps: Dictionary of the pumps, by name.
+
+        policy: One of POLICIES, default set to POLICY_EDF.
+
+        clock: The clock timing the jobs and their deadlines, default set to None (the clock of the pumps).
+
+    Raises:
+        ValueError: Unknown policy.
+
+    """
+    def __init__(self, pumps: Dict[str, 'C3000Controller'], policy: str = POLICY_EDF, clock: Clock = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        if policy not in POLICIES:
+            raise ValueError('Scheduling policy must be one of {}'.format(POLICIES))
+        self.pumps = pumps
+        self.policy = policy
+        self.clock = clock if clock is not None else clock_of(pumps.values())
+
+        self.jobs: List[ScheduledJob] = []
+        self._pending: List[Tuple[int, ScheduledJob]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._workers: List[threading.Thread] = []
+
+    def start(self) -> 'PumpScheduler':
+        """
+        Starts one worker thread per pump.
+
+        Returns:
+            self, so that the scheduler can be created and started in one line.
+
+        """
+        for pump in self.pumps.values():
+            worker = threading.Thread(target=self._work, args=(pump,), name='scheduler-{}'.format(pump.name),
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def submit(self, pump_names: List[str], command: str, args: Dict[str, Any] = None, priority: int = 0,
+               deadline: float = None) -> ScheduledJob:
+        """
+        Adds a job, see ScheduledJob.
+
+        Args:
+            pump_names: The pumps that can run the job, the first free one takes it.
+
+            command: The C3000Controller method to call.
+
+            args: Keyword arguments of the command, default set to None.
+
+            priority: Higher priorities run first, default set to 0.
+
+            deadline: Time allowed for the job from now (in seconds), default set to None.
+
+        Returns:
+            job: The submitted job, use job.wait() to block until it has run.
+
+        Raises:
+            ValueError: Unknown pump, or the scheduler is closed.
+
+        """
+        for pump_name in pump_names:
+            if pump_name not in self.pumps:
+                raise ValueError('Pump {} is not scheduled'.format(pump_name))
+        job = ScheduledJob(pump_names, command, args, priority, deadline, self.clock)
+        with self._condition:
+            if self._closed:
+                raise ValueError('Cannot submit to a closed PumpScheduler')
+            job.order = next(self._counter)
+            self.jobs.append(job)
+            self._pending.append((job.order, job))
+            self.clock.notify_all(self._condition)
+        return job
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Waits until every submitted job has run.
+
+        Args:
+            timeout: Maximum time to wait (in seconds), default set to None (no limit).
+
+        Returns:
+            True: All jobs have run.
+
+            False: The timeout expired first.
+
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: all(job.done() for job in self.jobs), timeout)
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Stops accepting jobs, the workers exit once no job is left.
+
+        Args:
+            wait: Waits for the jobs and the workers to finish, default set to True.
+
+        """
+        with self._condition:
+            self._closed = True
+            self.clock.notify_all(self._condition)
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def missed_deadlines(self) -> List[ScheduledJob]:
+        """
+        Lists the jobs that finished (or are still running) past their deadline.
+        """
+        with self._condition:
+            return [job for job in self.jobs if job.missed_deadline]
+
+    def _urgency(self, entry: Tuple[int, ScheduledJob]) -> Tuple:
+        order, job = entry
+        return urgency_key(self.policy, job.deadline_at, job.priority, order)
+
+    def _next_job(self, pump_name: str) -> Optional[ScheduledJob]:
+        with self._condition:
+            while True:
+                candidates = [entry for entry in self._pending if pump_name in entry[1].pump_names]
+                if candidates:
+                    entry = min(candidates, key=self._urgency)
+                    self._pending.remove(entry)
+                    return entry[1]
+                if self._closed and not self._pending:
+                    return None
+                self.clock.wait(self._condition)
+
+    def _work(self, pump: 'C3000Controller') -> None:
+        unfinished: Optional[ScheduledJob] = None
+        while True:
+            job = self._next_job(pump.name)
+            if job is None:
+                return
+            if unfinished is not None and job is not unfinished:
+                unfinished.preemptions += 1
+                self.logger.debug("[PUMP {}] {} set aside for {}".format(pump.name, unfinished, job))
+
+            if job.started_at is None:
+                job.started_at = self.clock.time()
+                job.pump_name = pump.name
+            try:
+                finished = job.run_slice(pump)
+            except Exception as err:
+                self.logger.warning("[PUMP {}] Job {} failed: {!r}".format(pump.name, job, err))
+                job.error = err
+                finished = True
+
+            with self._condition:
+                if finished:
+                    unfinished = None
+                    job.finished_at = self.clock.time()
+                    job._done.set()
+                    if job.missed_deadline:
+                        self.logger.warning("[PUMP {}] Job {} missed its deadline by {:.2f}s".format(
+                            pump.name, job, job.finished_at - job.deadline_at))
+                else:
+                    # Back to the scheduler, pinned to this pump, a more urgent job may run before the next stroke
+                    unfinished = job
+                    job.pump_names = [pump.name]
+                    self._pending.append((job.order, job))
+                self.clock.notify_all(self._condition)
@@ -0,0 +1,514 @@
+"""
+.. module:: server
+   :platform: Unix
+   :synopsis: A module used for sharing warm controllers between client processes over a Unix socket.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from ._logger import create_logger
+
+if TYPE_CHECKING:
+    from .controller import MultiPumpController
+
+#: Socket the server listens on by default
+DEFAULT_SOCKET_PATH = '/tmp/pycont.sock'
+
+#: Target of the calls made to the MultiPumpController
+CONTROLLER_TARGET = 'controller'
+
+#: Pump operations that move or configure a pump, callable by the client holding its lease
+PUMP_COMMANDS = ('smart_initialize', 'initialize', 'pump', 'deliver', 'transfer', 'go_to_volume', 'go_to_max_volume',
+                 'set_valve_position', 'set_top_velocity', 'set_default_top_velocity', 'ensure_default_top_velocity',
+                 'set_liquid_class', 'set_motion_profile', 'sync_plunger_position', 'wait_until_idle', 'terminate')
+#: Pump operations that only read, callable by any client
+PUMP_QUERIES = ('ping', 'is_idle', 'is_busy', 'is_initialized', 'get_valve_position', 'get_raw_valve_position',
+                'get_volume', 'current_volume', 'remaining_volume', 'current_steps', 'get_plunger_position',
+                'get_top_velocity', 'get_default_top_velocity', 'is_volume_pumpable', 'is_volume_deliverable',
+                'is_volume_valid', 'estimate_move_duration')
+#: MultiPumpController operations taking the list of pumps they drive first
+CONTROLLER_COMMANDS = ('pump', 'deliver', 'transfer', 'parallel_transfer', 'apply_command_to_pumps')
+#: MultiPumpController operations that only read, callable by any client
+CONTROLLER_QUERIES = ('are_pumps_idle', 'are_pumps_busy', 'are_pumps_initialized', 'get_pumps_in_group')
+
+
+class LeaseError(Exception):
+    """
+    Exception raised when a client drives a pump it does not hold the lease of, or leases a pump held by another.
+    """
+    pass
+
+
+class RemoteCallError(Exception):
+    """
+    Exception raised by the client when a call failed on the server.
+
+    Args:
+        error_type: Name of the exception raised on the server.
+
+        message: Its message.
+
+        index: Position of the failed call in its batch.
+
+    """
+    def __init__(self, error_type: str, message: str, index: int = 0):
+        super().__init__('{}: {}'.format(error_type, message))
+        self.error_type = error_type
+        self.message = message
+        self.index = index
+
+
+class PumpLeases:
+    """
+    This class keeps which client may drive which pump.
+
+    A lease is held until released, until its holder disconnects, or until its time to live runs out without being
+    renewed by leasing again.
+
+    Args:
+        pump_names: The pumps that can be leased.
+
+    """
+    def __init__(self, pump_names: Iterable[str]):
+        self.pump_names = set(pump_names)
+        self._lock = threading.Lock()
+        # Holder and expiry (monotonic time, None for no expiry) of each leased pump
+        self._leases: Dict[str, Tuple[int, Optional[float]]] = {}
+
+    def _expire(self, now: float) -> None:
+        for pump_name, (_, expires_at) in list(self._leases.items()):
+            if expires_at is not None and expires_at <= now:
+                del self._leases[pump_name]
+
+    def acquire(self, client_id: int, pump_names: Sequence[str], ttl: float = None) -> None:
+        """
+        Leases pumps to a client, all or none.
+
+        Args:
+            client_id: The client.
+
+            pump_names: The pumps to lease, pumps already held by the client are renewed.
+
+            ttl: Time after which the lease runs out (in seconds), default set to None (until released).
+
+        Raises:
+            LeaseError: A pump is unknown or held by another client.
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            for pump_name in pump_names:
+                if pump_name not in self.pump_names:
+                    raise LeaseError('Unknown pump {}'.format(pump_name))
+                if pump_name in self._leases and self._leases[pump_name][0] != client_id:
+                    raise LeaseError('Pump {} is leased to client {}'.format(pump_name, self._leases[pump_name][0]))
+            for pump_name in pump_names:
+                self._leases[pump_name] = (client_id, now + ttl if ttl is not None else None)
+
+    def release(self, client_id: int, pump_names: Sequence[str] = None) -> None:
+        """
+        Releases the leases of a client, all of them if pump_names is None.
+        """
+        with self._lock:
+            for pump_name, (holder, _) in list(self._leases.items()):
+                if holder == client_id and (pump_names is None or pump_name in pump_names):
+                    del self._leases[pump_name]
+
+    def check(self, client_id: int, pump_names: Iterable[str]) -> None:
+        """
+        Checks that a client holds the lease of pumps.
+
+        Raises:
+            LeaseError: A pump is not leased to the client.
+
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            for pump_name in pump_names:
+                if self._leases.get(pump_name, (None, None))[0] != client_id:
+                    raise LeaseError('Pump {} is not leased to client {}'.format(pump_name, client_id))
+
+    def holders(self) -> Dict[str, int]:
+        """
+        Gets the holder of each leased pump.
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            return {pump_name: holder for pump_name, (holder, _) in self._leases.items()}
+
+
+class PumpServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    This class owns a MultiPumpController and runs the calls of local clients on it.
+
+    Clients send one JSON request per line and get one JSON reply per line. A request runs a batch of calls in
+    order, stopping at the first that raises:
+
+        {"id": 1, "op": "call", "calls": [{"target": "water", "method": "pump", "args": [2, "I"], "kwargs": {}}]}
+        {"id": 1, "ok": true, "results": [true]}
+
+    The target is a pump name or CONTROLLER_TARGET. Moving or configuring a pump needs its lease ("op": "lease",
+    "pumps": [...], "ttl": seconds, then "op": "release"), reading does not. Leases are released when their client
+    disconnects. "op": "status" lists the pumps, groups and leases.
+
+    Args:
+        controller: The controller owning the hubs.
+
+        socket_path: The Unix socket to listen on, default set to DEFAULT_SOCKET_PATH.
+
+    Raises:
+        OSError: Another server listens on the socket.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, controller: 'MultiPumpController', socket_path: str = DEFAULT_SOCKET_PATH):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.controller = controller
+        self.socket_path = socket_path
+        self.leases = PumpLeases(controller.pumps)
+        self._client_ids = itertools.count(1)
+
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                os.unlink(socket_path)  # Left over by a server that did not shut down cleanly
+            else:
+                raise OSError('A pump server already listens on {}'.format(socket_path))
+            finally:
+                probe.close()
+        super().__init__(socket_path, _ClientHandler)
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def new_client_id(self) -> int:
+        return next(self._client_ids)
+
+    def handle_request_message(self, client_id: int, request: Dict) -> Dict:
+        """
+        Runs one request of a client.
+
+        Args:
+            client_id: The client.
+
+            request: The decoded request.
+
+        Returns:
+            reply: The reply to send back.
+
+        """
+        reply: Dict[str, Any] = {'id': request.get('id')}
+        op = request.get('op', 'call')
+        try:
+            if op == 'call':
+                reply['results'] = []
+                for index, call in enumerate(request.get('calls', [])):
+                    try:
+                        reply['results'].append(self.run_call(client_id, call))
+                    except Exception as err:
+                        err.index = index
+                        raise
+            elif op == 'lease':
+                self.leases.acquire(client_id, request['pumps'], request.get('ttl'))
+            elif op == 'release':
+                self.leases.release(client_id, request.get('pumps'))
+            elif op == 'status':
+                reply['client'] = client_id
+                reply['pumps'] = sorted(self.controller.pumps)
+                reply['groups'] = self.controller.groups
+                reply['leases'] = self.leases.holders()
+            else:
+                raise ValueError('Unknown op {}'.format(op))
+        except Exception as err:
+            reply['ok'] = False
+            reply['error'] = {'type': err.__class__.__name__, 'message': str(err), 'index': getattr(err, 'index', 0)}
+            return reply
+        reply['ok'] = True
+        return reply
+
+    def run_call(self, client_id: int, call: Dict) -> Any:
+        """
+        Runs one call of a batch, after checking the leases it needs.
+
+        Raises:
+            ValueError: The target or method is unknown or not exposed.
+
+            LeaseError: The call drives a pump not leased to the client.
+
+        """
+        target = call.get('target', CONTROLLER_TARGET)
+        method = call['method']
+        args = call.get('args', [])
+        kwargs = call.get('kwargs', {})
+
+        if method.startswith('_'):
+            raise ValueError('Method {} is not exposed'.format(method))
+
+        if target == CONTROLLER_TARGET:
+            obj = self.controller
+            if method in CONTROLLER_COMMANDS:
+                driven = args[0] if args else kwargs.get('pump_names', kwargs.get('pumps_and_volumes_dict', []))
+                self.leases.check(client_id, list(driven))
+            elif method not in CONTROLLER_QUERIES:
+                raise ValueError('Controller method {} is not exposed'.format(method))
+            if method == 'apply_command_to_pumps':
+                # The pump method may be given by position or by keyword, it is checked either way
+                command = args[1] if len(args) > 1 else kwargs.get('command')
+                if not isinstance(command, str) or command.startswith('_') or \
+                        command not in PUMP_COMMANDS + PUMP_QUERIES:
+                    raise ValueError('Pump method {} is not exposed'.format(command))
+        elif target in self.controller.pumps:
+            obj = self.controller.pumps[target]
+            if method in PUMP_COMMANDS:
+                self.leases.check(client_id, [target])
+            elif method not in PUMP_QUERIES:
+                raise ValueError('Pump method {} is not exposed'.format(method))
+        else:
+            raise ValueError('Unknown target {}'.format(target))
+
+        self.logger.debug("Client {} calls {}.{}".format(client_id, target, method))
+        attribute = getattr(obj, method)
+        return attribute(*args, **kwargs) if callable(attribute) else attribute
+
+
+class _ClientHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one client connection, one request per line.
+    """
+    def handle(self):
+        client_id = self.server.new_client_id()
+        self.server.logger.info("Client {} connected".format(client_id))
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                except ValueError as err:
+                    reply = {'id': None, 'ok': False, 'error': {'type': 'ValueError', 'message': str(err), 'index': 0}}
+                else:
+                    reply = self.server.handle_request_message(client_id, request)
+                self.wfile.write(json.dumps(reply, default=str).encode() + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.server.leases.release(client_id)
+            self.server.logger.info("Client {} disconnected".format(client_id))
+
+
+class PumpClient:
+    """
+    This class talks to a PumpServer, for scripts sharing the pumps of a server instead of opening the hubs.
+
+    Pumps are driven through client.pumps[name] and the controller through the client itself, with the arguments of
+    C3000Controller and MultiPumpController, e.g. client.pumps['water'].pump(2, 'I') or
+    client.pump(['water', 'acetone'], 1, 'I'). See batch() to send several calls at once.
+
+    Args:
+        socket_path: The Unix socket of the server, default set to DEFAULT_SOCKET_PATH.
+
+    """
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile('rwb')
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+
+        status = self.request({'op': 'status'})
+        self.client_id = status['client']
+        self.groups = status['groups']
+        self.pumps = {pump_name: RemotePump(self, pump_name) for pump_name in status['pumps']}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(CONTROLLER_TARGET, name, *args, **kwargs)
+
+    def close(self) -> None:
+        """
+        Disconnects, releasing the leases of the client.
+        """
+        self._file.close()
+        self._socket.close()
+
+    def request(self, request: Dict) -> Dict:
+        """
+        Sends a request and waits for its reply.
+
+        Raises:
+            RemoteCallError: The request failed on the server.
+
+        """
+        with self._lock:
+            request = dict(request, id=next(self._request_ids))
+            self._file.write(json.dumps(request).encode() + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError('The pump server closed the connection')
+        reply = json.loads(line)
+        if not reply['ok']:
+            error = reply['error']
+            raise RemoteCallError(error['type'], error['message'], error['index'])
+        return reply
+
+    def call(self, target: str, method: str, *args, **kwargs) -> Any:
+        """
+        Calls a method of a pump, or of the controller with target CONTROLLER_TARGET, and returns its result.
+        """
+        return self.request({'op': 'call', 'calls': [_call(target, method, args, kwargs)]})['results'][0]
+
+    def batch(self) -> 'RequestBatch':
+        """
+        Starts a batch of calls sent in one request, run in order by the server.
+        """
+        return RequestBatch(self)
+
+    def lease(self, pump_names: Sequence[str], ttl: float = None) -> None:
+        """
+        Leases pumps, all or none, so that only this client drives them. Leasing again renews the lease.
+
+        Args:
+            pump_names: The pumps to lease.
+
+            ttl: Time after which the lease runs out unless renewed (in seconds), default set to None (until
+                released or disconnected).
+
+        Raises:
+            RemoteCallError: A pump is held by another client (error_type 'LeaseError').
+
+        """
+        self.request({'op': 'lease', 'pumps': list(pump_names), 'ttl': ttl})
+
+    def release(self, pump_names: Sequence[str] = None) -> None:
+        """
+        Releases leased pumps, all of them by default.
+        """
+        self.request({'op': 'release', 'pumps': list(pump_names) if pump_names is not None else None})
+
+    def status(self) -> Dict:
+        """
+        Gets the pumps, groups and leases of the server.
+        """
+        return self.request({'op': 'status'})
+
+
+class RemotePump:
+    """
+    This class stands for a pump of a PumpServer, its methods are called on the server.
+    """
+    def __init__(self, client: PumpClient, name: str):
+        self.client = client
+        self.name = name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.client.call(self.name, name, *args, **kwargs)
+
+    def __repr__(self):
+        return "RemotePump({})".format(self.name)
+
+
+class RequestBatch:
+    """
+    This class collects calls and sends them in one request, saving a round trip per call.
+
+    Used as a context manager, the batch is sent on exit and the results are in results.
+    """
+    def __init__(self, client: PumpClient):
+        self.client = client
+        self.calls: List[Dict] = []
+        self.results: Optional[List[Any]] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def call(self, target: str, method: str, *args, **kwargs) -> 'RequestBatch':
+        """
+        Adds a call to the batch, see PumpClient.call().
+        """
+        self.calls.append(_call(target, method, args, kwargs))
+        return self
+
+    def send(self) -> List[Any]:
+        """
+        Sends the batch.
+
+        Returns:
+            results: The result of each call, in order.
+
+        Raises:
+            RemoteCallError: A call failed, its index tells which, the calls after it did not run.
+
+        """
+        self.results = self.client.request({'op': 'call', 'calls': self.calls})['results']
+        return self.results
+
+
+def _call(target: str, method: str, args: Sequence, kwargs: Dict) -> Dict:
+    return {'target': target, 'method': method, 'args': list(args), 'kwargs': kwargs}
+
+
+def main(argv: Sequence[str] = None) -> None:
+    """
+    Runs the server until interrupted: python -m pycont.server setup_config.json
+    """
+    from .controller import MultiPumpController
+
+    parser = argparse.ArgumentParser(description='Owns the hubs of a setup and shares its pumps with local clients.')
+    parser.add_argument('setup_configfile', help='The setup configuration file')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH, help='The Unix socket to listen on')
+    parser.add_argument('--initialize', action='store_true', help='Initialises the pumps before serving')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    logger = create_logger('server')
+    controller = MultiPumpController.from_configfile(args.setup_configfile)
+    if args.initialize:
+        controller.smart_initialize()
+    server = PumpServer(controller, args.socket)
+    logger.info("Serving {} pumps on {}".format(len(controller.pumps), args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,572 @@
+"""
+.. module:: simulation
+   :platform: Unix
+   :synopsis: A module used for simulating a fleet of pumps on their hubs, in virtual time, to compare schedulers.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import math
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from ._logger import create_logger
+
+from .bus import DEFAULT_TELEMETRY_BUDGET
+from .clock import Clock, ClockStopped, SimulationClock
+from .controller import C3000Controller, MultiPumpController, PumpIO, PumpIOTimeOutError
+from .controller import DEFAULT_IO_BAUDRATE, DEFAULT_IO_TIMEOUT
+from .dtprotocol import DTEnd, DTInstructionPacket, DTStart
+from .scheduler import POLICIES, POLICY_EDF, PumpScheduler, ScheduledJob
+from .virtual import VirtualPump, VALVE_COMMANDS
+
+#: Bits on the wire per byte (start bit, 8 data bits, stop bit)
+BITS_PER_BYTE = 10
+#: Bytes of a reply around its data: start, address, status, ETX, CR and LF
+REPLY_OVERHEAD_BYTES = 6
+#: Default time a pump takes to start replying (in seconds)
+DEFAULT_TURNAROUND = 0.002
+#: Percentiles reported by SimulationReport.summary()
+REPORTED_PERCENTILES = (50, 95, 99)
+
+
+class SimulatedJob:
+    """
+    This class represents an operation submitted to a FleetSimulator, handed to its PumpScheduler when it arrives.
+
+    Args:
+        pump_names: The pumps that can run the job, the first free one takes it.
+
+        command: 'transfer', 'pump' or 'deliver'.
+
+        volume_in_ml: Volume of the job (in mL).
+
+        from_valve: The valve position to aspirate from, default set to None.
+
+        to_valve: The valve position to dispense to, default set to None.
+
+        speed: Top velocity of the moves (steps/second), default set to None (the default top velocity of the pump).
+
+        priority: Higher priorities run first, default set to 0.
+
+        deadline: Time allowed for the job from its submission (in seconds), default set to None (no deadline).
+
+        submitted_at: Simulated time of the submission (in seconds), default set to 0.
+
+    """
+    def __init__(self, pump_names: List[str], command: str, volume_in_ml: float, from_valve: str = None,
+                 to_valve: str = None, speed: int = None, priority: int = 0, deadline: float = None,
+                 submitted_at: float = 0.):
+        if command not in ('transfer', 'pump', 'deliver'):
+            raise ValueError('Command {} cannot be simulated'.format(command))
+        self.pump_names = pump_names
+        self.command = command
+        self.volume_in_ml = volume_in_ml
+        self.from_valve = from_valve
+        self.to_valve = to_valve
+        self.speed = speed
+        self.priority = priority
+        self.deadline = deadline
+        self.submitted_at = submitted_at
+        self.deadline_at = submitted_at + deadline if deadline is not None else None
+
+        #: The job run by the scheduler, None until the job arrives
+        self.scheduled: Optional[ScheduledJob] = None
+
+    @property
+    def args(self) -> Dict[str, Any]:
+        """
+        Keyword arguments of the C3000Controller method running the job.
+        """
+        if self.command == 'transfer':
+            return {'volume_in_ml': self.volume_in_ml, 'from_valve': self.from_valve, 'to_valve': self.to_valve,
+                    'speed_in': self.speed, 'speed_out': self.speed}
+        if self.command == 'pump':
+            return {'volume_in_ml': self.volume_in_ml, 'from_valve': self.from_valve, 'speed_in': self.speed,
+                    'wait': True}
+        return {'volume_in_ml': self.volume_in_ml, 'to_valve': self.to_valve, 'speed_out': self.speed, 'wait': True}
+
+    @property
+    def pump_name(self) -> Optional[str]:
+        return self.scheduled.pump_name if self.scheduled is not None else None
+
+    @property
+    def started_at(self) -> Optional[float]:
+        return self.scheduled.started_at if self.scheduled is not None else None
+
+    @property
+    def finished_at(self) -> Optional[float]:
+        return self.scheduled.finished_at if self.scheduled is not None else None
+
+    @property
+    def preemptions(self) -> int:
+        return self.scheduled.preemptions if self.scheduled is not None else 0
+
+    @property
+    def error(self) -> Optional[Exception]:
+        return self.scheduled.error if self.scheduled is not None else None
+
+    @property
+    def missed_deadline(self) -> bool:
+        if self.deadline_at is None:
+            return False
+        return self.finished_at is None or self.finished_at > self.deadline_at
+
+    @property
+    def latency(self) -> Optional[float]:
+        """
+        Time from submission to completion (in seconds), None if not finished.
+        """
+        return self.finished_at - self.submitted_at if self.finished_at is not None else None
+
+    def __repr__(self):
+        return "SimulatedJob({} {}mL on {}, priority {})".format(self.command, self.volume_in_ml, self.pump_names,
+                                                                 self.priority)
+
+
+class SimulatedHub:
+    """
+    This class represents the bus of a hub: each exchange takes the time of its bytes on the wire at the baudrate of
+    the hub, plus the turnaround of the pump. The pumps on it are VirtualPumps, by address.
+
+    Args:
+        port: The port of the hub, as in its config.
+
+        baudrate: Baudrate of the hub.
+
+        clock: The clock of the simulation.
+
+        turnaround: Time a pump takes to start replying (in seconds).
+
+        turnaround_jitter: Random extra turnaround, up to this value (in seconds).
+
+        rng: Random draws of the jitter.
+
+    """
+    def __init__(self, port: str, baudrate: int, clock: SimulationClock, turnaround: float, turnaround_jitter: float,
+                 rng: random.Random):
+        self.port = port
+        self.baudrate = baudrate
+        self.clock = clock
+        self.turnaround = turnaround
+        self.turnaround_jitter = turnaround_jitter
+        self.rng = rng
+
+        self.devices: Dict[str, VirtualPump] = {}
+        #: Time the bus was in use and number of exchanges
+        self.busy_time = 0.
+        self.exchanges = 0
+
+    def wire_time(self, n_bytes: int) -> float:
+        return n_bytes * BITS_PER_BYTE / self.baudrate
+
+    def exchange(self, packet: DTInstructionPacket, timeout: float) -> bytes:
+        """
+        Sends a packet to the pump at its address and gets its reply, in simulated time.
+
+        Args:
+            packet: The packet sent.
+
+            timeout: Time waited for a reply when no pump has the address (in seconds).
+
+        Returns:
+            The reply, as read on the serial port, empty when no pump answers.
+
+        """
+        started_at = self.clock.time()
+        self.clock.sleep(self.wire_time(len(packet.to_string())))
+        device = self.devices.get(packet.address.decode())
+        if device is None:
+            self.clock.sleep(timeout)
+            reply = b''
+        else:
+            (address, status, data) = device.execute(packet)
+            turnaround = self.turnaround + (self.rng.uniform(0, self.turnaround_jitter)
+                                            if self.turnaround_jitter else 0)
+            self.clock.sleep(turnaround + self.wire_time(REPLY_OVERHEAD_BYTES + len(data)))
+            reply = '{}{}{}{}{}\r\n'.format(DTStart, address, status, data, DTEnd).encode()
+        self.busy_time += self.clock.time() - started_at
+        self.exchanges += 1
+        return reply
+
+
+class SimulatedPumpIO(PumpIO):
+    """
+    This class is a PumpIO whose hub is a SimulatedHub instead of a serial port.
+
+    Args:
+        hub: The simulated hub.
+
+        See PumpIO for the other arguments.
+
+    """
+    def __init__(self, hub: SimulatedHub, timeout: float = DEFAULT_IO_TIMEOUT,
+                 telemetry_budget: float = DEFAULT_TELEMETRY_BUDGET, clock: Clock = None):
+        self.hub = hub
+        self._reply = b''
+        super().__init__(hub.port, hub.baudrate, timeout, telemetry_budget, clock)
+
+    def open(self, port, baudrate=DEFAULT_IO_BAUDRATE, timeout=DEFAULT_IO_TIMEOUT):
+        self._serial = self.hub
+
+    def close(self):
+        self._serial = None
+
+    def flush_input(self):
+        self._reply = b''
+
+    def write(self, packet):
+        self._reply = self.hub.exchange(packet, self.timeout)
+
+    def readline(self):
+        reply, self._reply = self._reply, b''
+        if not reply:
+            raise PumpIOTimeOutError
+        return reply
+
+
+class SimulatedMultiPumpController(MultiPumpController):
+    """
+    This class is a MultiPumpController whose hubs are SimulatedHubs, the pumps are C3000Controllers talking to
+    VirtualPumps in simulated time. The pumps start initialised with their config applied.
+
+    Args:
+        setup_config: The configuration of the setup.
+
+        clock: The clock of the simulation.
+
+        turnaround: Time a pump takes to start replying (in seconds), default set to DEFAULT_TURNAROUND.
+
+        turnaround_jitter: Random extra turnaround, up to this value (in seconds), default set to 0.
+
+        rng: Random draws of the jitter, default set to None (unseeded).
+
+    """
+    persists_state = False
+
+    def __init__(self, setup_config: Dict, clock: SimulationClock, turnaround: float = DEFAULT_TURNAROUND,
+                 turnaround_jitter: float = 0., rng: random.Random = None):
+        self.turnaround = turnaround
+        self.turnaround_jitter = turnaround_jitter
+        self.rng = rng if rng is not None else random.Random()
+        self.simulated_hubs: List[SimulatedHub] = []
+        super().__init__(setup_config, clock)
+
+    def _create_pump_io(self, io_config: Dict) -> PumpIO:
+        hub = SimulatedHub(io_config['port'], io_config.get('baudrate', DEFAULT_IO_BAUDRATE), self.clock,
+                           self.turnaround, self.turnaround_jitter, self.rng)
+        self.simulated_hubs.append(hub)
+        return SimulatedPumpIO(hub, io_config.get('timeout', DEFAULT_IO_TIMEOUT),
+                               io_config.get('telemetry_budget', DEFAULT_TELEMETRY_BUDGET), self.clock)
+
+    def _create_pump(self, pump_io: PumpIO, pump_name: str, full_pump_config: Dict) -> C3000Controller:
+        pump = super()._create_pump(pump_io, pump_name, full_pump_config)
+        device = VirtualPump(pump.address, self.clock)
+        # Starts initialised with its config applied, as after smart_initialize()
+        device.set_initialized_state(pump.micro_step_mode, pump.default_top_velocity,
+                                     VALVE_COMMANDS.get(pump.initialize_valve_position,
+                                                        pump.initialize_valve_position))
+        pump_io.hub.devices[pump.address] = device
+        return pump
+
+
+class _SimulatedScheduler(PumpScheduler):
+    """
+    A PumpScheduler whose workers take part in a SimulationClock.
+    """
+    def start(self) -> 'PumpScheduler':
+        self._turns = {pump_name: self.clock.add_participant() for pump_name in self.pumps}
+        return super().start()
+
+    def _work(self, pump: C3000Controller) -> None:
+        try:
+            self.clock.enter(self._turns[pump.name])
+            super()._work(pump)
+        except ClockStopped:  # The simulation ended while the pump was busy or waiting for a job
+            pass
+        finally:
+            self.clock.leave()
+
+    def wait_for_jobs(self, jobs: List[SimulatedJob], until: float = None) -> None:
+        """
+        Waits, in simulated time, until the jobs have run or until a given time.
+        """
+        with self._condition:
+            while not all(job.scheduled is not None and job.scheduled.done() for job in jobs):
+                timeout = until - self.clock.time() if until is not None else None
+                if timeout is not None and timeout <= 0:
+                    return
+                self.clock.wait(self._condition, timeout)
+
+
+class SimulationReport:
+    """
+    This class holds the outcome of a simulation.
+    """
+    def __init__(self, policy: str, jobs: List[SimulatedJob], hubs: List[SimulatedHub], duration: float,
+                 wall_time: float):
+        self.policy = policy
+        self.jobs = jobs
+        self.duration = duration
+        self.wall_time = wall_time
+
+        #: Fraction of the simulated time each bus was in use, by port
+        self.bus_utilisation = {hub.port: hub.busy_time / duration if duration > 0 else 0. for hub in hubs}
+        #: Number of exchanges on each bus, by port
+        self.exchanges = {hub.port: hub.exchanges for hub in hubs}
+
+    @property
+    def finished(self) -> List[SimulatedJob]:
+        return [job for job in self.jobs if job.finished_at is not None and job.error is None]
+
+    @property
+    def failed(self) -> List[SimulatedJob]:
+        return [job for job in self.jobs if job.error is not None]
+
+    @property
+    def missed_deadlines(self) -> List[SimulatedJob]:
+        return [job for job in self.jobs if job.missed_deadline]
+
+    @property
+    def throughput(self) -> float:
+        """
+        Jobs finished per hour of simulated time.
+        """
+        return len(self.finished) * 3600. / self.duration if self.duration > 0 else 0.
+
+    def latency_percentile(self, percent: float) -> Optional[float]:
+        """
+        Gets a percentile of the time from submission to completion of the finished jobs (in seconds).
+
+        Args:
+            percent: The percentile, from 0 to 100.
+
+        """
+        latencies = sorted(job.latency for job in self.finished)
+        if not latencies:
+            return None
+        return latencies[max(int(math.ceil(percent / 100. * len(latencies))) - 1, 0)]
+
+    def summary(self) -> str:
+        """
+        Formats the report on one line.
+        """
+        if self.finished:
+            latencies = ', '.join('p{} {:.1f}s'.format(percent, self.latency_percentile(percent))
+                                  for percent in REPORTED_PERCENTILES)
+        else:
+            latencies = 'no job finished'
+        busiest = max(self.bus_utilisation.values(), default=0.)
+        return "{}: {} jobs in {:.0f}s ({:.1f}s wall), {:.1f} jobs/h, {}, {} missed deadlines, {} failed, " \
+               "busiest bus {:.0%}".format(self.policy, len(self.finished), self.duration, self.wall_time,
+                                          self.throughput, latencies, len(self.missed_deadlines), len(self.failed),
+                                          busiest)
+
+    def __repr__(self):
+        return "SimulationReport({})".format(self.summary())
+
+
+class FleetSimulator:
+    """
+    This class simulates a fleet of pumps running jobs, in virtual time, as a discrete-event simulation.
+
+    The fleet is built from a setup config by a SimulatedMultiPumpController: its pumps are C3000Controllers talking
+    to VirtualPumps over SimulatedHubs, each hub carrying one exchange at a time at its baudrate, arbitrated by
+    priority class like a real bus (see bus.BusArbiter). The jobs are run by a PumpScheduler under the scheduling
+    policy, and the controllers poll their pumps until idle, so that the scheduler, the pump operations and the bus
+    load are those of a real setup. Everything runs on a SimulationClock, pumps start initialised with their config
+    applied.
+
+    Hours of activity are simulated in seconds, and runs with the same seed and jobs give the same result.
+
+    Args:
+        setup_config: The configuration of the setup, see MultiPumpController.
+
+        policy: One of scheduler.POLICIES, default set to POLICY_EDF.
+
+        seed: Seed of the random draws (turnaround jitter and random jobs), default set to None.
+
+        turnaround: Time a pump takes to start replying (in seconds), default set to DEFAULT_TURNAROUND.
+
+        turnaround_jitter: Random extra turnaround, up to this value (in seconds), default set to 0.
+
+    Raises:
+        ValueError: Unknown policy.
+
+    """
+    def __init__(self, setup_config: Dict, policy: str = POLICY_EDF, seed: int = None,
+                 turnaround: float = DEFAULT_TURNAROUND, turnaround_jitter: float = 0.):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.policy = policy
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.clock = SimulationClock()
+
+        self.controller = SimulatedMultiPumpController(setup_config, self.clock, turnaround, turnaround_jitter,
+                                                       self.rng)
+        self.pumps = self.controller.pumps
+        self.hubs = self.controller.simulated_hubs
+        self.scheduler = _SimulatedScheduler(dict(self.pumps.items()), policy, self.clock)
+
+        self.jobs: List[SimulatedJob] = []
+        self._ran = False
+
+    def now(self) -> float:
+        """
+        Gets the simulated time (in seconds).
+        """
+        return self.clock.time()
+
+    def resolve(self, pumps: Union[str, Sequence[str]]) -> List[str]:
+        """
+        Gets the pump names of a group name, a pump name or a list of pump names.
+        """
+        if isinstance(pumps, str):
+            return list(self.controller.groups[pumps]) if pumps in self.controller.groups else [pumps]
+        return list(pumps)
+
+    def submit(self, pumps: Union[str, Sequence[str]], command: str, volume_in_ml: float, from_valve: str = None,
+               to_valve: str = None, speed: int = None, priority: int = 0, deadline: float = None,
+               at: float = None) -> SimulatedJob:
+        """
+        Adds a job, see SimulatedJob.
+
+        Args:
+            pumps: The pumps that can run the job, a group name, a pump name or a list of pump names.
+
+            at: Simulated time of the submission (in seconds), default set to None (now).
+
+            See SimulatedJob for the other arguments.
+
+        Returns:
+            job: The submitted job, filled in while the simulation runs.
+
+        Raises:
+            ValueError: Unknown pump.
+
+        """
+        pump_names = self.resolve(pumps)
+        for pump_name in pump_names:
+            if pump_name not in self.pumps:
+                raise ValueError('Pump {} is not simulated'.format(pump_name))
+        at = self.now() if at is None else max(at, self.now())
+        job = SimulatedJob(pump_names, command, volume_in_ml, from_valve, to_valve, speed, priority, deadline, at)
+        self.jobs.append(job)
+        return job
+
+    def submit_random(self, pumps: Union[str, Sequence[str]], jobs_per_hour: float, duration: float,
+                      from_valve: str, to_valve: str, volume_range: Tuple[float, float] = (0.5, 5.),
+                      priorities: Sequence[int] = (0,), deadline_range: Tuple[float, float] = None,
+                      command: str = 'transfer') -> List[SimulatedJob]:
+        """
+        Adds jobs arriving at random (Poisson arrivals), drawn from the seed of the simulator.
+
+        Args:
+            pumps: The pumps that can run each job, see submit().
+
+            jobs_per_hour: Mean arrival rate.
+
+            duration: Time over which jobs arrive (in seconds), from now.
+
+            from_valve: The valve position to aspirate from.
+
+            to_valve: The valve position to dispense to.
+
+            volume_range: Range of the volumes, drawn uniformly (in mL), default set to (0.5, 5).
+
+            priorities: Priorities drawn from, default set to (0,).
+
+            deadline_range: Range of the deadlines, drawn uniformly (in seconds), default set to None (no deadline).
+
+            command: 'transfer', 'pump' or 'deliver', default set to 'transfer'.
+
+        Returns:
+            jobs: The submitted jobs.
+
+        """
+        jobs = []
+        at = self.now()
+        end = at + duration
+        while True:
+            at += self.rng.expovariate(jobs_per_hour / 3600.)
+            if at >= end:
+                return jobs
+            deadline = self.rng.uniform(*deadline_range) if deadline_range is not None else None
+            jobs.append(self.submit(pumps, command, round(self.rng.uniform(*volume_range), 3), from_valve, to_valve,
+                                    priority=self.rng.choice(priorities), deadline=deadline, at=at))
+
+    def run(self, until: float = None) -> SimulationReport:
+        """
+        Runs the simulation until no job is left, or until a given time. A simulator runs once.
+
+        Args:
+            until: Simulated time at which to stop (in seconds), default set to None (when all jobs have run).
+
+        Returns:
+            SimulationReport: The outcome of the simulation.
+
+        Raises:
+            ValueError: The simulation has already run.
+
+        """
+        if self._ran:
+            raise ValueError('The simulation has already run')
+        self._ran = True
+
+        wall_start = time.time()
+        # The calling thread submits the jobs as they arrive, taking part in the clock with the workers
+        self.clock.enter(self.clock.add_participant())
+        try:
+            self.scheduler.start()
+            for job in sorted(self.jobs, key=lambda job: job.submitted_at):
+                if until is not None and job.submitted_at > until:
+                    break
+                self.clock.sleep(job.submitted_at - self.now())
+                job.scheduled = self.scheduler.submit(job.pump_names, job.command, job.args, job.priority,
+                                                      job.deadline)
+            self.scheduler.wait_for_jobs(self.jobs, until)
+        finally:
+            # Jobs still running end where they are
+            self.clock.stop()
+            self.clock.leave()
+            self.scheduler.close()
+        report = SimulationReport(self.policy, self.jobs, self.hubs, self.now(), time.time() - wall_start)
+        self.logger.info(report.summary())
+        return report
+
+
+def compare_policies(setup_config: Dict, add_jobs: Callable[[FleetSimulator], Any],
+                     policies: Sequence[str] = POLICIES, seed: int = 0, until: float = None,
+                     **simulator_kwargs) -> Dict[str, SimulationReport]:
+    """
+    Simulates the same jobs under several scheduling policies.
+
+    Args:
+        setup_config: The configuration of the setup, see MultiPumpController.
+
+        add_jobs: Submits the jobs to a simulator, e.g. lambda simulator: simulator.submit_random(...). Called once
+            per policy on a simulator with the same seed, so that random jobs are the same.
+
+        policies: The policies to compare, default set to scheduler.POLICIES.
+
+        seed: Seed of the simulations, default set to 0.
+
+        until: Simulated time at which to stop (in seconds), default set to None (when all jobs have run).
+
+        simulator_kwargs: Other arguments of FleetSimulator.
+
+    Returns:
+        reports: The report of each policy, by policy.
+
+    """
+    reports = {}
+    for policy in policies:
+        simulator = FleetSimulator(setup_config, policy=policy, seed=seed, **simulator_kwargs)
+        add_jobs(simulator)
+        reports[policy] = simulator.run(until)
+    return reports
@@ -0,0 +1,231 @@
+"""
+.. module:: state
+   :platform: Unix
+   :synopsis: A module used for saving the state of the pumps to disk and starting from it after a restart.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union, TYPE_CHECKING
+
+from ._logger import create_logger
+
+from . import pump_protocol
+
+if TYPE_CHECKING:
+    from .controller import C3000Controller
+
+#: Version of the snapshot format, snapshots of another version are ignored
+SNAPSHOT_VERSION = 1
+#: Default time between two flushes of the snapshot (in seconds)
+DEFAULT_SNAPSHOT_PERIOD = 10.
+
+
+def pump_snapshot(pump: 'C3000Controller') -> Dict[str, Any]:
+    """
+    Gets what the controller knows of a pump, without talking to it.
+
+    Args:
+        pump: The pump.
+
+    Returns:
+        state: The state of the pump, values never read being None.
+
+    """
+    return {
+        'name': pump.name,
+        'initialized': pump.last_known.get('initialized'),
+        'micro_step_mode': pump.micro_step_mode,
+        'top_velocity': pump.last_known.get('top_velocity'),
+        'valve_position': pump.last_known.get('valve_position'),
+        'eeprom_config': pump.last_known.get('eeprom_config'),
+        'plunger_steps': pump._plunger_steps,
+        'motion_profile': pump._active_motion_profile,
+        'liquid_class': pump.liquid_class,
+        'saved_at': pump.clock.time(),
+    }
+
+
+def save_snapshot(pumps: Dict[str, 'C3000Controller'], path: Union[str, Path]) -> None:
+    """
+    Writes the state of pumps to a file, keyed by hub port and pump address.
+
+    The file is replaced atomically, so that a crash while writing leaves the previous snapshot.
+
+    Args:
+        pumps: The pumps, by name.
+
+        path: The snapshot file.
+
+    """
+    hubs: Dict[str, Dict[str, Dict]] = {}
+    for pump in pumps.values():
+        hubs.setdefault(pump._io.port, {})[pump.address] = pump_snapshot(pump)
+    temporary_path = '{}.tmp'.format(path)
+    with open(temporary_path, 'w') as f:
+        json.dump({'version': SNAPSHOT_VERSION, 'hubs': hubs}, f, indent=2)
+    os.replace(temporary_path, path)
+
+
+def load_snapshot(path: Union[str, Path]) -> Dict[str, Dict[str, Dict]]:
+    """
+    Reads a snapshot file.
+
+    Args:
+        path: The snapshot file.
+
+    Returns:
+        hubs: The state of each pump, by hub port then pump address, empty if the file is missing, unreadable or
+            of another version.
+
+    """
+    logger = create_logger('load_snapshot')
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        logger.warning("Ignoring unreadable snapshot {}: {}".format(path, err))
+        return {}
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        logger.warning("Ignoring snapshot {} of another version".format(path))
+        return {}
+    return snapshot.get('hubs', {})
+
+
+def restore_pump(pump: 'C3000Controller', state: Dict[str, Any]) -> bool:
+    """
+    Starts a pump from its saved state if the pump still matches it.
+
+    The pump is checked with two reads: it must report being initialised, idle and without error, with its plunger
+    where the snapshot left it, and its config (microstep mode) must not have changed. The plunger model, the
+    last known values, the active motion profile and the liquid class are then taken from the snapshot.
+
+    Args:
+        pump: The pump.
+
+        state: Its saved state, see pump_snapshot().
+
+    Returns:
+        True: The pump was restored.
+
+        False: The pump does not match the snapshot (e.g. it was power cycled or moved since), nothing was changed.
+
+    """
+    from .controller import ControllerRepeatedError
+
+    if not state.get('initialized') or state.get('plunger_steps') is None or \
+            state.get('micro_step_mode') != pump.micro_step_mode:
+        return False
+    try:
+        (_, status, initialized) = pump.write_and_read_from_pump(pump._protocol.forge_report_initialized_packet())
+        if status != pump_protocol.STATUS_IDLE_ERROR_FREE or not initialized.isdigit() or not int(initialized):
+            return False
+        (_, _, steps) = pump.write_and_read_from_pump(pump._protocol.forge_report_plunger_position_packet())
+    except (ControllerRepeatedError, OSError):  # OSError includes serial.SerialException, e.g. the hub is gone
+        return False
+    if not steps.isdigit() or int(steps) != state['plunger_steps']:
+        return False
+
+    pump._plunger_steps = int(steps)
+    pump._plunger_synced_at = pump.clock.time()
+    pump._plunger_moving = False
+    for key in ('initialized', 'top_velocity', 'valve_position', 'eeprom_config'):
+        if state.get(key) is not None:
+            pump.last_known[key] = state[key]
+    if state.get('motion_profile') in pump.motion_profiles:
+        pump._active_motion_profile = state['motion_profile']
+    if state.get('liquid_class') in pump.liquid_classes:
+        pump.liquid_class = state['liquid_class']
+    return True
+
+
+def restore_snapshot(pumps: Dict[str, 'C3000Controller'], path: Union[str, Path]) -> List[str]:
+    """
+    Starts pumps from a snapshot file, see restore_pump().
+
+    Args:
+        pumps: The pumps, by name.
+
+        path: The snapshot file.
+
+    Returns:
+        pump_names: The pumps restored, the others need checking as usual.
+
+    """
+    hubs = load_snapshot(path)
+    restored = []
+    for pump_name, pump in pumps.items():
+        state = hubs.get(pump._io.port, {}).get(pump.address)
+        if state is not None and restore_pump(pump, state):
+            restored.append(pump_name)
+    create_logger('restore_snapshot').info("Restored {}/{} pumps from {}".format(len(restored), len(pumps), path))
+    return restored
+
+
+class StateSnapshotter:
+    """
+    This class flushes the state of pumps to a snapshot file periodically, in a background thread.
+
+    Only what the controller already knows is written, the pumps are not queried.
+
+    Args:
+        pumps: The pumps, by name.
+
+        path: The snapshot file.
+
+        period: Time between two flushes (in seconds), default set to DEFAULT_SNAPSHOT_PERIOD (10).
+
+    """
+    def __init__(self, pumps: Dict[str, 'C3000Controller'], path: Union[str, Path],
+                 period: float = DEFAULT_SNAPSHOT_PERIOD):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.pumps = pumps
+        self.path = path
+        self.period = period
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'StateSnapshotter':
+        """
+        Starts flushing in a background thread.
+
+        Returns:
+            self, so that the snapshotter can be created and started in one line.
+
+        """
+        self._thread = threading.Thread(target=self._run, name='state-snapshots', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Stops flushing, after a last flush.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the snapshot now.
+        """
+        try:
+            save_snapshot(self.pumps, self.path)
+        except OSError as err:
+            self.logger.warning("Could not write snapshot {}: {}".format(self.path, err))
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.period):
+            self.flush()
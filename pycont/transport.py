@@ -0,0 +1,420 @@
+"""
+.. module:: transport
+   :platform: Unix
+   :synopsis: A module used for opening the port of a hub from its URL, locally or through a TCP bridge on another host.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import hmac
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import serial
+
+from ._logger import create_logger
+
+#: Address a bridge listens on unless told otherwise, only this host can reach it
+DEFAULT_BRIDGE_HOST = '127.0.0.1'
+#: Environment variable holding the token shared by a bridge and its clients, when not given otherwise
+BRIDGE_TOKEN_ENV = 'PYCONT_BRIDGE_TOKEN'
+#: TCP port of the bridge, when the URL does not give one
+DEFAULT_BRIDGE_PORT = 7250
+#: Time allowed to connect to a bridge (in seconds)
+CONNECT_TIMEOUT = 5.
+#: Round trips measured when connecting, to start the latency estimate
+PING_COUNT = 3
+#: Weight of the last round trip in the latency estimate
+LATENCY_SMOOTHING = 0.2
+#: Network time added to the timeout of the bus: a multiple of the estimated round trip, at least a minimum
+LATENCY_MARGIN_FACTOR = 4
+MIN_LATENCY_MARGIN = 0.01
+
+#: Frame of the bridge protocol: kind, sequence number, time the exchange took on the bus (us), length of the data
+FRAME_HEADER = struct.Struct('<BIIH')
+FRAME_CONFIG = 1  # Client to bridge: baudrate and timeout of the bus, and token of the bridge if any, as JSON
+FRAME_WRITE = 2  # Client to bridge: bytes to write on the bus, the bridge replies with the line read back
+FRAME_REPLY = 3  # Bridge to client: the line read after the write of the same sequence number, empty on timeout
+FRAME_PING = 4
+FRAME_PONG = 5
+FRAME_ERROR = 6  # Bridge to client: the bus failed, the data is the message
+
+#: Opens a transport from its URL, baudrate and timeout, by URL scheme, see register_transport()
+TRANSPORTS: Dict[str, Callable[[str, int, float], object]] = {}
+
+
+def register_transport(scheme: str, factory: Callable[[str, int, float], object]) -> None:
+    """
+    Makes a transport available to the io.port of setup configs, as scheme://...
+
+    Args:
+        scheme: The URL scheme.
+
+        factory: Opens the transport from the URL, the baudrate and the timeout. The transport is used as a
+            serial.Serial: write(), readline() returning b'' on timeout, reset_input_buffer(), close() and timeout.
+
+    """
+    TRANSPORTS[scheme] = factory
+
+
+def open_transport(port: str, baudrate: int, timeout: float):
+    """
+    Opens the port of a hub.
+
+    A plain device name (e.g. /dev/ttyUSB0 or COM3) or serial:///dev/ttyUSB0 opens a local serial port,
+    tcp://host:port a serial bus exposed by a SerialBridge on another host, any other scheme registered with
+    register_transport() its transport, and the URLs known to pyserial (e.g. rfc2217://, socket://, loop://) are
+    left to it.
+
+    Args:
+        port: The device name or URL.
+
+        baudrate: The baudrate of the bus.
+
+        timeout: The timeout of a read (in seconds).
+
+    Raises:
+        serial.SerialException: The port cannot be opened.
+
+    """
+    if '://' not in port:
+        return serial.Serial(port, baudrate, timeout=timeout)
+    scheme = urlsplit(port).scheme
+    if scheme in TRANSPORTS:
+        return TRANSPORTS[scheme](port, baudrate, timeout)
+    return serial.serial_for_url(port, baudrate=baudrate, timeout=timeout)
+
+
+def _open_serial_url(port: str, baudrate: int, timeout: float):
+    return serial.Serial(urlsplit(port).path, baudrate, timeout=timeout)
+
+
+def _pack_frame(kind: int, sequence: int, data: bytes = b'', bus_time_us: int = 0) -> bytes:
+    return FRAME_HEADER.pack(kind, sequence, bus_time_us, len(data)) + data
+
+
+class _FrameReader:
+    """
+    Reads frames from a socket, keeping the bytes of a frame cut by a timeout for the next read.
+    """
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._buffer = bytearray()
+
+    def read(self, deadline: float = None) -> Optional[Tuple[int, int, int, bytes]]:
+        """
+        Reads a frame as (kind, sequence, bus time in us, data), None if the deadline passed first.
+
+        Raises:
+            serial.SerialException: The connection was closed.
+
+        """
+        while True:
+            if len(self._buffer) >= FRAME_HEADER.size:
+                kind, sequence, bus_time_us, length = FRAME_HEADER.unpack_from(self._buffer)
+                if len(self._buffer) >= FRAME_HEADER.size + length:
+                    data = bytes(self._buffer[FRAME_HEADER.size:FRAME_HEADER.size + length])
+                    del self._buffer[:FRAME_HEADER.size + length]
+                    return kind, sequence, bus_time_us, data
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.sock.settimeout(remaining)
+            else:
+                self.sock.settimeout(None)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                return None
+            if not chunk:
+                raise serial.SerialException('Connection closed')
+            self._buffer.extend(chunk)
+
+
+class TcpTransport:
+    """
+    This class reaches a serial bus exposed by a SerialBridge on another host, used by PumpIO as a serial port.
+
+    Each write is sent in a frame with a sequence number, and the bridge sends back the line it read after writing
+    it, tagged with the same number, without waiting to be asked. An exchange takes one network round trip, and a
+    reply arriving after its timeout is recognised by its number and dropped instead of answering the next command.
+
+    Reads wait for the timeout of the bus plus a network margin, LATENCY_MARGIN_FACTOR times the estimated round
+    trip (at least MIN_LATENCY_MARGIN). The round trip is measured when connecting and updated with each reply,
+    from which the time the bridge spent on the bus is taken out.
+
+    Args:
+        url: tcp://host:port of the bridge, the port defaulting to DEFAULT_BRIDGE_PORT, or tcp://token@host:port for
+            a bridge started with a token, the token otherwise read from the BRIDGE_TOKEN_ENV environment variable.
+
+        baudrate: The baudrate of the bus, set on the bridge.
+
+        timeout: The timeout of a read on the bus (in seconds), set on the bridge.
+
+    Raises:
+        serial.SerialException: The bridge cannot be reached, or refuses the token.
+
+    """
+    def __init__(self, url: str, baudrate: int, timeout: float):
+        self.logger = create_logger(self.__class__.__name__)
+
+        parts = urlsplit(url)
+        self.address = (parts.hostname, parts.port or DEFAULT_BRIDGE_PORT)
+        token = parts.username or os.environ.get(BRIDGE_TOKEN_ENV)
+        self.baudrate = baudrate
+        self.timeout = timeout
+        try:
+            self._socket = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        except OSError as err:
+            raise serial.SerialException('Cannot reach bridge {}:{}: {}'.format(*self.address, err)) from err
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = _FrameReader(self._socket)
+        self._sequence = 0
+        self._sent_at = 0.
+        self.is_open = True
+
+        #: Estimated network round trip to the bridge (in seconds)
+        self.round_trip: Optional[float] = None
+        settings = {'baudrate': baudrate, 'timeout': timeout}
+        if token:
+            settings['token'] = token
+        self._send(FRAME_CONFIG, json.dumps(settings).encode())
+        for _ in range(PING_COUNT):
+            self.ping()
+
+    @property
+    def latency_margin(self) -> float:
+        """
+        Network time added to the timeout of the bus (in seconds).
+        """
+        return max(LATENCY_MARGIN_FACTOR * (self.round_trip or 0.), MIN_LATENCY_MARGIN)
+
+    def _send(self, kind: int, data: bytes = b'') -> int:
+        self._sequence = (self._sequence + 1) % 2 ** 32
+        self._socket.sendall(_pack_frame(kind, self._sequence, data))
+        return self._sequence
+
+    def _update_round_trip(self, elapsed: float) -> None:
+        elapsed = max(elapsed, 0.)
+        if self.round_trip is None:
+            self.round_trip = elapsed
+        else:
+            self.round_trip += LATENCY_SMOOTHING * (elapsed - self.round_trip)
+
+    def _receive(self, kind: int, sequence: int, timeout: float) -> Optional[Tuple[int, bytes]]:
+        """
+        Waits for the frame of a sequence number, dropping the late ones, None on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self._reader.read(deadline)
+            if frame is None:
+                return None
+            frame_kind, frame_sequence, bus_time_us, data = frame
+            if frame_kind == FRAME_ERROR:
+                raise serial.SerialException('Bridge {}:{}: {}'.format(*self.address, data.decode()))
+            if frame_kind == kind and frame_sequence == sequence:
+                return bus_time_us, data
+            self.logger.debug("Dropping late frame {} from {}:{}".format(frame_sequence, *self.address))
+
+    def ping(self) -> Optional[float]:
+        """
+        Measures a round trip to the bridge (in seconds), None if it timed out.
+        """
+        sent_at = time.monotonic()
+        sequence = self._send(FRAME_PING)
+        if self._receive(FRAME_PONG, sequence, CONNECT_TIMEOUT) is None:
+            return None
+        elapsed = time.monotonic() - sent_at
+        self._update_round_trip(elapsed)
+        return elapsed
+
+    def write(self, data: bytes) -> int:
+        self._sent_at = time.monotonic()
+        self._send(FRAME_WRITE, data)
+        return len(data)
+
+    def readline(self) -> bytes:
+        reply = self._receive(FRAME_REPLY, self._sequence, self.timeout + self.latency_margin)
+        if reply is None:
+            return b''
+        bus_time_us, data = reply
+        self._update_round_trip(time.monotonic() - self._sent_at - bus_time_us / 1e6)
+        return data
+
+    def reset_input_buffer(self) -> None:
+        pass  # Late replies are dropped by sequence number
+
+    def close(self) -> None:
+        self.is_open = False
+        self._socket.close()
+
+
+register_transport('tcp', TcpTransport)
+register_transport('serial', _open_serial_url)
+
+
+class SerialBridge(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    This class exposes a local serial bus to PumpIOs on other hosts, reached with io.port set to tcp://host:port.
+
+    Exchanges of all the connected clients go through the bus one at a time. The baudrate and timeout are those
+    asked by the last client that connected.
+
+    Anyone reaching the bridge can write to the pumps. It only listens on this host by default; to expose it to
+    other hosts, give the address to listen on and a token, which clients then send when they connect.
+
+    Args:
+        port: The device name or URL of the local bus, see open_transport().
+
+        host: The address to listen on, default set to DEFAULT_BRIDGE_HOST (this host only), '' for all interfaces.
+
+        bridge_port: The TCP port to listen on, default set to DEFAULT_BRIDGE_PORT.
+
+        token: The token clients must send, default set to None (no token).
+
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: str, host: str = DEFAULT_BRIDGE_HOST, bridge_port: int = DEFAULT_BRIDGE_PORT,
+                 token: str = None):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.port = port
+        self.token = token
+        if token is None and host not in (DEFAULT_BRIDGE_HOST, 'localhost', '::1'):
+            self.logger.warning("Bridge of {} reachable on {!r} without a token".format(port, host))
+        self.bus_lock = threading.Lock()
+        self._serial = None
+        self._settings: Optional[Tuple[int, float]] = None
+        super().__init__((host, bridge_port), _BridgeHandler)
+
+    def check_token(self, token: Optional[str]) -> bool:
+        """
+        Checks the token sent by a client, any token is accepted by a bridge without one.
+        """
+        if self.token is None:
+            return True
+        return isinstance(token, str) and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def configure(self, baudrate: int, timeout: float) -> None:
+        """
+        Opens the bus, or reopens it with another baudrate or timeout.
+        """
+        with self.bus_lock:
+            if self._settings == (baudrate, timeout):
+                return
+            if self._serial is not None:
+                self._serial.close()
+                self._serial = None
+            self._serial = open_transport(self.port, baudrate, timeout)
+            self._settings = (baudrate, timeout)
+            self.logger.info("Opened {} at {} baud".format(self.port, baudrate))
+
+    def exchange(self, data: bytes) -> Tuple[bytes, float]:
+        """
+        Writes to the bus and reads the reply.
+
+        Returns:
+            (reply, bus_time): The line read, empty on timeout, and the time the exchange took (in seconds).
+
+        """
+        with self.bus_lock:
+            if self._serial is None:
+                raise serial.SerialException('Bus not configured')
+            started_at = time.monotonic()
+            self._serial.reset_input_buffer()
+            self._serial.write(data)
+            reply = self._serial.readline()
+            return reply, time.monotonic() - started_at
+
+    def server_close(self) -> None:
+        super().server_close()
+        with self.bus_lock:
+            if self._serial is not None:
+                self._serial.close()
+                self._serial = None
+
+
+class _BridgeHandler(socketserver.BaseRequestHandler):
+    """
+    Serves the frames of one client, in order.
+    """
+    def handle(self):
+        bridge = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = _FrameReader(self.request)
+        bridge.logger.info("Client {} connected".format(self.client_address))
+        authenticated = bridge.token is None
+        try:
+            while True:
+                kind, sequence, _, data = reader.read()
+                if not authenticated and kind != FRAME_CONFIG:
+                    bridge.logger.warning("Client {} refused: no token".format(self.client_address))
+                    self.request.sendall(_pack_frame(FRAME_ERROR, sequence, b'Token required'))
+                    return
+                try:
+                    if kind == FRAME_CONFIG:
+                        settings = json.loads(data)
+                        if not bridge.check_token(settings.get('token')):
+                            bridge.logger.warning("Client {} refused: invalid token".format(self.client_address))
+                            self.request.sendall(_pack_frame(FRAME_ERROR, sequence, b'Invalid token'))
+                            return
+                        authenticated = True
+                        bridge.configure(settings['baudrate'], settings['timeout'])
+                    elif kind == FRAME_PING:
+                        self.request.sendall(_pack_frame(FRAME_PONG, sequence))
+                    elif kind == FRAME_WRITE:
+                        reply, bus_time = bridge.exchange(data)
+                        self.request.sendall(_pack_frame(FRAME_REPLY, sequence, reply, int(bus_time * 1e6)))
+                except (serial.SerialException, OSError, ValueError) as err:
+                    if isinstance(err, (BrokenPipeError, ConnectionResetError)):
+                        raise
+                    bridge.logger.warning("Bus {} failed: {}".format(bridge.port, err))
+                    self.request.sendall(_pack_frame(FRAME_ERROR, sequence, str(err).encode()))
+        except (serial.SerialException, OSError):
+            pass  # The client disconnected
+        finally:
+            bridge.logger.info("Client {} disconnected".format(self.client_address))
+
+
+def main(argv: Sequence[str] = None) -> None:
+    """
+    Runs a bridge until interrupted: python -m pycont.transport /dev/ttyUSB0 --host 0.0.0.0 --port 7250
+    """
+    parser = argparse.ArgumentParser(description='Exposes a local serial bus to PumpIOs on other hosts.')
+    parser.add_argument('device', help='The device name or URL of the serial bus')
+    parser.add_argument('--host', default=DEFAULT_BRIDGE_HOST,
+                        help='The address to listen on, this host only by default, 0.0.0.0 for all interfaces')
+    parser.add_argument('--port', type=int, default=DEFAULT_BRIDGE_PORT, help='The TCP port to listen on')
+    parser.add_argument('--token', default=os.environ.get(BRIDGE_TOKEN_ENV),
+                        help='The token clients must send, from {} by default'.format(BRIDGE_TOKEN_ENV))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    bridge = SerialBridge(args.device, args.host, args.port, args.token)
+    create_logger('transport').info("Bridging {} on {}:{}".format(args.device, args.host, args.port))
+    try:
+        bridge.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bridge.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+.. module:: virtual
+   :platform: Unix
+   :synopsis: A module used for simulating a C3000 pump, its plunger, valve and move durations, without hardware.
+
+.. moduleauthor:: Jonathan Grizou <Jonathan.Grizou@gla.ac.uk>
+
+"""
+
+# -*- coding: utf-8 -*-
+
+import threading
+from typing import List, Optional, Tuple
+
+from ._logger import create_logger
+
+from . import pump_protocol
+from .clock import Clock, SYSTEM_CLOCK
+from .dtprotocol import DTInstructionPacket
+from .motion import MotionProfile, micro_step_scale
+
+#: Address the pumps reply from (the master address)
+REPLY_ADDRESS = '0'
+
+#: Plunger steps over the full stroke in Microstep Mode 0 and 1
+FULL_STROKE_STEPS = 3000
+#: Top velocity the pumps power up with, in Microstep Mode 0 (steps/second)
+POWER_UP_TOP_VELOCITY = 1400
+#: Range of the top velocity in Microstep Mode 0 (steps/second)
+TOP_VELOCITY_RANGE = (5, 6000)
+#: Top velocity of the plunger while initialising, in Microstep Mode 0 (steps/second)
+INITIALIZE_VELOCITY = 1000
+#: Time taken by the valve to find its home position when initialising (in seconds)
+VALVE_INITIALIZE_DURATION = 1.0
+#: Time taken by the valve to switch position (in seconds)
+VALVE_SWITCH_DURATION = 0.25
+#: EEPROM the pumps report, a 3-way valve configuration
+DEFAULT_EEPROM = '10,75,14,62,1,1,20,10,48,210,2013100,0,0,0,0,0,25,20,15,0000000'
+
+#: Raw valve positions reported by ?6, by valve command
+VALVE_COMMANDS = {
+    pump_protocol.CMD_VALVE_INPUT: 'i',
+    pump_protocol.CMD_VALVE_OUTPUT: 'o',
+    pump_protocol.CMD_VALVE_BYPASS: 'b',
+    pump_protocol.CMD_VALVE_EXTRA: 'e',
+}
+
+
+class VirtualPump:
+    """
+    This class models a C3000 pump: it executes the packets sent to it and replies the way the device does.
+
+    The pump tracks its plunger position, valve position, microstep mode, velocities and acceleration profile. Moves
+    keep it busy for their real duration, computed from the profile and the top velocity (see
+    MotionProfile.move_duration()), and the plunger position reported during a move is interpolated along it.
+    Commands sent while busy are rejected with a busy status, moves before initialisation and out of the stroke with
+    an error status, as on the device.
+
+    Time is read from a clock, a ScaledClock runs the pump faster than real time and a VirtualClock lets a
+    simulation drive it.
+
+    Args:
+        address: Address of the pump.
+
+        clock: The clock giving the time, default set to None (SYSTEM_CLOCK).
+
+        eeprom: EEPROM reported by the pump, default set to DEFAULT_EEPROM.
+
+    """
+    def __init__(self, address: str, clock: Clock = None, eeprom: str = DEFAULT_EEPROM):
+        self.logger = create_logger(self.__class__.__name__)
+
+        self.address = address
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.eeprom = eeprom
+
+        self._lock = threading.Lock()
+        self._created_at = self.clock.time()
+
+        # Power-up state
+        self.initialized = False
+        self.micro_step_mode = 0
+        self.valve_position = 'i'
+        self.top_velocity = POWER_UP_TOP_VELOCITY
+        factory_profile = MotionProfile.factory(0)
+        self.start_velocity = factory_profile.start_velocity
+        self.slope = factory_profile.slope
+        self.cutoff_velocity = factory_profile.cutoff_velocity
+
+        # Plunger moves as (start time, end time, start steps, end steps), in Microstep Mode 2 steps
+        self._moves: List[Tuple[float, float, float, float]] = []
+        self._steps = 0.
+        self.busy_until = 0.
+        #: Total time spent executing commands (in seconds)
+        self.busy_time = 0.
+
+    def set_initialized_state(self, micro_step_mode: int, top_velocity: int, valve_position: str = 'i',
+                              plunger_steps: int = 0) -> None:
+        """
+        Puts the pump in the state reached after initialisation and setting its parameters.
+
+        Args:
+            micro_step_mode: The microstep mode of the pump.
+
+            top_velocity: The top velocity of the pump (steps/second).
+
+            valve_position: The raw valve position, as reported by ?6, default set to 'i'.
+
+            plunger_steps: The plunger position, in the steps of micro_step_mode, default set to 0.
+
+        """
+        with self._lock:
+            factory_profile = MotionProfile.factory(micro_step_mode)
+            self.initialized = True
+            self.micro_step_mode = micro_step_mode
+            self.top_velocity = top_velocity
+            self.start_velocity = factory_profile.start_velocity
+            self.slope = factory_profile.slope
+            self.cutoff_velocity = factory_profile.cutoff_velocity
+            self.valve_position = valve_position
+            self._moves = []
+            self._steps = plunger_steps * micro_step_scale(2) / micro_step_scale(micro_step_mode)
+
+    def now(self) -> float:
+        """
+        Gets the simulated time (in seconds since the pump was created).
+        """
+        return self.clock.time() - self._created_at
+
+    @property
+    def scale(self) -> int:
+        return micro_step_scale(self.micro_step_mode)
+
+    @property
+    def max_steps(self) -> int:
+        """
+        Plunger steps over the full stroke in the current microstep mode.
+        """
+        return FULL_STROKE_STEPS * self.scale
+
+    def is_busy(self, now: float = None) -> bool:
+        return (self.now() if now is None else now) < self.busy_until
+
+    def plunger_steps(self, now: float = None) -> int:
+        """
+        Gets the plunger position in the steps of the current microstep mode, interpolated during a move.
+        """
+        now = self.now() if now is None else now
+        fine_steps = self._steps
+        for start_time, end_time, start_steps, end_steps in self._moves:
+            if now < start_time:
+                break
+            if now >= end_time:
+                fine_steps = end_steps
+            else:
+                fine_steps = start_steps + (end_steps - start_steps) * (now - start_time) / (end_time - start_time)
+                break
+        return int(fine_steps * self.scale / micro_step_scale(2))
+
+    def execute(self, packet: DTInstructionPacket) -> Tuple[str, str, str]:
+        """
+        Executes a packet and replies.
+
+        Args:
+            packet: The packet sent to the pump.
+
+        Returns:
+            (address, status, data): The decoded reply, see C3000Protocol.decode_packet().
+
+        """
+        commands = [(dtcommand.command.decode(), dtcommand.operand.decode() if dtcommand.operand is not None else '')
+                    for dtcommand in packet.dtcommands]
+        commands = [(command, operand) for command, operand in commands if command != pump_protocol.CMD_EXECUTE]
+        with self._lock:
+            now = self.now()
+            self._settle(now)
+            busy = self.is_busy(now)
+            status = pump_protocol.STATUS_BUSY_ERROR_FREE if busy else pump_protocol.STATUS_IDLE_ERROR_FREE
+
+            if not commands or commands[0][0] == pump_protocol.CMD_REPORT_STATUS:
+                return REPLY_ADDRESS, status, ''
+            if commands[0][0].startswith(pump_protocol.CMD_REPORT_PLUNGER_POSITION):
+                return REPLY_ADDRESS, status, self._report(commands[0][0], now)
+            if commands[0][0] == pump_protocol.CMD_TERMINATE:
+                self._terminate(now)
+                return REPLY_ADDRESS, pump_protocol.STATUS_IDLE_ERROR_FREE, ''
+            if busy:
+                return REPLY_ADDRESS, status, ''  # Rejected, the pump only takes new commands when idle
+
+            error = self._run(commands, now)
+            if error is not None:
+                return REPLY_ADDRESS, error, ''
+            return REPLY_ADDRESS, pump_protocol.STATUS_IDLE_ERROR_FREE, ''
+
+    def _settle(self, now: float) -> None:
+        """
+        Forgets the finished moves.
+        """
+        while self._moves and self._moves[0][1] <= now:
+            self._steps = self._moves.pop(0)[3]
+
+    def _report(self, query: str, now: float) -> str:
+        if query == pump_protocol.CMD_REPORT_PLUNGER_POSITION:
+            return str(self.plunger_steps(now))
+        reports = {
+            pump_protocol.CMD_REPORT_START_VELOCITY: self.start_velocity,
+            pump_protocol.CMD_REPORT_PEAK_VELOCITY: self.top_velocity,
+            pump_protocol.CMD_REPORT_CUTOFF_VELOCITY: self.cutoff_velocity,
+            pump_protocol.CMD_REPORT_VALVE_POSITION: self.valve_position,
+            pump_protocol.CMD_REPORT_INTIALIZED: int(self.initialized),
+            pump_protocol.CMD_REPORT_EEPROM: self.eeprom,
+            pump_protocol.CMD_REPORT_JUMPER_3WAY: 0,
+        }
+        return str(reports.get(query, 0))
+
+    def _terminate(self, now: float) -> None:
+        if self._moves:
+            fine_steps = self.plunger_steps(now) * micro_step_scale(2) / self.scale
+            self._moves = []
+            self._steps = fine_steps
+        self.busy_until = now
+
+    def _run(self, commands: List[Tuple[str, str]], now: float) -> Optional[str]:
+        """
+        Runs the commands of a packet one after the other, returns an error status if one is not accepted.
+        """
+        # Commands are checked against the state reached by the previous ones before anything is applied
+        end_time = now
+        steps = self.plunger_steps(now)
+        state = {'micro_step_mode': self.micro_step_mode, 'top_velocity': self.top_velocity,
+                 'start_velocity': self.start_velocity, 'slope': self.slope,
+                 'cutoff_velocity': self.cutoff_velocity, 'valve_position': self.valve_position,
+                 'initialized': self.initialized}
+        moves = []
+        for command, operand in commands:
+            scale = micro_step_scale(state['micro_step_mode'])
+            value = int(operand) if operand.isdigit() else None
+
+            if command in (pump_protocol.CMD_INITIALIZE_VALVE_RIGHT, pump_protocol.CMD_INITIALIZE_VALVE_LEFT,
+                           pump_protocol.CMD_INITIALIZE_NO_VALVE):
+                if command != pump_protocol.CMD_INITIALIZE_NO_VALVE:
+                    state['valve_position'] = 'o' if command == pump_protocol.CMD_INITIALIZE_VALVE_RIGHT else 'i'
+                    end_time += VALVE_INITIALIZE_DURATION
+                duration = steps / (INITIALIZE_VELOCITY * scale)
+                moves.append((end_time, end_time + duration, steps, 0, scale))
+                end_time += duration
+                steps = 0
+                state['initialized'] = True
+            elif command == pump_protocol.CMD_INITIALIZE_VALVE_ONLY:
+                end_time += VALVE_INITIALIZE_DURATION
+            elif command in VALVE_COMMANDS or command.startswith(pump_protocol.CMD_VALVE_INPUT):
+                position = VALVE_COMMANDS.get(command, command[1:])
+                if position != state['valve_position']:
+                    end_time += VALVE_SWITCH_DURATION
+                state['valve_position'] = position
+            elif command in (pump_protocol.CMD_MOVE_TO, pump_protocol.CMD_PUMP, pump_protocol.CMD_DELIVER):
+                if not state['initialized']:
+                    return pump_protocol.STATUS_IDLE_NOT_INITIALIZED
+                if value is None:
+                    return pump_protocol.STATUS_IDLE_INVALID_OPERAND
+                if command == pump_protocol.CMD_MOVE_TO:
+                    target = value
+                elif command == pump_protocol.CMD_PUMP:
+                    target = steps + value
+                else:
+                    target = steps - value
+                if not 0 <= target <= FULL_STROKE_STEPS * scale:
+                    return pump_protocol.STATUS_IDLE_INVALID_OPERAND
+                profile = MotionProfile(state['start_velocity'], state['slope'], state['cutoff_velocity'])
+                duration = profile.move_duration(target - steps, state['top_velocity'], state['micro_step_mode'])
+                moves.append((end_time, end_time + duration, steps, target, scale))
+                end_time += duration
+                steps = target
+            elif command == pump_protocol.CMD_MICROSTEPMODE:
+                if value not in (0, 1, 2):
+                    return pump_protocol.STATUS_IDLE_INVALID_OPERAND
+                # Positions and velocities are kept, expressed in the steps of the new mode
+                new_scale = micro_step_scale(value)
+                steps = steps * new_scale // scale
+                for key in ('top_velocity', 'start_velocity', 'cutoff_velocity'):
+                    state[key] = state[key] * new_scale // scale
+                state['micro_step_mode'] = value
+            elif command == pump_protocol.CMD_TOPVELOCITY:
+                if value is None or not TOP_VELOCITY_RANGE[0] * scale <= value <= TOP_VELOCITY_RANGE[1] * scale:
+                    return pump_protocol.STATUS_IDLE_INVALID_OPERAND
+                state['top_velocity'] = value
+            elif command in (pump_protocol.CMD_START_VELOCITY, pump_protocol.CMD_SLOPE,
+                             pump_protocol.CMD_CUTOFF_VELOCITY):
+                if value is None:
+                    return pump_protocol.STATUS_IDLE_INVALID_OPERAND
+                key = {pump_protocol.CMD_START_VELOCITY: 'start_velocity', pump_protocol.CMD_SLOPE: 'slope',
+                       pump_protocol.CMD_CUTOFF_VELOCITY: 'cutoff_velocity'}[command]
+                state[key] = value
+            elif command == pump_protocol.CMD_DELAY:
+                if value is None or not pump_protocol.DELAY_RANGE[0] <= value <= pump_protocol.DELAY_RANGE[1]:
+                    return pump_protocol.STATUS_IDLE_INVALID_OPERAND
+                end_time += value / 1000.
+            elif command in (pump_protocol.CMD_EEPROM_CONFIG, pump_protocol.CMD_EEPROM_LOWLEVEL_CONFIG):
+                pass  # Only active after a power cycle
+            else:
+                return pump_protocol.STATUS_IDLE_INVALID_COMMAND
+
+        # Moves are stored in Microstep Mode 2 steps, so that a mode change does not move the plunger
+        self._moves = [(start_time, move_end, start * micro_step_scale(2) / scale, end * micro_step_scale(2) / scale)
+                       for start_time, move_end, start, end, scale in moves]
+        if not self._moves:
+            self._steps = steps * micro_step_scale(2) / micro_step_scale(state['micro_step_mode'])
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.busy_until = end_time
+        self.busy_time += end_time - now
+        return None
@@ -12,5 +12,8 @@ setup(name="pycont",
             "pycont": ["py.typed"]
       },
       include_package_data=True,
-      install_requires=['pyserial']
+      install_requires=['pyserial'],
+      extras_require={
+            "gradient": ["numpy"]
+      }
       )
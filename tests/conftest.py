@@ -0,0 +1,127 @@
+"""
+Fixtures running pycont off hardware: the pumps of a bus are simulated by VirtualPump behind a stand-in for the serial
+port, so that the controllers talk the DT protocol as they would to a real bus.
+"""
+import re
+from urllib.parse import urlsplit
+
+import pytest
+
+from pycont import transport
+from pycont.clock import VirtualClock
+from pycont.dtprotocol import DTCommand, DTInstructionPacket, DTEnd, DTStart
+from pycont.virtual import VirtualPump
+
+#: A packet written on the bus, /<address><commands>\r
+PACKET = re.compile(rb'/(.)(.*)\r')
+#: A command of a packet: a report (?<n>) or a letter, followed by its operand
+COMMAND = re.compile(r'(\?\d*|[A-Za-z])([0-9,]*)')
+
+
+class VirtualBus(object):
+    """
+    A bus of simulated pumps, by address. The pumps only answer at the baudrate of the bus when it is set, or at their
+    own one in baudrates (their jumper), and a second pump answers along with the first at the duplicate addresses.
+    """
+    def __init__(self, clock, baudrate=None):
+        self.clock = clock
+        self.baudrate = baudrate
+        self.baudrates = {}
+        self.pumps = {}
+        self.duplicates = set()
+        self.writes = []
+
+    def add_pump(self, address):
+        self.pumps[address] = VirtualPump(address, self.clock)
+        return self.pumps[address]
+
+
+class VirtualBusSerial(object):
+    """
+    Stands for the serial port of a VirtualBus.
+    """
+    def __init__(self, bus, baudrate, timeout):
+        self.bus = bus
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self._replies = []
+
+    def write(self, data):
+        self.bus.writes.append(data)
+        match = PACKET.match(data)
+        address = match.group(1).decode()
+        pump = self.bus.pumps.get(address)
+        baudrate = self.bus.baudrates.get(address, self.bus.baudrate)
+        if pump is None or baudrate not in (None, self.baudrate):  # Nobody answers
+            self._replies = []
+            return len(data)
+        commands = COMMAND.findall(match.group(2).decode())
+        dtcommands = [DTCommand(command, operand or None) for command, operand in commands]
+        reply_address, status, data_out = pump.execute(DTInstructionPacket(address, dtcommands))
+        reply = '{}{}{}{}{}\r\n'.format(DTStart, reply_address, status, data_out, DTEnd).encode()
+        self._replies = [reply, reply] if address in self.bus.duplicates else [reply]
+        return len(data)
+
+    def readline(self):
+        return self._replies.pop(0) if self._replies else b''
+
+    def reset_input_buffer(self):
+        self._replies = []
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock()
+
+
+@pytest.fixture
+def virtual_buses(clock):
+    """
+    The buses opened as virtualbus://<name>, created with their pumps at the addresses of the setup config.
+    """
+    buses = {}
+
+    def open_bus(port, baudrate, timeout):
+        return VirtualBusSerial(buses.setdefault(urlsplit(port).netloc, VirtualBus(clock)), baudrate, timeout)
+
+    transport.register_transport('virtualbus', open_bus)
+    yield buses
+    transport.TRANSPORTS.pop('virtualbus', None)
+
+
+@pytest.fixture
+def make_setup(virtual_buses, clock):
+    """
+    Builds a MultiPumpController on virtual buses, with a simulated pump at the address of each pump of the config.
+    """
+    from pycont.controller import C3000SwitchToAddress, MultiPumpController
+
+    def make(config):
+        hub_configs = config['hubs'] if 'hubs' in config else [config]
+        for hub_config in hub_configs:
+            bus = virtual_buses.setdefault(urlsplit(hub_config['io']['port']).netloc, VirtualBus(clock))
+            for pump_config in hub_config['pumps'].values():
+                address = C3000SwitchToAddress[pump_config['switch']]
+                if address not in bus.pumps:
+                    bus.add_pump(address)
+        return MultiPumpController(config, clock)
+
+    return make
+
+
+def one_hub_config(pumps, port='virtualbus://hub', **extra):
+    """
+    Gives the setup config of one hub of 5 ml pumps, given by name and switch.
+    """
+    config = {
+        'io': {'port': port, 'baudrate': 9600, 'timeout': 0.05},
+        'default': {'volume': 5, 'micro_step_mode': 2, 'top_velocity': 6000},
+        'groups': {},
+        'pumps': {pump_name: {'switch': switch} for pump_name, switch in pumps.items()},
+    }
+    config.update(extra)
+    return config
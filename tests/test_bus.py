@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from pycont.bus import BusArbiter, PRIORITY_CONTROL, PRIORITY_EMERGENCY, PRIORITY_TELEMETRY
+from pycont.clock import VirtualClock
+
+
+def test_waiting_requests_are_granted_by_priority():
+    arbiter = BusArbiter()
+    granted = []
+
+    def request(priority):
+        arbiter.acquire(priority=priority)
+        granted.append(priority)
+        arbiter.release()
+
+    arbiter.acquire()
+    threads = []
+    for priority in (PRIORITY_TELEMETRY, PRIORITY_CONTROL, PRIORITY_EMERGENCY):
+        threads.append(threading.Thread(target=request, args=(priority,)))
+        threads[-1].start()
+    deadline = time.monotonic() + 5
+    while arbiter._waiting != [1, 1, 1] and time.monotonic() < deadline:
+        time.sleep(0.001)
+    arbiter.release()
+    for thread in threads:
+        thread.join(5)
+    assert granted == [PRIORITY_EMERGENCY, PRIORITY_CONTROL, PRIORITY_TELEMETRY]
+
+
+def test_telemetry_waits_for_its_budget_in_the_time_of_the_clock():
+    clock = VirtualClock()
+    arbiter = BusArbiter(telemetry_budget=0.25, clock=clock)
+    with pytest.raises(ValueError):
+        BusArbiter(telemetry_budget=0)
+
+    arbiter.acquire(priority=PRIORITY_TELEMETRY)
+    clock.sleep(0.5)
+    arbiter.release()
+    assert arbiter.telemetry_usage() == pytest.approx(0.5)
+
+    # Commands are not limited, queries wait until the last second holds no more than a quarter of telemetry
+    assert arbiter.acquire(priority=PRIORITY_CONTROL)
+    arbiter.release()
+    assert clock.time() == 0.5
+    assert not arbiter.acquire(blocking=False, priority=PRIORITY_TELEMETRY)
+    assert arbiter.acquire(priority=PRIORITY_TELEMETRY)
+    arbiter.release()
+    assert clock.time() == pytest.approx(1.25)
+
+
+def test_timeout_is_measured_on_the_clock():
+    clock = VirtualClock()
+    arbiter = BusArbiter(clock=clock)
+    arbiter.acquire()
+    assert not arbiter.acquire(timeout=2)
+    assert clock.time() == pytest.approx(2)
+    arbiter.release()
+    assert arbiter.acquire(timeout=2)
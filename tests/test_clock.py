@@ -0,0 +1,75 @@
+import threading
+
+from conftest import one_hub_config
+from pycont.clock import SYSTEM_CLOCK, SimulationClock, VirtualClock, clock_of
+from pycont.controller import VirtualMultiPumpController
+
+
+def test_clock_of():
+    clock = VirtualClock()
+    controller = VirtualMultiPumpController(one_hub_config({'water': '0'}), clock=clock)
+    assert clock_of(controller.pumps.values()) is clock
+    assert clock_of([]) is SYSTEM_CLOCK
+
+
+def test_scheduled_jobs_are_timed_in_the_time_of_the_pumps():
+    clock = VirtualClock(1000.)
+    controller = VirtualMultiPumpController(one_hub_config({'water': '0'}), clock=clock)
+    controller.smart_initialize()
+
+    scheduler = controller.job_scheduler()
+    assert scheduler.clock is clock
+    job = scheduler.submit(['water'], 'transfer', {'volume_in_ml': 5, 'from_valve': 'I', 'to_valve': 'O'},
+                           deadline=1)
+    assert scheduler.join(timeout=5)
+    scheduler.close()
+
+    assert job.error is None
+    assert job.submitted_at >= 1000.
+    # A 5 ml stroke each way takes seconds of pump time, and no time on the wall clock
+    assert job.finished_at - job.submitted_at > 1
+    assert job.missed_deadline
+
+
+def test_dispense_queue_takes_the_clock_of_the_pumps():
+    clock = VirtualClock()
+    controller = VirtualMultiPumpController(dict(one_hub_config({'a': '0', 'b': '1'}), groups={'oil': ['a', 'b']}),
+                                            clock=clock)
+    controller.smart_initialize()
+    queue = controller.dispense_queue('oil', 'I', 'O')
+    assert queue.clock is clock
+    job = queue.submit(1)
+    assert queue.join(timeout=5)
+    queue.close()
+    assert job.error is None and job.finished_at > job.submitted_at
+
+
+def test_simulation_clock_interleaves_threads_in_time_order():
+    clock = SimulationClock()
+    condition = threading.Condition()
+    events = []
+
+    def sleeper(name, period, turn):
+        clock.enter(turn)
+        for _ in range(3):
+            clock.sleep(period)
+            events.append((clock.time(), name))
+        with condition:
+            clock.notify_all(condition)
+        clock.leave()
+
+    clock.enter(clock.add_participant())
+    threads = [threading.Thread(target=sleeper, args=(name, period, clock.add_participant()))
+               for name, period in (('slow', 1.5), ('fast', 1.))]
+    for thread in threads:
+        thread.start()
+    with condition:
+        # Times out at 10 unless woken by the last sleeper at 4.5
+        assert clock.wait(condition, timeout=10)
+        assert clock.wait(condition, timeout=10)
+    assert clock.time() == 4.5
+    clock.stop()
+    clock.leave()
+    for thread in threads:
+        thread.join(5)
+    assert events == [(1., 'fast'), (1.5, 'slow'), (2., 'fast'), (3., 'slow'), (3., 'fast'), (4.5, 'slow')]
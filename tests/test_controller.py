@@ -0,0 +1,97 @@
+import pytest
+
+from pycont import pump_protocol
+from pycont.controller import ControllerRepeatedError
+
+from conftest import COMMAND, PACKET, one_hub_config
+
+
+def test_move_sent_to_busy_pump_is_not_tracked(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'water': '0'}))
+    controller.smart_initialize()
+    pump = controller.pumps['water']
+    pump.pump(2, 'I', wait=True)
+    pump.pump(1)
+    pump.pump(1)  # Dropped, the pump is still running the previous move
+    pump.wait_until_idle()
+
+    assert virtual_buses['hub'].pumps['1'].plunger_steps() == pump.volume_to_step(3)
+    assert pump.current_steps == pump.volume_to_step(3)
+
+
+def test_move_answered_with_error_is_not_tracked(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'water': '0'}))
+    controller.smart_initialize()
+    pump = controller.pumps['water']
+    pump.pump(2, 'I', wait=True)
+
+    virtual_pump = virtual_buses['hub'].pumps['1']
+    execute = virtual_pump.execute
+
+    def overload_moves(packet):
+        if any(dtcommand.command == pump_protocol.CMD_MOVE_TO.encode() for dtcommand in packet.dtcommands):
+            return '0', pump_protocol.STATUS_IDLE_PLUNGER_OVERLOAD, ''
+        return execute(packet)
+
+    virtual_pump.execute = overload_moves
+    pump.go_to_volume(1, wait=True)
+
+    assert virtual_pump.plunger_steps() == pump.volume_to_step(2)
+    assert pump.current_steps == pump.volume_to_step(2)
+
+
+def delivered_steps(writes):
+    """
+    Sums the steps of the deliveries written on a bus, by address.
+    """
+    steps = {}
+    for write in writes:
+        match = PACKET.match(write)
+        for command, operand in COMMAND.findall(match.group(2).decode()):
+            if command == pump_protocol.CMD_DELIVER:
+                steps[match.group(1).decode()] = steps.get(match.group(1).decode(), 0) + int(operand)
+    return steps
+
+
+def test_volume_is_split_in_proportion_to_the_transfer_rates(make_setup):
+    config = one_hub_config({'small': '0', 'big': '1', 'fast': '2'})
+    config['pumps']['small']['volume'] = 1
+    config['pumps']['fast']['top_velocity'] = 12000
+    controller = make_setup(config)
+
+    # A 5 mL syringe moves 5 times the volume of a 1 mL one per step, twice the velocity doubles the rate
+    volumes = controller.split_volume(['small', 'big', 'fast'], 16)
+    assert volumes == {'small': pytest.approx(1), 'big': pytest.approx(5), 'fast': pytest.approx(10)}
+    # Forced speeds apply to every pump alike
+    volumes = controller.split_volume(['big', 'fast'], 8, speed_in=3000, speed_out=3000)
+    assert volumes == {'big': pytest.approx(4), 'fast': pytest.approx(4)}
+
+
+def test_split_transfer_runs_each_share_on_its_pump(make_setup, virtual_buses):
+    config = one_hub_config({'a': '0', 'b': '1', 'c': '2'}, groups={'pair': ['a', 'b']})
+    config['pumps']['b']['volume'] = 1
+    controller = make_setup(config)
+    controller.smart_initialize()
+    del virtual_buses['hub'].writes[:]
+
+    volumes = controller.split_transfer('pair', 12, 'I', 'O')
+    assert volumes == {'a': pytest.approx(10), 'b': pytest.approx(2)}
+    # Beyond their syringe the pumps refill, and the pump out of the group is left alone
+    steps = delivered_steps(virtual_buses['hub'].writes)
+    pumps = controller.pumps
+    assert steps == {pumps['a'].address: pumps['a'].volume_to_step(10),
+                     pumps['b'].address: pumps['b'].volume_to_step(2)}
+    assert all(pumps[pump_name].current_volume == 0 for pump_name in ('a', 'b'))
+
+
+def test_split_transfer_raises_the_error_of_a_failing_pump_once_the_others_are_done(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'a': '0', 'b': '1'}, groups={'pair': ['a', 'b']}))
+    controller.smart_initialize()
+    del virtual_buses['hub'].pumps[controller.pumps['b'].address]  # Nobody answers at this address
+    del virtual_buses['hub'].writes[:]
+
+    with pytest.raises(ControllerRepeatedError):
+        controller.split_transfer('pair', 8, 'I', 'O')
+    assert delivered_steps(virtual_buses['hub'].writes) == {controller.pumps['a'].address:
+                                                            controller.pumps['a'].volume_to_step(4)}
+    assert controller.pumps['a'].current_volume == 0
@@ -0,0 +1,66 @@
+import json
+
+from conftest import VirtualBus
+from pycont.controller import C3000SwitchToAddress
+from pycont.discovery import BusScanner
+
+
+def add_bus(virtual_buses, clock, name, switches, baudrate=None):
+    bus = virtual_buses[name] = VirtualBus(clock, baudrate)
+    for switch in switches:
+        bus.add_pump(C3000SwitchToAddress[switch])
+    return bus
+
+
+def test_pumps_are_found_at_the_baudrate_they_answer(virtual_buses, clock):
+    add_bus(virtual_buses, clock, 'slow', ['0', '1'], baudrate=9600)
+    add_bus(virtual_buses, clock, 'fast', ['2'], baudrate=38400)
+    add_bus(virtual_buses, clock, 'empty', [])
+
+    report = BusScanner(['virtualbus://slow', 'virtualbus://fast', 'virtualbus://empty']).scan()
+    slow, fast, empty = report.hubs
+    assert (slow.baudrate, [pump.switch for pump in slow.pumps]) == (9600, ['0', '1'])
+    assert (fast.baudrate, [pump.switch for pump in fast.pumps]) == (38400, ['2'])
+    assert (empty.baudrate, empty.pumps) == (None, [])
+    assert all(pump.rtt is not None and pump.initialized is False and pump.valve_config is not None
+               for pump in report.pumps)
+    assert not report.duplicates
+    # The fast bus was first probed at 9600 baud, every address in vain
+    assert len(virtual_buses['fast'].writes) > len(C3000SwitchToAddress)
+
+
+def test_addresses_answered_twice_are_reported(virtual_buses, clock):
+    bus = add_bus(virtual_buses, clock, 'hub', ['0', '3'])
+    bus.duplicates.add(C3000SwitchToAddress['3'])
+
+    report = BusScanner(['virtualbus://hub'], baudrates=[9600]).scan()
+    assert [(pump.switch, pump.duplicate) for pump in report.pumps] == [('0', False), ('3', True)]
+    assert report.duplicates == [report.pumps[1]]
+    assert 'DUPLICATE ADDRESS' in report.summary()
+
+
+def test_setup_config_holds_the_pumps_that_can_be_told_apart(virtual_buses, clock, tmp_path, make_setup):
+    add_bus(virtual_buses, clock, 'first', ['0', '1'], baudrate=38400).duplicates.add(C3000SwitchToAddress['1'])
+    add_bus(virtual_buses, clock, 'second', ['4'])
+    add_bus(virtual_buses, clock, 'empty', [])
+
+    report = BusScanner(['virtualbus://first', 'virtualbus://empty', 'virtualbus://second']).scan()
+    setup_config = report.setup_config(volume=1, timeout=0.5)
+    assert setup_config == {
+        'default': {'volume': 1, 'micro_step_mode': 2, 'top_velocity': 6000},
+        'groups': {},
+        'hubs': [
+            {'io': {'port': 'virtualbus://first', 'baudrate': 38400, 'timeout': 0.5},
+             'pumps': {'pump_0_0': {'switch': '0'}}},
+            {'io': {'port': 'virtualbus://second', 'baudrate': 9600, 'timeout': 0.5},
+             'pumps': {'pump_1_4': {'switch': '4'}}},
+        ],
+    }
+
+    report.save_configfile(tmp_path / 'setup.json', volume=1, timeout=0.5)
+    with open(tmp_path / 'setup.json') as f:
+        assert json.load(f) == setup_config
+    # The generated config starts a controller talking to the pumps found
+    controller = make_setup(setup_config)
+    controller.smart_initialize()
+    assert controller.pumps['pump_1_4'].is_initialized()
@@ -0,0 +1,69 @@
+import threading
+
+from pycont.dispatch import DispenseQueue
+
+
+class SyringePump(object):
+    """
+    Stands for a pump in a DispenseQueue, holding a volume.
+    """
+    def __init__(self, name, current_volume=5., fail_refill=False):
+        self.name = name
+        self.total_volume = 5.
+        self.current_volume = current_volume
+        self.fail_refill = fail_refill
+        self.reading = threading.Event()  # Cleared to make volume reads hang, as a resync over a busy bus would
+
+        self.reading.set()
+
+    @property
+    def remaining_volume(self):
+        self.reading.wait()
+        return self.total_volume - self.current_volume
+
+    def volume_to_step(self, volume_in_ml):
+        return int(volume_in_ml * 1200)
+
+    def is_volume_deliverable(self, volume_in_ml):
+        self.reading.wait()
+        return volume_in_ml <= self.current_volume
+
+    def pump(self, volume_in_ml, from_valve=None, speed_in=None, wait=False):
+        if self.fail_refill:
+            raise IOError('Pump {} does not answer'.format(self.name))
+        self.current_volume += volume_in_ml
+
+    def deliver(self, volume_in_ml, to_valve=None, speed_out=None, wait=False):
+        self.current_volume -= volume_in_ml
+
+
+def test_jobs_are_dispensed():
+    pumps = [SyringePump('a'), SyringePump('b')]
+    queue = DispenseQueue(pumps, 'I', 'O').start()
+    jobs = [queue.submit(1.5) for _ in range(10)]
+    assert queue.join(timeout=5)
+    queue.close()
+    assert all(job.error is None for job in jobs)
+    assert sum(report['volume'] for report in queue.utilisation().values()) == 15
+
+
+def test_volume_reads_do_not_block_submit():
+    pump = SyringePump('a')
+    queue = DispenseQueue([pump], 'I', 'O').start()
+    pump.reading.clear()
+    queue.submit(1)
+    submitter = threading.Thread(target=queue.submit, args=(1,))
+    submitter.start()
+    submitter.join(timeout=1)
+    assert not submitter.is_alive()
+    pump.reading.set()
+    assert queue.join(timeout=5)
+    queue.close()
+
+
+def test_queued_jobs_fail_once_every_pump_left():
+    pumps = [SyringePump('a', 0., fail_refill=True), SyringePump('b', 0., fail_refill=True)]
+    queue = DispenseQueue(pumps, 'I', 'O').start()
+    jobs = [queue.submit(1) for _ in range(3)]
+    assert queue.join(timeout=5)
+    assert all(job.done() and job.error is not None for job in jobs)
@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import one_hub_config
+
+
+def test_twin_starts_from_the_known_plunger_position(make_setup):
+    controller = make_setup(one_hub_config({'water': '0'}))
+    controller.smart_initialize()
+    controller.pumps['water'].pump(3, 'I', wait=True)
+
+    report = controller.dry_run().run(lambda setup: setup.pumps['water'].deliver(2, 'O', wait=True))
+    assert report.aborted is None and report.infeasible_steps == []
+
+    report = controller.dry_run().run(lambda setup: setup.pumps['water'].pump(3, 'I', wait=True))
+    assert [step.operation for step in report.infeasible_steps] == ['pump']
+    assert not report.fits(3600)
+    assert 'infeasible' in report.summary()
+
+
+def test_pump_twin_starts_from_the_known_plunger_position(make_setup):
+    controller = make_setup(one_hub_config({'water': '0'}))
+    controller.smart_initialize()
+    pump = controller.pumps['water']
+    pump.pump(3, 'I', wait=True)
+
+    report = pump.dry_run().run(lambda twin: twin.deliver(3, 'O', wait=True))
+    assert report.infeasible_steps == []
+    assert pump.current_volume == pytest.approx(3)
+
+
+def test_parallel_moves_overlap_in_the_makespan(make_setup):
+    controller = make_setup(one_hub_config({'water': '0', 'acid': '1'}))
+    report = controller.dry_run().run(lambda setup: setup.pump(['water', 'acid'], 2, from_valve='I', wait=True))
+    busy_times = report.pump_busy_time
+    assert busy_times['water'] > 0 and busy_times['acid'] > 0
+    assert max(busy_times.values()) <= report.makespan < sum(busy_times.values())
+
+
+def test_bus_occupancy_follows_the_baudrate(make_setup):
+    def script(setup):
+        setup.pumps['water'].get_plunger_position()
+        setup.pumps['water'].get_valve_position()
+
+    reports = {}
+    for baudrate in (9600, 19200):
+        config = one_hub_config({'water': '0'})
+        config['io']['baudrate'] = baudrate
+        dry_run = make_setup(config).dry_run()
+        reports[baudrate] = (dry_run.run(script), dry_run.turnaround)
+
+    (slow, turnaround), (fast, _) = reports[9600], reports[19200]
+    port = 'virtualbus://hub'
+    assert slow.exchanges[port] == fast.exchanges[port] > 0
+    # Only the time of the bytes on the wire depends on the baudrate, not the turnaround of the pump
+    wire_time_slow = slow.bus_occupancy[port] - slow.exchanges[port] * turnaround
+    wire_time_fast = fast.bus_occupancy[port] - fast.exchanges[port] * turnaround
+    assert wire_time_slow == pytest.approx(2 * wire_time_fast)
+    assert slow.makespan == pytest.approx(slow.bus_occupancy[port])
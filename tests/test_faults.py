@@ -0,0 +1,122 @@
+import pytest
+
+from conftest import one_hub_config
+from pycont import faults, pump_protocol
+from pycont.dtprotocol import DTStatus
+from pycont.faults import FaultInjectingSerial, FaultMix, FaultReport, benchmark_faults
+
+REPLY = '/0`1500\x03\r\n'.encode()
+
+
+class RepeatingSerial(object):
+    """
+    A serial port always reading the same reply, with no timeout to wait for.
+    """
+    timeout = 0
+
+    def readline(self):
+        return REPLY
+
+
+def read_replies(fault_mix, count=50):
+    serial_port = FaultInjectingSerial(RepeatingSerial(), fault_mix)
+    return [serial_port.readline() for _ in range(count)], serial_port.counts
+
+
+def test_dropped_replies_are_lost():
+    replies, counts = read_replies(FaultMix(drop_rate=1, seed=0))
+    assert replies == [b''] * 50
+    assert counts == {'replies': 50, 'dropped': 50, 'truncated': 0, 'corrupted': 0, 'error_status': 0}
+
+
+def test_truncated_replies_only_decode_when_the_frame_end_arrived():
+    replies, counts = read_replies(FaultMix(truncation_rate=1, seed=0))
+    assert counts['truncated'] == 50
+    assert all(len(reply) < len(REPLY) and REPLY.startswith(reply) for reply in replies)
+    # Only the replies cut before the end of the frame are lost, the line ending aside
+    for reply in replies:
+        assert DTStatus(reply).decode() == (('0', '`', '1500') if b'\x03' in reply else None)
+    assert any(b'\x03' not in reply for reply in replies)
+
+
+def test_corrupted_replies_have_one_bit_flipped():
+    replies, counts = read_replies(FaultMix(corruption_rate=1, seed=0))
+    assert counts['corrupted'] == 50
+    for reply in replies:
+        assert len(reply) == len(REPLY)
+        flipped = [bin(a ^ b).count('1') for a, b in zip(reply, REPLY)]
+        assert sum(flipped) == 1
+
+
+def test_error_statuses_replace_the_status():
+    statuses = [pump_protocol.STATUS_IDLE_INIT_FAILURE, pump_protocol.STATUS_IDLE_INVALID_COMMAND]
+    replies, counts = read_replies(FaultMix(error_status_rate=1, error_statuses=statuses, seed=0))
+    assert counts['error_status'] == 50
+    decoded = [DTStatus(reply).decode() for reply in replies]
+    assert {status for _, status, _ in decoded} == set(statuses)
+    assert all((address, data) == ('0', '1500') for address, _, data in decoded)
+
+
+def test_faults_are_drawn_at_their_rates_and_replayed_from_the_seed():
+    fault_mix = FaultMix(drop_rate=0.1, truncation_rate=0.2, corruption_rate=0.3, seed=42)
+    replies, counts = read_replies(fault_mix, count=2000)
+    assert read_replies(fault_mix, count=2000) == (replies, counts)
+    assert read_replies(FaultMix(drop_rate=0.1, truncation_rate=0.2, corruption_rate=0.3, seed=7),
+                        count=2000)[0] != replies
+    for fault, rate in (('dropped', 0.1), ('truncated', 0.2), ('corrupted', 0.3)):
+        assert counts[fault] == pytest.approx(rate * 2000, rel=0.15)
+    assert replies.count(REPLY) == 2000 - counts['dropped'] - counts['truncated'] - counts['corrupted']
+
+    with pytest.raises(ValueError):
+        FaultMix(drop_rate=0.6, corruption_rate=0.6)
+
+
+def test_latency_is_drawn_from_its_distribution(monkeypatch):
+    delays = []
+    monkeypatch.setattr(faults.time, 'sleep', delays.append)
+    fault_mix = FaultMix.from_config({'latency': {'distribution': 'uniform', 'low': 0.01, 'high': 0.02}, 'seed': 3})
+    read_replies(fault_mix, count=20)
+    assert len(delays) == 20 and all(0.01 <= delay <= 0.02 for delay in delays)
+    with pytest.raises(ValueError):
+        FaultMix.from_config({'latency': {'distribution': 'pareto'}})
+
+
+def test_percentiles_are_nearest_rank():
+    report = FaultReport('steps')
+    assert report.percentile(50) is None
+    assert 'no calls' in report.summary()
+
+    report.latencies = [0.001 * i for i in range(100, 0, -1)]
+    assert report.percentile(50) == pytest.approx(0.050)
+    assert report.percentile(95) == pytest.approx(0.095)
+    assert report.percentile(99) == pytest.approx(0.099)
+    assert report.percentile(100) == pytest.approx(0.100)
+    assert report.percentile(0) == pytest.approx(0.001)
+    assert 'p50 50.0ms, p95 95.0ms, p99 99.0ms' in report.summary()
+
+
+def test_decode_rejects_incomplete_frames():
+    assert DTStatus(REPLY).decode() == ('0', '`', '1500')
+    for end in range(len(REPLY.rstrip())):
+        assert DTStatus(REPLY[:end]).decode() is None
+    assert DTStatus(b'0`1500\x03\r\n').decode() is None
+    assert DTStatus(b'/0\x03\r\n').decode() is None
+    assert DTStatus(b'/\xff`\x03').decode() is None
+
+
+def test_benchmark_counts_the_outcome_of_each_mix(make_setup):
+    controller = make_setup(one_hub_config({'a': '0', 'b': '1'}))
+    pumps = list(controller.pumps.values())
+    reports = benchmark_faults(pumps, {
+        'clean': FaultMix(),
+        'errors': FaultMix(error_status_rate=1, seed=0),
+        'dropped': FaultMix(drop_rate=1, seed=0),
+    }, requests=6)
+
+    assert (reports['clean'].succeeded, reports['clean'].retries) == (6, 0)
+    assert reports['errors'].error_statuses == 6
+    assert (reports['dropped'].failed, reports['dropped'].succeeded) == (6, 0)
+    assert reports['dropped'].retries > 0
+    assert all(len(report.latencies) == 6 for report in reports.values())
+    # Faults are removed after each mix
+    assert all(not isinstance(pump._io._serial, FaultInjectingSerial) for pump in pumps)
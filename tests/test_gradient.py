@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from conftest import PACKET, one_hub_config
+from pycont import pump_protocol
+from pycont.clock import VirtualClock
+from pycont.controller import VirtualMultiPumpController
+from pycont.gradient import GradientExecutor, MAX_SEGMENTS_PER_PACKET, segment_edges, split_pause
+
+
+@pytest.mark.parametrize('pause_in_ms, pauses', [
+    (3, []),
+    (5, [5]),
+    (30000, [30000]),
+    (30001, [15001, 15000]),
+    (95000, [23750, 23750, 23750, 23750]),
+])
+def test_split_pause(pause_in_ms, pauses):
+    assert split_pause(pause_in_ms) == pauses
+
+
+def test_segment_edges_keep_no_sliver_next_to_a_curve_point():
+    edges = segment_edges([0., 0.3 + 1e-10, 0.9], 0.1)
+    assert np.all(np.diff(edges) >= 0.005)
+    assert edges[0] == 0. and edges[-1] == 0.9
+
+
+def test_long_pauses_are_split_within_the_delay_range():
+    clock = VirtualClock()
+    controller = VirtualMultiPumpController(one_hub_config({'water': '0'}), clock=clock)
+    controller.smart_initialize()
+    pump = controller.pumps['water']
+    pump.pump(5, 'I', wait=True)
+
+    # Holding still for two segments of 90 s, longer than one delay command can pause
+    executor = GradientExecutor([pump], [0., 180.], [[0., 0.]], segment_duration=90.)
+    targets = executor.target_steps(pump, executor.flow_rates[0])
+    moves = executor.forge_moves(pump, pump_protocol.CMD_DELIVER, targets, 0, 0, 0.)
+    assert moves == [[(pump_protocol.CMD_DELAY, 30000)] * 3] * 2
+
+    start = clock.time()
+    assert controller.run_gradient(['water'], [0., 180.], [[0., 0.]], valve='O', segment_duration=90.)
+    assert clock.time() - start == pytest.approx(180, abs=5)
+    assert pump.current_volume == pytest.approx(5)
+
+
+def test_batches_of_long_segments_fit_in_a_packet(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'water': '0'}))
+    controller.smart_initialize()
+    pump = controller.pumps['water']
+    pump.pump(5, 'I', wait=True)
+
+    # A flow slower than the pump moves, each segment of 100 s is a move and 3 pauses, 12 would not fit in a packet
+    times, flow_rates = [0., 1200.], [[0.002, 0.002]]
+    executor = GradientExecutor([pump], times, flow_rates, segment_duration=100.)
+    targets = executor.target_steps(pump, executor.flow_rates[0])
+    moves = executor.forge_moves(pump, pump_protocol.CMD_DELIVER, targets, 0, 0, 0.)
+    assert len(moves) == MAX_SEGMENTS_PER_PACKET
+    assert 0 < executor.packet_segments(pump, moves) < MAX_SEGMENTS_PER_PACKET
+
+    writes = virtual_buses['hub'].writes
+    del writes[:]
+    assert controller.run_gradient(['water'], times, flow_rates, valve='O', segment_duration=100.)
+    sequences = [write for write in writes if pump_protocol.CMD_DELAY.encode() in PACKET.match(write).group(2)]
+    assert len(sequences) > 1
+    assert max(len(write) for write in sequences) <= pump_protocol.MAX_PACKET_LENGTH
+    assert pump.current_volume == pytest.approx(5 - 2.4, abs=0.01)
+
+
+def test_segments_too_long_for_a_packet_are_refused():
+    controller = VirtualMultiPumpController(one_hub_config({'water': '0'}), clock=VirtualClock())
+    with pytest.raises(ValueError):
+        GradientExecutor([controller.pumps['water']], [0., 3600.], [[0., 0.]], segment_duration=3600.)
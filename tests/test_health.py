@@ -0,0 +1,56 @@
+from conftest import one_hub_config
+from pycont.controller import PumpIOTimeOutError
+from pycont.health import HealthMonitor
+
+
+def test_one_silent_pump_does_not_lose_the_port(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'water': '0', 'acid': '1', 'base': '2'}))
+    controller.smart_initialize()
+    monitor = HealthMonitor(controller.pumps, timeout_threshold=3)
+    pump_io = controller.pumps['water']._io
+
+    del virtual_buses['hub'].pumps[controller.pumps['acid'].address]  # Switched off
+    for _ in range(5):
+        try:
+            pump_io.write_and_readline(controller.pumps['acid']._protocol.forge_report_status_packet())
+        except PumpIOTimeOutError:
+            pass
+    assert pump_io.consecutive_timeouts == 5
+    assert monitor.loss_reason(pump_io) is None
+
+    del virtual_buses['hub'].pumps[controller.pumps['base'].address]
+    try:
+        pump_io.write_and_readline(controller.pumps['base']._protocol.forge_report_status_packet())
+    except PumpIOTimeOutError:
+        pass
+    assert monitor.loss_reason(pump_io) is not None
+
+
+def test_unused_hub_is_not_lost(make_setup):
+    controller = make_setup(one_hub_config({'water': '0'}, port='virtualbus:///dev/pycont-unplugged'))
+    monitor = HealthMonitor(controller.pumps)
+    assert not controller.pumps['water']._io.is_open
+    assert monitor.loss_reason(controller.pumps['water']._io) is None
+
+
+def test_dead_hub_does_not_hold_up_the_others(make_setup):
+    one = one_hub_config({'water': '0'}, port='virtualbus://one')
+    two = one_hub_config({'acid': '0'}, port='virtualbus://two')
+    controller = make_setup({'default': one.pop('default'), 'hubs': [one, two]})
+    controller.smart_initialize()
+    dead_io, live_io = controller.pumps['water']._io, controller.pumps['acid']._io
+
+    def fail_open(*args, **kwargs):
+        raise OSError('could not open port')
+    dead_io.open = fail_open
+
+    monitor = HealthMonitor(controller.pumps)
+    assert not monitor.reconnect(dead_io, 'unplugged')  # One attempt, then gives back control
+    assert not dead_io.connected.is_set()
+    assert monitor.reconnect(live_io, 'reset')
+    assert live_io.connected.is_set()
+
+    del dead_io.open
+    assert monitor.reconnect(dead_io)
+    assert [reason for _, _, _, reason in monitor.reconnections] == ['reset', 'unplugged']
+    assert monitor.pump_states['water']['initialized']
@@ -0,0 +1,58 @@
+import pytest
+
+from conftest import PACKET, one_hub_config
+from pycont.controller import ControllerRepeatedError
+from pycont.initialization import InitializationEngine
+
+
+def two_hub_config():
+    first_hub = one_hub_config({'a': '0', 'b': '1'}, port='virtualbus://first')
+    second_hub = one_hub_config({'c': '0'}, port='virtualbus://second')
+    return {'default': first_hub['default'], 'groups': {},
+            'hubs': [{'io': hub['io'], 'pumps': hub['pumps']} for hub in (first_hub, second_hub)]}
+
+
+def test_each_pump_is_ready_with_its_own_future(make_setup, virtual_buses):
+    controller = make_setup(two_hub_config())
+    engine = controller.start_initialization()
+    assert sorted(engine.as_ready(timeout=5)) == ['a', 'b', 'c']
+    for pump_name, pump in controller.pumps.items():
+        assert engine.futures[pump_name].result() is pump
+        assert engine.ready(pump_name) is pump
+    engine.wait(timeout=5)
+    assert all(device.initialized for bus in virtual_buses.values() for device in bus.pumps.values())
+
+
+def test_hubs_have_their_own_thread_and_pumps_of_a_hub_interleave(make_setup, virtual_buses):
+    controller = make_setup(two_hub_config())
+    engine = controller.start_initialization()
+    engine.wait(timeout=5)
+    assert sorted(thread.name for thread in engine._threads) == ['initialize-virtualbus://first',
+                                                                 'initialize-virtualbus://second']
+
+    # The second pump starts while the first one is still moving
+    addresses = [PACKET.match(write).group(1).decode() for write in virtual_buses['first'].writes]
+    first, second = controller.pumps['a'].address, controller.pumps['b'].address
+    assert addresses.index(second) < len(addresses) - addresses[::-1].index(first) - 1
+
+
+def test_a_failing_pump_leaves_the_others_ready(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'a': '0', 'b': '1', 'c': '2'}))
+    del virtual_buses['hub'].pumps[controller.pumps['b'].address]  # Nobody answers at this address
+
+    engine = controller.start_initialization()
+    assert sorted(engine.as_ready(timeout=5)) == ['a', 'b', 'c']
+    assert engine.ready('a') is controller.pumps['a'] and engine.ready('c') is controller.pumps['c']
+    with pytest.raises(ControllerRepeatedError):
+        engine.ready('b')
+    with pytest.raises(ControllerRepeatedError):
+        engine.wait()
+
+
+def test_pumps_known_to_be_ready_are_left_alone(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'a': '0', 'b': '1'}))
+    engine = InitializationEngine(controller.pumps, ready=['a']).start()
+    engine.wait(timeout=5)
+    written = {PACKET.match(write).group(1).decode() for write in virtual_buses['hub'].writes}
+    assert written == {controller.pumps['b'].address}
+    assert not virtual_buses['hub'].pumps[controller.pumps['a'].address].initialized
@@ -0,0 +1,78 @@
+import pytest
+
+from conftest import VirtualBus, one_hub_config
+from pycont import pump_protocol
+from pycont.controller import C3000SwitchToAddress
+from pycont.liquid import DEFAULT_TUNING_RESOLUTION, SpeedTuner
+from pycont.virtual import REPLY_ADDRESS, VirtualPump
+
+INITIALIZE_COMMANDS = (pump_protocol.CMD_INITIALIZE_VALVE_RIGHT, pump_protocol.CMD_INITIALIZE_VALVE_LEFT,
+                       pump_protocol.CMD_INITIALIZE_NO_VALVE)
+
+
+class StallingPump(VirtualPump):
+    """
+    A simulated pump whose plunger overloads when it aspirates faster than stall_in or dispenses faster than
+    stall_out, until it is initialised again.
+    """
+    def __init__(self, address, clock, stall_in, stall_out):
+        super().__init__(address, clock)
+        self.stall_in = stall_in
+        self.stall_out = stall_out
+        self.overloaded = False
+
+    def execute(self, packet):
+        command = packet.dtcommands[0].command.decode() if packet.dtcommands else ''
+        if self.overloaded and command not in INITIALIZE_COMMANDS:
+            if command.startswith(pump_protocol.CMD_REPORT_PLUNGER_POSITION):
+                return REPLY_ADDRESS, pump_protocol.STATUS_IDLE_PLUNGER_OVERLOAD, super().execute(packet)[2]
+            return REPLY_ADDRESS, pump_protocol.STATUS_IDLE_PLUNGER_OVERLOAD, ''
+        self.overloaded = False
+        if (command == pump_protocol.CMD_PUMP and self.top_velocity > self.stall_in) or \
+                (command == pump_protocol.CMD_DELIVER and self.top_velocity > self.stall_out):
+            self.overloaded = True
+            return REPLY_ADDRESS, pump_protocol.STATUS_IDLE_PLUNGER_OVERLOAD, ''
+        return super().execute(packet)
+
+
+@pytest.fixture
+def stalling_pump(make_setup, virtual_buses, clock):
+    def make(stall_in, stall_out):
+        address = C3000SwitchToAddress['0']
+        virtual_buses.setdefault('hub', VirtualBus(clock)).pumps[address] = StallingPump(address, clock, stall_in,
+                                                                                            stall_out)
+        controller = make_setup(one_hub_config({'water': '0'}))
+        controller.smart_initialize()
+        return controller.pumps['water']
+    return make
+
+
+def test_tuner_bisects_below_the_stall_velocities(stalling_pump):
+    pump = stalling_pump(stall_in=20000, stall_out=30000)
+    tuner = SpeedTuner(pump, 'I', 'O', test_volume=1, safety_factor=0.5)
+    liquid_class = tuner.run()
+
+    for direction, stall_velocity, speed in ((pump_protocol.CMD_PUMP, 20000, liquid_class.speed_in),
+                                             (pump_protocol.CMD_DELIVER, 30000, liquid_class.speed_out)):
+        trials = [(velocity, stall_free) for trial_direction, velocity, stall_free in tuner.trials
+                  if trial_direction == direction]
+        assert trials[0] == (pump.max_top_velocity, False)
+        assert all(stall_free == (velocity <= stall_velocity) for velocity, stall_free in trials)
+        highest_stall_free = max(velocity for velocity, stall_free in trials if stall_free)
+        lowest_stalling = min(velocity for velocity, stall_free in trials if not stall_free)
+        assert lowest_stalling - highest_stall_free <= DEFAULT_TUNING_RESOLUTION * highest_stall_free
+        assert speed == int(highest_stall_free * 0.5)
+    assert pump.current_volume == 0
+
+
+def test_tuner_keeps_the_max_velocity_of_a_pump_that_never_stalls(stalling_pump):
+    pump = stalling_pump(stall_in=10 ** 6, stall_out=10 ** 6)
+    liquid_class = pump.tune_liquid_class('water', 'I', 'O', test_volume=1)
+    assert (liquid_class.speed_in, liquid_class.speed_out) == (pump.max_top_velocity, pump.max_top_velocity)
+    assert pump.liquid_class == 'water'
+
+
+def test_tuner_gives_up_on_a_pump_stalling_at_any_velocity(stalling_pump):
+    pump = stalling_pump(stall_in=10, stall_out=10 ** 6)
+    with pytest.raises(ValueError):
+        SpeedTuner(pump, 'I', 'O', test_volume=1).search(pump_protocol.CMD_PUMP)
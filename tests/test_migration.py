@@ -0,0 +1,87 @@
+import pytest
+
+from conftest import one_hub_config
+from pycont.migration import (BaudrateMigration, PUMP_EEPROM_MISMATCH, PUMP_MIGRATED, PUMP_NOT_MIGRATED,
+                              PUMP_SILENT)
+from pycont.virtual import VirtualPump
+
+PORT = 'virtualbus://hub'
+
+
+@pytest.fixture
+def setup(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'a': '0', 'b': '1', 'c': '2'}))
+    bus = virtual_buses['hub']
+    bus.baudrate = 9600
+    return controller, bus
+
+
+def test_prepare_backs_up_every_pump(setup):
+    controller, bus = setup
+    migration = controller.migrate_baudrate(PORT, 38400)
+    assert sorted(migration.eeprom_backup) == ['a', 'b', 'c']
+    assert migration.eeprom_backup['a'] == bus.pumps[controller.pumps['a'].address].eeprom
+    instructions = migration.instructions()
+    assert 'from 9600 to 38400 baud' in instructions and 'a, b, c' in instructions
+
+    with pytest.raises(ValueError):
+        controller.migrate_baudrate(PORT, 19200)
+    with pytest.raises(ValueError):
+        controller.migrate_baudrate('virtualbus://elsewhere', 38400)
+    with pytest.raises(ValueError):
+        BaudrateMigration(controller.pumps['a']._io, list(controller.pumps.values()), 38400).verify()
+
+
+def test_prepare_refuses_a_hub_with_a_silent_pump(setup):
+    controller, bus = setup
+    del bus.pumps[controller.pumps['c'].address]
+    with pytest.raises(ValueError):
+        controller.migrate_baudrate(PORT, 38400)
+
+
+def test_verified_migration_moves_the_hub_config(setup):
+    controller, bus = setup
+    migration = controller.migrate_baudrate(PORT, 38400)
+    bus.baudrate = 38400  # The jumpers are moved
+
+    assert migration.verify()
+    assert migration.report == {'a': PUMP_MIGRATED, 'b': PUMP_MIGRATED, 'c': PUMP_MIGRATED}
+    assert controller.setup_config['io']['baudrate'] == 38400
+    assert controller.pumps['a']._io.baudrate == 38400
+    controller.smart_initialize()
+    assert controller.pumps['c'].is_initialized()
+
+
+def test_failed_migration_is_reported_and_rolled_back(setup):
+    controller, bus = setup
+    migration = controller.migrate_baudrate(PORT, 38400)
+    bus.baudrate = 38400
+    bus.baudrates[controller.pumps['b'].address] = 9600  # Its jumper was missed
+    silent = bus.pumps.pop(controller.pumps['c'].address)
+
+    assert not migration.verify()
+    assert migration.report == {'a': PUMP_MIGRATED, 'b': PUMP_NOT_MIGRATED, 'c': PUMP_SILENT}
+    assert controller.setup_config['io']['baudrate'] == 9600
+    assert controller.pumps['a']._io.baudrate == 38400
+    # Only the pumps that moved need their jumper set back
+    assert 'on: a, c' in migration.rollback_instructions()
+
+    bus.baudrate = 9600
+    assert not migration.rollback()
+    bus.pumps[controller.pumps['c'].address] = silent
+    assert migration.rollback()
+    assert controller.pumps['a']._io.baudrate == 9600
+    assert controller.setup_config['io']['baudrate'] == 9600
+    assert controller.pumps['c'].ping()
+
+
+def test_another_pump_on_an_address_is_not_taken_for_the_migrated_one(setup, clock):
+    controller, bus = setup
+    migration = controller.migrate_baudrate(PORT, 38400)
+    bus.baudrate = 38400
+    address = controller.pumps['b'].address
+    bus.pumps[address] = VirtualPump(address, clock, eeprom=bus.pumps[address].eeprom.replace('10,75', '11,75', 1))
+
+    assert not migration.verify()
+    assert migration.report['b'] == PUMP_EEPROM_MISMATCH
+    assert controller.setup_config['io']['baudrate'] == 9600
@@ -0,0 +1,89 @@
+import math
+
+import pytest
+
+from conftest import one_hub_config
+from pycont.motion import MOTION_PROFILE_FACTORY, MotionProfile
+
+
+@pytest.mark.parametrize('profile, micro_step_mode', [
+    (MotionProfile(1001, 14, 900), 0),
+    (MotionProfile(49, 14, 900), 0),
+    (MotionProfile(900, 0, 900), 0),
+    (MotionProfile(900, 21, 900), 2),
+    (MotionProfile(900, 14, 2701), 0),
+    (MotionProfile(8001, 14, 7200), 2),
+    (MotionProfile(900, 14, 399), 2),
+])
+def test_profiles_out_of_range_are_refused(profile, micro_step_mode):
+    with pytest.raises(ValueError):
+        profile.check_within_range(micro_step_mode)
+
+
+def test_ranges_scale_with_the_micro_step_mode():
+    assert MotionProfile(8000, 20, 21600).check_within_range(2)
+    assert MotionProfile(50, 1, 50).check_within_range(0)
+    assert MotionProfile.factory(2) == MotionProfile(7200, 14, 7200)
+
+
+def test_long_moves_ramp_up_cruise_and_ramp_down():
+    profile = MotionProfile(900, 14, 900)
+    acceleration = 14 * 2500
+    ramp_time = (6000 - 900) / acceleration
+    ramp_steps = (900 + 6000) / 2 * ramp_time
+    expected = 2 * ramp_time + (3000 - 2 * ramp_steps) / 6000
+    assert profile.move_duration(3000, 6000, 0) == pytest.approx(expected)
+    assert profile.move_duration(-3000, 6000, 0) == pytest.approx(expected)
+    # Eight times the steps at eight times the velocities and acceleration take the same time
+    assert MotionProfile.factory(2).move_duration(24000, 48000, 2) == pytest.approx(expected)
+
+
+def test_short_moves_peak_below_the_top_velocity():
+    profile = MotionProfile(900, 14, 900)
+    acceleration = 14 * 2500
+    # Each ramp covers half the move
+    peak_velocity = math.sqrt(900 ** 2 + acceleration * 500)
+    assert profile.move_duration(500, 6000, 0) == pytest.approx(2 * (peak_velocity - 900) / acceleration)
+    assert profile.move_duration(0, 6000, 0) == 0.
+    # Below the start velocity the plunger runs at the top velocity throughout
+    assert profile.move_duration(500, 250, 0) == pytest.approx(2.)
+
+
+def test_profiles_are_only_sent_when_they_change(make_setup, virtual_buses):
+    controller = make_setup(one_hub_config({'water': '0'}))
+    controller.smart_initialize()
+    pump = controller.pumps['water']
+    device = virtual_buses['hub'].pumps[pump.address]
+    writes = virtual_buses['hub'].writes
+
+    def profile_packets():
+        return [write for write in writes if b'L' in write]
+
+    # Never changed by the controller, the pump settings are left alone
+    del writes[:]
+    pump.ensure_motion_profile()
+    assert writes == []
+
+    with pytest.raises(ValueError):
+        pump.add_motion_profile('gentle', MotionProfile(100, 5, 400))
+    pump.add_motion_profile('gentle', MotionProfile(400, 5, 400))
+    pump.ensure_motion_profile('gentle')
+    assert len(profile_packets()) == 1
+    assert (device.start_velocity, device.slope, device.cutoff_velocity) == (400, 5, 400)
+    pump.ensure_motion_profile('gentle')
+    pump.pump(1, 'I', wait=True, profile='gentle')
+    assert len(profile_packets()) == 1
+
+    # Moves without a profile go back to the factory one, once
+    pump.pump(1, 'I', wait=True)
+    pump.ensure_motion_profile()
+    assert len(profile_packets()) == 2
+    assert MotionProfile(device.start_velocity, device.slope, device.cutoff_velocity) == \
+        pump.get_motion_profile(MOTION_PROFILE_FACTORY)
+
+    # Replacing the profile the pump holds sends it again
+    pump.ensure_motion_profile('gentle')
+    pump.add_motion_profile('gentle', MotionProfile(800, 5, 800))
+    pump.ensure_motion_profile('gentle')
+    assert len(profile_packets()) == 4
+    assert device.start_velocity == 800
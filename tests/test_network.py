@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from pycont.liquid import LiquidClass
+from pycont.network import FluidicNetwork, VALVE_SWITCH_TIME
+
+
+class RecordingPump(object):
+    """
+    Stands for a pump in a network, records the strokes it is driven through.
+    """
+    def __init__(self, name, strokes):
+        self.name = name
+        self.total_volume = 5.
+        self.default_top_velocity = 6000
+        self.remaining_volume = 5.
+        self.liquid_class = None
+        self.liquid_classes = {}
+        self.strokes = strokes
+        self.feasible = True
+
+    def volume_to_step(self, volume_in_ml):
+        return int(volume_in_ml * 6000 / self.total_volume)
+
+    def pump(self, volume_in_ml, from_valve=None, speed_in=None, wait=False):
+        if not self.feasible:
+            return False
+        self.strokes.append((self.name, threading.current_thread().name, 'pump'))
+        time.sleep(0.005)
+
+    def deliver(self, volume_in_ml, to_valve=None, speed_out=None, wait=False):
+        self.strokes.append((self.name, threading.current_thread().name, 'deliver'))
+        time.sleep(0.005)
+
+
+def test_routes_sharing_a_pump_do_not_interleave():
+    strokes = []
+    pumps = {name: RecordingPump(name, strokes) for name in ('left', 'right', 'bypass')}
+    network = FluidicNetwork(pumps, {
+        'connections': {'left': {'1': 'water', '3': 'buffer', '6': 'waste'},
+                        'right': {'1': 'buffer', '2': 'reactor'},
+                        'bypass': {'I': 'acetone', 'O': 'waste'}},
+        'buffers': ['buffer']})
+
+    transfers = [threading.Thread(target=network.transfer, args=('water', 'reactor', 12), name='first'),
+                 threading.Thread(target=network.transfer, args=('water', 'waste', 12), name='second')]
+    for transfer in transfers:
+        transfer.start()
+    for transfer in transfers:
+        transfer.join()
+
+    # The strokes of pump left are made by one route, then by the other
+    left_strokes = [thread_name for pump_name, thread_name, _ in strokes if pump_name == 'left']
+    assert len(left_strokes) == 12
+    assert len(set(left_strokes[:6])) == 1
+
+
+def shortcut_network(strokes):
+    pumps = {name: RecordingPump(name, strokes) for name in ('left', 'right', 'direct')}
+    network = FluidicNetwork(pumps, {
+        'connections': {'left': {'1': 'water', '3': 'buffer'},
+                        'right': {'1': 'buffer', '2': 'reactor'},
+                        'direct': {'I': 'water', 'O': 'reactor'}},
+        'buffers': ['buffer']})
+    return pumps, network
+
+
+def test_route_estimates_use_the_given_speeds():
+    pumps, network = shortcut_network([])
+    pumps['direct'].liquid_classes['glycerol'] = LiquidClass(speed_in=300, speed_out=600)
+    pumps['direct'].liquid_class = 'glycerol'
+
+    # The liquid class slows the direct pump down, the route through the buffer is faster
+    route = network.plan_transfer('water', 'reactor', 5)
+    assert [hop.pump.name for hop in route.hops] == ['left', 'right']
+
+    # Given speeds replace the liquid class, the direct route is faster
+    route = network.plan_transfer('water', 'reactor', 5, speed_in=1000, speed_out=2000)
+    assert [hop.pump.name for hop in route.hops] == ['direct']
+    assert route.duration == pytest.approx(6000 / 1000 + 6000 / 2000 + VALVE_SWITCH_TIME)
+
+
+def test_stroke_refused_by_a_pump_fails_the_route():
+    strokes = []
+    pumps, network = shortcut_network(strokes)
+    pumps['direct'].feasible = False
+    with pytest.raises(ValueError):
+        network.transfer('water', 'reactor', 2)
+    assert strokes == []
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import one_hub_config
+from pycont.recipe import Recipe, RecipeReport, RecipeRunner, RecipeStep
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class RecordingRunner(RecipeRunner):
+    """
+    A RecipeRunner whose steps leave the pumps alone and only take some real time, recording which steps ran at the
+    same time.
+    """
+    def __init__(self, controller, recipe, durations=None):
+        super().__init__(controller, recipe)
+        self.durations = durations if durations is not None else {}
+        self.lock = threading.Lock()
+        self.running = set()
+        self.started = []
+        self.overlaps = set()
+
+    def run_step(self, step):
+        with self.lock:
+            self.started.append(step.name)
+            self.overlaps.update(frozenset((step.name, name)) for name in self.running)
+            self.running.add(step.name)
+        time.sleep(self.durations.get(step.name, 0.02))
+        with self.lock:
+            self.running.remove(step.name)
+
+    def overlapped(self, first, second):
+        return frozenset((first, second)) in self.overlaps
+
+
+def two_hub_config():
+    first_hub = one_hub_config({'a': '0', 'b': '1'}, port='virtualbus://first')
+    second_hub = one_hub_config({'c': '0'}, port='virtualbus://second')
+    return {'default': first_hub['default'], 'groups': {},
+            'hubs': [{'io': hub['io'], 'pumps': hub['pumps']} for hub in (first_hub, second_hub)]}
+
+
+def test_steps_are_ordered_after_their_dependencies():
+    recipe = Recipe.from_configfile(os.path.join(HERE, 'recipe_example.json'), {'chemicals': ['water', 'acetone']})
+    for name, step in recipe.steps.items():
+        assert all(recipe.order.index(dependency) < recipe.order.index(name) for dependency in step.after)
+    assert recipe.steps['rinse'].pumps == ['water', 'acetone']
+
+    with pytest.raises(ValueError):
+        Recipe([RecipeStep('fill', 'pump', ['a'], after=['empty']), RecipeStep('empty', 'deliver', ['a'],
+                                                                               after=['fill'])])
+    with pytest.raises(ValueError):
+        Recipe([RecipeStep('fill', 'pump', ['a'], after=['rinse'])])
+
+
+def test_example_recipe_runs_on_the_pumps(make_setup):
+    config = one_hub_config({'water': '0', 'acetone': '1'}, groups={'chemicals': ['water', 'acetone']})
+    controller = make_setup(config)
+    controller.smart_initialize()
+
+    report = controller.run_recipe(os.path.join(HERE, 'recipe_example.json'))
+    assert report.errors == {}
+    assert sorted(report.end_times) == sorted(report.recipe.steps)
+    for name, step in report.recipe.steps.items():
+        assert all(report.end_times[dependency] <= report.start_times[name] for dependency in step.after)
+    assert report.critical_path[-1] == 'rinse'
+    assert all(pump.current_volume == 0 for pump in controller.pumps.values())
+
+    with pytest.raises(ValueError):
+        RecipeRunner(controller, Recipe([RecipeStep('fill', 'pump', ['milk'])]))
+
+
+def test_steps_never_share_a_pump(make_setup):
+    controller = make_setup(one_hub_config({'a': '0', 'b': '1', 'c': '2'}))
+    runner = RecordingRunner(controller, Recipe([
+        RecipeStep('first_on_a', 'pump', ['a']),
+        RecipeStep('second_on_a', 'pump', ['a']),
+        RecipeStep('on_b', 'pump', ['b']),
+        RecipeStep('on_b_and_c', 'pump', ['b', 'c']),
+    ]))
+    report = runner.run()
+    assert report.errors == {} and len(report.end_times) == 4
+    assert not runner.overlapped('first_on_a', 'second_on_a')
+    assert not runner.overlapped('on_b', 'on_b_and_c')
+    # Steps on other pumps of the same hub run together
+    assert runner.overlapped('first_on_a', 'on_b')
+    assert runner.overlapped('second_on_a', 'on_b_and_c')
+
+
+def test_a_step_holding_its_hub_runs_alone_on_it(make_setup):
+    controller = make_setup(two_hub_config())
+    runner = RecordingRunner(controller, Recipe.from_config({'steps': {
+        'other': {'command': 'pump', 'pumps': ['b']},
+        'dose': {'command': 'deliver', 'pumps': ['a'], 'exclusive_hub': True},
+        'later': {'command': 'pump', 'pumps': ['b']},
+        'far': {'command': 'pump', 'pumps': ['c']},
+    }}), durations={'far': 0.2})
+    report = runner.run()
+    assert report.errors == {}
+
+    # The dose waits for the step running on its hub, and no step starts on it before the dose
+    assert [name for name in runner.started if name != 'far'] == ['other', 'dose', 'later']
+    assert not runner.overlapped('dose', 'other') and not runner.overlapped('dose', 'later')
+    # The other hub is left free
+    assert runner.overlapped('dose', 'far')
+    assert report.hubs == {'other': {0}, 'dose': {0}, 'later': {0}, 'far': {1}}
+
+
+def test_critical_path_follows_dependencies_pumps_and_held_hubs():
+    recipe = Recipe([
+        RecipeStep('fill', 'pump', ['a']),
+        RecipeStep('wash', 'transfer', ['b']),
+        RecipeStep('far', 'transfer', ['d']),
+        RecipeStep('dose', 'deliver', ['a'], after=['fill'], exclusive_hub=True),
+        RecipeStep('collect', 'pump', ['c'], after=['dose']),
+    ])
+    start_times = {'fill': 0, 'wash': 0, 'far': 0, 'dose': 6, 'collect': 7}
+    end_times = {'fill': 2, 'wash': 6, 'far': 8.5, 'dose': 7, 'collect': 9}
+    hubs = {'fill': {0}, 'wash': {0}, 'far': {1}, 'dose': {0}, 'collect': {1}}
+
+    # The dose waited for the wash holding its hub, not for the fill
+    report = RecipeReport(recipe, start_times, end_times, {}, hubs)
+    assert report.critical_path == ['wash', 'dose', 'collect']
+    assert report.makespan == 9
+    assert 'Critical path: wash -> dose -> collect' in report.summary()
+    assert RecipeReport(recipe, start_times, end_times, {}).critical_path == ['fill', 'dose', 'collect']
+
+
+def test_no_step_starts_once_a_step_failed(make_setup):
+    controller = make_setup(one_hub_config({'a': '0', 'b': '1'}))
+    controller.smart_initialize()
+
+    report = controller.run_recipe({'steps': {
+        'empty': {'command': 'deliver', 'pumps': ['a'], 'args': {'volume_in_ml': 1, 'to_valve': 'O'}},
+        'refill': {'command': 'pump', 'pumps': ['a'], 'args': {'volume_in_ml': 1, 'from_valve': 'I'},
+                   'after': ['empty']},
+    }})
+    assert list(report.errors) == ['empty']
+    assert 'refill' not in report.start_times
+    assert report.critical_path == ['empty']
+    assert 'Step empty failed' in report.summary()
+    assert controller.pumps['a'].current_volume == 0
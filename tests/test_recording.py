@@ -0,0 +1,40 @@
+import pytest
+
+from conftest import one_hub_config
+from pycont.recording import ReplayMismatchError, ReplayMultiPumpController, read_traffic
+
+
+def script(controller):
+    controller.smart_initialize()
+    controller.pump(['water', 'acid'], 2, 'I', wait=True)
+    controller.deliver(['water', 'acid'], 1.5, 'O', wait=True)
+    return {pump_name: controller.pumps[pump_name].current_volume for pump_name in ('water', 'acid')}
+
+
+@pytest.fixture
+def recording(make_setup, tmp_path):
+    config = one_hub_config({'water': '0', 'acid': '1'})
+    controller = make_setup(config)
+    path = tmp_path / 'traffic.pyrec'
+    with controller.record_traffic(str(path)):
+        volumes = script(controller)
+    return config, path, volumes
+
+
+def test_replay_runs_the_recorded_script(recording):
+    config, path, volumes = recording
+    frames = list(read_traffic(str(path)))
+    assert frames and {frame.hub for frame in frames} == {config['io']['port']}
+
+    replay = ReplayMultiPumpController(config, str(path))
+    assert script(replay) == volumes
+    assert replay.session.mismatches == 0
+    assert replay.session.finished
+
+
+def test_replay_detects_another_script(recording):
+    config, path, _ = recording
+    replay = ReplayMultiPumpController(config, str(path))
+    with pytest.raises(ReplayMismatchError):
+        replay.smart_initialize()
+        replay.pump(['water', 'acid'], 3, 'I', wait=True)
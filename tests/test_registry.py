@@ -0,0 +1,60 @@
+import pytest
+
+from pycont.clock import VirtualClock
+from pycont.controller import VirtualMultiPumpController
+from pycont.registry import PumpRegistry
+
+
+@pytest.fixture
+def controller():
+    hubs = [{'io': {'port': 'hub0'}, 'pumps': {'a': {'switch': '0', 'tags': ['heated']}, 'b': {'switch': '1'}}},
+            {'io': {'port': 'hub1'}, 'pumps': {'c': {'switch': '0', 'tags': ['heated', 'bay-2']},
+                                               'd': {'switch': '1', 'tags': ['bay-2']}}}]
+    return VirtualMultiPumpController({'default': {'volume': 5}, 'groups': {'oils': ['a', 'c', 'd'], 'acids': ['b']},
+                                       'hubs': hubs}, clock=VirtualClock())
+
+
+def test_select(controller):
+    registry = controller.pumps
+    assert registry.select() == ['a', 'b', 'c', 'd']
+    assert registry.select(hub=1) == ['c', 'd']
+    assert registry.select(hub='hub0', group='oils') == ['a']
+    assert registry.select(group=['oils', 'acids'], tag='heated') == ['a', 'c']
+    assert registry.select(tag=['heated', 'bay-2'], names=['d', 'a']) == ['a', 'd']
+    assert registry.select(tag='unknown') == []
+    with pytest.raises(KeyError):
+        registry.select(hub=2)
+    with pytest.raises(KeyError):
+        registry.select(group='bases')
+    with pytest.raises(KeyError):
+        registry.select(names=['e'])
+
+
+def test_selections_follow_group_changes(controller):
+    assert controller.select(group='oils') == ['a', 'c', 'd']
+    controller.groups = {'oils': ['d']}
+    assert controller.select(group='oils') == ['d']
+    assert controller.groups == controller.pumps.groups == {'oils': ('d',)}
+    assert controller.get_pumps_in_group('oils') == [controller.pumps['d']]
+
+
+def test_lookups(controller):
+    registry = controller.pumps
+    assert registry.hub_of('c') == 1
+    assert registry.on_hub('hub1') == ['c', 'd']
+    assert registry.at_address(0, controller.pumps['b'].address) == 'b'
+    assert registry.at_address(1, '9') is None
+    assert registry.with_tag('bay-2') == ['c', 'd']
+    assert registry.tags_of('a') == {'heated'}
+    assert registry.partition_by_hub(['d', 'a', 'c']) == {1: ['d', 'c'], 0: ['a']}
+
+
+def test_duplicates_are_refused(controller):
+    registry = PumpRegistry()
+    registry.add('a', controller.pumps['a'])
+    with pytest.raises(ValueError):
+        registry.add('a', controller.pumps['b'])
+    with pytest.raises(ValueError):
+        registry.add('twin', controller.pumps['a'])  # Same address on the same hub
+    with pytest.raises(ValueError):
+        registry.set_groups({'oils': ['a', 'z']})
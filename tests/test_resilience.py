@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from conftest import one_hub_config
+from pycont.clock import VirtualClock
+from pycont.resilience import CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, CircuitBreaker, RetryPolicy
+
+
+class GatedClock(VirtualClock):
+    """
+    A VirtualClock whose sleeps wait for the gate to open, keeping the sleeping threads.
+    """
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.sleepers = []
+
+    def sleep(self, seconds):
+        self.sleepers.append(threading.current_thread())
+        self.gate.wait()
+        super().sleep(seconds)
+
+    def release(self):
+        self.gate.set()
+        for thread in self.sleepers:
+            thread.join(timeout=5)
+
+
+def test_breaker_opens_and_lets_a_request_through_after_the_cooldown():
+    clock = VirtualClock()
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=5, clock=clock)
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED and breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN and not breaker.allow_request()
+
+    clock.sleep(5)
+    assert breaker.allow_request()
+    assert breaker.state == CIRCUIT_HALF_OPEN and not breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN and breaker.opened_at == 5
+
+    clock.sleep(5)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CIRCUIT_CLOSED and breaker.failures == 0
+
+
+def test_failures_while_open_do_not_schedule_more_probes():
+    clock = GatedClock()
+    probes = []
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=5, probe=lambda: probes.append(1) or True, clock=clock)
+    breaker.record_failure()
+    breaker.record_failure()  # An exchange already under way when the circuit opened
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    assert len(clock.sleepers) == 1
+    assert breaker.opened_at == 0
+    clock.release()
+    assert probes == [1] and breaker.state == CIRCUIT_CLOSED
+
+
+def test_reset_cancels_the_probe():
+    clock = GatedClock()
+    probes = []
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=5, probe=lambda: probes.append(1) or True, clock=clock)
+    breaker.record_failure()
+    breaker.reset()
+    clock.release()
+    assert probes == []
+    assert breaker.state == CIRCUIT_CLOSED
+
+
+def test_probe_closes_the_circuit():
+    answers = iter([False, True])
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=5, probe=lambda: next(answers), clock=VirtualClock())
+    closed = threading.Event()
+    breaker.record_success = lambda: (CircuitBreaker.record_success(breaker), closed.set())
+    breaker.record_failure()
+    assert closed.wait(timeout=5)
+    assert breaker.state == CIRCUIT_CLOSED
+
+
+def test_circuit_breaker_true_uses_the_defaults(make_setup):
+    config = one_hub_config({'water': '0'})
+    config['default']['circuit_breaker'] = True
+    controller = make_setup(config)
+    assert isinstance(controller.pumps['water'].circuit_breaker, CircuitBreaker)
+    assert controller.pumps['water'].circuit_breaker.clock is controller.clock
+
+
+def test_retry_policy_delays():
+    policy = RetryPolicy(attempts=4, backoff=0.1, backoff_factor=2, max_backoff=0.3)
+    assert [policy.delay(retry) for retry in (1, 2, 3)] == pytest.approx([0.1, 0.2, 0.3])
+    with pytest.raises(ValueError):
+        RetryPolicy(attempts=0)
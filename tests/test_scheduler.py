@@ -0,0 +1,104 @@
+import pytest
+
+from pycont.clock import VirtualClock
+from pycont.scheduler import POLICY_EDF, POLICY_PRIORITY, PumpScheduler
+
+
+class TimedPump(object):
+    """
+    Stands for a 5 ml pump in a PumpScheduler, its moves take a second per ml on the clock.
+    """
+    def __init__(self, name, clock, current_volume=0., refuse_pump=False):
+        self.name = name
+        self.clock = clock
+        self.total_volume = 5.
+        self.current_volume = current_volume
+        self.refuse_pump = refuse_pump
+        self.moves = []
+        self.on_move = None
+
+    @property
+    def remaining_volume(self):
+        return self.total_volume - self.current_volume
+
+    def pump(self, volume_in_ml, from_valve=None, speed_in=None, wait=False):
+        if self.refuse_pump or volume_in_ml > self.remaining_volume:
+            return False
+        return self._move('pump', volume_in_ml)
+
+    def deliver(self, volume_in_ml, to_valve=None, speed_out=None, wait=False):
+        if volume_in_ml > self.current_volume:
+            return False
+        return self._move('deliver', -volume_in_ml)
+
+    def _move(self, command, volume_in_ml):
+        self.moves.append((command, abs(volume_in_ml)))
+        if self.on_move is not None:
+            self.on_move()
+        self.current_volume += volume_in_ml
+        self.clock.sleep(abs(volume_in_ml))
+        return True
+
+    def wait_until_idle(self):
+        pass
+
+
+def run(scheduler):
+    scheduler.start()
+    assert scheduler.join(timeout=5)
+    scheduler.close()
+
+
+@pytest.mark.parametrize('policy, expected', [
+    (POLICY_EDF, [0.4, 0.1, 0.2, 0.3]),
+    (POLICY_PRIORITY, [0.2, 0.1, 0.4, 0.3]),
+])
+def test_jobs_run_in_policy_order(policy, expected):
+    pump = TimedPump('a', VirtualClock(), current_volume=5.)
+    scheduler = PumpScheduler({'a': pump}, policy=policy)
+    scheduler.submit(['a'], 'deliver', {'volume_in_ml': 0.1}, priority=1, deadline=30)
+    scheduler.submit(['a'], 'deliver', {'volume_in_ml': 0.2}, priority=5, deadline=60)
+    scheduler.submit(['a'], 'deliver', {'volume_in_ml': 0.3})
+    scheduler.submit(['a'], 'deliver', {'volume_in_ml': 0.4}, deadline=10)
+    run(scheduler)
+    assert [volume for _, volume in pump.moves] == expected
+
+
+def test_urgent_job_runs_between_two_strokes():
+    pump = TimedPump('a', VirtualClock())
+    scheduler = PumpScheduler({'a': pump}, policy=POLICY_PRIORITY)
+    long_job = scheduler.submit(['a'], 'transfer', {'volume_in_ml': 8, 'from_valve': 'I', 'to_valve': 'O'})
+    urgent_jobs = []
+
+    def submit_urgent():
+        pump.on_move = None
+        urgent_jobs.append(scheduler.submit(['a'], 'transfer', {'volume_in_ml': 1, 'from_valve': 'I',
+                                                                'to_valve': 'O'}, priority=10))
+
+    pump.on_move = submit_urgent
+    run(scheduler)
+    assert pump.moves == [('pump', 5), ('deliver', 5), ('pump', 1), ('deliver', 1), ('pump', 3), ('deliver', 3)]
+    assert long_job.preemptions == 1 and long_job.error is None
+    assert urgent_jobs[0].finished_at < long_job.finished_at
+
+
+def test_missed_deadlines_are_reported():
+    clock = VirtualClock()
+    pump = TimedPump('a', clock, current_volume=5.)
+    scheduler = PumpScheduler({'a': pump})
+    late = scheduler.submit(['a'], 'deliver', {'volume_in_ml': 2}, deadline=1)
+    on_time = scheduler.submit(['a'], 'deliver', {'volume_in_ml': 1}, deadline=100)
+    run(scheduler)
+    assert late.finished_at == 2 and on_time.finished_at == 3
+    assert scheduler.missed_deadlines() == [late]
+
+
+def test_stroke_refused_by_the_pump_fails_the_job():
+    pump = TimedPump('a', VirtualClock(), refuse_pump=True)
+    scheduler = PumpScheduler({'a': pump})
+    transfer = scheduler.submit(['a'], 'transfer', {'volume_in_ml': 2, 'from_valve': 'I', 'to_valve': 'O'})
+    deliver = scheduler.submit(['a'], 'deliver', {'volume_in_ml': 1})
+    run(scheduler)
+    assert isinstance(transfer.error, ValueError) and transfer._volume_left == 2
+    assert isinstance(deliver.error, ValueError)
+    assert pump.moves == []
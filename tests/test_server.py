@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from conftest import one_hub_config
+from pycont.server import LeaseError, PumpClient, PumpLeases, PumpServer, RemoteCallError
+
+
+@pytest.fixture
+def server(make_setup, tmp_path):
+    controller = make_setup(one_hub_config({'water': '0', 'acid': '1'}))
+    controller.smart_initialize()
+    server = PumpServer(controller, str(tmp_path / 'pycont.sock'))
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_commands_need_the_lease(server):
+    with PumpClient(server.socket_path) as client, PumpClient(server.socket_path) as other:
+        with pytest.raises(RemoteCallError) as error:
+            client.call('water', 'pump', 1, 'I')
+        assert error.value.error_type == 'LeaseError'
+
+        client.lease(['water'])
+        with pytest.raises(RemoteCallError):
+            other.lease(['water'])
+        assert client.call('water', 'pump', 1, 'I', wait=True)
+        assert other.call('water', 'is_idle')  # Reading needs no lease
+
+        client.release()
+        other.lease(['water'])
+        assert server.leases.holders() == {'water': 2}
+
+
+def test_leases_are_released_on_disconnect(server):
+    with PumpClient(server.socket_path) as client:
+        client.lease(['acid'])
+    with PumpClient(server.socket_path) as other:
+        other.lease(['acid'])
+
+
+def test_lease_runs_out():
+    leases = PumpLeases(['water'])
+    leases.acquire(1, ['water'], ttl=0)
+    leases.acquire(2, ['water'])
+    with pytest.raises(LeaseError):
+        leases.check(1, ['water'])
+    with pytest.raises(LeaseError):
+        leases.acquire(1, ['unknown'])
+
+
+@pytest.mark.parametrize('call', [
+    {'method': '__init__', 'args': [{}]},
+    {'method': 'save_configfile', 'args': ['/tmp/x.json']},
+    {'target': 'water', 'method': '_exchange', 'args': []},
+    {'target': 'water', 'method': 'set_eeprom_config', 'args': []},
+    {'method': 'apply_command_to_pumps', 'args': [['water'], '__init__']},
+    {'method': 'apply_command_to_pumps', 'args': [['water']], 'kwargs': {'command': '__init__'}},
+    {'method': 'apply_command_to_pumps', 'kwargs': {'pump_names': ['water'], 'command': 'set_eeprom_config'}},
+    {'method': 'apply_command_to_pumps', 'kwargs': {'pump_names': ['water']}},
+])
+def test_calls_outside_the_allowlist_are_rejected(server, call):
+    server.leases.acquire(1, ['water'])
+    with pytest.raises(ValueError):
+        server.run_call(1, call)
+
+
+def test_apply_command_by_keyword(server):
+    server.leases.acquire(1, ['water'])
+    results = server.run_call(1, {'method': 'apply_command_to_pumps',
+                                  'kwargs': {'pump_names': ['water'], 'command': 'is_idle'}})
+    assert results == {'water': True}
@@ -0,0 +1,48 @@
+import pytest
+
+from conftest import one_hub_config
+from pycont.scheduler import POLICY_PRIORITY, PumpScheduler, ScheduledJob
+from pycont.simulation import FleetSimulator
+
+SETUP_CONFIG = dict(one_hub_config({'a': '0', 'b': '1'}, port='sim://hub'), groups={'reagents': ['a', 'b']})
+
+
+def simulate(seed):
+    simulator = FleetSimulator(SETUP_CONFIG, seed=seed, turnaround_jitter=0.001)
+    simulator.submit_random('reagents', jobs_per_hour=600, duration=300, from_valve='I', to_valve='O',
+                            volume_range=(0.5, 8), priorities=(0, 5), deadline_range=(30, 120))
+    return simulator, simulator.run()
+
+
+def test_runs_are_reproducible_from_their_seed():
+    simulator, report = simulate(1)
+    _, same_report = simulate(1)
+    assert isinstance(simulator.scheduler, PumpScheduler)
+    assert all(isinstance(job.scheduled, ScheduledJob) for job in simulator.jobs)
+    assert len(report.finished) == len(simulator.jobs) > 0 and not report.failed
+    assert report.exchanges['sim://hub'] > 0 and 0 < report.bus_utilisation['sim://hub'] < 1
+    assert report.duration == same_report.duration
+    assert [job.finished_at for job in report.jobs] == [job.finished_at for job in same_report.jobs]
+    assert report.exchanges == same_report.exchanges
+    with pytest.raises(ValueError):
+        simulator.run()
+
+
+def test_jobs_run_on_the_controllers_by_policy():
+    simulator = FleetSimulator(SETUP_CONFIG, policy=POLICY_PRIORITY)
+    jobs = [simulator.submit('a', 'transfer', 2, 'I', 'O', priority=priority) for priority in (0, 1, 5)]
+    report = simulator.run()
+    # The first job is taken as soon as it arrives, the others by priority
+    assert jobs[0].finished_at < jobs[2].finished_at < jobs[1].finished_at
+    assert simulator.hubs[0].devices[simulator.pumps['a'].address].busy_time > 0
+    assert report.duration == max(job.finished_at for job in jobs)
+
+
+def test_simulation_stops_at_a_given_time():
+    simulator = FleetSimulator(SETUP_CONFIG)
+    long_job = simulator.submit('a', 'transfer', 50, 'I', 'O')
+    late_job = simulator.submit('b', 'transfer', 1, 'I', 'O', at=100)
+    report = simulator.run(until=10)
+    assert report.duration == 10
+    assert long_job.started_at == 0 and long_job.finished_at is None and late_job.scheduled is None
+    assert not any(worker.is_alive() for worker in simulator.scheduler._workers)
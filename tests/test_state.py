@@ -0,0 +1,35 @@
+import json
+
+from conftest import one_hub_config
+
+
+def test_snapshot_file_unchanged_by_dry_run(make_setup, tmp_path):
+    path = tmp_path / 'state.json'
+    controller = make_setup(one_hub_config({'water': '0', 'acid': '1'},
+                                           state_snapshot={'path': str(path), 'period': 60}))
+    controller.smart_initialize()
+    controller.pumps['water'].pump(2, 'I', wait=True)
+    controller.state_snapshotter.flush()
+    saved = path.read_bytes()
+    assert json.loads(saved)
+
+    dry_run = controller.dry_run()
+    assert dry_run.controller.state_snapshotter is None
+    report = dry_run.run(lambda setup: (setup.smart_initialize(), setup.pumps['water'].pump(1, 'I', wait=True)))
+    assert report.aborted is None
+    controller.state_snapshotter.stop()
+
+    assert path.read_bytes() == saved
+
+
+def test_warm_restart_restores_pumps(make_setup, tmp_path):
+    config = one_hub_config({'water': '0'}, state_snapshot={'path': str(tmp_path / 'state.json'), 'period': 60})
+    controller = make_setup(config)
+    controller.smart_initialize()
+    controller.pumps['water'].pump(2, 'I', wait=True)
+    controller.state_snapshotter.stop()
+
+    restarted = make_setup(config)
+    restarted.state_snapshotter.stop()
+    assert restarted._restored_pumps == ['water']
+    assert abs(restarted.pumps['water'].current_volume - 2) < 0.01
@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+import serial
+
+from pycont.transport import DEFAULT_BRIDGE_HOST, SerialBridge, TcpTransport
+
+
+@pytest.fixture
+def start_bridge(virtual_buses, clock):
+    from conftest import VirtualBus
+
+    virtual_buses['hub'] = VirtualBus(clock)
+    virtual_buses['hub'].add_pump('1')
+    bridges = []
+
+    def start(**kwargs):
+        bridge = SerialBridge('virtualbus://hub', bridge_port=0, **kwargs)
+        threading.Thread(target=bridge.serve_forever, args=(0.05,), daemon=True).start()
+        bridges.append(bridge)
+        return bridge
+
+    yield start
+    for bridge in bridges:
+        bridge.shutdown()
+        bridge.server_close()
+
+
+def test_bridge_listens_on_this_host_by_default(start_bridge):
+    bridge = start_bridge()
+    assert bridge.server_address[0] == DEFAULT_BRIDGE_HOST
+
+    transport = TcpTransport('tcp://localhost:{}'.format(bridge.server_address[1]), 9600, 0.05)
+    transport.write(b'/1QR\r')
+    assert transport.readline().startswith(b'/0')
+    transport.close()
+
+
+def test_bridge_refuses_clients_without_its_token(start_bridge):
+    bridge = start_bridge(token='s3cret')
+    port = bridge.server_address[1]
+    with pytest.raises(serial.SerialException):
+        TcpTransport('tcp://localhost:{}'.format(port), 9600, 0.05)
+    with pytest.raises(serial.SerialException):
+        TcpTransport('tcp://wrong@localhost:{}'.format(port), 9600, 0.05)
+
+    transport = TcpTransport('tcp://s3cret@localhost:{}'.format(port), 9600, 0.05)
+    transport.write(b'/1QR\r')
+    assert transport.readline().startswith(b'/0')
+    transport.close()